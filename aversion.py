@@ -13,9 +13,55 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import bisect
+import collections
 import copy
+import cProfile
+import errno
+import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
+import os
+import pstats
+import random
 import re
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import urllib
+    quote = urllib.quote
+    unquote_plus = urllib.unquote_plus
+except AttributeError:
+    import urllib.parse
+    quote = urllib.parse.quote
+    unquote_plus = urllib.parse.unquote_plus
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
 
 import webob.dec
 import webob.exc
@@ -25,6 +71,76 @@ LOG = logging.getLogger('aversion')
 
 SLASH_RE = re.compile('/+')
 
+# The window sizes selecting the format of each supported content
+# coding; "deflate" is the zlib format
+CODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# Content types which are not compressed, because they are already
+# compressed
+COMPRESS_SKIP_TYPES = (
+    'image/gif image/jpeg image/png image/webp audio/* video/* '
+    'application/gzip application/x-gzip application/zip '
+    'application/x-bzip2 application/x-xz application/x-7z-compressed '
+    'application/zstd font/woff font/woff2'
+).split()
+
+# The stages of request processing which may select the version,
+# mapped to the methods implementing them
+PROCESS_STAGES = {
+    'uri': '_proc_uri',
+    'header': '_proc_version_header',
+    'query': '_proc_version_param',
+    'ctype': '_proc_ctype_header',
+    'accept': '_proc_accept_header',
+}
+
+# Matches the clauses of a version range: an optional comparison
+# operator followed by a version
+RANGE_CLAUSE_RE = re.compile(r'(>=|<=|==|=|>|<)?\s*([^\s,<>=]+)')
+
+# Frame types for the protocol spoken with worker processes
+FRAME_HEADER = struct.Struct('!cI')
+FRAME_ENVIRON = b'E'
+FRAME_BODY = b'B'
+FRAME_BODY_END = b'b'
+FRAME_START = b'S'
+FRAME_DATA = b'D'
+FRAME_END = b'Z'
+FRAME_ERROR = b'X'
+
+# Types of WSGI environment values passed to worker processes
+ENVIRON_TYPES = (type(''), type(b''), type(u''), bool, int, float,
+                 type(None))
+
+# Headers which apply to a single connection, and which are not
+# forwarded by a proxy
+HOP_BY_HOP = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'trailers',
+    'transfer-encoding', 'upgrade',
+])
+
+# Request methods which may be safely sent to the upstream server
+# again if a reused connection turns out to have been closed
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# Response statuses which may be shared with coalesced requests; these
+# are the statuses cacheable by default (RFC 7231, section 6.1), less
+# "206 Partial Content" and "501 Not Implemented"
+SHAREABLE_STATUSES = frozenset(['200', '203', '204', '300', '301', '404',
+                                '405', '410', '414'])
+
+
+class HeaderLimitExceeded(ValueError):
+    """
+    Raised when a header exceeds one of the configured parsing limits.
+    """
+
+    pass
+
 
 def quoted_split(string, sep, quotes='"'):
     """
@@ -95,27 +211,41 @@ def unquote(quoted):
     return quoted
 
 
-def parse_ctype(ctype):
+def parse_ctype(ctype, max_params=None):
     """
     Parse a content type.
 
     :param ctype: The content type, with corresponding parameters.
+    :param max_params: The maximum number of parameters to accept.  If
+                       None, the number of parameters is not limited.
 
     :returns: A tuple of the content type and a dictionary containing
               the content type parameters.  The content type will
               additionally be available in the dictionary as the '_'
               key.
+
+    :raises HeaderLimitExceeded: The content type has more than
+                                 ``max_params`` parameters.
     """
 
     result_ctype = None
     result = {}
+    nparams = 0
     for part in quoted_split(ctype, ';'):
+        # Ignore the whitespace surrounding each part
+        part = part.strip()
+
         # Extract the content type first
         if result_ctype is None:
             result_ctype = part
             result['_'] = part
             continue
 
+        # Enforce the parameter limit
+        nparams += 1
+        if max_params is not None and nparams > max_params:
+            raise HeaderLimitExceeded("Too many parameters in content type")
+
         # OK, we have a 'key' or 'key=value' to handle; figure it
         # out...
         equal = part.find('=')
@@ -156,50 +286,326 @@ def _match_mask(mask, ctype):
     return ctype_major == mask_major
 
 
-def best_match(requested, allowed):
+def match_media_range(mask, ctype):
     """
-    Determine the best content type to use for the request.
+    A match rule for media ranges, as found in the "Accept" header.
+    Content types match exactly or by the "type/\*" and "\*/\*"
+    wildcards.
 
-    :param ctypes: A list of the available content types.
+    :param mask: The media range.
+    :param ctype: The content type to match to the media range.
 
-    :returns: A tuple of the best match content type and the
-              parameters for that content type.
+    :returns: None if the content type does not match; otherwise, the
+              specificity of the media range, from 0 for "\*/\*" to 2
+              for a full content type.
+    """
+
+    if not _match_mask(mask, ctype):
+        return None
+    return 2 - mask.count('*')
+
+
+def match_language_range(lrange, tag):
+    """
+    A match rule for language ranges, as found in the
+    "Accept-Language" header.  A language range matches a language
+    tag equal to it or beginning with it followed by a "-", ignoring
+    case; "\*" matches every language tag.
+
+    :param lrange: The language range.
+    :param tag: The language tag to match to the language range.
+
+    :returns: None if the language tag does not match; otherwise, the
+              specificity of the language range, which is 0 for "\*"
+              and the number of subtags otherwise.
+    """
+
+    if lrange == '*':
+        return 0
+
+    lrange = lrange.lower()
+    tag = tag.lower()
+    if tag != lrange and not tag.startswith(lrange + '-'):
+        return None
+    return lrange.count('-') + 1
+
+
+def match_charset(mask, charset):
+    """
+    A match rule for character sets, as found in the "Accept-Charset"
+    header.  Character sets match ignoring case; "\*" matches every
+    character set.
+
+    :param mask: The character set from the header.
+    :param charset: The character set to match.
+
+    :returns: None if the character set does not match; otherwise, 0
+              for "\*" and 1 for an exact match.
     """
 
-    requested = [parse_ctype(ctype) for ctype in quoted_split(requested, ',')]
+    if mask == '*':
+        return 0
+    elif mask.lower() != charset.lower():
+        return None
+    return 1
+
 
-    best_q = -1
-    best_ctype = ''
-    best_params = {}
-    best_match = '*/*'
+def _rank_matches(requested, allowed, rule):
+    """
+    Rank the available values acceptable for a request.
+
+    :param requested: A list of the parsed ranges from the request
+                      header, as returned by _parse_ranges().
+    :param allowed: A list of the available values.
+    :param rule: The match rule, which is called with a range and a
+                 value and returns None if they do not match or the
+                 specificity of the range if they do.
+
+    :returns: A list of tuples of a value and the parameters of a
+              range it matches, best match first.  As described in
+              RFC 7231, only the most specific ranges matching a
+              value apply to it; a value matching several equally
+              specific ranges appears once for each.  Values whose
+              applicable ranges have a quality of 0 are not
+              acceptable and are omitted.  The matches are ranked by
+              quality, then by the specificity of the range; ties are
+              broken by the order of the allowed list, then by the
+              order of the ranges.
+    """
 
-    # Walk the list of content types
-    for ctype in allowed:
-        # Compare to the accept list
-        for ctype_mask, params in requested:
+    # Walk the list of values
+    matches = []
+    for value in allowed:
+        # Find the most specific ranges matching the value
+        best = []
+        for mask, params in requested:
             try:
                 q = float(params.get('q', 1.0))
             except ValueError:
                 # Bad quality value
                 continue
 
-            if q < best_q:
-                # Not any better
+            specificity = rule(mask, value)
+            if specificity is None:
                 continue
-            elif best_q == q:
-                # Base on the best match
-                if best_match.count('*') <= ctype_mask.count('*'):
-                    continue
+            elif best and specificity > best[0][1]:
+                best = []
+            if not best or specificity == best[0][1]:
+                best.append((q, specificity, value, params))
+
+        matches.extend(match for match in best if match[0] > 0)
+
+    # Rank the matches; the sort is stable, so ties remain in order
+    matches.sort(key=lambda x: (-x[0], -x[1]))
+    return [(value, params) for _q, _spec, value, params in matches]
+
+
+def _parse_ranges(requested, max_ranges=None, max_params=None):
+    """
+    Parse the value of an "Accept" or "Accept-\*" header.
+
+    :param requested: The value of the header.
+    :param max_ranges: The maximum number of ranges to accept.  If
+                       None, the number of ranges is not limited.
+    :param max_params: The maximum number of parameters to accept on
+                       each range.  If None, the number of parameters
+                       is not limited.
+
+    :returns: A list of tuples of the range and a dictionary of its
+              parameters, as for parse_ctype().
+
+    :raises HeaderLimitExceeded: One of the limits was exceeded.
+    """
+
+    ranges = quoted_split(requested, ',')
+    if max_ranges is not None:
+        # Stop splitting as soon as the limit is exceeded
+        ranges = list(itertools.islice(ranges, max_ranges + 1))
+        if len(ranges) > max_ranges:
+            raise HeaderLimitExceeded("Too many media ranges")
+    return [parse_ctype(ctype, max_params) for ctype in ranges]
+
+
+def best_matches(requested, allowed, max_ranges=None, max_params=None):
+    """
+    Rank the content types acceptable for the request.
+
+    :param requested: The value of the "Accept" header.
+    :param allowed: A list of the available content types.
+    :param max_ranges: The maximum number of media ranges to accept.
+                       If None, the number of media ranges is not
+                       limited.
+    :param max_params: The maximum number of parameters to accept on
+                       each media range.  If None, the number of
+                       parameters is not limited.
+
+    :returns: A list of tuples of a content type and the parameters
+              of a media range it matches, best match first.  Only
+              the most specific media ranges matching a content type
+              apply to it; a content type matching several equally
+              specific media ranges appears once for each, and one
+              whose media ranges have a quality of 0 is omitted.  The
+              matches are ranked by quality, then by the specificity
+              of the media range; ties are broken by the order of the
+              allowed list, then by the order of the media ranges.
+
+    :raises HeaderLimitExceeded: One of the limits was exceeded.
+    """
+
+    return _rank_matches(_parse_ranges(requested, max_ranges, max_params),
+                         allowed, match_media_range)
+
+
+def best_match(requested, allowed, max_ranges=None, max_params=None):
+    """
+    Determine the best content type to use for the request.
+
+    :param requested: The value of the "Accept" header.
+    :param allowed: A list of the available content types.
+    :param max_ranges: The maximum number of media ranges to accept.
+                       If None, the number of media ranges is not
+                       limited.
+    :param max_params: The maximum number of parameters to accept on
+                       each media range.  If None, the number of
+                       parameters is not limited.
+
+    :returns: A tuple of the best match content type and the
+              parameters for that content type.
+
+    :raises HeaderLimitExceeded: One of the limits was exceeded.
+    """
+
+    matches = best_matches(requested, allowed, max_ranges, max_params)
+    return matches[0] if matches else ('', {})
+
+
+class FrozenParams(dict):
+    """
+    An immutable dictionary of content type parameters, as produced
+    by parse_ctype().  Parsed headers are shared between requests, so
+    they may not be altered.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        """
+        Refuse to alter the parameters.
+        """
+
+        raise TypeError("%s objects are immutable" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
 
-            # OK, see if we have a match
-            if _match_mask(ctype_mask, ctype):
-                best_q = q
-                best_ctype = ctype
-                best_params = params
-                best_match = ctype_mask
+    def __hash__(self):
+        """
+        Compute a hash of the parameters.
+        """
+
+        return hash(frozenset(self.items()))
+
+    def __copy__(self):
+        """
+        Immutable objects need not be copied.
+        """
+
+        return self
+
+    def __deepcopy__(self, memo):
+        """
+        Immutable objects need not be copied.
+        """
+
+        return self
+
+    def __reduce__(self):
+        """
+        Support pickling of the parameters.
+        """
+
+        return (self.__class__, (dict(self),))
+
+
+def parse_accept(requested, max_ranges=None, max_params=None):
+    """
+    Parse the value of an "Accept" header into its media ranges,
+    ranked by quality, then by specificity.
+
+    :param requested: The value of the "Accept" header.
+    :param max_ranges: The maximum number of media ranges to accept.
+                       If None, the number of media ranges is not
+                       limited.
+    :param max_params: The maximum number of parameters to accept on
+                       each media range.  If None, the number of
+                       parameters is not limited.
+
+    :returns: A tuple of tuples of a media range and its parameters,
+              as a FrozenParams object, most preferred first; the
+              quality is in the "q" parameter, if given.  Ties remain
+              in the order of the header.  Empty media ranges, and
+              media ranges with a bad quality value, are omitted.
+
+    :raises HeaderLimitExceeded: One of the limits was exceeded.
+    """
+
+    ranges = []
+    for mask, params in _parse_ranges(requested, max_ranges, max_params):
+        try:
+            q = float(params.get('q', 1.0))
+        except ValueError:
+            # Bad quality value
+            continue
+
+        if mask:
+            ranges.append((-q, mask.count('*'), mask, FrozenParams(params)))
+
+    # The sort is stable, so ties remain in order
+    ranges.sort(key=lambda x: x[:2])
+    return tuple((mask, params) for _q, _stars, mask, params in ranges)
+
+
+def best_encoding(requested, allowed, max_ranges=None, max_params=None):
+    """
+    Determine the best content coding to use for the response.
+
+    :param requested: The value of the "Accept-Encoding" header.
+    :param allowed: A list of the available content codings, in order
+                    of preference.
+    :param max_ranges: The maximum number of codings to accept.  If
+                       None, the number of codings is not limited.
+    :param max_params: The maximum number of parameters to accept on
+                       each coding.  If None, the number of parameters
+                       is not limited.
+
+    :returns: The best content coding, or None if the response should
+              not be encoded.
+
+    :raises HeaderLimitExceeded: One of the limits was exceeded.
+    """
+
+    # Determine the quality of each coding; a coding not listed
+    # takes the quality of "*"
+    qualities = {}
+    default = 0.0
+    for coding, params in _parse_ranges(requested, max_ranges, max_params):
+        try:
+            q = float(params.get('q', 1.0))
+        except ValueError:
+            # Bad quality value
+            continue
+
+        if coding == '*':
+            default = q
+        else:
+            qualities[coding.lower()] = q
 
-    # Return the best match
-    return best_ctype, best_params
+    # The identity coding is preferred only if the client prefers it
+    best, best_q = None, qualities.get('identity', 0.0)
+    for coding in allowed:
+        q = qualities.get(coding, default)
+        if q > 0 and q > best_q:
+            best, best_q = coding, q
+
+    return best
 
 
 class TypeRule(object):
@@ -207,7 +613,7 @@ class TypeRule(object):
     Represents a basic rule for content type interpretation.
     """
 
-    def __init__(self, ctype, version, params):
+    def __init__(self, ctype, version, params, version_range=None):
         """
         Initialize a TypeRule object.
 
@@ -223,11 +629,20 @@ class TypeRule(object):
                        AVersion, but are included in the configuration
                        made available through the 'aversion.config'
                        WSGI environment variable.
+        :param version_range: A version range.  If not None, the range
+                              will be formed by formatting the string,
+                              using the parameter dictionary, and
+                              resolved against the ``index``
+                              attribute, a VersionIndex; the version
+                              is only used if the range does not
+                              resolve.
         """
 
         self.ctype = ctype
         self.version = version
         self.params = params
+        self.version_range = version_range
+        self.index = None
 
     def __call__(self, params):
         """
@@ -247,13 +662,384 @@ class TypeRule(object):
             # Treat it as undefined rather than defaulted
             ctype = None
 
+        # Resolve the version range, if any
+        version = None
+        if self.version_range and self.index is not None:
+            try:
+                version = self.index.resolve(self.version_range % params)
+            except KeyError:
+                pass
+
         # Determine the desired version
+        if version is None:
+            try:
+                version = (self.version % params) if self.version else None
+            except KeyError:
+                version = None
+
+        return ctype, version
+
+
+def natural_version_key(version):
+    """
+    Compute the sort key of a version name for natural ordering.  The
+    numbers in the name are compared numerically, so "v1.10" sorts
+    after "v1.9"; any other text is ignored.
+
+    :param version: The version name.
+
+    :returns: A tuple of the integers in the name.
+    """
+
+    return tuple(int(num) for num in re.findall(r'\d+', version))
+
+
+class VersionIndex(object):
+    """
+    A sorted index of the declared versions, used to resolve version
+    ranges, such as "2.x" or ">=2.1,<3", to the newest matching
+    version.  Each resolution takes a few binary searches.
+    """
+
+    def __init__(self, versions, order='natural'):
+        """
+        Initialize a VersionIndex object.
+
+        :param versions: The names of the versions to index.
+        :param order: The ordering of the version names.  This may be
+                      "natural", ordering by the numbers in the names
+                      as for natural_version_key(); "lexical",
+                      ordering by the names themselves; or a list of
+                      version names, oldest first, in which case other
+                      versions are omitted from the index.
+        """
+
+        if order == 'natural':
+            self.key = natural_version_key
+        elif order == 'lexical':
+            self.key = lambda version: version
+        else:
+            ranks = dict((version, i) for i, version in enumerate(order))
+            self.key = ranks.get
+            versions = [version for version in versions if version in ranks]
+
+        # Sort the versions; ties are broken by the name
+        entries = sorted((self.key(version), version) for version in versions)
+        self.keys = [key for key, _version in entries]
+        self.versions = [version for _key, version in entries]
+
+    def _bounds(self, op, value):
+        """
+        Determine the slice of the index matching a single clause of
+        a version range.  In natural order, a version stands for
+        itself and every version it is a prefix of, so "2" stands for
+        "2", "2.0", and "2.3": "<=2" and "=2" both include "2.3", and
+        ">2" and "<2" both exclude it.
+
+        :param op: The comparison operator, or None to match the
+                   version as for "=".
+        :param value: The version to compare to.  The value "x" or
+                      "*" without an operator matches every version.
+
+        :returns: A tuple of the lower and upper bounds of the slice.
+        """
+
+        if value in ('x', '*'):
+            return (0, len(self.keys)) if op is None else (0, 0)
+
+        key = self.key(value)
+        if key is None or key == ():
+            # Not an indexed version, or no numbers to order by
+            return 0, 0
+
+        # Find the versions the value stands for
+        lower = bisect.bisect_left(self.keys, key)
+        if isinstance(key, tuple):
+            upper = bisect.bisect_left(self.keys,
+                                       key[:-1] + (key[-1] + 1,))
+        else:
+            upper = bisect.bisect_right(self.keys, key)
+
+        if op == '>=':
+            return lower, len(self.keys)
+        elif op == '>':
+            return upper, len(self.keys)
+        elif op == '<=':
+            return 0, upper
+        elif op == '<':
+            return 0, lower
+
+        return lower, upper
+
+    def resolve(self, spec):
+        """
+        Resolve a version range to the newest matching version.
+
+        :param spec: The version range.  This is a list of clauses,
+                     separated by commas or whitespace, all of which
+                     must match.  Each clause is a version, optionally
+                     preceded by one of the operators ">=", ">", "<=",
+                     "<", "=", or "==".  Without an operator, a clause
+                     matches as for "=".  In natural order, a version
+                     stands for any version it is a prefix of, and
+                     "2.x" is the same as "2"; a clause whose version
+                     contains no numbers matches nothing, except that
+                     "x" or "*" alone matches every version.
+
+        :returns: The newest matching version, or None if no version
+                  matches.
+        """
+
+        lower, upper = 0, len(self.keys)
+        matched = False
+        for op, value in RANGE_CLAUSE_RE.findall(spec):
+            matched = True
+            clause_lower, clause_upper = self._bounds(op or None, value)
+            lower = max(lower, clause_lower)
+            upper = min(upper, clause_upper)
+
+        if not matched or lower >= upper:
+            return None
+        return self.versions[upper - 1]
+
+
+class HeaderCache(object):
+    """
+    Caches the parsed values of recently seen "Accept" and
+    "Content-Type" headers.  The parsed values are immutable, so they
+    may be shared between requests and threads.
+    """
+
+    def __init__(self, max_ranges=None, max_params=None, size=256):
+        """
+        Initialize a HeaderCache object.
+
+        :param max_ranges: The maximum number of media ranges to
+                           accept in an "Accept" header.  If None, the
+                           number of media ranges is not limited.
+        :param max_params: The maximum number of parameters to accept
+                           on each content type or media range.  If
+                           None, the number of parameters is not
+                           limited.
+        :param size: The maximum number of header values whose parsed
+                     values are cached.  If 0, parsed values are not
+                     cached.
+        """
+
+        self.max_ranges = max_ranges
+        self.max_params = max_params
+        self.size = size
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key, parse, *args):
+        """
+        Look up a parsed header value, parsing it on a miss.
+
+        :param key: The cache key.
+        :param parse: The parsing function.
+        :param args: The arguments for the parsing function.
+
+        :returns: The parsed value.
+
+        :raises HeaderLimitExceeded: One of the limits was exceeded.
+        """
+
         try:
-            version = (self.version % params) if self.version else None
+            parsed = self.cache[key]
         except KeyError:
-            version = None
+            pass
+        else:
+            self.hits += 1
+            return parsed
 
-        return ctype, version
+        self.misses += 1
+        parsed = parse(*args)
+
+        if self.size > 0:
+            # Make room by discarding an arbitrary entry
+            while len(self.cache) >= self.size:
+                try:
+                    self.cache.popitem()
+                except KeyError:
+                    # Emptied by another thread
+                    break
+            self.cache[key] = parsed
+
+        return parsed
+
+    def parse_accept(self, value):
+        """
+        Parse the value of an "Accept" header.
+
+        :param value: The value of the header.
+
+        :returns: A tuple of the ranked media ranges, as for
+                  parse_accept().
+
+        :raises HeaderLimitExceeded: One of the limits was exceeded.
+        """
+
+        return self._lookup(('accept', value), parse_accept, value,
+                            self.max_ranges, self.max_params)
+
+    def parse_ctype(self, value):
+        """
+        Parse the value of a "Content-Type" header.
+
+        :param value: The value of the header.
+
+        :returns: A tuple of the content type and a FrozenParams
+                  object containing the content type parameters, as
+                  for parse_ctype().
+
+        :raises HeaderLimitExceeded: One of the limits was exceeded.
+        """
+
+        return self._lookup(('content-type', value), self._parse_ctype,
+                            value)
+
+    def _parse_ctype(self, value):
+        """
+        Parse the value of a "Content-Type" header, freezing the
+        parameters.
+
+        :param value: The value of the header.
+
+        :returns: A tuple of the content type and a FrozenParams
+                  object.
+        """
+
+        ctype, params = parse_ctype(value, self.max_params)
+        return ctype, FrozenParams(params)
+
+    def snapshot(self):
+        """
+        Retrieve the statistics of the cache.
+
+        :returns: A dictionary with the keys "entries", "hits", and
+                  "misses".
+        """
+
+        return dict(entries=len(self.cache), hits=self.hits,
+                    misses=self.misses)
+
+
+class Negotiator(object):
+    """
+    Negotiates a value, such as a language or character set, from an
+    "Accept" or "Accept-\*" header.  The available values and the
+    match rule are fixed when the negotiator is created, and the
+    results for recently seen header values are cached, so that the
+    header need not be parsed again.  Negotiators may be shared
+    between threads.
+    """
+
+    def __init__(self, allowed, rule=match_media_range, max_ranges=None,
+                 max_params=None, cache_size=256):
+        """
+        Initialize a Negotiator object.
+
+        :param allowed: A list of the available values, in order of
+                        preference.
+        :param rule: The match rule, which is called with a range from
+                     the header and an available value, and returns
+                     None if they do not match or the specificity of
+                     the range if they do.  The match_media_range(),
+                     match_language_range(), and match_charset()
+                     functions are suitable.
+        :param max_ranges: The maximum number of ranges to accept.  If
+                           None, the number of ranges is not limited.
+        :param max_params: The maximum number of parameters to accept
+                           on each range.  If None, the number of
+                           parameters is not limited.
+        :param cache_size: The maximum number of header values whose
+                           results are cached.  If 0, results are not
+                           cached.
+        """
+
+        self.allowed = list(allowed)
+        self.rule = rule
+        self.max_ranges = max_ranges
+        self.max_params = max_params
+        self.cache_size = cache_size
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __deepcopy__(self, memo):
+        """
+        Negotiators hold no configuration of their own; a copy of the
+        configuration refers to the same negotiator.
+        """
+
+        return self
+
+    def best_matches(self, requested):
+        """
+        Rank the available values acceptable for the request.
+
+        :param requested: The value of the header.
+
+        :returns: A list of tuples of an available value and the
+                  parameters of a range it matches, best match first,
+                  as for best_matches().  The list must not be
+                  altered.
+
+        :raises HeaderLimitExceeded: One of the limits was exceeded.
+        """
+
+        try:
+            matches = self.cache[requested]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return matches
+
+        self.misses += 1
+        matches = _rank_matches(
+            _parse_ranges(requested, self.max_ranges, self.max_params),
+            self.allowed, self.rule)
+
+        if self.cache_size > 0:
+            # Make room by discarding an arbitrary entry
+            while len(self.cache) >= self.cache_size:
+                try:
+                    self.cache.popitem()
+                except KeyError:
+                    # Emptied by another thread
+                    break
+            self.cache[requested] = matches
+
+        return matches
+
+    def best_match(self, requested):
+        """
+        Determine the best available value for the request.
+
+        :param requested: The value of the header.
+
+        :returns: The best available value, or None if none is
+                  acceptable.
+
+        :raises HeaderLimitExceeded: One of the limits was exceeded.
+        """
+
+        matches = self.best_matches(requested)
+        return matches[0][0] if matches else None
+
+    def snapshot(self):
+        """
+        Retrieve the cache statistics of the negotiator.
+
+        :returns: A dictionary with the keys "entries", "hits", and
+                  "misses".
+        """
+
+        return dict(entries=len(self.cache), hits=self.hits,
+                    misses=self.misses)
 
 
 class Result(object):
@@ -270,6 +1056,16 @@ class Result(object):
         self.version = None
         self.ctype = None
         self.orig_ctype = None
+        self.request_ctype = None
+        self.orig_request_ctype = None
+        self.request_header = None
+        self.vary = []
+        self.candidates = []
+        self.encoding = None
+        self.language = None
+        self.charset = None
+        self.parsed_accept = None
+        self.parsed_ctype = None
 
     def __nonzero__(self):
         """
@@ -279,6 +1075,8 @@ class Result(object):
 
         return self.version is not None and self.ctype is not None
 
+    __bool__ = __nonzero__
+
     def set_version(self, version):
         """
         Set the selected version.  Will not override the value of the
@@ -305,49 +1103,3345 @@ class Result(object):
             self.ctype = ctype
             self.orig_ctype = orig_ctype
 
+    def set_request_ctype(self, ctype, orig_ctype, header):
+        """
+        Set the selected content type of the request body.  Will not
+        override the value of the request content type if that has
+        already been determined.
 
-def _set_key(log_prefix, result_dict, key, value, desc="parameter"):
-    """
-    Helper to set a key value in a dictionary.  This function issues a
-    warning if the key has already been set, and issues a warning and
-    returns without setting the value if the value is not surrounded
-    by parentheses.  This is used to eliminate duplicated code from
-    the rule parsers below.
+        :param ctype: The content type string to set.
+        :param orig_ctype: The original content type, as found in the
+                           configuration.
+        :param header: The original value of the "Content-Type"
+                       header.
+        """
 
-    :param log_prefix: A prefix to use in log messages.  This should
-                       be the configuration key.
-    :param result_dict: A dictionary of results, into which the key
-                        and value should be inserted.
-    :param key: The dictionary key to insert.
-    :param value: The value to insert into the dictionary.
-    :param desc: A description of what the dictionary is.  This is
-                 used in log messages help the user understand what
-                 the log message is referring to.  By default, this
-                 description is "parameter", indicating that entries
-                 in the dictionary are parameters of something;
-                 however, _parse_type_rule() also uses "token type" to
-                 help identify its more complex tokens.
-    """
+        if self.request_ctype is None:
+            self.request_ctype = ctype
+            self.orig_request_ctype = orig_ctype
+            self.request_header = header
 
-    if key in result_dict:
-        LOG.warn("%s: Duplicate value for %s %r" %
-                 (log_prefix, desc, key))
-        # Allow the overwrite
+    def add_vary(self, header):
+        """
+        Record that the selection depends on the value of a request
+        header.  This is used to construct the "Vary" header of the
+        response.
 
-    # Demand the value be quoted
-    if len(value) <= 2 or value[0] not in ('"', "'") or value[0] != value[-1]:
-        LOG.warn("%s: Invalid value %r for %s %r" %
-                 (log_prefix, value, desc, key))
-        return
+        :param header: The name of the request header.
+        """
 
-    # Save the value
-    result_dict[key] = value[1:-1]
+        if header not in self.vary:
+            self.vary.append(header)
+
+
+class Decision(object):
+    """
+    Describes the routing decision made by AVersion for a request.
+    The values of the ``aversion.*`` WSGI environment variables are
+    available as attributes.  The configuration is only copied when
+    the ``config`` attribute is first accessed.
+    """
+
+    __slots__ = ('version', 'response_type', 'orig_response_type', 'accept',
+                 'request_type', 'orig_request_type', 'content_type',
+                 'language', 'charset', 'parsed_accept',
+                 'parsed_content_type', '_config', '_config_src')
+
+    # Maps each environment variable to the attribute containing its
+    # value and the attribute which must be set for the variable to
+    # be present
+    _environ_map = {
+        'aversion.config': ('config', None),
+        'aversion.version': ('version', None),
+        'aversion.response_type': ('response_type', 'response_type'),
+        'aversion.orig_response_type': ('orig_response_type',
+                                        'response_type'),
+        'aversion.accept': ('accept', 'response_type'),
+        'aversion.request_type': ('request_type', 'request_type'),
+        'aversion.orig_request_type': ('orig_request_type', 'request_type'),
+        'aversion.content_type': ('content_type', 'request_type'),
+        'aversion.language': ('language', 'language'),
+        'aversion.charset': ('charset', 'charset'),
+        'aversion.parsed_accept': ('parsed_accept', 'parsed_accept'),
+        'aversion.parsed_content_type': ('parsed_content_type',
+                                         'parsed_content_type'),
+    }
+
+    def __init__(self, config, version, result, accept):
+        """
+        Initialize a Decision object.
+
+        :param config: The AVersion configuration dictionary.  A deep
+                       copy is made when the ``config`` attribute is
+                       first accessed.
+        :param version: The name of the selected version, or None if
+                        the default application was selected.
+        :param result: The Result object describing the selected
+                       content types.
+        :param accept: The original value of the "Accept" header.
+        """
+
+        self.version = version
+        self.response_type = result.ctype
+        self.orig_response_type = result.orig_ctype
+        self.accept = accept
+        self.request_type = result.request_ctype
+        self.orig_request_type = result.orig_request_ctype
+        self.content_type = result.request_header
+        self.language = result.language
+        self.charset = result.charset
+        self.parsed_accept = result.parsed_accept
+        self.parsed_content_type = result.parsed_ctype
+        self._config = None
+        self._config_src = config
+
+    def __deepcopy__(self, memo):
+        """
+        Copy the decision.  The configuration dictionary it was made
+        from is shared, not copied; it is only ever read.
+        """
+
+        result = self.__class__.__new__(self.__class__)
+        for attr in self.__slots__:
+            value = getattr(self, attr)
+            if attr != '_config_src':
+                value = copy.deepcopy(value, memo)
+            setattr(result, attr, value)
+
+        return result
+
+    @property
+    def config(self):
+        """
+        A copy of the AVersion configuration dictionary.  This is
+        copied on first access, to avoid accidental overwrite of the
+        data.
+        """
+
+        if self._config is None:
+            self._config = copy.deepcopy(self._config_src)
+
+        return self._config
+
+    def get(self, key, default=None):
+        """
+        Retrieve the value of an ``aversion.*`` WSGI environment
+        variable.
+
+        :param key: The name of the environment variable.
+        :param default: The value to return if the variable would not
+                        be present in the environment.
+
+        :returns: The value of the variable.
+        """
+
+        try:
+            attr, cond = self._environ_map[key]
+        except KeyError:
+            return default
+
+        if cond is not None and not getattr(self, cond):
+            return default
+
+        return getattr(self, attr)
+
+    def populate(self, environ):
+        """
+        Set the individual ``aversion.*`` WSGI environment variables.
+
+        :param environ: The WSGI environment to populate.
+        """
+
+        for key, (attr, cond) in self._environ_map.items():
+            if cond is None or getattr(self, cond):
+                environ[key] = getattr(self, attr)
+
+
+def environ_get(environ, key, default=None):
+    """
+    Retrieve the value of an ``aversion.*`` WSGI environment variable.
+    This works whether AVersion populated the individual environment
+    variables or stored a Decision in the ``aversion.decision``
+    variable.
+
+    :param environ: The WSGI environment.
+    :param key: The name of the environment variable.
+    :param default: The value to return if the variable is not
+                    present.
+
+    :returns: The value of the variable.
+    """
+
+    try:
+        return environ[key]
+    except KeyError:
+        pass
+
+    decision = environ.get('aversion.decision')
+    if decision is None:
+        return default
+
+    return decision.get(key, default)
+
+
+class ProfileSampler(object):
+    """
+    Runs a sample of calls under cProfile and aggregates the resulting
+    profile data in memory.  Calls which are not sampled pay only the
+    cost of a counter increment.
+    """
+
+    def __init__(self, rate, filename=None):
+        """
+        Initialize a ProfileSampler object.
+
+        :param rate: The sampling rate; one call in every ``rate``
+                     calls will be profiled.
+        :param filename: The default name of the file to dump the
+                         aggregated profile data to.
+        """
+
+        self.rate = rate
+        self.filename = filename
+        self.samples = 0
+        self.stats = None
+        self.dump_pending = False
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __call__(self, func, *args, **kwargs):
+        """
+        Call a function, profiling the call if it has been selected
+        for sampling.
+
+        :param func: The function to call.  All remaining positional
+                     and keyword arguments are passed to the function.
+
+        :returns: The return value of the function.
+        """
+
+        # Perform a dump requested by a signal handler
+        if self.dump_pending:
+            self.dump_pending = False
+            self.dump()
+
+        # The common case is that the call is not sampled
+        if next(self._counter) % self.rate:
+            return func(*args, **kwargs)
+
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Another profiler is already active; skip this sample
+            return func(*args, **kwargs)
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            prof.disable()
+
+            # Merge the profile data into the aggregate
+            with self._lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(prof)
+                else:
+                    self.stats.add(prof)
+                self.samples += 1
+
+    def dump(self, filename=None):
+        """
+        Dump the aggregated profile data to a file.  The file may be
+        examined using the ``pstats`` module.
+
+        :param filename: The name of the file to dump the profile
+                         data to.  If not given, the filename passed
+                         to the constructor is used.
+
+        :returns: True if profile data was dumped, False if no
+                  samples have yet been collected or no file name is
+                  available.
+        """
+
+        filename = filename or self.filename
+        if not filename:
+            LOG.warn("No file name available for dumping profile data")
+            return False
+
+        with self._lock:
+            if self.stats is None:
+                return False
+
+            self.stats.dump_stats(filename)
+
+        return True
+
+    def request_dump(self):
+        """
+        Request that the aggregated profile data be dumped to the
+        default file at the start of the next call.  Unlike dump(),
+        this is safe to call from a signal handler, which could
+        otherwise deadlock on the lock held while merging profile
+        data.
+        """
+
+        self.dump_pending = True
+
+    def reset(self):
+        """
+        Discard the aggregated profile data.
+        """
+
+        with self._lock:
+            self.stats = None
+            self.samples = 0
+
+
+class CounterSet(object):
+    """
+    A thread-safe set of named counters.  To bound the memory used,
+    at most ``max_keys`` distinct counters are kept; counts for any
+    further names are accumulated under the ``overflow`` name.
+    """
+
+    overflow = '<other>'
+
+    def __init__(self, max_keys=100):
+        """
+        Initialize a CounterSet object.
+
+        :param max_keys: The maximum number of distinct counters.
+        """
+
+        self.max_keys = max_keys
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :param amount: The amount to increment the counter by.
+        """
+
+        with self._lock:
+            if name not in self._counts and len(self._counts) >= self.max_keys:
+                name = self.overflow
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def snapshot(self):
+        """
+        Retrieve the current values of the counters.
+
+        :returns: A dictionary mapping counter names to their values.
+        """
+
+        with self._lock:
+            return dict(self._counts)
+
+
+class StaticResponse(object):
+    """
+    A WSGI application which returns a fixed response.  The response
+    is rendered once, when the object is created.
+    """
+
+    def __init__(self, status, headers=None, body=b''):
+        """
+        Initialize a StaticResponse object.
+
+        :param status: The response status, e.g., "200 OK".
+        :param headers: A list of response headers.  A
+                        "Content-Length" header is added
+                        automatically, except to "304 Not Modified"
+                        responses.
+        :param body: The response body, as a byte string.
+        """
+
+        self.status = status
+        self.headers = list(headers or [])
+        if not status.startswith('304'):
+            self.headers.append(('Content-Length', str(len(body))))
+        self.body = body
+
+    def __call__(self, environ, start_response):
+        """
+        Return the response.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        start_response(self.status, list(self.headers))
+
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [self.body]
+
+
+def _error_response(status, message, headers=None):
+    """
+    Render a simple plain-text error response.
+
+    :param status: The response status, e.g., "406 Not Acceptable".
+    :param message: A message explaining the error.
+    :param headers: A list of additional response headers.
+
+    :returns: A StaticResponse object.
+    """
+
+    body = ('%s\n\n%s\n' % (status, message)).encode('utf-8')
+    return StaticResponse(status, [
+        ('Content-Type', 'text/plain; charset=UTF-8'),
+    ] + (headers or []), body)
+
+
+class DiscoveryApp(object):
+    """
+    A WSGI application which describes the versions, aliases, and
+    content types configured for an AVersion object as a JSON
+    document.  The document is rendered once, and the same bytes are
+    returned for every request.
+    """
+
+    def __init__(self, avers):
+        """
+        Initialize a DiscoveryApp object.
+
+        :param avers: The AVersion object to describe.
+        """
+
+        self.avers = avers
+        self.render()
+
+    def render(self):
+        """
+        Render the document.  This must be called again if the
+        configuration of the AVersion object is changed.
+        """
+
+        self.document = self.build_document(self.avers)
+        body = json.dumps(self.document, sort_keys=True).encode('utf-8')
+        self.response = StaticResponse('200 OK', [
+            ('Content-Type', 'application/json'),
+        ], body)
+
+    @staticmethod
+    def build_document(avers):
+        """
+        Build the discovery document for an AVersion object.
+
+        :param avers: The AVersion object to describe.
+
+        :returns: A dictionary of three entries: "versions", "aliases",
+                  and "types".  These are as for the
+                  ``aversion.config`` WSGI environment variable, except
+                  that the application is omitted from the version
+                  descriptions and each version is described with a
+                  list of the content types which select it.
+        """
+
+        # Start with the versions
+        versions = {}
+        for name, desc in avers.versions.items():
+            versions[name] = dict(
+                name=name,
+                params=desc['params'],
+                prefixes=sorted(desc.get('prefixes', [])),
+                types=[],
+            )
+
+        # Add the types which always select a given version
+        for ctype, rule in sorted(avers.types.items()):
+            if (not rule.version or '%' in rule.version or
+                    rule.version_range):
+                continue
+
+            version = rule.version
+            if version in avers.aliases:
+                version = avers.aliases[version]['version']
+            if version in versions:
+                versions[version]['types'].append(ctype)
+
+        return dict(
+            versions=versions,
+            aliases=avers.config['aliases'],
+            types=avers.config['types'],
+        )
+
+    def __call__(self, environ, start_response):
+        """
+        Return the discovery document.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        return self.response(environ, start_response)
+
+
+class ShortCircuit(Exception):
+    """
+    Raised by the processing steps to answer a request directly,
+    without passing it to any of the configured applications.
+    """
+
+    def __init__(self, app):
+        """
+        Initialize a ShortCircuit exception.
+
+        :param app: The WSGI application which will answer the
+                    request; usually a StaticResponse.
+        """
+
+        super(ShortCircuit, self).__init__()
+        self.app = app
+
+
+class ResponseFilter(object):
+    """
+    A WSGI application wrapper which passes the status and headers of
+    the wrapped application's response through a list of filters
+    before they are handed to the server.  The response body is never
+    examined.
+    """
+
+    def __init__(self, app, filters):
+        """
+        Initialize a ResponseFilter object.
+
+        :param app: The WSGI application to wrap.
+        :param filters: A list of filters.  Each filter is a callable
+                        taking the status and the list of headers, and
+                        returning a tuple of the new status and list
+                        of headers.
+        """
+
+        self.app = app
+        self.filters = filters
+
+    def __call__(self, environ, start_response):
+        """
+        Call the wrapped application.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable returned by the wrapped
+                  application.
+        """
+
+        def filtered_start_response(status, headers, exc_info=None):
+            for filt in self.filters:
+                status, headers = filt(status, headers)
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, filtered_start_response)
+
+
+class CompressedApp(object):
+    """
+    A WSGI application wrapper which compresses the response body as
+    it is produced.  Responses whose content type is already
+    compressed, which already have a content coding, or which are
+    smaller than a threshold are passed through unaltered.
+    """
+
+    def __init__(self, app, coding, min_size=1024, level=6,
+                 skip_types=None):
+        """
+        Initialize a CompressedApp object.
+
+        :param app: The WSGI application to wrap.
+        :param coding: The content coding to apply; one of the keys of
+                       CODINGS.  If None, the response is not
+                       compressed, but the "Vary" header is added to
+                       responses which could be.
+        :param min_size: The minimum size of the response body, in
+                         bytes, to compress.
+        :param level: The compression level, from 1 to 9.
+        :param skip_types: A list of content types or masks, such as
+                           "image/\*", which are not compressed.
+                           Defaults to COMPRESS_SKIP_TYPES.
+        """
+
+        self.app = app
+        self.coding = coding
+        self.min_size = min_size
+        self.level = level
+        self.skip_types = (COMPRESS_SKIP_TYPES if skip_types is None
+                           else skip_types)
+
+    def _compressible(self, status, headers):
+        """
+        Determine whether a response could be compressed.
+
+        :param status: The response status.
+        :param headers: The list of response headers.
+
+        :returns: True if the response could be compressed, False
+                  otherwise.
+        """
+
+        if status[:3] in ('204', '206', '304') or status[:1] == '1':
+            return False
+
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            elif name == 'content-type':
+                ctype = value.split(';', 1)[0].strip().lower()
+                for mask in self.skip_types:
+                    if _match_mask(mask, ctype):
+                        return False
+            elif name == 'content-length':
+                try:
+                    if int(value) < self.min_size:
+                        return False
+                except ValueError:
+                    pass
+
+        return True
+
+    def _compressed_headers(self, headers):
+        """
+        Alter the headers for a compressed response.
+
+        :param headers: The list of response headers.
+
+        :returns: The new list of headers.
+        """
+
+        result = []
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'content-length':
+                continue
+            elif lower == 'etag' and not value.startswith('W/'):
+                # The compressed body differs byte for byte
+                value = 'W/' + value
+            result.append((name, value))
+        result.append(('Content-Encoding', self.coding))
+        return result
+
+    def __call__(self, environ, start_response):
+        """
+        Call the wrapped application, compressing its response.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        # The start of a response which may be compressed is deferred
+        # until enough of the body is seen
+        state = dict(start=None, deferred=False)
+
+        def compress_start_response(status, headers, exc_info=None):
+            if not self._compressible(status, headers):
+                state['deferred'] = False
+                return start_response(status, headers, exc_info)
+
+            headers = VaryFilter(['Accept-Encoding'])(status, headers)[1]
+            if not self.coding:
+                state['deferred'] = False
+                return start_response(status, headers, exc_info)
+
+            # A HEAD response gets the headers of the matching GET
+            # response; with a "Content-Length" header, the size is
+            # known to be large enough, and otherwise it depends on
+            # the body the application produces, as for GET
+            if (environ.get('REQUEST_METHOD') == 'HEAD' and
+                    'content-length' in [name.lower()
+                                         for name, _value in headers]):
+                state['deferred'] = False
+                return start_response(status,
+                                      self._compressed_headers(headers),
+                                      exc_info)
+
+            state['start'] = (status, headers, exc_info)
+            state['deferred'] = True
+            return write
+
+        def write(data):
+            # Give up on compression; send the response as is
+            if state['deferred']:
+                state['deferred'] = False
+                state['write'] = start_response(*state['start'])
+            if 'write' not in state:
+                raise RuntimeError("write() called after compression "
+                                   "started")
+            state['write'](data)
+
+        return CompressingIterable(self,
+                                   self.app(environ,
+                                            compress_start_response),
+                                   state, start_response)
+
+
+class CompressingIterable(object):
+    """
+    The application iterable of a CompressedApp.  The start of the
+    response is deferred until the minimum size is reached, and the
+    body is then compressed as it is produced.
+    """
+
+    def __init__(self, compressed, iterable, state, start_response):
+        """
+        Initialize a CompressingIterable object.
+
+        :param compressed: The CompressedApp object.
+        :param iterable: The application iterable to wrap.
+        :param state: A dictionary shared with the start_response
+                      callable passed to the application; "deferred"
+                      is True while the start of the response is
+                      deferred, and "start" contains the arguments to
+                      pass to start_response().
+        :param start_response: The WSGI start_response callable.
+        """
+
+        self.compressed = compressed
+        self.iterable = iterable
+        self.state = state
+        self.start_response = start_response
+
+    def __iter__(self):
+        """
+        Iterate over the wrapped application iterable, compressing
+        the blocks of the body.
+        """
+
+        buffered = []
+        size = 0
+        compressor = None
+
+        for data in self.iterable:
+            if compressor is not None:
+                data = compressor.compress(data)
+                if data:
+                    yield data
+                continue
+            elif not self.state['deferred']:
+                yield data
+                continue
+
+            # Collect enough data to decide whether to compress
+            buffered.append(data)
+            size += len(data)
+            if size < self.compressed.min_size:
+                continue
+
+            status, headers, exc_info = self.state['start']
+            self.state['deferred'] = False
+            self.start_response(
+                status, self.compressed._compressed_headers(headers),
+                exc_info)
+            compressor = zlib.compressobj(self.compressed.level,
+                                          zlib.DEFLATED,
+                                          CODINGS[self.compressed.coding])
+            data = compressor.compress(b''.join(buffered))
+            buffered = None
+            if data:
+                yield data
+
+        if compressor is not None:
+            yield compressor.flush()
+        elif self.state['deferred']:
+            # Too small to compress
+            self.state['deferred'] = False
+            self.start_response(*self.state['start'])
+            yield b''.join(buffered)
+
+    def close(self):
+        """
+        Close the wrapped application iterable.
+        """
+
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+
+class ClosingIterable(object):
+    """
+    A wrapper for a WSGI application iterable which calls a callback
+    when the iterable is closed, i.e., when the server has finished
+    sending the response.
+    """
+
+    def __init__(self, iterable, callback, errback=None):
+        """
+        Initialize a ClosingIterable object.
+
+        :param iterable: The application iterable to wrap.
+        :param callback: A callable taking no arguments.  It is called
+                         at most once.
+        :param errback: An optional callable taking no arguments.  It
+                        is called if iterating over the wrapped
+                        application iterable raises an exception.
+        """
+
+        self.iterable = iterable
+        self.callback = callback
+        self.errback = errback
+
+    def __iter__(self):
+        """
+        Iterate over the wrapped application iterable.
+        """
+
+        if not self.errback:
+            return iter(self.iterable)
+
+        return self._iter_checked()
+
+    def _iter_checked(self):
+        """
+        Iterate over the wrapped application iterable, calling the
+        errback if it raises an exception.
+        """
+
+        try:
+            for chunk in self.iterable:
+                yield chunk
+        except Exception:
+            self.errback()
+            raise
+
+    def close(self):
+        """
+        Close the wrapped application iterable, then call the
+        callback.
+        """
+
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            callback, self.callback = self.callback, None
+            if callback:
+                callback()
+
+
+class Limiter(object):
+    """
+    Limits the number of requests concurrently being processed by the
+    application for a version.  A request exceeding the limit may wait
+    up to a timeout for another request to complete; if it does not,
+    it is rejected.
+    """
+
+    def __init__(self, version, concurrency, timeout=0, retry_after=1):
+        """
+        Initialize a Limiter object.
+
+        :param version: The version name.  This is used in the error
+                        message.
+        :param concurrency: The maximum number of requests which may
+                            be processed at once.
+        :param timeout: The number of seconds a request may wait for
+                        another request to complete.  If 0, requests
+                        exceeding the limit are rejected immediately.
+        :param retry_after: The value of the "Retry-After" header of
+                            the rejection response.
+        """
+
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.in_flight = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+        # Pre-render the rejection response
+        self.response = _error_response(
+            '503 Service Unavailable',
+            'Version %s is at its concurrency limit.' % version,
+            [('Retry-After', str(retry_after))])
+
+    def acquire(self):
+        """
+        Acquire a slot for a request, waiting up to the timeout for
+        one to become available.
+
+        :returns: True if a slot was acquired, False if the request
+                  must be rejected.
+        """
+
+        with self._cond:
+            if self.in_flight >= self.concurrency and self.timeout > 0:
+                deadline = time.time() + self.timeout
+                while self.in_flight >= self.concurrency:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+            if self.in_flight >= self.concurrency:
+                self.rejected += 1
+                return False
+
+            self.in_flight += 1
+            return True
+
+    def full(self):
+        """
+        Determine whether the limit has been reached.  This is only a
+        hint, since another request may complete or be admitted at
+        any time.
+
+        :returns: True if no slots are available, False otherwise.
+        """
+
+        return self.in_flight >= self.concurrency
+
+    def release(self):
+        """
+        Release a slot acquired by acquire().
+        """
+
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+class LimitedApp(object):
+    """
+    A WSGI application wrapper which admits requests to the wrapped
+    application subject to a Limiter.  The slot is held until the
+    application iterable is closed.
+    """
+
+    def __init__(self, app, limiter, on_reject=None):
+        """
+        Initialize a LimitedApp object.
+
+        :param app: The WSGI application to wrap.
+        :param limiter: The Limiter to acquire slots from.
+        :param on_reject: An optional callable taking no arguments,
+                          which is called if the request is rejected.
+        """
+
+        self.app = app
+        self.limiter = limiter
+        self.on_reject = on_reject
+
+    def __call__(self, environ, start_response):
+        """
+        Call the wrapped application, or return the rejection response
+        of the limiter if no slot is available.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        if not self.limiter.acquire():
+            if self.on_reject:
+                self.on_reject()
+            return self.limiter.response(environ, start_response)
+
+        try:
+            iterable = self.app(environ, start_response)
+        except BaseException:
+            self.limiter.release()
+            raise
+
+        return ClosingIterable(iterable, self.limiter.release)
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker for the application of a version.  The breaker
+    opens when too many requests fail, and requests are then rejected
+    without calling the application.  Once the reset interval has
+    elapsed, the breaker is half-open: a single probe request is
+    admitted, and its outcome determines whether the breaker closes or
+    opens again.  The probe is identified by the token returned by
+    allow(); the outcomes of other requests, such as slow requests
+    admitted before the breaker opened, do not affect a half-open
+    breaker.
+    """
+
+    def __init__(self, version, failures=5, error_rate=None, window=20,
+                 latency=None, reset=30, fallback=None):
+        """
+        Initialize a CircuitBreaker object.
+
+        :param version: The version name.  This is used in the error
+                        message.
+        :param failures: The number of consecutive failures which open
+                         the breaker.  If 0, consecutive failures are
+                         not counted.
+        :param error_rate: The fraction of failed requests among the
+                           last ``window`` requests which opens the
+                           breaker.  If None, the error rate is not
+                           considered.
+        :param window: The number of requests over which the error
+                       rate is computed.
+        :param latency: The number of seconds after which a request is
+                        considered to have failed, even if it
+                        succeeded.  If None, latency is not
+                        considered.
+        :param reset: The number of seconds the breaker remains open
+                      before admitting a probe request.
+        :param fallback: The name of a version or alias to route
+                         requests to while the breaker is open.  If
+                         None, such requests are rejected.
+        """
+
+        self.failures = failures
+        self.error_rate = error_rate
+        self.window = window
+        self.latency = latency
+        self.reset = reset
+        self.fallback = fallback
+
+        self.state = 'closed'
+        self.consecutive = 0
+        self.outcomes = collections.deque(maxlen=window)
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._probe = None
+        self._probe_at = None
+        self._lock = threading.Lock()
+
+        # Pre-render the rejection response
+        self.response = _error_response(
+            '503 Service Unavailable',
+            'Version %s is temporarily unavailable.' % version,
+            [('Retry-After', str(int(reset + 0.999)))])
+
+    def available(self, now=None):
+        """
+        Determine whether a request would be admitted, without
+        admitting it.
+
+        :param now: The current time.  If None, the current time is
+                    obtained.
+
+        :returns: True if a request would be admitted, False
+                  otherwise.
+        """
+
+        if self.state == 'closed':
+            return True
+
+        now = time.time() if now is None else now
+        if self.state == 'open':
+            return now >= self._opened_at + self.reset
+
+        # Half-open; a probe which never completed is abandoned after
+        # the reset interval
+        return self._probe_at is None or now >= self._probe_at + self.reset
+
+    def allow(self):
+        """
+        Admit a request.  In the half-open state, the admitted request
+        is the probe.
+
+        :returns: A token identifying the admitted request, which must
+                  be passed to record() or cancel(), or None if the
+                  request must be rejected.  The token is always true.
+        """
+
+        with self._lock:
+            if self.state == 'closed':
+                return True
+
+            now = time.time()
+            if not self.available(now):
+                self.rejected += 1
+                return None
+
+            self.state = 'half-open'
+            self._probe = object()
+            self._probe_at = now
+            return self._probe
+
+    def cancel(self, token=None):
+        """
+        Withdraw a request admitted by allow() without recording an
+        outcome, e.g., because it was rejected by a concurrency limit.
+
+        :param token: The token returned by allow().
+        """
+
+        with self._lock:
+            if self.state == 'half-open' and token is self._probe:
+                self._probe = None
+                self._probe_at = None
+
+    def record(self, success, token=None):
+        """
+        Record the outcome of a request admitted by allow().
+
+        :param success: True if the request succeeded, False if it
+                        failed.
+        :param token: The token returned by allow().
+        """
+
+        with self._lock:
+            if self.state == 'half-open':
+                # Only the outcome of the probe decides
+                if token is not self._probe:
+                    return
+                self._probe = None
+                self._probe_at = None
+                if success:
+                    self._close()
+                else:
+                    self._open()
+                return
+            elif self.state == 'open':
+                # Admitted before the breaker opened
+                return
+
+            self.outcomes.append(success)
+            if success:
+                self.consecutive = 0
+                return
+
+            self.consecutive += 1
+            if self.failures and self.consecutive >= self.failures:
+                self._open()
+            elif (self.error_rate is not None and
+                  len(self.outcomes) == self.window):
+                errors = sum(1 for x in self.outcomes if not x)
+                if errors >= self.error_rate * self.window:
+                    self._open()
+
+    def _open(self):
+        """
+        Open the breaker.  The lock must be held.
+        """
+
+        self.state = 'open'
+        self.opened += 1
+        self.consecutive = 0
+        self.outcomes.clear()
+        self._opened_at = time.time()
+
+    def _close(self):
+        """
+        Close the breaker.  The lock must be held.
+        """
+
+        self.state = 'closed'
+        self.consecutive = 0
+        self.outcomes.clear()
+
+    def snapshot(self):
+        """
+        Retrieve the state of the breaker.
+
+        :returns: A dictionary with the keys "state", one of "closed",
+                  "open", or "half-open"; "consecutive_failures";
+                  "opened", the number of times the breaker has
+                  opened; and "rejected", the number of requests
+                  rejected.
+        """
+
+        with self._lock:
+            return dict(
+                state=self.state,
+                consecutive_failures=self.consecutive,
+                opened=self.opened,
+                rejected=self.rejected,
+            )
+
+
+class BreakerApp(object):
+    """
+    A WSGI application wrapper which records the outcome of each
+    request in a CircuitBreaker.  A request fails if the application
+    raises an exception, returns a 5xx status, or takes longer than
+    the breaker's latency threshold, or if iterating over the
+    application iterable raises an exception; the request is complete
+    when the application iterable is closed.
+    """
+
+    def __init__(self, app, breaker, token=True):
+        """
+        Initialize a BreakerApp object.
+
+        :param app: The WSGI application to wrap.
+        :param breaker: The CircuitBreaker to record outcomes in.
+        :param token: The token returned by the breaker's allow()
+                      method when the request was admitted.
+        """
+
+        self.app = app
+        self.breaker = breaker
+        self.token = token
+
+    def __call__(self, environ, start_response):
+        """
+        Call the wrapped application.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        start = time.time()
+        status = []
+        failed = []
+
+        def breaker_start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line]
+            return start_response(status_line, headers, exc_info)
+
+        def complete():
+            latency = self.breaker.latency
+            self.breaker.record(
+                bool(status) and not failed and
+                not status[0].startswith('5') and
+                (latency is None or time.time() - start <= latency),
+                self.token)
+
+        try:
+            iterable = self.app(environ, breaker_start_response)
+        except BaseException:
+            self.breaker.record(False, self.token)
+            raise
+
+        return ClosingIterable(iterable, complete,
+                               lambda: failed.append(True))
+
+
+class LatencyStats(object):
+    """
+    Accumulates the number of requests, the number of failed requests,
+    and the latency of requests.
+    """
+
+    def __init__(self):
+        """
+        Initialize a LatencyStats object.
+        """
+
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, success, latency):
+        """
+        Record the outcome of a request.  The caller must provide any
+        necessary locking.
+
+        :param success: True if the request succeeded, False if it
+                        failed.
+        :param latency: The latency of the request, in seconds.
+        """
+
+        self.requests += 1
+        if not success:
+            self.errors += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def snapshot(self):
+        """
+        Summarize the statistics.
+
+        :returns: A dictionary with the keys "requests", "errors",
+                  "mean_latency", and "max_latency".
+        """
+
+        return dict(
+            requests=self.requests,
+            errors=self.errors,
+            mean_latency=(self.total_latency / self.requests
+                          if self.requests else 0.0),
+            max_latency=self.max_latency,
+        )
+
+
+class Shadow(object):
+    """
+    Replays a sample of the requests routed to a version against a
+    candidate version, on a bounded pool of background threads.  The
+    responses of the candidate are discarded; the latency and errors
+    of both versions over the sampled requests are recorded for
+    comparison.  If the queue of requests to replay is full, sampled
+    requests are dropped rather than queued, without reading their
+    bodies.
+    """
+
+    def __init__(self, version, target, rate=0.01, workers=1,
+                 queue_size=100, methods=('GET', 'HEAD'), max_body=65536):
+        """
+        Initialize a Shadow object.
+
+        :param version: The name of the version whose requests are
+                        sampled.
+        :param target: The name of the candidate version.
+        :param rate: The fraction of requests to sample.
+        :param workers: The number of background threads.
+        :param queue_size: The maximum number of requests waiting to
+                           be replayed.
+        :param methods: The request methods which may be sampled.
+        :param max_body: The maximum size of a request body which may
+                         be sampled.  The body of a sampled request
+                         is read into memory, so that it can be
+                         replayed.
+        """
+
+        self.version = version
+        self.target = target
+        self.app = None
+        self.rate = rate
+        self.workers = workers
+        self.queue_size = queue_size
+        self.methods = frozenset(methods)
+        self.max_body = max_body
+
+        self.dropped = 0
+        self.primary = LatencyStats()
+        self.shadow = LatencyStats()
+        self._lock = threading.Lock()
+        self._queue = None
+        self._slots = None
+        self._pid = None
+
+    def sample(self, environ):
+        """
+        Decide whether to replay a request.
+
+        :param environ: The WSGI environment.
+
+        :returns: True if the request should be replayed.
+        """
+
+        if (environ.get('REQUEST_METHOD', 'GET') not in self.methods or
+                random.random() >= self.rate):
+            return False
+
+        # Only requests with a small, known body length may be sampled
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            return False
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return False
+        return length <= self.max_body
+
+    def copy_environ(self, environ):
+        """
+        Copy the WSGI environment of a request for replay.  The
+        ``aversion.*`` variables are copied deeply, so that neither
+        application can alter the other's view of the routing
+        decision.  If the request has a body, it is read, and the
+        input streams of both the original and the copy are replaced.
+
+        :param environ: The WSGI environment.
+
+        :returns: The copy of the WSGI environment.
+        """
+
+        copy_env = dict(environ)
+        for key, value in environ.items():
+            if key.startswith('aversion.'):
+                copy_env[key] = copy.deepcopy(value)
+        copy_env['aversion.shadow'] = self.version
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if length:
+            body = environ['wsgi.input'].read(length)
+            environ['wsgi.input'] = io.BytesIO(body)
+            copy_env['wsgi.input'] = io.BytesIO(body)
+        else:
+            copy_env['wsgi.input'] = io.BytesIO()
+
+        return copy_env
+
+    def submit(self, environ):
+        """
+        Queue a copy of a request for replay against the candidate
+        version.  A place in the queue is reserved before the request
+        is copied by copy_environ(), so the body of a request which
+        is dropped is never read.  The background threads are started
+        on first use, and restarted in a forked child process.
+
+        :param environ: The WSGI environment.
+
+        :returns: True if the request was queued, False if it was
+                  dropped.
+        """
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+
+            work_queue, slots = self._queue, self._slots
+            if not slots.acquire(False):
+                self.dropped += 1
+                return False
+
+        try:
+            copy_env = self.copy_environ(environ)
+        except Exception:
+            slots.release()
+            raise
+
+        work_queue.put(copy_env)
+        return True
+
+    def _start(self):
+        """
+        Start the background threads.  The lock must be held.
+        """
+
+        self._pid = os.getpid()
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      args=(self._queue, self._slots),
+                                      name='aversion-shadow-%s-%d' %
+                                      (self.version, i))
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self, work_queue, slots):
+        """
+        Replay queued requests against the candidate version.
+
+        :param work_queue: The queue to take requests from.
+        :param slots: The semaphore counting the free places in the
+                      queue.
+        """
+
+        while True:
+            environ = work_queue.get()
+            slots.release()
+            self.replay(environ)
+
+    def replay(self, environ):
+        """
+        Replay a request against the candidate version, discarding the
+        response and recording the outcome.
+
+        :param environ: The copied WSGI environment.
+        """
+
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line]
+            return lambda data: None
+
+        start = time.time()
+        try:
+            iterable = self.app(environ, start_response)
+            try:
+                for _data in iterable:
+                    pass
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        except Exception as exc:
+            LOG.debug("Shadow request to version %s failed: %s" %
+                      (self.target, exc))
+            status = []
+
+        self.record(self.shadow, status, time.time() - start)
+
+    def record(self, stats, status, latency):
+        """
+        Record the outcome of a request.  A request fails if the
+        application raises an exception or returns a 5xx status.
+
+        :param stats: The LatencyStats to record the outcome in;
+                      either the ``primary`` or ``shadow`` attribute.
+        :param status: A list containing the status line of the
+                       response, or an empty list if the application
+                       failed to return one.
+        :param latency: The latency of the request, in seconds.
+        """
+
+        with self._lock:
+            stats.record(bool(status) and not status[0].startswith('5'),
+                         latency)
+
+    def snapshot(self):
+        """
+        Retrieve the comparison statistics.
+
+        :returns: A dictionary with the keys "target", the candidate
+                  version; "dropped", the number of sampled requests
+                  dropped because the queue was full; and "primary"
+                  and "shadow", the statistics for the sampled
+                  requests, as for LatencyStats.snapshot().
+        """
+
+        with self._lock:
+            return dict(
+                target=self.target,
+                dropped=self.dropped,
+                primary=self.primary.snapshot(),
+                shadow=self.shadow.snapshot(),
+            )
+
+
+class ShadowApp(object):
+    """
+    A WSGI application wrapper which submits a copy of the request to
+    a Shadow, and records the outcome of the request for comparison.
+    """
+
+    def __init__(self, app, shadow):
+        """
+        Initialize a ShadowApp object.
+
+        :param app: The WSGI application to wrap.
+        :param shadow: The Shadow to submit the request to.
+        """
+
+        self.app = app
+        self.shadow = shadow
+
+    def __call__(self, environ, start_response):
+        """
+        Call the wrapped application.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        if not self.shadow.submit(environ):
+            # Dropped; do not record the outcome
+            return self.app(environ, start_response)
+
+        start = time.time()
+        status = []
+
+        def shadow_start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line]
+            return start_response(status_line, headers, exc_info)
+
+        def complete():
+            self.shadow.record(self.shadow.primary, status,
+                               time.time() - start)
+
+        try:
+            iterable = self.app(environ, shadow_start_response)
+        except BaseException:
+            self.shadow.record(self.shadow.primary, [], time.time() - start)
+            raise
+
+        return ClosingIterable(iterable, complete)
+
+
+def _cache_directives(headers):
+    """
+    Parse the "Cache-Control" response headers.
+
+    :param headers: A list of the response headers.
+
+    :returns: A dictionary mapping the lower-cased directive names to
+              their arguments; directives without arguments map to
+              the empty string.
+    """
+
+    directives = {}
+    for name, value in headers:
+        if name.lower() != 'cache-control':
+            continue
+        for directive in value.split(','):
+            key, _eq, arg = directive.strip().partition('=')
+            directives[key.strip().lower()] = arg.strip().strip('"')
+    return directives
+
+
+def _shareable(headers):
+    """
+    Determine whether a response may be sent to clients other than
+    the one which requested it.
+
+    :param headers: A list of the response headers.
+
+    :returns: False if the response sets cookies, varies by headers
+              other than "Accept", or has a "Cache-Control" header
+              containing "no-store", "no-cache", or "private"; True
+              otherwise.  A response varying by "Accept" may only be
+              shared with requests passing the same "Accept" header
+              to the application.
+    """
+
+    for name, value in headers:
+        name = name.lower()
+        if name == 'set-cookie':
+            return False
+        elif name == 'vary':
+            for header in value.split(','):
+                if header.strip().lower() not in ('', 'accept'):
+                    return False
+
+    directives = _cache_directives(headers)
+    return not ('no-store' in directives or 'no-cache' in directives or
+                'private' in directives)
+
+
+def _private_request(environ):
+    """
+    Determine whether a request must not be answered with a response
+    shared with other requests.
+
+    :param environ: The WSGI environment.
+
+    :returns: True if the request carries credentials or asks for
+              revalidation; False otherwise.
+    """
+
+    control = (environ.get('HTTP_CACHE_CONTROL', '') + ',' +
+               environ.get('HTTP_PRAGMA', '')).lower()
+    return 'HTTP_AUTHORIZATION' in environ or 'no-cache' in control
+
+
+def _cache_lifetime(headers, default=0):
+    """
+    Determine how long a response may be stored by a shared cache.
+
+    :param headers: A list of the response headers.
+    :param default: The lifetime, in seconds, to use if the response
+                    does not specify one.
+
+    :returns: The lifetime in seconds.  This is 0 if the response may
+              not be stored.
+    """
+
+    if not _shareable(headers):
+        return 0
+
+    directives = _cache_directives(headers)
+    for key in ('s-maxage', 'max-age'):
+        if key in directives:
+            try:
+                return max(int(directives[key]), 0)
+            except ValueError:
+                return 0
+
+    return default
+
+
+class ResponseCache(object):
+    """
+    An in-memory cache of the responses of the application for a
+    version.  Responses are evicted in least-recently-used order to
+    keep the total size of the cached response bodies and headers
+    within a byte budget.
+    """
+
+    def __init__(self, version, size=1048576, ttl=0, max_entry=None):
+        """
+        Initialize a ResponseCache object.
+
+        :param version: The version name.
+        :param size: The maximum total size of the cached responses,
+                     in bytes.
+        :param ttl: The number of seconds to cache a response which
+                    does not specify a lifetime with a
+                    "Cache-Control" header.  If 0, such responses are
+                    not cached.
+        :param max_entry: The maximum size of a single response, in
+                          bytes.  Defaults to ``size``.
+        """
+
+        self.version = version
+        self.size = size
+        self.ttl = ttl
+        self.max_entry = size if max_entry is None else min(max_entry, size)
+
+        # The entries are kept in a circular doubly-linked list, most
+        # recently used first; each node is a list of the previous
+        # node, the next node, the key, and the entry
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._nodes = {}
+        self.used = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def _unlink(self, node):
+        """
+        Remove a node from the list.  The lock must be held.
+
+        :param node: The node.
+        """
+
+        prev_node, next_node = node[0], node[1]
+        prev_node[1] = next_node
+        next_node[0] = prev_node
+
+    def _link(self, node):
+        """
+        Insert a node at the head of the list.  The lock must be
+        held.
+
+        :param node: The node.
+        """
+
+        first = self._root[1]
+        node[0], node[1] = self._root, first
+        first[0] = node
+        self._root[1] = node
+
+    def _remove(self, node):
+        """
+        Remove an entry from the cache.  The lock must be held.
+
+        :param node: The node for the entry.
+        """
+
+        self._unlink(node)
+        del self._nodes[node[2]]
+        self.used -= node[3]['cost']
+
+    def get(self, key, now=None):
+        """
+        Look up a response.
+
+        :param key: The cache key.
+        :param now: The current time.  Defaults to the value of
+                    ``time.time()``.
+
+        :returns: A dictionary with the keys "status", "headers",
+                  "body", "stored", and "expires"; or None if no fresh
+                  response is cached.
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is not None and node[3]['expires'] <= now:
+                self._remove(node)
+                node = None
+
+            if node is None:
+                self.misses += 1
+                return None
+
+            # Mark the entry as recently used
+            self._unlink(node)
+            self._link(node)
+            self.hits += 1
+            return node[3]
+
+    def put(self, key, status, headers, body, lifetime, now=None):
+        """
+        Store a response.
+
+        :param key: The cache key.
+        :param status: The response status.
+        :param headers: A list of the response headers.
+        :param body: The response body, as a byte string.
+        :param lifetime: The number of seconds the response is fresh.
+        :param now: The current time.  Defaults to the value of
+                    ``time.time()``.
+
+        :returns: True if the response was stored, False if it is too
+                  large.
+        """
+
+        if now is None:
+            now = time.time()
+
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'age']
+        cost = len(body) + sum(len(name) + len(value) + 4
+                               for name, value in headers)
+        if cost > self.max_entry:
+            return False
+
+        entry = dict(status=status, headers=headers, body=body,
+                     stored=now, expires=now + lifetime, cost=cost)
+
+        with self._lock:
+            if key in self._nodes:
+                self._remove(self._nodes[key])
+
+            # Evict the least recently used entries to make room
+            while self._nodes and self.used + cost > self.size:
+                self._remove(self._root[0])
+                self.evictions += 1
+
+            node = [None, None, key, entry]
+            self._link(node)
+            self._nodes[key] = node
+            self.used += cost
+            self.stores += 1
+
+        return True
+
+    def snapshot(self):
+        """
+        Retrieve the current state of the cache.
+
+        :returns: A dictionary with the keys "entries", "bytes",
+                  "hits", "misses", "stores", and "evictions".
+        """
+
+        with self._lock:
+            return dict(
+                entries=len(self._nodes),
+                bytes=self.used,
+                hits=self.hits,
+                misses=self.misses,
+                stores=self.stores,
+                evictions=self.evictions,
+            )
+
+
+class BufferingIterable(object):
+    """
+    A wrapper for a WSGI application iterable which collects the
+    response body as it is sent.  Once the response is complete, a
+    callback is passed the status, headers, and body; if the body is
+    too large, or the response is not sent in full, the callback is
+    passed None for the body instead.
+    """
+
+    def __init__(self, iterable, start, max_size, callback):
+        """
+        Initialize a BufferingIterable object.
+
+        :param iterable: The application iterable to wrap.
+        :param start: A list which will contain the status and headers
+                      passed to start_response().
+        :param max_size: The maximum size of the body to collect, in
+                         bytes.
+        :param callback: A callable taking the status, headers, and
+                         body.  It is called at most once.
+        """
+
+        self.iterable = iterable
+        self.start = start
+        self.max_size = max_size
+        self.callback = callback
+        self.chunks = []
+        self.length = 0
+        self.complete = False
+
+    def __iter__(self):
+        """
+        Iterate over the wrapped application iterable.
+        """
+
+        for data in self.iterable:
+            if self.chunks is not None:
+                self.length += len(data)
+                if self.length > self.max_size:
+                    # Too big; stop collecting
+                    self.chunks = None
+                    self._done(None)
+                else:
+                    self.chunks.append(data)
+            yield data
+
+        self.complete = True
+
+    def _done(self, body):
+        """
+        Call the callback, if it has not been called.
+
+        :param body: The response body, or None.
+        """
+
+        callback, self.callback = self.callback, None
+        if callback:
+            status, headers = self.start[-1] if self.start else (None, [])
+            callback(status, headers, body)
+
+    def close(self):
+        """
+        Close the wrapped application iterable, then call the
+        callback.
+        """
+
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            if self.complete and self.chunks is not None and self.start:
+                self._done(b''.join(self.chunks))
+            else:
+                self._done(None)
+
+
+class CachedApp(object):
+    """
+    A WSGI application wrapper which answers GET and HEAD requests
+    from a ResponseCache when possible, and stores the responses to
+    GET requests.
+    """
+
+    def __init__(self, app, cache, key, on_hit=None):
+        """
+        Initialize a CachedApp object.
+
+        :param app: The WSGI application to wrap.
+        :param cache: The ResponseCache object.
+        :param key: The cache key for the request.
+        :param on_hit: An optional callable taking no arguments,
+                       which is called if the request is answered from
+                       the cache.
+        """
+
+        self.app = app
+        self.cache = cache
+        self.key = key
+        self.on_hit = on_hit
+
+    def __call__(self, environ, start_response):
+        """
+        Return the cached response, or call the wrapped application.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        # Requests with credentials are not answered from the cache,
+        # nor are requests which ask the cache to revalidate
+        if _private_request(environ):
+            return self.app(environ, start_response)
+
+        entry = self.cache.get(self.key)
+        if entry is not None:
+            if self.on_hit:
+                self.on_hit()
+            age = int(time.time() - entry['stored'])
+            start_response(entry['status'], entry['headers'] +
+                           [('Age', str(age))])
+            if environ.get('REQUEST_METHOD') == 'HEAD':
+                return []
+            return [entry['body']]
+
+        if environ.get('REQUEST_METHOD') != 'GET':
+            return self.app(environ, start_response)
+
+        # Capture the status and headers to store with the body
+        start = []
+
+        def caching_start_response(status, headers, exc_info=None):
+            start.append((status, headers))
+            return start_response(status, headers, exc_info)
+
+        return BufferingIterable(self.app(environ, caching_start_response),
+                                 start, self.cache.max_entry, self.store)
+
+    def store(self, status, headers, body):
+        """
+        Store a complete response in the cache, if it may be cached.
+
+        :param status: The response status.
+        :param headers: A list of the response headers.
+        :param body: The response body, or None if the response is
+                     incomplete or too large.  If the headers have no
+                     "Content-Length" header, one is added.
+        """
+
+        if body is None or not status.startswith('200'):
+            return
+
+        lifetime = _cache_lifetime(headers, self.cache.ttl)
+        if lifetime <= 0:
+            return
+
+        # Record the length, so that a HEAD request answered from the
+        # cache gets the headers of the matching GET response
+        if 'content-length' not in [name.lower() for name, _value in headers]:
+            headers = headers + [('Content-Length', str(len(body)))]
+
+        self.cache.put(self.key, status, headers, body, lifetime)
+
+
+class Flight(object):
+    """
+    A request being processed on behalf of a group of identical
+    requests.
+    """
+
+    def __init__(self, started):
+        """
+        Initialize a Flight object.
+
+        :param started: The time the request started.
+        """
+
+        self.started = started
+        self.response = None
+        self.event = threading.Event()
+
+
+class Coalescer(object):
+    """
+    Coalesces identical concurrent requests for a version.  The first
+    request is passed to the application; identical requests arriving
+    while it is processed wait for it to complete, and then share its
+    response.  Error responses are not shared; the waiting requests
+    are then passed to the application themselves.
+    """
+
+    def __init__(self, version, max_size=65536, timeout=5):
+        """
+        Initialize a Coalescer object.
+
+        :param version: The version name.
+        :param max_size: The maximum size of a response body which may
+                         be shared, in bytes.
+        :param timeout: The maximum number of seconds a request waits
+                        for the response; requests waiting longer are
+                        passed to the application.
+        """
+
+        self.version = version
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self._flights = {}
+        self.waiting = 0
+        self.leaders = 0
+        self.shared = 0
+        self.unshared = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def join(self, key, now=None):
+        """
+        Join the flight for a request, starting a new one if no
+        identical request is being processed.
+
+        :param key: The key identifying identical requests.
+        :param now: The current time.  Defaults to the value of
+                    ``time.time()``.
+
+        :returns: A tuple of the Flight object and a boolean, which is
+                  True if the caller must process the request and then
+                  call finish().
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            flight = self._flights.get(key)
+
+            # A flight which outlived the timeout is abandoned, in
+            # case its response is never closed
+            if flight is not None and flight.started + self.timeout > now:
+                return flight, False
+
+            flight = Flight(now)
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def finish(self, key, flight, response=None):
+        """
+        Complete a flight, releasing the waiting requests.
+
+        :param key: The key identifying identical requests.
+        :param flight: The Flight object.
+        :param response: A tuple of the status, headers, and body of
+                         the response to share, or None if the waiting
+                         requests must be processed separately.
+        """
+
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        flight.response = response
+        flight.event.set()
+
+    def wait(self, flight):
+        """
+        Wait for a flight to complete.
+
+        :param flight: The Flight object.
+
+        :returns: A tuple of the status, headers, and body of the
+                  response, or None if the response cannot be shared
+                  or the wait timed out.
+        """
+
+        with self._lock:
+            self.waiting += 1
+
+        flight.event.wait(self.timeout)
+
+        with self._lock:
+            self.waiting -= 1
+            if not flight.event.is_set():
+                self.timeouts += 1
+            elif flight.response is None:
+                self.unshared += 1
+            else:
+                self.shared += 1
+
+        return flight.response if flight.event.is_set() else None
+
+    def snapshot(self):
+        """
+        Retrieve the current state of the coalescer.
+
+        :returns: A dictionary with the keys "in_flight", "waiting",
+                  "leaders", "shared", "unshared", and "timeouts".
+        """
+
+        with self._lock:
+            return dict(
+                in_flight=len(self._flights),
+                waiting=self.waiting,
+                leaders=self.leaders,
+                shared=self.shared,
+                unshared=self.unshared,
+                timeouts=self.timeouts,
+            )
+
+
+class CoalescedApp(object):
+    """
+    A WSGI application wrapper which coalesces identical concurrent
+    GET requests using a Coalescer.
+    """
+
+    def __init__(self, app, coalescer, key, on_shared=None):
+        """
+        Initialize a CoalescedApp object.
+
+        :param app: The WSGI application to wrap.
+        :param coalescer: The Coalescer object.
+        :param key: The key identifying identical requests.
+        :param on_shared: An optional callable taking no arguments,
+                          which is called if the request is answered
+                          with a shared response.
+        """
+
+        self.app = app
+        self.coalescer = coalescer
+        self.key = key
+        self.on_shared = on_shared
+
+    def __call__(self, environ, start_response):
+        """
+        Call the wrapped application, or wait for an identical request
+        to complete and return its response.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        if (environ.get('REQUEST_METHOD') != 'GET' or
+                _private_request(environ)):
+            return self.app(environ, start_response)
+
+        flight, leader = self.coalescer.join(self.key)
+        if not leader:
+            response = self.coalescer.wait(flight)
+            if response is None:
+                return self.app(environ, start_response)
+
+            if self.on_shared:
+                self.on_shared()
+            status, headers, body = response
+            start_response(status, list(headers))
+            return [body]
+
+        # Capture the status and headers to share with the body
+        start = []
+
+        def leader_start_response(status, headers, exc_info=None):
+            start.append((status, headers))
+            return start_response(status, headers, exc_info)
+
+        def finish(status, headers, body):
+            if (body is not None and status[:3] in SHAREABLE_STATUSES and
+                    _shareable(headers)):
+                self.coalescer.finish(self.key, flight,
+                                      (status, headers, body))
+            else:
+                self.coalescer.finish(self.key, flight)
+
+        try:
+            iterable = self.app(environ, leader_start_response)
+        except BaseException:
+            self.coalescer.finish(self.key, flight)
+            raise
+
+        return BufferingIterable(iterable, start, self.coalescer.max_size,
+                                 finish)
+
+
+class ConnectionPool(object):
+    """
+    A pool of persistent HTTP connections to a single upstream server.
+    At most ``max_size`` idle connections are retained; a request
+    finding no idle connection opens a new one.
+    """
+
+    def __init__(self, scheme, host, port=None, max_size=10, timeout=None):
+        """
+        Initialize a ConnectionPool object.
+
+        :param scheme: The URL scheme; either "http" or "https".
+        :param host: The host name of the upstream server.
+        :param port: The port number of the upstream server.  If
+                     None, the default port for the scheme is used.
+        :param max_size: The maximum number of idle connections to
+                         retain.
+        :param timeout: The socket timeout for connections, in
+                        seconds.  If None, the global default is used.
+        """
+
+        self.connection_class = (httplib.HTTPSConnection
+                                 if scheme == 'https' else
+                                 httplib.HTTPConnection)
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Open a new connection to the upstream server.  The connection
+        is made when the first request is sent.
+
+        :returns: An HTTPConnection object.
+        """
+
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        return self.connection_class(self.host, self.port, **kwargs)
+
+    def get(self):
+        """
+        Obtain a connection from the pool, opening a new one if no
+        idle connection is available.
+
+        :returns: A tuple of the HTTPConnection object and a boolean
+                  which is True if the connection was idle in the
+                  pool, and hence may have been closed by the
+                  upstream server.
+        """
+
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+
+        return self.connect(), False
+
+    def put(self, conn):
+        """
+        Return a connection to the pool.  The connection is closed if
+        the pool is full.
+
+        :param conn: The HTTPConnection object.  Any response must
+                     have been completely read and closed.
+        """
+
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        """
+        Close all the idle connections.
+        """
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn in idle:
+            conn.close()
+
+
+class ProxyResponse(object):
+    """
+    A WSGI application iterable which streams the body of an upstream
+    response.  When the iterable is closed, the connection is returned
+    to the pool if the body was completely read and the upstream
+    server allows the connection to be reused.
+    """
+
+    def __init__(self, pool, conn, response, block_size=65536):
+        """
+        Initialize a ProxyResponse object.
+
+        :param pool: The ConnectionPool the connection came from.
+        :param conn: The HTTPConnection object.
+        :param response: The HTTPResponse object.
+        :param block_size: The maximum size of each block of the body.
+        """
+
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.block_size = block_size
+        self.complete = False
+
+    def __iter__(self):
+        """
+        Iterate over the blocks of the response body.
+        """
+
+        while True:
+            data = self.response.read(self.block_size)
+            if not data:
+                self.complete = True
+                return
+            yield data
+
+    def close(self):
+        """
+        Release the connection.
+        """
+
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+
+        reusable = ((self.complete or self.response.length == 0) and
+                    not self.response.will_close)
+        self.response.close()
+        if reusable:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+
+class ProxyApp(object):
+    """
+    A WSGI application which forwards requests to an upstream HTTP
+    server over a pool of persistent connections.  Request and
+    response bodies are streamed, not buffered.
+    """
+
+    def __init__(self, url, pool_size=10, timeout=None, block_size=65536):
+        """
+        Initialize a ProxyApp object.
+
+        :param url: The base URL of the upstream server, e.g.,
+                    "http://localhost:8081/api".  The path of each
+                    request, relative to the selected version, is
+                    appended to the path of the URL.
+        :param pool_size: The maximum number of idle connections to
+                          retain.
+        :param timeout: The socket timeout for connections, in
+                        seconds.  If None, the global default is used.
+        :param block_size: The maximum size of each block of the
+                           request and response bodies.
+        """
+
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError("Invalid upstream URL %r" % url)
+
+        self.url = url
+        self.prefix = parts.path.rstrip('/')
+        self.block_size = block_size
+        self.pool = ConnectionPool(parts.scheme, parts.hostname, parts.port,
+                                   pool_size, timeout)
+
+        # Pre-render the error responses
+        self.bad_gateway = _error_response(
+            '502 Bad Gateway', 'Unable to contact the upstream server.')
+        self.gateway_timeout = _error_response(
+            '504 Gateway Timeout', 'The upstream server timed out.')
+        self.length_required = _error_response(
+            '411 Length Required',
+            'A Content-Length header is required.')
+
+    def __deepcopy__(self, memo):
+        """
+        The configuration describing the versions, including their
+        applications, is copied into each request's environment; the
+        connection pool must be shared, not copied.
+        """
+
+        return self
+
+    def configure(self, pool_size=None, timeout=None):
+        """
+        Alter the connection pool options.  This affects connections
+        opened after it is called.
+
+        :param pool_size: The maximum number of idle connections to
+                          retain.
+        :param timeout: The socket timeout for connections, in
+                        seconds.
+        """
+
+        if pool_size is not None:
+            self.pool.max_size = pool_size
+        if timeout is not None:
+            self.pool.timeout = timeout
+
+    def __call__(self, environ, start_response):
+        """
+        Forward the request to the upstream server.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        # Determine how the request body is to be sent
+        chunked = ('chunked' in
+                   environ.get('HTTP_TRANSFER_ENCODING', '').lower())
+        try:
+            length = 0 if chunked else int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if chunked and not environ.get('wsgi.input_terminated'):
+            # We cannot tell where the request body ends
+            return self.length_required(environ, start_response)
+
+        path = self.prefix + quote(environ.get('PATH_INFO', ''),
+                                   safe="/:@&+$,;=-._~!*'()")
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        headers = self._request_headers(environ, length, chunked)
+
+        # Only requests which may safely be sent twice, and whose body
+        # has not been consumed, are retried
+        method = environ.get('REQUEST_METHOD', 'GET')
+        retry = method in IDEMPOTENT_METHODS and not (length or chunked)
+
+        while True:
+            conn, reused = self.pool.get()
+            try:
+                response = self._forward(conn, environ, path, headers,
+                                         length, chunked)
+                break
+            except (socket.error, httplib.HTTPException) as exc:
+                conn.close()
+
+                # An idle connection may have been closed by the
+                # upstream server before it received the request
+                if retry and reused and _stale_connection(exc):
+                    continue
+
+                LOG.warn("Error forwarding request to %s: %s" %
+                         (self.url, exc))
+                if isinstance(exc, socket.timeout):
+                    return self.gateway_timeout(environ, start_response)
+                return self.bad_gateway(environ, start_response)
+
+        start_response('%d %s' % (response.status, response.reason),
+                       self._response_headers(response))
+        return ProxyResponse(self.pool, conn, response, self.block_size)
+
+    def _request_headers(self, environ, length, chunked):
+        """
+        Build the list of headers to send to the upstream server.
+
+        :param environ: The WSGI environment.
+        :param length: The length of the request body.
+        :param chunked: If True, the request body is sent using the
+                        chunked transfer coding.
+
+        :returns: A list of tuples of header name and value.
+        """
+
+        # Headers named in the Connection header are also hop-by-hop
+        skip = set(HOP_BY_HOP)
+        skip.update(x.strip().lower() for x in
+                    environ.get('HTTP_CONNECTION', '').split(','))
+        skip.update(['host', 'expect', 'content-length',
+                     'x-forwarded-for', 'x-forwarded-host',
+                     'x-forwarded-proto'])
+
+        headers = []
+        for key, value in environ.items():
+            if not key.startswith('HTTP_'):
+                continue
+            name = key[5:].replace('_', '-').title()
+            if name.lower() not in skip:
+                headers.append((name, value))
+        if environ.get('CONTENT_TYPE'):
+            headers.append(('Content-Type', environ['CONTENT_TYPE']))
+        if chunked:
+            headers.append(('Transfer-Encoding', 'chunked'))
+        elif length:
+            headers.append(('Content-Length', str(length)))
+
+        # Identify the original request
+        forwarded_for = environ.get('HTTP_X_FORWARDED_FOR')
+        remote_addr = environ.get('REMOTE_ADDR')
+        if forwarded_for and remote_addr:
+            forwarded_for = '%s, %s' % (forwarded_for, remote_addr)
+        if forwarded_for or remote_addr:
+            headers.append(('X-Forwarded-For', forwarded_for or remote_addr))
+        if environ.get('HTTP_HOST'):
+            headers.append(('X-Forwarded-Host', environ['HTTP_HOST']))
+        headers.append(('X-Forwarded-Proto',
+                        environ.get('wsgi.url_scheme', 'http')))
+
+        return headers
+
+    def _forward(self, conn, environ, path, headers, length, chunked):
+        """
+        Send the request to the upstream server, streaming the request
+        body, and read the response status and headers.
+
+        :param conn: The HTTPConnection object.
+        :param environ: The WSGI environment.
+        :param path: The path and query string of the request.
+        :param headers: The list of headers to send.
+        :param length: The length of the request body.
+        :param chunked: If True, the request body is sent using the
+                        chunked transfer coding.
+
+        :returns: The HTTPResponse object.
+        """
+
+        conn.putrequest(environ.get('REQUEST_METHOD', 'GET'), path,
+                        skip_accept_encoding=True)
+        for name, value in headers:
+            conn.putheader(name, value)
+        conn.endheaders()
+
+        # Stream the request body
+        body = environ.get('wsgi.input')
+        if chunked:
+            while True:
+                data = body.read(self.block_size)
+                if not data:
+                    break
+                conn.send(('%x\r\n' % len(data)).encode('ascii') +
+                          data + b'\r\n')
+            conn.send(b'0\r\n\r\n')
+        else:
+            while length > 0:
+                data = body.read(min(length, self.block_size))
+                if not data:
+                    break
+                conn.send(data)
+                length -= len(data)
+
+        return conn.getresponse()
+
+    @staticmethod
+    def _response_headers(response):
+        """
+        Build the list of headers to return to the client.
+
+        :param response: The HTTPResponse object.
+
+        :returns: A list of tuples of header name and value.
+        """
+
+        msg = response.msg
+        if hasattr(msg, 'items') and not hasattr(msg, 'headers'):
+            items = msg.items()
+        else:
+            # Python 2's HTTPMessage merges repeated headers in
+            # items(), so parse the raw header lines instead
+            items = []
+            for line in msg.headers:
+                if line[:1] in (' ', '\t') and items:
+                    # A continuation line
+                    name, value = items[-1]
+                    items[-1] = (name, value + ' ' + line.strip())
+                    continue
+                name, _sep, value = line.partition(':')
+                items.append((name.strip(), value.strip()))
+
+        # Headers named in the Connection header are also hop-by-hop
+        skip = set(HOP_BY_HOP)
+        skip.update(x.strip().lower() for x in
+                    (response.getheader('connection') or '').split(','))
+
+        return [(name, value) for name, value in items
+                if name.lower() not in skip]
+
+
+def _stale_connection(exc):
+    """
+    Determine whether an error forwarding a request indicates that
+    the connection was closed by the upstream server before any part
+    of the response was received, as happens when the server closes
+    an idle persistent connection.  Timeouts never qualify.
+
+    :param exc: The exception raised.
+
+    :returns: True if the connection was closed before the response
+              began, False otherwise.
+    """
+
+    if isinstance(exc, socket.timeout):
+        return False
+    elif isinstance(exc, httplib.BadStatusLine):
+        return True
+
+    return (isinstance(exc, socket.error) and
+            getattr(exc, 'errno', None) in (errno.ECONNRESET, errno.EPIPE))
+
+
+def _send_frame(sock, kind, payload=b''):
+    """
+    Send a frame to a worker process or its parent.
+
+    :param sock: The socket.
+    :param kind: The frame type, one of the FRAME_* constants.
+    :param payload: The frame payload, as a byte string.
+    """
+
+    sock.sendall(FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exact(sock, length):
+    """
+    Receive exactly the given number of bytes.
+
+    :param sock: The socket.
+    :param length: The number of bytes to receive.
+
+    :returns: The bytes received.
+
+    :raises EOFError: The connection was closed.
+    """
+
+    chunks = []
+    while length > 0:
+        data = sock.recv(min(length, 65536))
+        if not data:
+            raise EOFError("Connection closed")
+        chunks.append(data)
+        length -= len(data)
+    return b''.join(chunks)
+
+
+def _recv_frame(sock):
+    """
+    Receive a frame from a worker process or its parent.
+
+    :param sock: The socket.
+
+    :returns: A tuple of the frame type and the payload.
+
+    :raises EOFError: The connection was closed.
+    """
+
+    kind, length = FRAME_HEADER.unpack(_recv_exact(sock, FRAME_HEADER.size))
+    return kind, _recv_exact(sock, length)
+
+
+def _close_fds(keep):
+    """
+    Close all file descriptors other than the standard streams and
+    the given descriptor.
+
+    :param keep: The file descriptor to keep open.
+    """
+
+    try:
+        max_fd = os.sysconf('SC_OPEN_MAX')
+    except (AttributeError, ValueError, OSError):
+        max_fd = -1
+    if max_fd < 0:
+        max_fd = 256
+
+    os.closerange(3, keep)
+    os.closerange(keep + 1, max_fd)
+
+
+def _worker_main(app, sock):
+    """
+    The main loop of a worker process.  Requests are received from
+    the parent, passed to the application, and the responses streamed
+    back, until the parent closes the connection.  The worker does
+    not log; errors are reported to the parent, which logs them.
+
+    :param app: The WSGI application.
+    :param sock: The socket connected to the parent.
+    """
+
+    while True:
+        try:
+            kind, payload = _recv_frame(sock)
+        except EOFError:
+            return
+
+        # Receive the environment and spool the request body, so the
+        # parent never blocks sending the body while we send the
+        # response
+        environ = pickle.loads(payload)
+        body = tempfile.SpooledTemporaryFile(1024 * 1024)
+        while True:
+            kind, payload = _recv_frame(sock)
+            if kind != FRAME_BODY:
+                break
+            body.write(payload)
+        body.seek(0)
+
+        environ.update({
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': True,
+        })
+
+        # Headers are sent along with the first data
+        state = dict(start=None, sent=False)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state['sent']:
+                # Too late to change the status and headers
+                raise exc_info[1]
+            state['start'] = (status, headers)
+            return write
+
+        def write(data):
+            if not state['sent']:
+                if state['start'] is None:
+                    raise RuntimeError("Application did not call "
+                                       "start_response")
+                _send_frame(sock, FRAME_START,
+                            pickle.dumps(state['start'], 2))
+                state['sent'] = True
+            if data:
+                _send_frame(sock, FRAME_DATA, data)
+
+        try:
+            iterable = app(environ, start_response)
+            try:
+                for data in iterable:
+                    write(data)
+                write(b'')
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        except Exception:
+            msg = traceback.format_exc()
+            if not isinstance(msg, bytes):
+                msg = msg.encode('utf-8')
+            _send_frame(sock, FRAME_ERROR, msg)
+        else:
+            _send_frame(sock, FRAME_END)
+        finally:
+            body.close()
+
+
+class WorkerProcess(object):
+    """
+    A worker process running a WSGI application.  The process is
+    forked from the current process, and so inherits the loaded
+    application.  It handles one request at a time, received over a
+    Unix socket.
+    """
+
+    def __init__(self, app):
+        """
+        Initialize a WorkerProcess object, forking the process.
+
+        :param app: The WSGI application to run.
+        """
+
+        parent_sock, child_sock = socket.socketpair()
+        self.pid = os.fork()
+        if not self.pid:
+            # In the child; close every inherited file descriptor but
+            # the standard streams and the socket to the parent, so
+            # the client connections, listening sockets, and sockets
+            # to the other workers are not held open
+            status = 1
+            try:
+                parent_sock.close()
+                _close_fds(child_sock.fileno())
+                _worker_main(app, child_sock)
+                status = 0
+            finally:
+                os._exit(status)
+
+        child_sock.close()
+        self.sock = parent_sock
+
+    def stop(self):
+        """
+        Stop the worker process.
+        """
+
+        self.sock.close()
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+
+class WorkerResponse(object):
+    """
+    A WSGI application iterable which streams the response body from a
+    worker process.  When the iterable is closed, the remainder of the
+    response is discarded and the worker is returned to the pool.
+    """
+
+    def __init__(self, pool, worker):
+        """
+        Initialize a WorkerResponse object.
+
+        :param pool: The WorkerPool the worker came from.
+        :param worker: The WorkerProcess object.
+        """
+
+        self.pool = pool
+        self.worker = worker
+        self.complete = False
+
+    def __iter__(self):
+        """
+        Iterate over the blocks of the response body.
+        """
+
+        while not self.complete:
+            kind, payload = _recv_frame(self.worker.sock)
+            if kind == FRAME_DATA:
+                yield payload
+            elif kind == FRAME_END:
+                self.complete = True
+            else:
+                # The worker is ready for the next request
+                self.complete = True
+                raise RuntimeError("Worker for version %s failed: %s" %
+                                   (self.pool.version,
+                                    payload.decode('utf-8', 'replace')))
+
+    def close(self):
+        """
+        Release the worker.
+        """
+
+        worker, self.worker = self.worker, None
+        if worker is None:
+            return
+
+        # Discard the rest of the response
+        try:
+            while not self.complete:
+                kind, _payload = _recv_frame(worker.sock)
+                self.complete = kind in (FRAME_END, FRAME_ERROR)
+        except (socket.error, EOFError):
+            self.pool.discard(worker)
+            return
+
+        self.pool.release(worker)
+
+
+class WorkerPool(object):
+    """
+    A WSGI application which runs another WSGI application in a pool
+    of worker processes.  The processes are started by start() when
+    the pool is configured, before the server starts any request
+    threads, and restarted in a forked child process.  Each request
+    is passed to an idle worker; the request body is spooled by the
+    worker before the application is called, and the response is
+    streamed back.
+    """
+
+    def __init__(self, version, app, processes=2, timeout=None,
+                 block_size=65536):
+        """
+        Initialize a WorkerPool object.
+
+        :param version: The version name.  This is used in messages.
+        :param app: The WSGI application to run in the workers.
+        :param processes: The number of worker processes.
+        :param timeout: The number of seconds a request may wait for
+                        an idle worker.  If None, requests wait
+                        indefinitely.
+        :param block_size: The maximum size of each block of the
+                           request body.
+        """
+
+        self.version = version
+        self.app = app
+        self.processes = processes
+        self.timeout = timeout
+        self.block_size = block_size
+
+        self._workers = []
+        self._idle = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        # Pre-render the error responses
+        self.unavailable = _error_response(
+            '503 Service Unavailable',
+            'No worker is available for version %s.' % version,
+            [('Retry-After', '1')])
+        self.worker_failed = _error_response(
+            '502 Bad Gateway',
+            'The worker for version %s failed.' % version)
+        self.length_required = _error_response(
+            '411 Length Required',
+            'A Content-Length header is required.')
+        self.app_failed = _error_response(
+            '500 Internal Server Error',
+            'The application for version %s failed.' % version)
+
+    def __deepcopy__(self, memo):
+        """
+        The configuration describing the versions, including their
+        applications, is copied into each request's environment; the
+        pool must be shared, not copied.
+        """
+
+        return self
+
+    def _spawn(self):
+        """
+        Start a new worker process.  The lock must be held.
+
+        :returns: The WorkerProcess object.
+        """
+
+        worker = WorkerProcess(self.app)
+        self._workers.append(worker)
+        return worker
+
+    def start(self):
+        """
+        Start the worker processes, if they have not been started in
+        this process.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            # Forget workers inherited from a parent process
+            for worker in self._workers:
+                worker.sock.close()
+            self._workers = []
+            self._pid = os.getpid()
+            self._idle = queue.Queue()
+            for i in range(self.processes):
+                self._idle.put(self._spawn())
+
+    def stop(self):
+        """
+        Stop the worker processes.
+        """
+
+        with self._lock:
+            workers, self._workers = self._workers, []
+            self._pid = None
+
+        for worker in workers:
+            worker.stop()
+
+    def release(self, worker):
+        """
+        Return a worker to the pool.
+
+        :param worker: The WorkerProcess object.
+        """
+
+        self._idle.put(worker)
+
+    def discard(self, worker):
+        """
+        Stop a worker which has failed, and replace it.
+
+        :param worker: The WorkerProcess object.
+        """
+
+        LOG.warn("Restarting worker %d for version %s" %
+                 (worker.pid, self.version))
+        worker.stop()
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+            self._idle.put(self._spawn())
+
+    def __call__(self, environ, start_response):
+        """
+        Pass the request to a worker process.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        # Determine how much of the request body is to be sent
+        chunked = ('chunked' in
+                   environ.get('HTTP_TRANSFER_ENCODING', '').lower())
+        if chunked:
+            if not environ.get('wsgi.input_terminated'):
+                # We cannot tell where the request body ends
+                return self.length_required(environ, start_response)
+            length = None
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+
+        self.start()
+
+        # Find an idle worker
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            return self.unavailable(environ, start_response)
+
+        try:
+            # Send the environment, then stream the request body
+            _send_frame(worker.sock, FRAME_ENVIRON, pickle.dumps(dict(
+                (key, value) for key, value in environ.items()
+                if isinstance(value, ENVIRON_TYPES) or
+                (isinstance(value, tuple) and
+                 all(isinstance(x, ENVIRON_TYPES) for x in value))), 2))
+
+            # A chunked body is read until the input is exhausted
+            while length is None or length > 0:
+                data = environ['wsgi.input'].read(
+                    self.block_size if length is None else
+                    min(length, self.block_size))
+                if not data:
+                    break
+                _send_frame(worker.sock, FRAME_BODY, data)
+                if length is not None:
+                    length -= len(data)
+            _send_frame(worker.sock, FRAME_BODY_END)
+
+            # Receive the status and headers
+            kind, payload = _recv_frame(worker.sock)
+        except (socket.error, EOFError):
+            self.discard(worker)
+            return self.worker_failed(environ, start_response)
+
+        if kind != FRAME_START:
+            # The application failed before starting the response
+            LOG.warn("Worker for version %s failed: %s" %
+                     (self.version, payload.decode('utf-8', 'replace')))
+            self.release(worker)
+            return self.app_failed(environ, start_response)
+
+        status, headers = pickle.loads(payload)
+        start_response(status, headers)
+        return WorkerResponse(self, worker)
+
+
+class ContentTypeFilter(object):
+    """
+    A response filter which rewrites the "Content-Type" header of a
+    response from the content type selected by a type rule back to
+    the content type originally negotiated by the client.
+    """
+
+    def __init__(self, ctype, orig_ctype):
+        """
+        Initialize a ContentTypeFilter object.
+
+        :param ctype: The content type selected by the type rule.
+        :param orig_ctype: The content type originally negotiated by
+                           the client.
+        """
+
+        self.ctype = ctype.lower()
+        self.orig_ctype = orig_ctype
+
+    def __call__(self, status, headers):
+        """
+        Filter the response headers.
+
+        :param status: The response status.
+        :param headers: The list of response headers.
+
+        :returns: A tuple of the status and the filtered list of
+                  headers.
+        """
+
+        result = []
+        for name, value in headers:
+            if name.lower() == 'content-type':
+                # Only rewrite the type the application was asked for;
+                # the parameters, e.g. charset, are preserved
+                ctype, sep, params = value.partition(';')
+                if ctype.strip().lower() == self.ctype:
+                    value = self.orig_ctype + sep + params
+            result.append((name, value))
+
+        return status, result
+
+
+class VaryFilter(object):
+    """
+    A response filter which adds header names to the "Vary" header of
+    a response, so that HTTP caches can cache negotiated responses.
+    """
+
+    def __init__(self, fields):
+        """
+        Initialize a VaryFilter object.
+
+        :param fields: A list of the names of request headers which
+                       the response depends on.
+        """
+
+        self.fields = fields
+
+    def __call__(self, status, headers):
+        """
+        Filter the response headers.
+
+        :param status: The response status.
+        :param headers: The list of response headers.
+
+        :returns: A tuple of the status and the filtered list of
+                  headers.
+        """
+
+        # Find the existing Vary fields
+        result = []
+        existing = []
+        for name, value in headers:
+            if name.lower() == 'vary':
+                existing.extend(field.strip() for field in value.split(',')
+                                if field.strip())
+            else:
+                result.append((name, value))
+
+        # "*" already covers everything
+        if '*' in existing:
+            return status, headers
+
+        # Merge in our fields
+        seen = set(field.lower() for field in existing)
+        for field in self.fields:
+            if field.lower() not in seen:
+                existing.append(field)
+                seen.add(field.lower())
+
+        result.append(('Vary', ', '.join(existing)))
+
+        return status, result
+
+
+class CacheFilter(object):
+    """
+    A response filter which sets the "ETag" and, optionally, the
+    "Cache-Control" headers of successful responses.
+    """
+
+    def __init__(self, etag, cache_control=None):
+        """
+        Initialize a CacheFilter object.
+
+        :param etag: The entity tag, including the quotes.
+        :param cache_control: The value for the "Cache-Control"
+                              header.  If None, the "Cache-Control"
+                              header is left alone.
+        """
+
+        self.etag = etag
+        self.cache_control = cache_control
+
+    def __call__(self, status, headers):
+        """
+        Filter the response headers.
+
+        :param status: The response status.
+        :param headers: The list of response headers.
+
+        :returns: A tuple of the status and the filtered list of
+                  headers.
+        """
+
+        # Leave unsuccessful responses alone
+        if not status.startswith('2'):
+            return status, headers
+
+        replace = set(['etag'])
+        if self.cache_control:
+            replace.add('cache-control')
+
+        result = [(name, value) for name, value in headers
+                  if name.lower() not in replace]
+        result.append(('ETag', self.etag))
+        if self.cache_control:
+            result.append(('Cache-Control', self.cache_control))
+
+        return status, result
+
+
+def _etag_match(etag, if_none_match):
+    """
+    Determine if an entity tag matches the value of an
+    "If-None-Match" header.  The weak comparison function is used.
+
+    :param etag: The entity tag, including the quotes.
+    :param if_none_match: The value of the "If-None-Match" header.
+
+    :returns: True if the entity tag matches, False otherwise.
+    """
+
+    if not if_none_match:
+        return False
+
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+
+    return False
+
+
+def _query_param(query_string, name):
+    """
+    Find the value of a parameter in a query string.  Only the text
+    of the parameter is decoded; the rest of the query string is not
+    parsed.
+
+    :param query_string: The query string.
+    :param name: The name of the parameter.
+
+    :returns: The value of the first occurrence of the parameter, or
+              None if it is not present.
+    """
+
+    target = name + '='
+    start = 0
+    while True:
+        idx = query_string.find(target, start)
+        if idx < 0:
+            return None
+        elif idx == 0 or query_string[idx - 1] == '&':
+            break
+        start = idx + 1
+
+    idx += len(target)
+    end = query_string.find('&', idx)
+    return unquote_plus(query_string[idx:] if end < 0
+                        else query_string[idx:end])
+
+
+def _set_key(log_prefix, result_dict, key, value, desc="parameter"):
+    """
+    Helper to set a key value in a dictionary.  This function issues a
+    warning if the key has already been set, and issues a warning and
+    returns without setting the value if the value is not surrounded
+    by parentheses.  This is used to eliminate duplicated code from
+    the rule parsers below.
+
+    :param log_prefix: A prefix to use in log messages.  This should
+                       be the configuration key.
+    :param result_dict: A dictionary of results, into which the key
+                        and value should be inserted.
+    :param key: The dictionary key to insert.
+    :param value: The value to insert into the dictionary.
+    :param desc: A description of what the dictionary is.  This is
+                 used in log messages help the user understand what
+                 the log message is referring to.  By default, this
+                 description is "parameter", indicating that entries
+                 in the dictionary are parameters of something;
+                 however, _parse_type_rule() also uses "token type" to
+                 help identify its more complex tokens.
+    """
+
+    if key in result_dict:
+        LOG.warn("%s: Duplicate value for %s %r" %
+                 (log_prefix, desc, key))
+        # Allow the overwrite
+
+    # Demand the value be quoted
+    if len(value) <= 2 or value[0] not in ('"', "'") or value[0] != value[-1]:
+        LOG.warn("%s: Invalid value %r for %s %r" %
+                 (log_prefix, value, desc, key))
+        return
+
+    # Save the value
+    result_dict[key] = value[1:-1]
+
+
+def _conf_bool(key, value, default):
+    """
+    Interpret a boolean configuration value.
+
+    :param key: The configuration key.  This is used in log messages.
+    :param value: The configuration value.
+    :param default: The value to return if the configuration value is
+                    not recognized.
+
+    :returns: The boolean value.
+    """
+
+    value = value.lower()
+    if value in ('true', 't', 'on', 'yes', 'enable'):
+        return True
+    elif value in ('false', 'f', 'off', 'no', 'disable'):
+        return False
+
+    try:
+        return bool(int(value))
+    except ValueError:
+        LOG.warn("Unrecognized value %r for configuration key %r" %
+                 (value, key))
+        return default
+
+
+def _conf_int(key, value, default):
+    """
+    Interpret an integer configuration value.
+
+    :param key: The configuration key.  This is used in log messages.
+    :param value: The configuration value.
+    :param default: The value to return if the configuration value is
+                    not recognized.
+
+    :returns: The integer value.
+    """
+
+    try:
+        return int(value)
+    except ValueError:
+        LOG.warn("Unrecognized value %r for configuration key %r" %
+                 (value, key))
+        return default
 
 
 def _parse_version_rule(loader, version, verspec):
     """
     Parse a version rule.  The first token is the name of the
-    application implementing that API version.  The remaining tokens
+    application implementing that API version, or the URL of an
+    upstream HTTP server to forward requests to.  The remaining tokens
     are key="quoted value" pairs that specify parameters; these
     parameters are ignored by AVersion, but may be used by the
     application.
@@ -367,9 +4461,12 @@ def _parse_version_rule(loader, version, verspec):
         if not token:
             continue
 
-        # Convert the application
+        # Convert the application; a URL names an upstream server
         if 'app' not in result:
-            result['app'] = loader.get_app(token)
+            if token.startswith(('http://', 'https://')):
+                result['app'] = ProxyApp(token)
+            else:
+                result['app'] = loader.get_app(token)
             continue
 
         # What remains is key="quoted value" pairs...
@@ -421,58 +4518,350 @@ def _parse_alias_rule(alias, alias_spec):
         raise KeyError("Cannot determine canonical version for alias %r" %
                        alias)
 
-    return result
+    return result
+
+
+def _parse_type_rule(ctype, typespec):
+    """
+    Parse a content type rule.  Unlike the other rules, content type
+    rules are more complex, since both selected content type and API
+    version must be expressed by one rule.  The rule is split on
+    whitespace, then the components beginning with "type:" and
+    "version:" are selected; in both cases, the text following the ":"
+    character will be treated as a format string, which will be
+    formatted using a content parameter dictionary.  A component
+    beginning with "range:" is similarly formatted to produce a
+    version range, which is resolved against the declared versions
+    in preference to the "version:" component.  Components
+    beginning with "param:" specify key="quoted value" pairs that
+    specify parameters; these parameters are ignored by AVersion, but
+    may be used by the application.
+
+    :param ctype: The content type the rule is for.
+    :param typespec: The rule text, described above.
+
+    :returns: An instance of TypeRule.
+    """
+
+    params = {'param': {}}
+    for token in quoted_split(typespec, ' ', quotes='"\''):
+        if not token:
+            continue
+
+        tok_type, _sep, tok_val = token.partition(':')
+
+        # Validate the token type
+        if not tok_val:
+            LOG.warn("%s: Invalid type token %r" % (ctype, token))
+            continue
+        elif tok_type not in ('type', 'version', 'range', 'param'):
+            LOG.warn("%s: Unrecognized token type %r" % (ctype, tok_type))
+            continue
+
+        # Intercept 'param' clauses
+        if tok_type == 'param':
+            key, _eq, value = tok_val.partition('=')
+
+            # Set the parameter key
+            _set_key('type.%s' % ctype, params['param'], key, value)
+            continue
+
+        # Set the token value
+        _set_key('type.%s' % ctype, params, tok_type, tok_val,
+                 desc="token type")
+
+    return TypeRule(ctype=params.get('type'),
+                    version=params.get('version'),
+                    params=params['param'],
+                    version_range=params.get('range'))
+
+
+def _parse_options(log_prefix, spec, allowed):
+    """
+    Parse a rule consisting of key="quoted value" pairs.
+
+    :param log_prefix: A prefix to use in log messages.  This should
+                       be the configuration key.
+    :param spec: The rule text.
+    :param allowed: A sequence of the recognized keys.
+
+    :returns: A dictionary mapping the keys to the unquoted values.
+    """
+
+    params = {}
+    for token in quoted_split(spec, ' ', quotes='"\''):
+        if not token:
+            continue
+
+        key, _eq, value = token.partition('=')
+
+        # Validate the key
+        if key not in allowed:
+            LOG.warn("%s: Unrecognized parameter %r" % (log_prefix, key))
+            continue
+
+        # Set the parameter key
+        _set_key(log_prefix, params, key, value)
+
+    return params
+
+
+def _parse_limit_rule(version, limit_spec):
+    """
+    Parse a concurrency limit rule.  The rule consists of
+    key="quoted value" pairs; "concurrency" is the maximum number of
+    requests which may be processed at once, "timeout" is the number
+    of seconds a request may wait for a slot, and "retry_after" is the
+    value of the "Retry-After" header returned when a request is
+    rejected.
+
+    :param version: The version name.
+    :param limit_spec: The limit text, described above.
+
+    :returns: An instance of Limiter, or None if the rule does not
+              specify a valid concurrency.
+    """
+
+    params = _parse_options('limit.%s' % version, limit_spec,
+                            ('concurrency', 'timeout', 'retry_after'))
+
+    # Convert the values
+    try:
+        concurrency = int(params['concurrency'])
+        timeout = float(params.get('timeout', 0))
+        retry_after = int(params.get('retry_after', 1))
+    except (KeyError, ValueError):
+        LOG.warn("limit.%s: Invalid concurrency limit %r" %
+                 (version, limit_spec))
+        return None
+
+    if concurrency <= 0:
+        LOG.warn("limit.%s: Invalid concurrency limit %r" %
+                 (version, limit_spec))
+        return None
+
+    return Limiter(version, concurrency, timeout, retry_after)
+
+
+def _parse_breaker_rule(version, breaker_spec):
+    """
+    Parse a circuit breaker rule.  The rule consists of
+    key="quoted value" pairs corresponding to the arguments of
+    CircuitBreaker: "failures", "error_rate", "window", "latency",
+    "reset", and "fallback".
+
+    :param version: The version name.
+    :param breaker_spec: The breaker text, described above.
+
+    :returns: An instance of CircuitBreaker.
+    """
+
+    params = _parse_options('breaker.%s' % version, breaker_spec,
+                            ('failures', 'error_rate', 'window', 'latency',
+                             'reset', 'fallback'))
+
+    # Convert the values
+    kwargs = {}
+    for key, conv in (('failures', int), ('error_rate', float),
+                      ('window', int), ('latency', float),
+                      ('reset', float), ('fallback', str)):
+        if key not in params:
+            continue
+        try:
+            value = conv(params[key])
+        except ValueError:
+            value = None
+        if value is None or (conv is not str and value < 0) or (
+                key == 'window' and value == 0):
+            LOG.warn("breaker.%s: Invalid value %r for parameter %r" %
+                     (version, params[key], key))
+            continue
+        kwargs[key] = value
+
+    return CircuitBreaker(version, **kwargs)
+
+
+def _parse_shadow_rule(version, shadow_spec):
+    """
+    Parse a shadow rule.  The rule consists of key="quoted value"
+    pairs: "target" is the required name of the candidate version;
+    "rate" is the fraction of requests to replay; "workers" is the
+    number of background threads; "queue" is the maximum number of
+    requests waiting to be replayed; "methods" is a space-separated
+    list of the request methods which may be replayed; and "max_body"
+    is the maximum size of a request body which may be replayed.
+
+    :param version: The version name.
+    :param shadow_spec: The shadow text, described above.
+
+    :returns: An instance of Shadow, or None if the rule does not
+              specify a target.
+    """
+
+    params = _parse_options('shadow.%s' % version, shadow_spec,
+                            ('target', 'rate', 'workers', 'queue',
+                             'methods', 'max_body'))
+    if 'target' not in params:
+        LOG.warn("shadow.%s: No target version specified" % version)
+        return None
+
+    # Convert the values
+    kwargs = {}
+    for key, name, conv in (('rate', 'rate', float),
+                            ('workers', 'workers', int),
+                            ('queue', 'queue_size', int),
+                            ('max_body', 'max_body', int)):
+        if key not in params:
+            continue
+        try:
+            value = conv(params[key])
+        except ValueError:
+            value = -1
+        if value < 0 or (key in ('workers', 'queue') and value == 0):
+            LOG.warn("shadow.%s: Invalid value %r for parameter %r" %
+                     (version, params[key], key))
+            continue
+        kwargs[name] = value
+    if 'methods' in params:
+        kwargs['methods'] = params['methods'].upper().split()
+
+    return Shadow(version, params['target'], **kwargs)
+
+
+def _parse_cache_rule(version, cache_spec):
+    """
+    Parse a response cache rule.  The rule consists of
+    key="quoted value" pairs; "size" is the maximum total size of the
+    cached responses in bytes, "ttl" is the number of seconds to cache
+    responses which do not specify a lifetime, and "max_entry" is the
+    maximum size of a single response in bytes.
+
+    :param version: The version name.
+    :param cache_spec: The cache text, described above.
+
+    :returns: An instance of ResponseCache, or None if the rule does
+              not specify a valid size.
+    """
+
+    params = _parse_options('cache.%s' % version, cache_spec,
+                            ('size', 'ttl', 'max_entry'))
+
+    # Convert the values
+    try:
+        size = int(params.get('size', 1048576))
+        ttl = float(params.get('ttl', 0))
+        max_entry = (int(params['max_entry']) if 'max_entry' in params
+                     else None)
+    except ValueError:
+        LOG.warn("cache.%s: Invalid response cache %r" %
+                 (version, cache_spec))
+        return None
+
+    if size <= 0 or ttl < 0 or (max_entry is not None and max_entry <= 0):
+        LOG.warn("cache.%s: Invalid response cache %r" %
+                 (version, cache_spec))
+        return None
+
+    return ResponseCache(version, size, ttl, max_entry)
+
+
+def _parse_coalesce_rule(version, coalesce_spec):
+    """
+    Parse a request coalescing rule.  The rule consists of
+    key="quoted value" pairs; "max_size" is the maximum size of a
+    response body which may be shared in bytes, and "timeout" is the
+    maximum number of seconds a request waits for the shared
+    response.
+
+    :param version: The version name.
+    :param coalesce_spec: The coalescing text, described above.
+
+    :returns: An instance of Coalescer, or None if the rule is
+              invalid.
+    """
+
+    params = _parse_options('coalesce.%s' % version, coalesce_spec,
+                            ('max_size', 'timeout'))
+
+    # Convert the values
+    try:
+        max_size = int(params.get('max_size', 65536))
+        timeout = float(params.get('timeout', 5))
+    except ValueError:
+        max_size = timeout = 0
+
+    if max_size <= 0 or timeout <= 0:
+        LOG.warn("coalesce.%s: Invalid request coalescing %r" %
+                 (version, coalesce_spec))
+        return None
 
+    return Coalescer(version, max_size, timeout)
 
-def _parse_type_rule(ctype, typespec):
+
+def _parse_proxy_rule(version, proxy_spec):
     """
-    Parse a content type rule.  Unlike the other rules, content type
-    rules are more complex, since both selected content type and API
-    version must be expressed by one rule.  The rule is split on
-    whitespace, then the components beginning with "type:" and
-    "version:" are selected; in both cases, the text following the ":"
-    character will be treated as a format string, which will be
-    formatted using a content parameter dictionary.  Components
-    beginning with "param:" specify key="quoted value" pairs that
-    specify parameters; these parameters are ignored by AVersion, but
-    may be used by the application.
+    Parse a proxy rule.  The rule consists of key="quoted value"
+    pairs; "pool_size" is the maximum number of idle connections to
+    the upstream server to retain, and "timeout" is the socket timeout
+    in seconds.
 
-    :param ctype: The content type the rule is for.
-    :param typespec: The rule text, described above.
+    :param version: The version name.
+    :param proxy_spec: The proxy text, described above.
 
-    :returns: An instance of TypeRule.
+    :returns: A dictionary of the options, suitable for passing to
+              ProxyApp.configure().
     """
 
-    params = {'param': {}}
-    for token in quoted_split(typespec, ' ', quotes='"\''):
-        if not token:
+    params = _parse_options('proxy.%s' % version, proxy_spec,
+                            ('pool_size', 'timeout'))
+
+    # Convert the values
+    result = {}
+    for key, conv in (('pool_size', int), ('timeout', float)):
+        if key not in params:
             continue
+        try:
+            result[key] = conv(params[key])
+        except ValueError:
+            LOG.warn("proxy.%s: Invalid value %r for parameter %r" %
+                     (version, params[key], key))
 
-        tok_type, _sep, tok_val = token.partition(':')
+    return result
 
-        # Validate the token type
-        if not tok_val:
-            LOG.warn("%s: Invalid type token %r" % (ctype, token))
-            continue
-        elif tok_type not in ('type', 'version', 'param'):
-            LOG.warn("%s: Unrecognized token type %r" % (ctype, tok_type))
-            continue
 
-        # Intercept 'param' clauses
-        if tok_type == 'param':
-            key, _eq, value = tok_val.partition('=')
+def _parse_workers_rule(version, workers_spec):
+    """
+    Parse a worker process rule.  The rule consists of key="quoted
+    value" pairs; "processes" is the number of worker processes to
+    run, and "timeout" is the number of seconds a request may wait
+    for an idle worker.
 
-            # Set the parameter key
-            _set_key('type.%s' % ctype, params['param'], key, value)
-            continue
+    :param version: The version name.
+    :param workers_spec: The worker process text, described above.
 
-        # Set the token value
-        _set_key('type.%s' % ctype, params, tok_type, tok_val,
-                 desc="token type")
+    :returns: A dictionary of the options, suitable for passing to
+              WorkerPool().
+    """
 
-    return TypeRule(ctype=params.get('type'),
-                    version=params.get('version'),
-                    params=params['param'])
+    params = _parse_options('workers.%s' % version, workers_spec,
+                            ('processes', 'timeout'))
+
+    # Convert the values
+    result = {}
+    for key, conv in (('processes', int), ('timeout', float)):
+        if key not in params:
+            continue
+        try:
+            value = conv(params[key])
+        except ValueError:
+            value = None
+        if value is None or value <= 0:
+            LOG.warn("workers.%s: Invalid value %r for parameter %r" %
+                     (version, params[key], key))
+            continue
+        result[key] = value
+
+    return result
 
 
 def _uri_normalize(uri):
@@ -511,9 +4900,54 @@ class AVersion(object):
 
         # Process the configuration
         self.overwrite_headers = True
+        self.compact_environ = False
+        self.correct_response_type = False
+        self.add_vary = True
+        self.strict_accept = False
+        self.strict_content_type = False
+        self.rejected_types = CounterSet()
+        self.max_header_length = None
+        self.max_media_ranges = None
+        self.max_type_params = None
+        self.header_limit_action = 'ignore'
+        self.limited_headers = CounterSet()
+        self.compress = []
+        self.compress_min_size = 1024
+        self.compress_level = 6
+        self.compress_skip_types = COMPRESS_SKIP_TYPES
+        languages = []
+        charsets = []
+        header_cache_size = 256
+        version_order = 'natural'
+        self.version_header = None
+        self.version_header_key = None
+        self.version_param = None
+        self.process_order = ['_proc_uri', '_proc_version_header',
+                              '_proc_version_param', '_proc_ctype_header',
+                              '_proc_accept_header']
         self.version_app = None
+        self.version_cacheable = False
+        self.version_cache_control = None
+        self.version_etag = None
+        discovery = False
+        self.health_paths = set()
+        health_versions = False
+        self.metrics_path = None
+        self.profiler = None
+        profile_rate = 0
+        profile_file = None
+        profile_signal = None
         self.versions = {}
         self.aliases = {}
+        limits = {}
+        proxies = {}
+        workers = {}
+        caches = {}
+        coalescers = {}
+        breakers = {}
+        shadows = {}
+        self.degraded = set()
+        self.fallbacks = CounterSet()
         uris = {}
         self.types = {}
         self.formats = {}
@@ -521,24 +4955,159 @@ class AVersion(object):
             if key == 'version':
                 # The version application--what we call if no version
                 # is specified
-                self.version_app = loader.get_app(value)
+                if value.strip() == 'aversion:discovery':
+                    # Use the built-in discovery application, which we
+                    # can only build once the configuration is complete
+                    discovery = True
+                else:
+                    self.version_app = loader.get_app(value)
+            elif key == 'version_cacheable':
+                # Alter whether the version application's responses
+                # depend only on the configuration
+                self.version_cacheable = _conf_bool(key, value,
+                                                    self.version_cacheable)
+            elif key == 'version_cache_control':
+                # The Cache-Control header for the version application
+                self.version_cache_control = value
+            elif key == 'health_paths':
+                # Paths answered directly, for load balancer health
+                # checks
+                self.health_paths = set(value.split())
+            elif key == 'health_versions':
+                # Alter whether health checks list the versions
+                health_versions = _conf_bool(key, value, health_versions)
+            elif key == 'metrics_path':
+                # Path answered with the metrics
+                self.metrics_path = value.strip() or None
+            elif key == 'degraded':
+                # Versions to avoid if the client accepts another
+                self.degraded = set(value.split())
             elif key == 'overwrite_headers':
                 # Alter whether or not we overwrite the headers
+                self.overwrite_headers = _conf_bool(key, value,
+                                                    self.overwrite_headers)
+            elif key == 'compact_environ':
+                # Alter whether we store a Decision in the environment
+                # in place of the individual variables
+                self.compact_environ = _conf_bool(key, value,
+                                                  self.compact_environ)
+            elif key == 'profile_rate':
+                # Profile one in every profile_rate requests
+                profile_rate = _conf_int(key, value, profile_rate)
+            elif key == 'profile_file':
+                # Where to dump the profile data
+                profile_file = value
+            elif key == 'profile_signal':
+                # The signal which triggers a profile dump
+                profile_signal = value.upper()
+            elif key == 'correct_response_type':
+                # Alter whether we rewrite the response content type
+                self.correct_response_type = _conf_bool(
+                    key, value, self.correct_response_type)
+            elif key == 'add_vary':
+                # Alter whether we add to the Vary header
+                self.add_vary = _conf_bool(key, value, self.add_vary)
+            elif key == 'strict_accept':
+                # Alter whether we reject unacceptable Accept headers
+                self.strict_accept = _conf_bool(key, value,
+                                                self.strict_accept)
+            elif key == 'strict_content_type':
+                # Alter whether we reject unrecognized request bodies
+                self.strict_content_type = _conf_bool(
+                    key, value, self.strict_content_type)
+            elif key in ('max_header_length', 'max_media_ranges',
+                         'max_type_params'):
+                # Limits on parsing the Accept and Content-Type
+                # headers; 0 means unlimited
+                setattr(self, key,
+                        _conf_int(key, value, getattr(self, key)) or None)
+            elif key == 'version_header':
+                # A request header naming the version directly
+                self.version_header = value.strip()
+                self.version_header_key = 'HTTP_%s' % (
+                    self.version_header.upper().replace('-', '_'))
+            elif key == 'version_param':
+                # A query parameter naming the version directly
+                self.version_param = value.strip()
+            elif key == 'process_order':
+                # The order of the stages which select the version
+                self.process_order = []
+                for stage in value.lower().split():
+                    if stage in PROCESS_STAGES:
+                        self.process_order.append(PROCESS_STAGES[stage])
+                    else:
+                        LOG.warn("Unknown processing stage %r for key %r" %
+                                 (stage, key))
+            elif key == 'version_order':
+                # The ordering of the version names for version ranges
+                version_order = value.strip()
+            elif key == 'header_cache_size':
+                # The number of parsed headers to cache
+                header_cache_size = _conf_int(key, value, header_cache_size)
+            elif key in ('languages', 'charsets'):
+                # The languages and character sets to negotiate, in
+                # order of preference
+                if key == 'languages':
+                    languages = value.split()
+                else:
+                    charsets = value.split()
+            elif key == 'compress':
+                # The content codings to compress responses with, in
+                # order of preference
+                self.compress = []
+                for coding in value.lower().split():
+                    if coding in CODINGS:
+                        self.compress.append(coding)
+                    else:
+                        LOG.warn("Unknown content coding %r for key %r" %
+                                 (coding, key))
+            elif key in ('compress_min_size', 'compress_level'):
+                # The compression parameters
+                setattr(self, key, _conf_int(key, value, getattr(self, key)))
+            elif key == 'compress_skip_types':
+                # Content types which are not to be compressed
+                self.compress_skip_types = value.lower().split()
+            elif key == 'header_limit_action':
+                # What to do with headers exceeding the limits
                 value = value.lower()
-                if value in ('true', 't', 'on', 'yes', 'enable'):
-                    self.overwrite_headers = True
-                elif value in ('false', 'f', 'off', 'no', 'disable'):
-                    self.overwrite_headers = False
+                if value in ('ignore', 'reject'):
+                    self.header_limit_action = value
                 else:
-                    try:
-                        self.overwrite_headers = bool(int(value))
-                    except ValueError:
-                        LOG.warn("Unrecognized value %r for configuration "
-                                 "key 'overwrite_headers'" % value)
+                    LOG.warn("Unrecognized value %r for configuration "
+                             "key 'header_limit_action'" % value)
             elif key.startswith('version.'):
                 # The application for a given version
                 self.versions[key[8:]] = _parse_version_rule(loader, key[8:],
                                                              value)
+            elif key.startswith('limit.'):
+                # A concurrency limit for a given version
+                limiter = _parse_limit_rule(key[6:], value)
+                if limiter:
+                    limits[key[6:]] = limiter
+            elif key.startswith('cache.'):
+                # A response cache for a given version
+                cache = _parse_cache_rule(key[6:], value)
+                if cache:
+                    caches[key[6:]] = cache
+            elif key.startswith('coalesce.'):
+                # Coalesce identical requests for a given version
+                coalescer = _parse_coalesce_rule(key[9:], value)
+                if coalescer:
+                    coalescers[key[9:]] = coalescer
+            elif key.startswith('breaker.'):
+                # A circuit breaker for a given version
+                breakers[key[8:]] = _parse_breaker_rule(key[8:], value)
+            elif key.startswith('shadow.'):
+                # Replay requests for a version against a candidate
+                shadow = _parse_shadow_rule(key[7:], value)
+                if shadow:
+                    shadows[key[7:]] = shadow
+            elif key.startswith('proxy.'):
+                # Connection pool options for an upstream server
+                proxies[key[6:]] = _parse_proxy_rule(key[6:], value)
+            elif key.startswith('workers.'):
+                # Run the application for a version in worker processes
+                workers[key[8:]] = _parse_workers_rule(key[8:], value)
             elif key.startswith('alias.'):
                 # An alias for a given version
                 self.aliases[key[6:]] = _parse_alias_rule(key[6:], value)
@@ -555,10 +5124,157 @@ class AVersion(object):
                 # content type
                 self.formats[key] = value
 
+        # Set up the profile sampler
+        if profile_rate > 0:
+            self.profiler = ProfileSampler(profile_rate, profile_file)
+            if profile_signal:
+                self._install_profile_signal(profile_signal)
+
+        # Move selected version applications into worker processes;
+        # this must happen before anything else refers to the
+        # applications.  The workers are forked now, while the server
+        # has not yet started any request threads
+        for version, options in workers.items():
+            app = self.versions.get(version, {}).get('app')
+            if app is None or isinstance(app, ProxyApp):
+                LOG.warn("workers.%s: Version %r is not a local application" %
+                         (version, version))
+                continue
+            if not hasattr(os, 'fork'):
+                LOG.warn("workers.%s: Worker processes are not supported "
+                         "on this platform" % version)
+                continue
+            pool = WorkerPool(version, app, **options)
+            pool.start()
+            self.versions[version]['app'] = pool
+
+        # Index the versions for resolving version ranges
+        if version_order not in ('natural', 'lexical'):
+            version_order = version_order.split()
+            for version in version_order:
+                if version not in self.versions:
+                    LOG.warn("version_order: Unknown version %r" % version)
+        self.version_index = VersionIndex(self.versions, version_order)
+        for rule in self.types.values():
+            if rule.version_range:
+                rule.index = self.version_index
+
+        # Set up the cache of parsed headers, and negotiation of the
+        # language and character set; the header name, the Result
+        # attribute, and the negotiator
+        self.header_cache = HeaderCache(self.max_media_ranges,
+                                        self.max_type_params,
+                                        header_cache_size)
+        self.negotiators = []
+        for header, attr, allowed, rule in (
+                ('accept-language', 'language', languages,
+                 match_language_range),
+                ('accept-charset', 'charset', charsets, match_charset)):
+            if allowed:
+                self.negotiators.append((header, attr, Negotiator(
+                    allowed, rule, self.max_media_ranges,
+                    self.max_type_params)))
+
+        # Concurrency limits may only be placed on known versions
+        self.limiters = {}
+        for version, limiter in limits.items():
+            if version not in self.versions:
+                LOG.warn("limit.%s: Unknown version %r" % (version, version))
+                continue
+            self.limiters[version] = limiter
+
+        # Response caches may only be placed on known versions
+        self.caches = {}
+        for version, cache in caches.items():
+            if version not in self.versions:
+                LOG.warn("cache.%s: Unknown version %r" % (version, version))
+                continue
+            self.caches[version] = cache
+
+        # Requests may only be coalesced for known versions
+        self.coalescers = {}
+        for version, coalescer in coalescers.items():
+            if version not in self.versions:
+                LOG.warn("coalesce.%s: Unknown version %r" %
+                         (version, version))
+                continue
+            self.coalescers[version] = coalescer
+
+        # Circuit breakers may only be placed on known versions, and
+        # may only fall back to known versions
+        self.breakers = {}
+        for version, breaker in breakers.items():
+            if version not in self.versions:
+                LOG.warn("breaker.%s: Unknown version %r" % (version, version))
+                continue
+            if (breaker.fallback is not None and
+                    self._canonical_version(breaker.fallback)
+                    not in self.versions):
+                LOG.warn("breaker.%s: Unknown fallback version %r" %
+                         (version, breaker.fallback))
+                breaker.fallback = None
+            self.breakers[version] = breaker
+
+        # Requests may only be replayed between known versions
+        self.shadows = {}
+        for version, shadow in shadows.items():
+            target = self._canonical_version(shadow.target)
+            if version not in self.versions or target not in self.versions:
+                LOG.warn("shadow.%s: Unknown version %r or %r" %
+                         (version, version, shadow.target))
+                continue
+            shadow.app = self.versions[target]['app']
+            self.shadows[version] = shadow
+
+        # Connection pool options may only be set for upstream servers
+        for version, options in proxies.items():
+            app = self.versions.get(version, {}).get('app')
+            if not isinstance(app, ProxyApp):
+                LOG.warn("proxy.%s: Version %r is not an upstream server" %
+                         (version, version))
+                continue
+            app.configure(**options)
+
+        # Pre-render the health check response; all the version
+        # applications were loaded above, or we would not get here
+        if health_versions:
+            body = json.dumps(dict(
+                status='ok',
+                versions=sorted(self.versions),
+            ), sort_keys=True).encode('utf-8')
+            ctype = 'application/json'
+        else:
+            body = b'OK\n'
+            ctype = 'text/plain; charset=UTF-8'
+        self.health_response = StaticResponse('200 OK', [
+            ('Content-Type', ctype),
+            ('Cache-Control', 'no-cache'),
+        ], body)
+
         # We want to search URIs in the correct order
         self.uris = sorted(uris.items(), key=lambda x: len(x[0]),
                            reverse=True)
 
+        # In strict mode, an Accept header must match one of the
+        # configured types or suffix types; pre-render the response
+        # for when it does not
+        self.acceptable = sorted(set(self.types.keys()) |
+                                 set(self.formats.values()))
+        self.not_acceptable = _error_response(
+            '406 Not Acceptable',
+            'Acceptable content types: %s' % ', '.join(self.acceptable))
+
+        # In strict mode, a request body must be of one of the
+        # configured types; pre-render the response for when it is not
+        self.unsupported_type = _error_response(
+            '415 Unsupported Media Type',
+            'Supported content types: %s' % ', '.join(sorted(self.types)))
+
+        # Pre-render the response for headers exceeding the limits
+        self.header_too_large = _error_response(
+            '431 Request Header Fields Too Large',
+            'The Accept or Content-Type header is too large or complex.')
+
         # The versioning application may find it useful to have some
         # introspection on the AVersion configuration, so build up a
         # couple of data structures we can add to requests.  We start
@@ -589,6 +5305,114 @@ class AVersion(object):
             types=types,
         )
 
+        # Set up the built-in discovery application; its responses
+        # depend only on the configuration
+        if discovery:
+            self.version_app = DiscoveryApp(self)
+            self.version_cacheable = True
+
+        # Compute the entity tag for the version application
+        self.config_changed()
+
+    def config_changed(self):
+        """
+        Update the state derived from the configuration.  This must be
+        called if the configuration is altered after the AVersion
+        object is created.  The built-in discovery application, if
+        used, is re-rendered, and the entity tag for the version
+        application is recomputed.
+        """
+
+        if isinstance(self.version_app, DiscoveryApp):
+            self.version_app.render()
+
+        if self.version_cacheable:
+            # Hash the description of the configuration
+            document = json.dumps(DiscoveryApp.build_document(self),
+                                  sort_keys=True).encode('utf-8')
+            self.version_etag = '"%s"' % hashlib.sha1(document).hexdigest()
+            self.not_modified = StaticResponse('304 Not Modified', [
+                ('ETag', self.version_etag),
+            ] + ([('Cache-Control', self.version_cache_control)]
+                 if self.version_cache_control else []))
+        else:
+            self.version_etag = None
+            self.not_modified = None
+
+    def metrics(self):
+        """
+        Retrieve the current values of the counters maintained by
+        AVersion.
+
+        :returns: A dictionary with the keys "versions", mapping the
+                  versions with concurrency limits to dictionaries of
+                  the number of requests in flight and the number of
+                  requests rejected; "breakers", mapping the versions
+                  with circuit breakers to the state of each breaker,
+                  as for CircuitBreaker.snapshot(); "fallbacks", the
+                  counts of requests routed away from each preferred
+                  version; "shadows", mapping the versions whose
+                  requests are replayed to the comparison statistics,
+                  as for Shadow.snapshot(); "caches", mapping the
+                  versions with response caches to the state of each
+                  cache, as for ResponseCache.snapshot();
+                  "coalescing", mapping the versions whose requests
+                  are coalesced to the state of each Coalescer, as
+                  for Coalescer.snapshot(); "negotiation", mapping the
+                  negotiated headers to the cache statistics of each
+                  Negotiator, as for Negotiator.snapshot();
+                  "header_cache", the statistics of the cache of
+                  parsed headers, as for HeaderCache.snapshot();
+                  "rejected_types", the
+                  counts of request content types rejected in strict
+                  mode; and "limited_headers", the counts of headers
+                  exceeding the parsing limits.
+        """
+
+        return dict(
+            versions=dict((version, dict(in_flight=limiter.in_flight,
+                                         rejected=limiter.rejected))
+                          for version, limiter in self.limiters.items()),
+            breakers=dict((version, breaker.snapshot())
+                          for version, breaker in self.breakers.items()),
+            fallbacks=self.fallbacks.snapshot(),
+            shadows=dict((version, shadow.snapshot())
+                         for version, shadow in self.shadows.items()),
+            caches=dict((version, cache.snapshot())
+                        for version, cache in self.caches.items()),
+            coalescing=dict((version, coalescer.snapshot())
+                            for version, coalescer
+                            in self.coalescers.items()),
+            negotiation=dict((header, negotiator.snapshot())
+                             for header, _attr, negotiator
+                             in self.negotiators),
+            header_cache=self.header_cache.snapshot(),
+            rejected_types=self.rejected_types.snapshot(),
+            limited_headers=self.limited_headers.snapshot(),
+        )
+
+    def _install_profile_signal(self, signame):
+        """
+        Install a signal handler which dumps the profile data
+        collected by the profile sampler.
+
+        :param signame: The name of the signal, e.g., "USR1" or
+                        "SIGUSR1".
+        """
+
+        if not signame.startswith('SIG'):
+            signame = 'SIG' + signame
+
+        # Dumping takes a lock, so the dump is left to the next
+        # request
+        def handler(signum, frame):
+            self.profiler.request_dump()
+
+        try:
+            signal.signal(getattr(signal, signame), handler)
+        except (AttributeError, ValueError):
+            LOG.warn("Unable to install handler for signal %r" % signame)
+
     @webob.dec.wsgify
     def __call__(self, request):
         """
@@ -600,43 +5424,250 @@ class AVersion(object):
         :param request: The Request object provided by WebOb.
         """
 
+        # Answer health checks before doing any other work
+        if self.health_paths and request.path_info in self.health_paths:
+            return self.health_response
+        elif self.metrics_path and request.path_info == self.metrics_path:
+            body = json.dumps(self.metrics(), sort_keys=True)
+            return StaticResponse('200 OK', [
+                ('Content-Type', 'application/json'),
+                ('Cache-Control', 'no-cache'),
+            ], body.encode('utf-8'))
+
         # Process the request; broken out for easy override and
         # testing
-        result = self._process(request)
-
-        # Add the config to the environment; we use a deep copy to
-        # avoid accidental overwrite of the data
-        request.environ['aversion.config'] = copy.deepcopy(self.config)
-
-        # Set the Accept header
-        if result.ctype:
-            request.environ['aversion.response_type'] = result.ctype
-            request.environ['aversion.orig_response_type'] = result.orig_ctype
-            request.environ['aversion.accept'] = request.headers.get('accept')
-            if self.overwrite_headers:
-                request.headers['accept'] = '%s;q=1.0' % result.ctype
+        try:
+            if self.profiler:
+                result = self.profiler(self._process, request)
+            else:
+                result = self._process(request)
+        except ShortCircuit as exc:
+            return exc.app
 
         # Determine the requested version; allows mapping through
         # aliases to a canonical value
-        if result.version in self.aliases:
-            version = self.aliases[result.version]['version']
-        else:
-            version = result.version
+        version = self._canonical_version(result.version)
+
+        # Route to another version the client accepts if the preferred
+        # version is overloaded
+        if result.candidates and self._unavailable(version):
+            version = self._fall_back(result, version)
 
         # Select the correct application
         try:
             app = self.versions[version]['app']
-            request.environ['aversion.version'] = version
         except KeyError:
             app = self.version_app
-            request.environ['aversion.version'] = None
+            version = None
 
-        if app:
-            return request.get_response(app)
+        # Fail fast if the circuit breaker for the version is open
+        breaker = self.breakers.get(version)
+        token = breaker.allow() if breaker else None
+        if breaker and not token:
+            fallback = self._canonical_version(breaker.fallback)
+            fallback_breaker = self.breakers.get(fallback)
+            if fallback not in self.versions:
+                return breaker.response
+            if fallback_breaker:
+                token = fallback_breaker.allow()
+                if not token:
+                    return breaker.response
+
+            # Route to the fallback version instead; the content types
+            # were selected for the original version
+            self.fallbacks.incr(version)
+            result.version = breaker.fallback
+            self._renegotiate(request, result, fallback)
+            version = fallback
+            app = self.versions[version]['app']
+            breaker = fallback_breaker
+
+        # Describe the decision in the environment
+        decision = Decision(self.config, version, result,
+                            request.environ.get('HTTP_ACCEPT'))
+        if self.compact_environ:
+            request.environ['aversion.decision'] = decision
         else:
+            decision.populate(request.environ)
+
+        # Set the Accept header
+        if result.ctype and self.overwrite_headers:
+            request.headers['accept'] = '%s;q=1.0' % result.ctype
+
+        if not app:
             return webob.exc.HTTPInternalServerError(
                 explanation='Cannot determine application to serve request')
 
+        # Replay a sample of the requests against a candidate version
+        if (version in self.shadows and
+                self.shadows[version].sample(request.environ)):
+            app = ShadowApp(app, self.shadows[version])
+
+        # Record the outcome in the circuit breaker and apply the
+        # concurrency limit for the version
+        cancel = None
+        if breaker:
+            app = BreakerApp(app, breaker, token)
+            cancel = functools.partial(breaker.cancel, token)
+        if version in self.limiters:
+            app = LimitedApp(app, self.limiters[version], cancel)
+
+        # Coalesce identical requests for the version, and answer
+        # from its response cache; the response depends on the
+        # rewritten path, the negotiated type, and the "Accept" header
+        # passed to the application, on which it may vary
+        if ((version in self.coalescers or version in self.caches) and
+                request.method in ('GET', 'HEAD')):
+            key = (version, request.host, request.script_name,
+                   request.path_info, request.query_string, result.ctype,
+                   result.language, result.charset,
+                   request.environ.get('HTTP_ACCEPT'))
+            if version in self.coalescers:
+                app = CoalescedApp(app, self.coalescers[version], key,
+                                   cancel)
+            if version in self.caches:
+                app = CachedApp(app, self.caches[version], key, cancel)
+
+        # Set up any filters for the response headers
+        filters = []
+
+        # Answer conditional requests for the version application
+        # without calling it
+        if (version is None and self.version_etag and
+                request.method in ('GET', 'HEAD')):
+            if _etag_match(self.version_etag,
+                           request.environ.get('HTTP_IF_NONE_MATCH')):
+                app = self.not_modified
+            else:
+                filters.append(CacheFilter(self.version_etag,
+                                           self.version_cache_control))
+        if (self.correct_response_type and result.orig_ctype and
+                result.orig_ctype != result.ctype):
+            filters.append(ContentTypeFilter(result.ctype,
+                                             result.orig_ctype))
+        if self.add_vary and result.vary:
+            filters.append(VaryFilter(result.vary))
+        if filters:
+            app = ResponseFilter(app, filters)
+
+        # Compress the response as it is produced
+        if self.compress:
+            app = CompressedApp(app, result.encoding, self.compress_min_size,
+                                self.compress_level, self.compress_skip_types)
+
+        # Return the application itself; wsgify will call it with the
+        # original start_response, so that the status, headers, and
+        # application iterable (including any wsgi.file_wrapper) are
+        # passed through to the server untouched
+        return app
+
+    def _canonical_version(self, version):
+        """
+        Map a version through the aliases.
+
+        :param version: The version or alias name.
+
+        :returns: The canonical version name.
+        """
+
+        if version in self.aliases:
+            return self.aliases[version]['version']
+        return version
+
+    def _unavailable(self, version):
+        """
+        Determine whether requests should be routed away from a
+        version, if the client accepts another.
+
+        :param version: The canonical version name.
+
+        :returns: True if the version is marked degraded, is at its
+                  concurrency limit, or has an open circuit breaker;
+                  False otherwise.
+        """
+
+        return (version in self.degraded or
+                (version in self.limiters and
+                 self.limiters[version].full()) or
+                (version in self.breakers and
+                 not self.breakers[version].available()))
+
+    def _fall_back(self, result, version):
+        """
+        Select the best of the other candidates the client accepts
+        which is available.  If one is found, the version and content
+        type in the result are replaced.
+
+        :param result: The Result object.
+        :param version: The canonical name of the preferred version.
+
+        :returns: The canonical name of the selected version; this is
+                  the preferred version if no other is available.
+        """
+
+        for ctype, params in result.candidates:
+            try:
+                q = float(params.get('q', 1.0))
+            except ValueError:
+                continue
+            if q <= 0:
+                # The client does not accept this one
+                continue
+
+            mapped_ctype, mapped_version = self.types[ctype](params)
+            candidate = self._canonical_version(mapped_version)
+            if (candidate == version or candidate not in self.versions or
+                    self._unavailable(candidate)):
+                continue
+
+            # Use this candidate instead
+            self.fallbacks.incr(version)
+            result.version = mapped_version
+            result.ctype = mapped_ctype or None
+            result.orig_ctype = ctype if mapped_ctype else None
+            return candidate
+
+        return version
+
+    def _renegotiate(self, request, result, version):
+        """
+        Redo the content type selection for a request routed to a
+        version other than the one the rules selected.  The request
+        "Content-Type" header is restored to the value the client
+        sent.  A response content type selected by a type rule is
+        replaced by that of the best type the client accepts which
+        maps to the new version; if there is none, the "Accept" header
+        is passed on unaltered.
+
+        :param request: The Request object provided by WebOb.
+        :param result: The Result object.
+        :param version: The canonical name of the new version.
+        """
+
+        if result.request_header is not None:
+            if self.overwrite_headers:
+                request.headers['content-type'] = result.request_header
+            result.request_ctype = None
+            result.orig_request_ctype = None
+            result.request_header = None
+
+        # Content types from URI suffixes do not depend on the version
+        if result.orig_ctype is None:
+            return
+
+        result.ctype = None
+        result.orig_ctype = None
+        if result.parsed_accept is None:
+            return
+        for ctype, params in _rank_matches(result.parsed_accept,
+                                           self.types.keys(),
+                                           match_media_range):
+            mapped_ctype, mapped_version = self.types[ctype](params)
+            if self._canonical_version(mapped_version) == version:
+                result.ctype = mapped_ctype or None
+                result.orig_ctype = ctype if mapped_ctype else None
+                return
+
     def _process(self, request, result=None):
         """
         Process the rules for the request.
@@ -649,11 +5680,26 @@ class AVersion(object):
                   content type.
         """
 
-        # Allocate a result and process all the rules
+        # Allocate a result
         result = result if result is not None else Result()
-        self._proc_uri(request, result)
-        self._proc_ctype_header(request, result)
-        self._proc_accept_header(request, result)
+
+        # In strict mode, reject unrecognized request bodies; this
+        # does not depend on the selected stages
+        if self.strict_content_type:
+            self._check_request_ctype(request)
+
+        # Process all the rules, in the configured order
+        for stage in self.process_order:
+            getattr(self, stage)(request, result)
+
+        # In strict mode, reject requests accepting none of the
+        # configured types, whether or not the Accept header rules
+        # were processed
+        if self.strict_accept:
+            self._check_accept(request, result)
+
+        self._proc_accept_encoding_header(request, result)
+        self._proc_negotiate(request, result)
 
         return result
 
@@ -693,6 +5739,56 @@ class AVersion(object):
                 request.path_info = request.path_info[:-len(format)]
                 break
 
+    def _select_version(self, version, result):
+        """
+        Select a version named directly by the client.  Versions and
+        aliases which are not configured are ignored.
+
+        :param version: The version or alias name.
+        :param result: The Result object to store the results in.
+        """
+
+        if version in self.versions or version in self.aliases:
+            result.set_version(version)
+
+    def _proc_version_header(self, request, result):
+        """
+        Process the version header for the request, if configured.
+        Only the desired API version can be determined from the
+        header.
+
+        :param request: The Request object provided by WebOb.
+        :param result: The Result object to store the results in.
+        """
+
+        if not self.version_header or result.version is not None:
+            return
+
+        # The version depends on the header
+        result.add_vary(self.version_header)
+
+        version = request.environ.get(self.version_header_key)
+        if version:
+            self._select_version(version.strip(), result)
+
+    def _proc_version_param(self, request, result):
+        """
+        Process the version query parameter for the request, if
+        configured.  Only the desired API version can be determined
+        from the parameter.
+
+        :param request: The Request object provided by WebOb.
+        :param result: The Result object to store the results in.
+        """
+
+        if not self.version_param or result.version is not None:
+            return
+
+        version = _query_param(request.environ.get('QUERY_STRING', ''),
+                               self.version_param)
+        if version:
+            self._select_version(version, result)
+
     def _proc_ctype_header(self, request, result):
         """
         Process the Content-Type header rules for the request.  Only
@@ -706,6 +5802,10 @@ class AVersion(object):
             # Result has already been fully determined
             return
 
+        # The version may depend on the Content-Type header
+        if self.types and result.version is None:
+            result.add_vary('Content-Type')
+
         try:
             ctype = request.headers['content-type']
         except KeyError:
@@ -713,7 +5813,11 @@ class AVersion(object):
             return
 
         # Parse the content type
-        ctype, params = parse_ctype(ctype)
+        try:
+            result.parsed_ctype = self._parse_ctype_header(ctype)
+        except HeaderLimitExceeded:
+            return
+        ctype, params = result.parsed_ctype
 
         # Is it a recognized content type?
         if ctype not in self.types:
@@ -724,15 +5828,229 @@ class AVersion(object):
 
         # Update the content type header and set the version
         if mapped_ctype:
-            request.environ['aversion.request_type'] = mapped_ctype
-            request.environ['aversion.orig_request_type'] = ctype
-            request.environ['aversion.content_type'] = \
-                request.headers['content-type']
+            result.set_request_ctype(mapped_ctype, ctype,
+                                     request.headers['content-type'])
             if self.overwrite_headers:
                 request.headers['content-type'] = mapped_ctype
         if mapped_version:
             result.set_version(mapped_version)
 
+    def _proc_accept_encoding_header(self, request, result):
+        """
+        Process the Accept-Encoding header for the request, if
+        response compression is enabled.  The content coding to apply
+        to the response is determined.
+
+        :param request: The Request object provided by WebOb.
+        :param result: The Result object to store the results in.
+        """
+
+        if not self.compress:
+            return
+
+        # The response varies with the Accept-Encoding header even if
+        # it is absent; CompressedApp adds "Vary" to responses which
+        # could be compressed
+        try:
+            result.encoding = self._best_encoding(
+                request.headers.get('accept-encoding', ''))
+        except HeaderLimitExceeded:
+            # Send the response uncompressed
+            pass
+
+    def _proc_negotiate(self, request, result):
+        """
+        Negotiate the language and character set for the request, if
+        configured.  The results are published in the WSGI
+        environment by way of the Decision.
+
+        :param request: The Request object provided by WebOb.
+        :param result: The Result object to store the results in.
+        """
+
+        for header, attr, negotiator in self.negotiators:
+            # The response depends on the header even if it is absent
+            result.add_vary(header.title())
+
+            value = request.headers.get(header)
+            if value is None:
+                # Without the header, every value is acceptable
+                setattr(result, attr, negotiator.allowed[0])
+                continue
+
+            try:
+                if (self.max_header_length is not None and
+                        len(value) > self.max_header_length):
+                    raise HeaderLimitExceeded("%s header too long" %
+                                              header.title())
+                setattr(result, attr, negotiator.best_match(value))
+            except HeaderLimitExceeded:
+                try:
+                    self._header_limit(header)
+                except HeaderLimitExceeded:
+                    # Process the request as if the header were absent
+                    setattr(result, attr, negotiator.allowed[0])
+
+    def _header_limit(self, header):
+        """
+        Handle a header which exceeds the configured parsing limits.
+        Depending on the ``header_limit_action`` configuration, the
+        request is either rejected or processed as if the header were
+        absent.
+
+        :param header: The name of the header.
+
+        :raises HeaderLimitExceeded: The header is to be ignored.
+        :raises ShortCircuit: The request is to be rejected.
+        """
+
+        self.limited_headers.incr(header)
+
+        if self.header_limit_action == 'reject':
+            raise ShortCircuit(self.header_too_large)
+
+        raise HeaderLimitExceeded("Header %r exceeds the limits" % header)
+
+    def _parse_ctype_header(self, value):
+        """
+        Parse the value of the "Content-Type" header, subject to the
+        configured limits.
+
+        :param value: The value of the "Content-Type" header.
+
+        :returns: A tuple of the content type and a dictionary
+                  containing the content type parameters, as for
+                  parse_ctype().
+
+        :raises HeaderLimitExceeded: The header exceeded the limits,
+                                     and is to be ignored.
+        :raises ShortCircuit: The header exceeded the limits, and the
+                              request is to be rejected.
+        """
+
+        try:
+            if (self.max_header_length is not None and
+                    len(value) > self.max_header_length):
+                raise HeaderLimitExceeded("Content-Type header too long")
+            return self.header_cache.parse_ctype(value)
+        except HeaderLimitExceeded:
+            self._header_limit('content-type')
+
+    def _parse_accept_header(self, accept):
+        """
+        Parse the value of the "Accept" header, subject to the
+        configured limits.
+
+        :param accept: The value of the "Accept" header.
+
+        :returns: A tuple of the ranked media ranges, as for
+                  parse_accept().
+
+        :raises HeaderLimitExceeded: The header exceeded the limits,
+                                     and is to be ignored.
+        :raises ShortCircuit: The header exceeded the limits, and the
+                              request is to be rejected.
+        """
+
+        try:
+            if (self.max_header_length is not None and
+                    len(accept) > self.max_header_length):
+                raise HeaderLimitExceeded("Accept header too long")
+            return self.header_cache.parse_accept(accept)
+        except HeaderLimitExceeded:
+            self._header_limit('accept')
+
+    def _best_encoding(self, accept_encoding):
+        """
+        Select the content coding for the value of the
+        "Accept-Encoding" header, subject to the configured limits.
+
+        :param accept_encoding: The value of the "Accept-Encoding"
+                                header.
+
+        :returns: The content coding to apply to the response, or
+                  None, as for best_encoding().
+
+        :raises HeaderLimitExceeded: The header exceeded the limits,
+                                     and is to be ignored.
+        :raises ShortCircuit: The header exceeded the limits, and the
+                              request is to be rejected.
+        """
+
+        try:
+            if (self.max_header_length is not None and
+                    len(accept_encoding) > self.max_header_length):
+                raise HeaderLimitExceeded("Accept-Encoding header too long")
+            return best_encoding(accept_encoding, self.compress,
+                                 self.max_media_ranges, self.max_type_params)
+        except HeaderLimitExceeded:
+            self._header_limit('accept-encoding')
+
+    def _check_request_ctype(self, request):
+        """
+        Reject a request with a body if the content type of the body
+        does not match any of the type rules.  The body is not read.
+
+        :param request: The Request object provided by WebOb.
+        """
+
+        environ = request.environ
+
+        # Does the request have a body?
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if (length <= 0 and 'chunked' not in
+                environ.get('HTTP_TRANSFER_ENCODING', '').lower()):
+            return
+
+        # Is it a recognized content type?
+        try:
+            ctype = self._parse_ctype_header(
+                environ.get('CONTENT_TYPE', ''))[0]
+        except HeaderLimitExceeded:
+            # Not a content type we could recognize
+            ctype = CounterSet.overflow
+        if ctype in self.types:
+            return
+
+        self.rejected_types.incr(ctype)
+        raise ShortCircuit(self.unsupported_type)
+
+    def _check_accept(self, request, result):
+        """
+        Reject a request whose "Accept" header matches none of the
+        type rules or suffix types, unless the content type has
+        already been selected, e.g., by a suffix.
+
+        :param request: The Request object provided by WebOb.
+        :param result: The Result object containing the results of
+                       the processing stages.
+        """
+
+        if not self.acceptable or result.ctype is not None:
+            return
+
+        accept = request.headers.get('accept')
+        if accept is None or not accept.strip():
+            return
+
+        # Use the ranges parsed by the Accept header rules, if they
+        # were processed
+        ranges = result.parsed_accept
+        if ranges is None:
+            if '_proc_accept_header' in self.process_order:
+                # The header exceeded the limits, and was ignored
+                return
+            try:
+                ranges = self._parse_accept_header(accept)
+            except HeaderLimitExceeded:
+                return
+
+        if not _rank_matches(ranges, self.acceptable, match_media_range):
+            raise ShortCircuit(self.not_acceptable)
+
     def _proc_accept_header(self, request, result):
         """
         Process the Accept header rules for the request.  Both the
@@ -747,19 +6065,34 @@ class AVersion(object):
             # Result has already been fully determined
             return
 
+        # The selection depends on the Accept header
+        if self.types:
+            result.add_vary('Accept')
+
         try:
             accept = request.headers['accept']
         except KeyError:
             # No Accept header to examine
             return
 
-        # Obtain the best-match content type and its parameters
-        ctype, params = best_match(accept, self.types.keys())
+        # Rank the acceptable content types
+        try:
+            ranges = self._parse_accept_header(accept)
+        except HeaderLimitExceeded:
+            return
+        result.parsed_accept = ranges
+        matches = _rank_matches(ranges, self.types.keys(), match_media_range)
 
-        # Is it a recognized content type?
-        if ctype not in self.types:
+        # Is there a recognized content type?
+        if not matches:
             return
 
+        # If the Accept header alone determines the version and
+        # content type, remember the others the client accepts
+        ctype, params = matches[0]
+        if result.version is None and result.ctype is None:
+            result.candidates = matches[1:]
+
         # Get the mapped ctype and version
         mapped_ctype, mapped_version = self.types[ctype](params)
 
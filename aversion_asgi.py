@@ -0,0 +1,787 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+An ASGI entry point for AVersion.  Requests are routed by an AVersion
+object exactly as they would be under WSGI; versions implemented by
+native ASGI applications are called directly, and WSGI applications
+are run in a thread pool dedicated to each version.  This module
+requires Python 3.6 or later.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import sys
+import threading
+
+import webob
+
+import aversion
+
+
+LOG = logging.getLogger('aversion')
+
+
+async def _call(func, *args):
+    """
+    Call an ASGI awaitable callable.
+
+    :param func: The callable.
+    :param args: The arguments to pass.
+
+    :returns: The result.
+    """
+
+    return await func(*args)
+
+
+def _call_threadsafe(loop, func, *args):
+    """
+    Call an ASGI awaitable callable in the event loop from another
+    thread, waiting for the result.
+
+    :param loop: The event loop.
+    :param func: The callable.
+    :param args: The arguments to pass.
+
+    :returns: The result.
+    """
+
+    return asyncio.run_coroutine_threadsafe(_call(func, *args),
+                                            loop).result()
+
+
+class NativeApp(object):
+    """
+    Stands in for a native ASGI application in the versions
+    configured for an AVersion object, so that requests may be routed
+    to the version.  If the AVersion object is called as a WSGI
+    application, requests for the version are answered with an error.
+    """
+
+    def __init__(self, app):
+        """
+        Initialize a NativeApp object.
+
+        :param app: The ASGI application.
+        """
+
+        self.app = app
+        self.response = aversion._error_response(
+            '500 Internal Server Error',
+            'The application is only available through ASGI.')
+
+    def __deepcopy__(self, memo):
+        """
+        The configuration describing the versions, including their
+        applications, is copied into each request's environment; the
+        application must be shared, not copied.
+        """
+
+        return self
+
+    def __call__(self, environ, start_response):
+        """
+        Answer a WSGI request with an error.
+
+        :param environ: The WSGI environment.
+        :param start_response: The WSGI start_response callable.
+
+        :returns: The application iterable.
+        """
+
+        return self.response(environ, start_response)
+
+
+class VersionPool(object):
+    """
+    A bounded pool of threads running the WSGI application for a
+    version.  The number of requests waiting for a thread is tracked,
+    and may be limited.
+    """
+
+    def __init__(self, version, threads=10, queue_size=None):
+        """
+        Initialize a VersionPool object.
+
+        :param version: The version name.  This is used in messages
+                        and in the names of the threads.
+        :param threads: The number of threads in the pool.
+        :param queue_size: The maximum number of requests which may
+                           wait for a thread.  If None, the number is
+                           not limited.
+        """
+
+        self.version = version
+        self.threads = threads
+        self.queue_size = queue_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            threads, thread_name_prefix='aversion-%s' % version)
+
+        self.queued = 0
+        self.max_queued = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        # Pre-render the rejection response
+        self.response = aversion._error_response(
+            '503 Service Unavailable',
+            'Too many requests are waiting for version %s.' % version,
+            [('Retry-After', '1')])
+
+    def full(self):
+        """
+        Determine whether a request should be rejected.  Each call
+        which returns True is counted.
+
+        :returns: True if the maximum number of requests are waiting
+                  for a thread, False otherwise.
+        """
+
+        with self._lock:
+            if self.queue_size is None or self.queued < self.queue_size:
+                return False
+            self.rejected += 1
+            return True
+
+    def _run(self, func):
+        """
+        Run a function in a thread of the pool, maintaining the
+        counters.
+
+        :param func: The function to run.
+
+        :returns: The return value of the function.
+        """
+
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+
+    async def run(self, func):
+        """
+        Run a function in a thread of the pool.
+
+        :param func: The function to run.  It is called with no
+                     arguments.
+
+        :returns: The return value of the function.
+        """
+
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._run, func)
+
+    def shutdown(self):
+        """
+        Stop the threads once the requests they are running finish.
+        """
+
+        self.executor.shutdown(wait=False)
+
+    def snapshot(self):
+        """
+        Retrieve the current state of the pool.
+
+        :returns: A dictionary with the keys "threads", "active",
+                  "queued", "max_queued", "completed", and
+                  "rejected".
+        """
+
+        with self._lock:
+            return dict(
+                threads=self.threads,
+                active=self.active,
+                queued=self.queued,
+                max_queued=self.max_queued,
+                completed=self.completed,
+                rejected=self.rejected,
+            )
+
+
+class RequestBody(object):
+    """
+    The ``wsgi.input`` for a WSGI application run under ASGI.  The
+    request body is received from the event loop as it is read, so
+    the body is streamed rather than buffered.  This must only be used
+    from a thread other than the one running the event loop.
+    """
+
+    def __init__(self, receive, loop):
+        """
+        Initialize a RequestBody object.
+
+        :param receive: The ASGI receive awaitable callable.
+        :param loop: The event loop.
+        """
+
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more = True
+
+    def _fill(self):
+        """
+        Receive the next block of the request body.
+        """
+
+        message = _call_threadsafe(self._loop, self._receive)
+        if message['type'] == 'http.request':
+            self._buffer += message.get('body', b'')
+            self._more = message.get('more_body', False)
+        else:
+            # The client disconnected
+            self._more = False
+
+    def _take(self, size):
+        """
+        Remove data from the buffer.
+
+        :param size: The number of bytes to remove.
+
+        :returns: The bytes removed.
+        """
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        """
+        Read from the request body.
+
+        :param size: The maximum number of bytes to read.  If negative
+                     or None, the remainder of the body is read.
+
+        :returns: The bytes read.
+        """
+
+        if size is None or size < 0:
+            while self._more:
+                self._fill()
+            return self._take(len(self._buffer))
+
+        while self._more and len(self._buffer) < size:
+            self._fill()
+        return self._take(size)
+
+    def readline(self, size=-1):
+        """
+        Read a line from the request body.
+
+        :param size: The maximum number of bytes to read.  If negative
+                     or None, the line is not limited.
+
+        :returns: The bytes read, including the newline.
+        """
+
+        if size is None or size < 0:
+            size = None
+        while (self._more and b'\n' not in self._buffer and
+               (size is None or len(self._buffer) < size)):
+            self._fill()
+
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None:
+            end = min(end, size)
+        return self._take(end)
+
+    def readlines(self, hint=None):
+        """
+        Read the lines of the request body.
+
+        :param hint: Ignored.
+
+        :returns: A list of the lines.
+        """
+
+        return list(self)
+
+    def __iter__(self):
+        """
+        Iterate over the lines of the request body.
+        """
+
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+class WSGIRunner(object):
+    """
+    Runs a WSGI application for an ASGI request.  The response is
+    sent to the event loop as the application produces it; the thread
+    running the application waits for each block to be sent.
+    """
+
+    def __init__(self, app, environ, send, loop):
+        """
+        Initialize a WSGIRunner object.
+
+        :param app: The WSGI application.
+        :param environ: The WSGI environment.
+        :param send: The ASGI send awaitable callable.
+        :param loop: The event loop.
+        """
+
+        self.app = app
+        self.environ = environ
+        self.send = send
+        self.loop = loop
+        self.started = False
+        self._start = None
+
+    def _send(self, message):
+        """
+        Send an ASGI message, waiting until it has been sent.
+
+        :param message: The ASGI message.
+        """
+
+        _call_threadsafe(self.loop, self.send, message)
+
+    def start_response(self, status, headers, exc_info=None):
+        """
+        The WSGI start_response callable.
+
+        :param status: The response status, e.g., "200 OK".
+        :param headers: A list of response headers.
+        :param exc_info: Exception information, if the application
+                         encountered an error.
+
+        :returns: The WSGI write callable.
+        """
+
+        if exc_info and self.started:
+            # Too late to change the status and headers
+            raise exc_info[1].with_traceback(exc_info[2])
+        self._start = (status, headers)
+        return self.write
+
+    def write(self, data):
+        """
+        Send a block of the response body.  The status and headers
+        are sent along with the first block.
+
+        :param data: The block of the response body.
+        """
+
+        if not self.started:
+            if self._start is None:
+                raise RuntimeError("start_response() was not called")
+            status, headers = self._start
+            self._send({
+                'type': 'http.response.start',
+                'status': int(status.split(None, 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers],
+            })
+            self.started = True
+
+        if data:
+            self._send({
+                'type': 'http.response.body',
+                'body': data,
+                'more_body': True,
+            })
+
+    def __call__(self):
+        """
+        Run the application and send its response.
+        """
+
+        iterable = self.app(self.environ, self.start_response)
+        try:
+            for data in iterable:
+                self.write(data)
+            self.write(b'')
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+        self._send({'type': 'http.response.body', 'body': b''})
+
+
+def build_environ(scope, body):
+    """
+    Build a WSGI environment describing an ASGI HTTP request.
+
+    :param scope: The ASGI connection scope.
+    :param body: The object to use as ``wsgi.input``.
+
+    :returns: The WSGI environment.
+    """
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope.get('method', 'GET'),
+        'SCRIPT_NAME': scope.get('root_path', '').encode(
+            'utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    # The path includes the root path
+    if (environ['SCRIPT_NAME'] and
+            environ['PATH_INFO'].startswith(environ['SCRIPT_NAME'])):
+        environ['PATH_INFO'] = environ['PATH_INFO'][
+            len(environ['SCRIPT_NAME']):]
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').lower()
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_%s' % name.upper().replace('-', '_')
+
+        # Combine repeated headers
+        if key in environ:
+            value = '%s%s%s' % (environ[key],
+                                '; ' if key == 'HTTP_COOKIE' else ',',
+                                value)
+        environ[key] = value
+
+    return environ
+
+
+def build_scope(scope, environ):
+    """
+    Build the ASGI connection scope to pass to a native ASGI
+    application, reflecting the changes AVersion made to the request.
+
+    :param scope: The original ASGI connection scope.
+    :param environ: The WSGI environment AVersion processed.
+
+    :returns: The new ASGI connection scope.  The "aversion" key
+              contains a dictionary of the ``aversion.*`` variables,
+              which may be passed to ``aversion.environ_get()``.
+    """
+
+    root_path = environ['SCRIPT_NAME'].encode('latin-1').decode('utf-8')
+    path = environ['PATH_INFO'].encode('latin-1').decode('utf-8')
+
+    scope = dict(scope)
+    scope.pop('raw_path', None)
+    scope['root_path'] = root_path
+    scope['path'] = root_path + path
+    if 'HTTP_ACCEPT' in environ:
+        scope['headers'] = [
+            (name, value) for name, value in scope.get('headers', [])
+            if name.lower() != b'accept'
+        ] + [(b'accept', environ['HTTP_ACCEPT'].encode('latin-1'))]
+    scope['aversion'] = dict((key, value) for key, value in environ.items()
+                             if key.startswith('aversion.'))
+
+    return scope
+
+
+def response_filters(app):
+    """
+    Collect the response filters AVersion wrapped around the
+    application selected for a request.
+
+    :param app: The WSGI application returned by the AVersion object.
+
+    :returns: A list of the response filters, in the order in which
+              they are to be applied.
+    """
+
+    filters = []
+    while app is not None:
+        if isinstance(app, aversion.ResponseFilter):
+            filters[:0] = app.filters
+        app = getattr(app, 'app', None)
+
+    return filters
+
+
+def filter_send(send, filters):
+    """
+    Wrap the ASGI send awaitable callable of a native application so
+    that the response headers are passed through response filters.
+
+    :param send: The ASGI send awaitable callable.
+    :param filters: A list of response filters, as for
+                    ``aversion.ResponseFilter``.
+
+    :returns: The wrapped send awaitable callable.
+    """
+
+    def filtered_send(message):
+        if message['type'] == 'http.response.start':
+            status = str(message['status'])
+            headers = [(name.decode('latin-1'), value.decode('latin-1'))
+                       for name, value in message.get('headers', [])]
+            for filt in filters:
+                status, headers = filt(status, headers)
+            message = dict(message, headers=[
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers])
+        return send(message)
+
+    return filtered_send
+
+
+async def send_static(send, response, method='GET'):
+    """
+    Send a pre-rendered response.
+
+    :param send: The ASGI send awaitable callable.
+    :param response: The aversion.StaticResponse object.
+    :param method: The request method.  No body is sent in response
+                   to a HEAD request.
+    """
+
+    await send({
+        'type': 'http.response.start',
+        'status': int(response.status.split(None, 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in response.headers],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': b'' if method == 'HEAD' else response.body,
+    })
+
+
+class AVersionASGI(object):
+    """
+    An ASGI application which routes requests using an AVersion
+    object.  Native ASGI applications may be given for some versions;
+    these are called directly.  The WSGI applications for the other
+    versions are each run in a dedicated pool of threads, so that a
+    slow version cannot take the threads from the others.  Requests
+    not routed to a version, such as requests for the version
+    application, are run in a default pool.
+    """
+
+    def __init__(self, avers, apps=None, threads=None, queue_sizes=None,
+                 default_threads=10, default_queue_size=None):
+        """
+        Initialize an AVersionASGI object.
+
+        :param avers: The AVersion object.
+        :param apps: A dictionary mapping version names to native ASGI
+                     applications.  A version need not be configured
+                     in the AVersion object; if it is, the native
+                     application takes precedence.
+        :param threads: A dictionary mapping version names to the
+                        number of threads to run the version's WSGI
+                        application in.
+        :param queue_sizes: A dictionary mapping version names to the
+                            maximum number of requests which may wait
+                            for a thread; further requests are
+                            answered with a "503 Service Unavailable"
+                            response.
+        :param default_threads: The number of threads for versions
+                                not listed in ``threads``, and for the
+                                default pool.
+        :param default_queue_size: The maximum number of waiting
+                                   requests for versions not listed in
+                                   ``queue_sizes``, and for the
+                                   default pool.  If None, the number
+                                   is not limited.
+        """
+
+        threads = threads or {}
+        queue_sizes = queue_sizes or {}
+
+        self.aversion = avers
+        self.apps = dict(apps or {})
+
+        # Route requests for the native applications
+        for version, app in self.apps.items():
+            for name, table in (('limit', avers.limiters),
+                                ('breaker', avers.breakers),
+                                ('shadow', avers.shadows),
+                                ('cache', avers.caches),
+                                ('coalesce', avers.coalescers)):
+                if version in table:
+                    LOG.warn("%s.%s: Not applied to native ASGI application" %
+                             (name, version))
+            params = avers.versions.get(version, {}).get('params', {})
+            avers.versions[version] = dict(name=version, app=NativeApp(app),
+                                           params=params)
+        if self.apps:
+            if avers.compress:
+                LOG.warn("compress: Not applied to native ASGI applications")
+            avers.config_changed()
+
+        # Set up the thread pools
+        self.pools = {}
+        for version in avers.versions:
+            if version in self.apps:
+                continue
+            self.pools[version] = VersionPool(
+                version, threads.get(version, default_threads),
+                queue_sizes.get(version, default_queue_size))
+        self.default_pool = VersionPool('default', default_threads,
+                                        default_queue_size)
+
+    async def __call__(self, scope, receive, send):
+        """
+        Process an ASGI connection.
+
+        :param scope: The ASGI connection scope.
+        :param receive: The ASGI receive awaitable callable.
+        :param send: The ASGI send awaitable callable.
+        """
+
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] in ('http', 'websocket'):
+            await self._request(scope, receive, send)
+        else:
+            raise ValueError("Unsupported ASGI connection type %r" %
+                             scope['type'])
+
+    async def _lifespan(self, receive, send):
+        """
+        Process the ASGI lifespan protocol.  The thread pools are
+        stopped at shutdown.
+
+        :param receive: The ASGI receive awaitable callable.
+        :param send: The ASGI send awaitable callable.
+        """
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _request(self, scope, receive, send):
+        """
+        Route an ASGI request and pass it to the selected
+        application.
+
+        :param scope: The ASGI connection scope.
+        :param receive: The ASGI receive awaitable callable.
+        :param send: The ASGI send awaitable callable.
+        """
+
+        loop = asyncio.get_event_loop()
+        environ = build_environ(scope, RequestBody(receive, loop))
+
+        # Answer metrics requests with the pool metrics included
+        if (scope['type'] == 'http' and self.aversion.metrics_path and
+                environ['PATH_INFO'] == self.aversion.metrics_path):
+            body = json.dumps(self.metrics(), sort_keys=True)
+            await send_static(send, aversion.StaticResponse('200 OK', [
+                ('Content-Type', 'application/json'),
+                ('Cache-Control', 'no-cache'),
+            ], body.encode('utf-8')), environ['REQUEST_METHOD'])
+            return
+
+        # Route the request; this does not read the body
+        app = self.aversion(webob.Request(environ))
+        version = aversion.environ_get(environ, 'aversion.version')
+
+        # Call native applications directly, applying the response
+        # header filters
+        if version in self.apps:
+            filters = response_filters(app)
+            if filters and scope['type'] == 'http':
+                send = filter_send(send, filters)
+            await self.apps[version](build_scope(scope, environ),
+                                     receive, send)
+            return
+        elif scope['type'] == 'websocket':
+            # WSGI applications cannot accept WebSocket connections
+            await send({'type': 'websocket.close'})
+            return
+
+        pool = self.pools.get(version, self.default_pool)
+        if pool.full():
+            await send_static(send, pool.response, environ['REQUEST_METHOD'])
+            return
+
+        runner = WSGIRunner(app, environ, send, loop)
+        try:
+            await pool.run(runner)
+        except Exception:
+            LOG.exception("Error running WSGI application for version %s" %
+                          version)
+            if runner.started:
+                raise
+            await send_static(send, aversion._error_response(
+                '500 Internal Server Error',
+                'The application encountered an error.'),
+                environ['REQUEST_METHOD'])
+
+    def metrics(self):
+        """
+        Retrieve the current values of the counters maintained by
+        AVersion, together with the state of the thread pools.
+
+        :returns: The dictionary returned by ``AVersion.metrics()``,
+                  with the additional keys "pools", mapping the
+                  versions to the state of their thread pools, as for
+                  VersionPool.snapshot(); and "default_pool", the
+                  state of the default pool.
+        """
+
+        result = self.aversion.metrics()
+        result['pools'] = dict((version, pool.snapshot())
+                               for version, pool in self.pools.items())
+        result['default_pool'] = self.default_pool.snapshot()
+        return result
+
+    def shutdown(self):
+        """
+        Stop the thread pools.
+        """
+
+        for pool in self.pools.values():
+            pool.shutdown()
+        self.default_pool.shutdown()
@@ -28,7 +28,7 @@ setup(
     author_email='kevin.mitchell@rackspace.com',
     description="AVersion WSGI Version Selection Application",
     license='Apache License (2.0)',
-    py_modules=['aversion'],
+    py_modules=['aversion', 'aversion_asgi'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'License :: OSI Approved :: Apache Software License',
@@ -14,6 +14,24 @@
 #    under the License.
 
 import collections
+import copy
+import errno
+import functools
+import hashlib
+import io
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+
+try:
+    import BaseHTTPServer
+    import SocketServer
+except ImportError:
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
 
 import mock
 import unittest2
@@ -23,8 +41,23 @@ import webob.exc
 import aversion
 
 
-FakeTypeRule = collections.namedtuple('FakeTypeRule',
-                                      ['ctype', 'version', 'params'])
+class FakeTypeRule(collections.namedtuple('FakeTypeRule',
+                                          ['ctype', 'version', 'params',
+                                           'version_range'])):
+    def __new__(cls, ctype, version, params, version_range=None):
+        return super(FakeTypeRule, cls).__new__(cls, ctype, version, params,
+                                                version_range)
+
+
+def fake_result(**kwargs):
+    result = aversion.Result()
+    for key, value in kwargs.items():
+        setattr(result, key, value)
+    return result
+
+
+class TestException(Exception):
+    pass
 
 
 class QuotedSplitTest(unittest2.TestCase):
@@ -108,6 +141,22 @@ class ParseCtypeTest(unittest2.TestCase):
             '_': 'application/example',
         })
 
+    def test_whitespace(self):
+        res_ctype, res_params = aversion.parse_ctype(' a/b ; c=d ;e')
+
+        self.assertEqual(res_ctype, 'a/b')
+        self.assertEqual(res_params, {'c': 'd', 'e': True, '_': 'a/b'})
+
+    def test_max_params(self):
+        res_ctype, res_params = aversion.parse_ctype('a/b;c=d;e', 2)
+
+        self.assertEqual(res_ctype, 'a/b')
+        self.assertEqual(res_params, {'c': 'd', 'e': True, '_': 'a/b'})
+
+    def test_max_params_exceeded(self):
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          aversion.parse_ctype, 'a/b;c=d;e;f', 2)
+
     def test_none(self):
         res_ctype, res_params = aversion.parse_ctype('')
 
@@ -178,6 +227,271 @@ class BestMatchTest(unittest2.TestCase):
         self.assertEqual(res_ctype, '')
         self.assertEqual(res_params, {})
 
+    def test_limits(self):
+        requested = 'a/a;q=0.3,a/b;q=0.5;v=1'
+        allowed = ['a/a', 'a/b', 'a/c']
+        res_ctype, res_params = aversion.best_match(requested, allowed, 2, 2)
+
+        self.assertEqual(res_ctype, 'a/b')
+        self.assertEqual(res_params, dict(_='a/b', q='0.5', v='1'))
+
+    @mock.patch.object(aversion, 'quoted_split',
+                       return_value=iter(['a/a', 'a/b', 'a/c', 'a/d']))
+    def test_max_ranges_exceeded(self, mock_quoted_split):
+        self.assertRaises(aversion.HeaderLimitExceeded, aversion.best_match,
+                          'accept', ['a/a'], 2)
+
+        # Make sure we stopped splitting once the limit was exceeded
+        self.assertEqual(list(mock_quoted_split.return_value), ['a/d'])
+
+    def test_max_params_exceeded(self):
+        self.assertRaises(aversion.HeaderLimitExceeded, aversion.best_match,
+                          'a/a;q=0.3,a/b;q=0.5;v=1', ['a/a'], None, 1)
+
+
+class BestMatchesTest(unittest2.TestCase):
+    def test_empty(self):
+        result = aversion.best_matches('', ['a/a', 'a/b', 'a/c'])
+
+        self.assertEqual(result, [])
+
+    def test_ranked(self):
+        requested = 'a/a;q=0.3,a/b;q=0.5,a/c;q=0.7'
+        allowed = ['a/a', 'a/b', 'a/c']
+        result = aversion.best_matches(requested, allowed)
+
+        self.assertEqual(result, [
+            ('a/c', dict(_='a/c', q='0.7')),
+            ('a/b', dict(_='a/b', q='0.5')),
+            ('a/a', dict(_='a/a', q='0.3')),
+        ])
+
+    def test_specificity(self):
+        requested = '*/*;q=0.7,a/*;q=0.7,a/c;q=0.7,b/b;q=0.1'
+        allowed = ['a/a', 'b/b', 'a/c', 'c/c']
+        result = aversion.best_matches(requested, allowed)
+
+        # The most specific matching range determines the quality
+        self.assertEqual(result, [
+            ('a/c', dict(_='a/c', q='0.7')),
+            ('a/a', dict(_='a/*', q='0.7')),
+            ('c/c', dict(_='*/*', q='0.7')),
+            ('b/b', dict(_='b/b', q='0.1')),
+        ])
+
+    def test_ties(self):
+        requested = 'a/a;v=1,a/b;v=2,a/a;v=3;q=0.5,a/a;v=4'
+        allowed = ['a/b', 'a/a']
+        result = aversion.best_matches(requested, allowed)
+
+        self.assertEqual(result, [
+            ('a/b', dict(_='a/b', v='2')),
+            ('a/a', dict(_='a/a', v='1')),
+            ('a/a', dict(_='a/a', v='4')),
+            ('a/a', dict(_='a/a', v='3', q='0.5')),
+        ])
+
+    def test_bad_q(self):
+        requested = 'a/a;q=spam,a/b;q=0.5'
+        allowed = ['a/a', 'a/b', 'a/c']
+        result = aversion.best_matches(requested, allowed)
+
+        self.assertEqual(result, [
+            ('a/b', dict(_='a/b', q='0.5')),
+        ])
+
+    def test_not_acceptable(self):
+        requested = 'a/b;q=0,a/*;q=0.5,b/*;q=0'
+        allowed = ['a/a', 'a/b', 'b/b']
+        result = aversion.best_matches(requested, allowed)
+
+        self.assertEqual(result, [
+            ('a/a', dict(_='a/*', q='0.5')),
+        ])
+
+
+class FrozenParamsTest(unittest2.TestCase):
+    def test_immutable(self):
+        params = aversion.FrozenParams({'_': 'a/a', 'q': '0.5'})
+
+        self.assertEqual(params, {'_': 'a/a', 'q': '0.5'})
+        for method, args in (('__setitem__', ('q', '1')),
+                             ('__delitem__', ('q',)), ('clear', ()),
+                             ('pop', ('q',)), ('popitem', ()),
+                             ('setdefault', ('v', '1')),
+                             ('update', ({'v': '1'},))):
+            self.assertRaises(TypeError, getattr(params, method), *args)
+        self.assertEqual(params, {'_': 'a/a', 'q': '0.5'})
+
+    def test_hash(self):
+        params1 = aversion.FrozenParams({'_': 'a/a', 'q': '0.5'})
+        params2 = aversion.FrozenParams({'q': '0.5', '_': 'a/a'})
+
+        self.assertEqual(hash(params1), hash(params2))
+
+    def test_copy(self):
+        params = aversion.FrozenParams({'_': 'a/a'})
+
+        self.assertIs(copy.copy(params), params)
+        self.assertIs(copy.deepcopy(params), params)
+
+    def test_pickle(self):
+        params = aversion.FrozenParams({'_': 'a/a'})
+
+        result = aversion.pickle.loads(aversion.pickle.dumps(params, 2))
+
+        self.assertIsInstance(result, aversion.FrozenParams)
+        self.assertEqual(result, params)
+
+
+class ParseAcceptTest(unittest2.TestCase):
+    def test_empty(self):
+        self.assertEqual(aversion.parse_accept(''), ())
+
+    def test_ranked(self):
+        result = aversion.parse_accept(
+            '*/*;q=0.1, a/*, a/b;q=spam, a/c;v=1, b/b;q=0.5, a/d')
+
+        self.assertEqual(result, (
+            ('a/c', {'_': 'a/c', 'v': '1'}),
+            ('a/d', {'_': 'a/d'}),
+            ('a/*', {'_': 'a/*'}),
+            ('b/b', {'_': 'b/b', 'q': '0.5'}),
+            ('*/*', {'_': '*/*', 'q': '0.1'}),
+        ))
+        for _mask, params in result:
+            self.assertIsInstance(params, aversion.FrozenParams)
+
+    def test_limits(self):
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          aversion.parse_accept, 'a/a, a/b', 1)
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          aversion.parse_accept, 'a/a;q=1;v=1', None, 1)
+
+
+class HeaderCacheTest(unittest2.TestCase):
+    def test_init(self):
+        cache = aversion.HeaderCache()
+
+        self.assertEqual(cache.max_ranges, None)
+        self.assertEqual(cache.max_params, None)
+        self.assertEqual(cache.size, 256)
+        self.assertEqual(cache.snapshot(),
+                         dict(entries=0, hits=0, misses=0))
+
+    def test_parse_accept(self):
+        cache = aversion.HeaderCache()
+
+        result1 = cache.parse_accept('a/a;q=0.5, a/b')
+        result2 = cache.parse_accept('a/a;q=0.5, a/b')
+
+        self.assertEqual(result1, (('a/b', {'_': 'a/b'}),
+                                   ('a/a', {'_': 'a/a', 'q': '0.5'})))
+        self.assertIs(result1, result2)
+        self.assertEqual(cache.snapshot(),
+                         dict(entries=1, hits=1, misses=1))
+
+    def test_parse_ctype(self):
+        cache = aversion.HeaderCache()
+
+        result1 = cache.parse_ctype('a/a;v=1')
+        result2 = cache.parse_ctype('a/a;v=1')
+
+        self.assertEqual(result1, ('a/a', {'_': 'a/a', 'v': '1'}))
+        self.assertIsInstance(result1[1], aversion.FrozenParams)
+        self.assertIs(result1, result2)
+
+    def test_separate_headers(self):
+        cache = aversion.HeaderCache()
+
+        cache.parse_ctype('a/a')
+        result = cache.parse_accept('a/a')
+
+        self.assertEqual(result, (('a/a', {'_': 'a/a'}),))
+        self.assertEqual(cache.snapshot(),
+                         dict(entries=2, hits=0, misses=2))
+
+    def test_full(self):
+        cache = aversion.HeaderCache(size=2)
+
+        for value in ('a/a', 'a/b', 'a/c'):
+            cache.parse_accept(value)
+
+        self.assertEqual(len(cache.cache), 2)
+        self.assertIn(('accept', 'a/c'), cache.cache)
+
+    def test_disabled(self):
+        cache = aversion.HeaderCache(size=0)
+
+        cache.parse_ctype('a/a')
+
+        self.assertEqual(cache.cache, {})
+
+    def test_limits(self):
+        cache = aversion.HeaderCache(max_ranges=1, max_params=1)
+
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          cache.parse_accept, 'a/a, a/b')
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          cache.parse_ctype, 'a/a;v=1;w=2')
+        self.assertEqual(cache.cache, {})
+
+
+class BestEncodingTest(unittest2.TestCase):
+    def test_empty(self):
+        result = aversion.best_encoding('', ['gzip', 'deflate'])
+
+        self.assertEqual(result, None)
+
+    def test_preferred_order(self):
+        result = aversion.best_encoding('deflate, gzip', ['gzip', 'deflate'])
+
+        self.assertEqual(result, 'gzip')
+
+    def test_quality(self):
+        result = aversion.best_encoding('gzip;q=0.5, deflate',
+                                        ['gzip', 'deflate'])
+
+        self.assertEqual(result, 'deflate')
+
+    def test_refused(self):
+        result = aversion.best_encoding('gzip;q=0, br', ['gzip', 'deflate'])
+
+        self.assertEqual(result, None)
+
+    def test_wildcard(self):
+        result = aversion.best_encoding('*;q=0.5, gzip;q=0',
+                                        ['gzip', 'deflate'])
+
+        self.assertEqual(result, 'deflate')
+
+    def test_identity_preferred(self):
+        result = aversion.best_encoding('identity, gzip;q=0.5',
+                                        ['gzip', 'deflate'])
+
+        self.assertEqual(result, None)
+
+    def test_case_insensitive(self):
+        result = aversion.best_encoding('GZip', ['gzip', 'deflate'])
+
+        self.assertEqual(result, 'gzip')
+
+    def test_bad_q(self):
+        result = aversion.best_encoding('gzip;q=spam, deflate;q=0.1',
+                                        ['gzip', 'deflate'])
+
+        self.assertEqual(result, 'deflate')
+
+    def test_max_ranges_exceeded(self):
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          aversion.best_encoding, 'gzip, deflate, br',
+                          ['gzip'], 2)
+
+    def test_max_params_exceeded(self):
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          aversion.best_encoding, 'gzip;q=1;a=b',
+                          ['gzip'], None, 1)
+
 
 class TypeRuleTest(unittest2.TestCase):
     def test_init(self):
@@ -186,6 +500,8 @@ class TypeRuleTest(unittest2.TestCase):
         self.assertEqual(tr.ctype, 'ctype')
         self.assertEqual(tr.version, 'version')
         self.assertEqual(tr.params, 'params')
+        self.assertEqual(tr.version_range, None)
+        self.assertEqual(tr.index, None)
 
     def test_call_fixed(self):
         tr = aversion.TypeRule('ctype', 'version', None)
@@ -219,6 +535,272 @@ class TypeRuleTest(unittest2.TestCase):
         self.assertEqual(ctype, None)
         self.assertEqual(version, None)
 
+    def test_call_range(self):
+        tr = aversion.TypeRule(None, 'v%(version)s', None,
+                               '>=%(min_version)s')
+        tr.index = mock.Mock(**{'resolve.return_value': 'v2.1'})
+
+        ctype, version = tr(dict(_='a/a', min_version='2', version='1'))
+
+        self.assertEqual(version, 'v2.1')
+        tr.index.resolve.assert_called_once_with('>=2')
+
+    def test_call_range_unresolved(self):
+        tr = aversion.TypeRule(None, 'v%(version)s', None, '%(version)s')
+        tr.index = mock.Mock(**{'resolve.return_value': None})
+
+        ctype, version = tr(dict(_='a/a', version='3'))
+
+        self.assertEqual(version, 'v3')
+
+    def test_call_range_badsubs(self):
+        tr = aversion.TypeRule(None, None, None, '%(version)s')
+        tr.index = mock.Mock()
+
+        ctype, version = tr(dict(_='a/a'))
+
+        self.assertEqual(version, None)
+        self.assertFalse(tr.index.resolve.called)
+
+    def test_call_range_no_index(self):
+        tr = aversion.TypeRule(None, 'v1', None, '%(version)s')
+
+        ctype, version = tr(dict(_='a/a', version='2'))
+
+        self.assertEqual(version, 'v1')
+
+
+class NaturalVersionKeyTest(unittest2.TestCase):
+    def test_key(self):
+        self.assertEqual(aversion.natural_version_key('v1.10'), (1, 10))
+        self.assertEqual(aversion.natural_version_key('2.x'), (2,))
+        self.assertEqual(aversion.natural_version_key('beta'), ())
+
+    def test_ordering(self):
+        result = sorted(['v1.10', 'v2', 'v1.9', 'v1'],
+                        key=aversion.natural_version_key)
+
+        self.assertEqual(result, ['v1', 'v1.9', 'v1.10', 'v2'])
+
+
+class VersionIndexTest(unittest2.TestCase):
+    versions = ['v1.0', 'v1.1', 'v1.10', 'v1.9', 'v2.0', 'v2.1', 'v3']
+
+    def test_init_natural(self):
+        index = aversion.VersionIndex(self.versions)
+
+        self.assertEqual(index.versions, ['v1.0', 'v1.1', 'v1.9', 'v1.10',
+                                          'v2.0', 'v2.1', 'v3'])
+        self.assertEqual(index.keys, [(1, 0), (1, 1), (1, 9), (1, 10),
+                                      (2, 0), (2, 1), (3,)])
+
+    def test_init_lexical(self):
+        index = aversion.VersionIndex(self.versions, 'lexical')
+
+        self.assertEqual(index.versions, sorted(self.versions))
+
+    def test_init_explicit(self):
+        index = aversion.VersionIndex(self.versions, ['v3', 'v1.0', 'v9'])
+
+        self.assertEqual(index.versions, ['v3', 'v1.0'])
+        self.assertEqual(index.keys, [0, 1])
+
+    def test_resolve_prefix(self):
+        index = aversion.VersionIndex(self.versions)
+
+        self.assertEqual(index.resolve('1.x'), 'v1.10')
+        self.assertEqual(index.resolve('1'), 'v1.10')
+        self.assertEqual(index.resolve('2.*'), 'v2.1')
+        self.assertEqual(index.resolve('1.1'), 'v1.1')
+        self.assertEqual(index.resolve('x'), 'v3')
+        self.assertEqual(index.resolve('4.x'), None)
+
+    def test_resolve_operators(self):
+        index = aversion.VersionIndex(self.versions)
+
+        self.assertEqual(index.resolve('<2'), 'v1.10')
+        self.assertEqual(index.resolve('<=2.0'), 'v2.0')
+        self.assertEqual(index.resolve('>1.9, <= 1.10'), 'v1.10')
+        self.assertEqual(index.resolve('>=2.1 <3'), 'v2.1')
+        self.assertEqual(index.resolve('=1.9'), 'v1.9')
+        self.assertEqual(index.resolve('==1.5'), None)
+        self.assertEqual(index.resolve('>3'), None)
+        self.assertEqual(index.resolve('>=2,<2'), None)
+
+    def test_resolve_prefix_operators(self):
+        index = aversion.VersionIndex(['v1', 'v2.0', 'v2.3', 'v10'])
+
+        self.assertEqual(index.resolve('>=2'), 'v10')
+        self.assertEqual(index.resolve('>=2, <10'), 'v2.3')
+        self.assertEqual(index.resolve('>2'), 'v10')
+        self.assertEqual(index.resolve('>2, <10'), None)
+        self.assertEqual(index.resolve('<=2'), 'v2.3')
+        self.assertEqual(index.resolve('<=2.0'), 'v2.0')
+        self.assertEqual(index.resolve('<2'), 'v1')
+        self.assertEqual(index.resolve('=2'), 'v2.3')
+        self.assertEqual(index.resolve('==2'), 'v2.3')
+        self.assertEqual(index.resolve('=2.0'), 'v2.0')
+        self.assertEqual(index.resolve('2'), 'v2.3')
+
+    def test_resolve_non_numeric(self):
+        index = aversion.VersionIndex(['v1', 'v2.0', 'v2.3', 'v10'])
+
+        self.assertEqual(index.resolve('garbage'), None)
+        self.assertEqual(index.resolve('latest'), None)
+        self.assertEqual(index.resolve('>=latest'), None)
+        self.assertEqual(index.resolve('<=x'), None)
+        self.assertEqual(index.resolve('=*'), None)
+        self.assertEqual(index.resolve('*'), 'v10')
+        self.assertEqual(index.resolve('x, <10'), 'v2.3')
+
+    def test_resolve_empty(self):
+        index = aversion.VersionIndex(self.versions)
+
+        self.assertEqual(index.resolve(''), None)
+        self.assertEqual(index.resolve(' , '), None)
+
+    def test_resolve_lexical(self):
+        index = aversion.VersionIndex(['alpha', 'beta', 'gamma'], 'lexical')
+
+        self.assertEqual(index.resolve('<gamma'), 'beta')
+        self.assertEqual(index.resolve('<=beta'), 'beta')
+        self.assertEqual(index.resolve('>beta'), 'gamma')
+        self.assertEqual(index.resolve('beta'), 'beta')
+        self.assertEqual(index.resolve('=beta'), 'beta')
+        self.assertEqual(index.resolve('delta'), None)
+        self.assertEqual(index.resolve('x'), 'gamma')
+
+    def test_resolve_explicit(self):
+        index = aversion.VersionIndex(['old', 'new', 'newer'],
+                                      ['old', 'new', 'newer'])
+
+        self.assertEqual(index.resolve('>=new'), 'newer')
+        self.assertEqual(index.resolve('<newer'), 'new')
+        self.assertEqual(index.resolve('>=unknown'), None)
+
+
+class MatchRuleTest(unittest2.TestCase):
+    def test_media_range(self):
+        self.assertEqual(aversion.match_media_range('*/*', 'a/b'), 0)
+        self.assertEqual(aversion.match_media_range('a/*', 'a/b'), 1)
+        self.assertEqual(aversion.match_media_range('a/b', 'a/b'), 2)
+        self.assertEqual(aversion.match_media_range('a/c', 'a/b'), None)
+
+    def test_language_range(self):
+        self.assertEqual(aversion.match_language_range('*', 'en-US'), 0)
+        self.assertEqual(aversion.match_language_range('en', 'en-US'), 1)
+        self.assertEqual(aversion.match_language_range('EN-us', 'en-US'),
+                         2)
+        self.assertEqual(aversion.match_language_range('en-US', 'en'), None)
+        self.assertEqual(aversion.match_language_range('e', 'en-US'), None)
+
+    def test_charset(self):
+        self.assertEqual(aversion.match_charset('*', 'utf-8'), 0)
+        self.assertEqual(aversion.match_charset('UTF-8', 'utf-8'), 1)
+        self.assertEqual(aversion.match_charset('latin1', 'utf-8'), None)
+
+
+class NegotiatorTest(unittest2.TestCase):
+    def test_init(self):
+        negotiator = aversion.Negotiator(('a/a', 'a/b'))
+
+        self.assertEqual(negotiator.allowed, ['a/a', 'a/b'])
+        self.assertEqual(negotiator.rule, aversion.match_media_range)
+        self.assertEqual(negotiator.max_ranges, None)
+        self.assertEqual(negotiator.max_params, None)
+        self.assertEqual(negotiator.cache_size, 256)
+        self.assertEqual(negotiator.snapshot(),
+                         dict(entries=0, hits=0, misses=0))
+
+    def test_deepcopy(self):
+        negotiator = aversion.Negotiator(['a/a'])
+
+        self.assertIs(copy.deepcopy(negotiator), negotiator)
+
+    def test_best_matches_language(self):
+        negotiator = aversion.Negotiator(['en-US', 'en-GB', 'fr'],
+                                         aversion.match_language_range)
+
+        result = negotiator.best_matches('fr;q=0.5, en, en-gb, *;q=0.1')
+
+        # Only the most specific ranges matching a value apply
+        self.assertEqual(result, [
+            ('en-GB', {'_': 'en-gb'}),
+            ('en-US', {'_': 'en'}),
+            ('fr', {'_': 'fr', 'q': '0.5'}),
+        ])
+
+    def test_best_match(self):
+        negotiator = aversion.Negotiator(['utf-8', 'iso-8859-1'],
+                                         aversion.match_charset)
+
+        self.assertEqual(negotiator.best_match('ISO-8859-1, *;q=0.5'),
+                         'iso-8859-1')
+        self.assertEqual(negotiator.best_match('ascii'), None)
+
+    def test_best_matches_equally_specific(self):
+        negotiator = aversion.Negotiator(['a/a'])
+
+        result = negotiator.best_matches('a/a;v=1;q=0.5, a/a;v=2, a/*')
+
+        self.assertEqual(result, [
+            ('a/a', {'_': 'a/a', 'v': '2'}),
+            ('a/a', {'_': 'a/a', 'v': '1', 'q': '0.5'}),
+        ])
+
+    def test_best_match_excluded(self):
+        negotiator = aversion.Negotiator(['fr', 'en'],
+                                         aversion.match_language_range)
+
+        self.assertEqual(negotiator.best_matches('fr;q=0, *;q=0.5'),
+                         [('en', {'_': '*', 'q': '0.5'})])
+        self.assertEqual(negotiator.best_match('fr;q=0, *;q=0.5'), 'en')
+        self.assertEqual(negotiator.best_match('fr;q=0'), None)
+
+    def test_best_match_none_acceptable(self):
+        negotiator = aversion.Negotiator(['fr', 'en'],
+                                         aversion.match_language_range)
+
+        self.assertEqual(negotiator.best_matches('*;q=0'), [])
+        self.assertEqual(negotiator.best_match('*;q=0'), None)
+        self.assertEqual(negotiator.best_match('en;q=0.0, fr;q=-1'), None)
+
+    def test_cache(self):
+        negotiator = aversion.Negotiator(['a/a', 'a/b'])
+
+        result1 = negotiator.best_matches('a/b')
+        result2 = negotiator.best_matches('a/b')
+
+        self.assertIs(result1, result2)
+        self.assertEqual(negotiator.snapshot(),
+                         dict(entries=1, hits=1, misses=1))
+
+    def test_cache_full(self):
+        negotiator = aversion.Negotiator(['a/a', 'a/b'], cache_size=2)
+
+        for requested in ('a/a', 'a/b', '*/*'):
+            negotiator.best_matches(requested)
+
+        self.assertEqual(len(negotiator.cache), 2)
+        self.assertIn('*/*', negotiator.cache)
+
+    def test_cache_disabled(self):
+        negotiator = aversion.Negotiator(['a/a', 'a/b'], cache_size=0)
+
+        negotiator.best_matches('a/b')
+
+        self.assertEqual(negotiator.cache, {})
+
+    def test_limits(self):
+        negotiator = aversion.Negotiator(['a/a'], max_ranges=1,
+                                         max_params=1)
+
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          negotiator.best_matches, 'a/a, a/b')
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          negotiator.best_matches, 'a/a;q=1;b=c')
+        self.assertEqual(negotiator.cache, {})
+
 
 class ResultTest(unittest2.TestCase):
     def test_init(self):
@@ -227,6 +809,16 @@ class ResultTest(unittest2.TestCase):
         self.assertEqual(res.version, None)
         self.assertEqual(res.ctype, None)
         self.assertEqual(res.orig_ctype, None)
+        self.assertEqual(res.request_ctype, None)
+        self.assertEqual(res.orig_request_ctype, None)
+        self.assertEqual(res.request_header, None)
+        self.assertEqual(res.vary, [])
+        self.assertEqual(res.candidates, [])
+        self.assertEqual(res.encoding, None)
+        self.assertEqual(res.language, None)
+        self.assertEqual(res.charset, None)
+        self.assertEqual(res.parsed_accept, None)
+        self.assertEqual(res.parsed_ctype, None)
 
     def test_nonzero(self):
         res = aversion.Result()
@@ -287,1014 +879,5927 @@ class ResultTest(unittest2.TestCase):
         self.assertEqual(res.ctype, 'ctype')
         self.assertEqual(res.orig_ctype, 'orig')
 
+    def test_set_request_ctype_unset(self):
+        res = aversion.Result()
 
-class SetKeyTest(unittest2.TestCase):
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_duplicate(self, mock_warn):
-        result = dict(foo='one')
-        aversion._set_key("pfx", result, 'foo', '"two"', 'bar')
+        res.set_request_ctype('ctype', 'orig', 'header')
 
-        self.assertEqual(result, dict(foo='two'))
-        mock_warn.assert_called_once_with(
-            "pfx: Duplicate value for bar 'foo'")
+        self.assertEqual(res.request_ctype, 'ctype')
+        self.assertEqual(res.orig_request_ctype, 'orig')
+        self.assertEqual(res.request_header, 'header')
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_unquoted(self, mock_warn):
-        result = {}
-        aversion._set_key("pfx", result, 'foo', 'one', 'bar')
+    def test_set_request_ctype_set(self):
+        res = aversion.Result()
+        res.request_ctype = 'ctype'
+        res.orig_request_ctype = 'orig'
+        res.request_header = 'header'
 
-        self.assertEqual(result, {})
-        mock_warn.assert_called_once_with(
-            "pfx: Invalid value 'one' for bar 'foo'")
+        res.set_request_ctype('epytc', 'giro', 'redaeh')
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_noerror(self, mock_warn):
-        result = {}
-        aversion._set_key("pfx", result, 'foo', '"one"', 'bar')
+        self.assertEqual(res.request_ctype, 'ctype')
+        self.assertEqual(res.orig_request_ctype, 'orig')
+        self.assertEqual(res.request_header, 'header')
 
-        self.assertEqual(result, dict(foo='one'))
-        self.assertFalse(mock_warn.called)
+    def test_add_vary(self):
+        res = aversion.Result()
 
+        res.add_vary('Accept')
+        res.add_vary('Content-Type')
+        res.add_vary('Accept')
 
-class ParseVersionRuleTest(unittest2.TestCase):
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_invalid_rule(self, mock_warn):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        self.assertEqual(res.vary, ['Accept', 'Content-Type'])
 
-        self.assertRaises(ImportError, aversion._parse_version_rule, loader,
-                          'v1', '')
-        self.assertFalse(loader.get_app.called)
-        self.assertFalse(mock_warn.called)
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_no_params(self, mock_warn):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+class DecisionTest(unittest2.TestCase):
+    def make_decision(self, **kwargs):
+        config = {'versions': {'v1': {'params': {}}}}
+        return aversion.Decision(config, 'v1', fake_result(**kwargs),
+                                 'accept')
 
-        result = aversion._parse_version_rule(loader, 'v1', 'api_v1')
+    def test_init(self):
+        result = fake_result(ctype='a/a', orig_ctype='a/b',
+                             request_ctype='a/c', orig_request_ctype='a/d',
+                             request_header='a/e')
 
-        self.assertEqual(result, dict(app='api_v1', name='v1', params={}))
-        loader.get_app.assert_called_once_with('api_v1')
-        self.assertFalse(mock_warn.called)
+        decision = aversion.Decision('config', 'v1', result, 'accept')
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_bad_parameter(self, mock_warn):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        self.assertEqual(decision.version, 'v1')
+        self.assertEqual(decision.response_type, 'a/a')
+        self.assertEqual(decision.orig_response_type, 'a/b')
+        self.assertEqual(decision.accept, 'accept')
+        self.assertEqual(decision.request_type, 'a/c')
+        self.assertEqual(decision.orig_request_type, 'a/d')
+        self.assertEqual(decision.content_type, 'a/e')
+        self.assertEqual(decision._config, None)
 
-        result = aversion._parse_version_rule(loader, 'v1',
-                                              'api_v1 foo=one')
+    @mock.patch('copy.deepcopy', side_effect=lambda x: dict(x))
+    def test_config(self, mock_deepcopy):
+        decision = self.make_decision()
 
-        self.assertEqual(result, dict(app='api_v1', name='v1', params={}))
-        loader.get_app.assert_called_once_with('api_v1')
-        mock_warn.assert_called_once_with(
-            "version.v1: Invalid value 'one' for parameter 'foo'")
+        self.assertFalse(mock_deepcopy.called)
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_full_parse(self, mock_warn):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        config1 = decision.config
+        config2 = decision.config
 
-        result = aversion._parse_version_rule(loader, 'v1',
-                                              'api_v1 foo="one"  bar="two"')
+        mock_deepcopy.assert_called_once_with(decision._config_src)
+        self.assertEqual(config1, decision._config_src)
+        self.assertIsNot(config1, decision._config_src)
+        self.assertIs(config1, config2)
 
-        self.assertEqual(result, dict(
-            app='api_v1',
-            name='v1',
-            params=dict(foo='one', bar='two'),
-        ))
-        loader.get_app.assert_called_once_with('api_v1')
-        self.assertFalse(mock_warn.called)
+    def test_deepcopy(self):
+        decision = self.make_decision(ctype='a/a',
+                                      parsed_accept=(('a/a', {'_': 'a/a'}),))
+        config = decision.config
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_duplicate_parameter(self, mock_warn):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        result = copy.deepcopy(decision)
 
-        result = aversion._parse_version_rule(loader, 'v1',
-                                              'api_v1 foo="one" foo="two"')
+        self.assertIsNot(result, decision)
+        self.assertEqual(result.version, 'v1')
+        self.assertEqual(result.response_type, 'a/a')
+        self.assertEqual(result.parsed_accept, decision.parsed_accept)
+        self.assertIsNot(result.parsed_accept[0][1],
+                         decision.parsed_accept[0][1])
+        self.assertEqual(result.config, config)
+        self.assertIsNot(result.config, config)
+        self.assertIs(result._config_src, decision._config_src)
+
+    def test_get_unknown(self):
+        decision = self.make_decision(ctype='a/a')
+
+        self.assertEqual(decision.get('aversion.other'), None)
+        self.assertEqual(decision.get('aversion.other', 'default'),
+                         'default')
+
+    def test_get_unset(self):
+        decision = self.make_decision()
+
+        self.assertEqual(decision.get('aversion.version'), 'v1')
+        self.assertEqual(decision.get('aversion.accept', 'default'),
+                         'default')
+        self.assertEqual(decision.get('aversion.content_type', 'default'),
+                         'default')
+
+    def test_get_set(self):
+        decision = self.make_decision(ctype='a/a', request_ctype='a/c',
+                                      request_header='a/e')
+
+        self.assertEqual(decision.get('aversion.accept', 'default'),
+                         'accept')
+        self.assertEqual(decision.get('aversion.orig_response_type',
+                                      'default'), None)
+        self.assertEqual(decision.get('aversion.content_type', 'default'),
+                         'a/e')
+        self.assertEqual(decision.get('aversion.config'),
+                         {'versions': {'v1': {'params': {}}}})
+
+    def test_populate_unset(self):
+        decision = self.make_decision()
+        environ = {}
+
+        decision.populate(environ)
+
+        self.assertEqual(environ, {
+            'aversion.config': {'versions': {'v1': {'params': {}}}},
+            'aversion.version': 'v1',
+        })
 
-        self.assertEqual(result, dict(
-            app='api_v1',
-            name='v1',
-            params=dict(foo='two'),
-        ))
-        loader.get_app.assert_called_once_with('api_v1')
-        mock_warn.assert_called_once_with(
-            "version.v1: Duplicate value for parameter 'foo'")
+    def test_populate_set(self):
+        decision = self.make_decision(ctype='a/a', orig_ctype='a/b',
+                                      request_ctype='a/c',
+                                      orig_request_ctype='a/d',
+                                      request_header='a/e')
+        environ = {}
 
+        decision.populate(environ)
 
-class ParseAliasRuleTest(unittest2.TestCase):
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_invalid_rule(self, mock_warn):
-        self.assertRaises(KeyError, aversion._parse_alias_rule, 'v1.1', '')
-        self.assertFalse(mock_warn.called)
+        self.assertEqual(environ, {
+            'aversion.config': {'versions': {'v1': {'params': {}}}},
+            'aversion.version': 'v1',
+            'aversion.response_type': 'a/a',
+            'aversion.orig_response_type': 'a/b',
+            'aversion.accept': 'accept',
+            'aversion.request_type': 'a/c',
+            'aversion.orig_request_type': 'a/d',
+            'aversion.content_type': 'a/e',
+        })
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_no_params(self, mock_warn):
-        result = aversion._parse_alias_rule('v1.1', 'v2')
+    def test_populate_negotiated(self):
+        decision = self.make_decision(language='en', charset='utf-8')
+        environ = {}
 
-        self.assertEqual(result, dict(alias='v1.1', version='v2', params={}))
-        self.assertFalse(mock_warn.called)
+        decision.populate(environ)
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_bad_parameter(self, mock_warn):
-        result = aversion._parse_alias_rule('v1.1', 'v2 foo=one')
+        self.assertEqual(environ['aversion.language'], 'en')
+        self.assertEqual(environ['aversion.charset'], 'utf-8')
 
-        self.assertEqual(result, dict(alias='v1.1', version='v2', params={}))
-        mock_warn.assert_called_once_with(
-            "alias.v1.1: Invalid value 'one' for parameter 'foo'")
+    def test_populate_parsed(self):
+        decision = self.make_decision(
+            parsed_accept=(('a/a', aversion.FrozenParams(_='a/a')),),
+            parsed_ctype=('a/b', aversion.FrozenParams(_='a/b')))
+        environ = {}
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_full_parse(self, mock_warn):
-        result = aversion._parse_alias_rule('v1.1', 'v2 foo="one"  bar="two"')
+        decision.populate(environ)
 
-        self.assertEqual(result, dict(
-            alias='v1.1',
-            version='v2',
-            params=dict(foo='one', bar='two'),
-        ))
-        self.assertFalse(mock_warn.called)
+        self.assertEqual(environ['aversion.parsed_accept'],
+                         (('a/a', {'_': 'a/a'}),))
+        self.assertEqual(environ['aversion.parsed_content_type'],
+                         ('a/b', {'_': 'a/b'}))
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_duplicate_parameter(self, mock_warn):
-        result = aversion._parse_alias_rule('v1.1', 'v2 foo="one" foo="two"')
 
-        self.assertEqual(result, dict(
-            alias='v1.1',
-            version='v2',
-            params=dict(foo='two'),
-        ))
-        mock_warn.assert_called_once_with(
-            "alias.v1.1: Duplicate value for parameter 'foo'")
+class EnvironGetTest(unittest2.TestCase):
+    def test_legacy(self):
+        environ = {'aversion.version': 'v1'}
 
+        self.assertEqual(aversion.environ_get(environ, 'aversion.version'),
+                         'v1')
+        self.assertEqual(aversion.environ_get(environ, 'aversion.accept',
+                                              'default'), 'default')
 
-class ParseTypeRuleTest(unittest2.TestCase):
-    @mock.patch.object(aversion.LOG, 'warn')
-    @mock.patch.object(aversion, 'TypeRule')
-    def test_invalid_rule(self, mock_TypeRule, mock_warn):
-        rule = aversion._parse_type_rule('ctype', 'value')
+    def test_decision(self):
+        decision = mock.Mock(**{'get.return_value': 'value'})
+        environ = {'aversion.decision': decision}
 
-        mock_warn.assert_called_once_with(
-            "ctype: Invalid type token 'value'")
-        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
-                                              params={})
+        result = aversion.environ_get(environ, 'aversion.version', 'default')
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    @mock.patch.object(aversion, 'TypeRule')
-    def test_unknown_token_type(self, mock_TypeRule, mock_warn):
-        rule = aversion._parse_type_rule('ctype', 'value:bar')
+        self.assertEqual(result, 'value')
+        decision.get.assert_called_once_with('aversion.version', 'default')
 
-        mock_warn.assert_called_once_with(
-            "ctype: Unrecognized token type 'value'")
-        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
-                                              params={})
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    @mock.patch.object(aversion, 'TypeRule')
-    def test_bad_token_value(self, mock_TypeRule, mock_warn):
-        rule = aversion._parse_type_rule('ctype', 'type:bar')
+class ProfileSamplerTest(unittest2.TestCase):
+    def test_init(self):
+        sampler = aversion.ProfileSampler(10, 'file')
 
-        mock_warn.assert_called_once_with(
-            "type.ctype: Invalid value 'bar' for token type 'type'")
-        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
-                                              params={})
+        self.assertEqual(sampler.rate, 10)
+        self.assertEqual(sampler.filename, 'file')
+        self.assertEqual(sampler.samples, 0)
+        self.assertEqual(sampler.stats, None)
+        self.assertEqual(sampler.dump_pending, False)
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    @mock.patch.object(aversion, 'TypeRule')
-    def test_token_parsing(self, mock_TypeRule, mock_warn):
-        rule = aversion._parse_type_rule('ctype', 'type:"bar"  version:"baz" '
-                                         'param:foo="one" param:bar="two"')
+    @mock.patch.object(aversion.ProfileSampler, 'dump')
+    def test_request_dump(self, mock_dump):
+        func = mock.Mock(return_value='result')
+        sampler = aversion.ProfileSampler(1000, 'file')
 
-        self.assertFalse(mock_warn.called)
-        mock_TypeRule.assert_called_once_with(ctype='bar', version='baz',
-                                              params=dict(foo='one',
-                                                          bar='two'))
+        sampler.request_dump()
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    @mock.patch.object(aversion, 'TypeRule')
-    def test_token_parsing_duplicate(self, mock_TypeRule, mock_warn):
-        rule = aversion._parse_type_rule('ctype', 'type:"bar" type:"baz"')
+        self.assertEqual(sampler.dump_pending, True)
+        self.assertFalse(mock_dump.called)
 
-        mock_warn.assert_called_once_with(
-            "type.ctype: Duplicate value for token type 'type'")
-        mock_TypeRule.assert_called_once_with(ctype='baz', version=None,
-                                              params={})
+        # The dump happens at the start of the next call
+        result = sampler(func)
+        sampler(func)
 
-    @mock.patch.object(aversion.LOG, 'warn')
-    @mock.patch.object(aversion, 'TypeRule')
-    def test_bad_param_value(self, mock_TypeRule, mock_warn):
-        rule = aversion._parse_type_rule('ctype', 'param:foo=bar')
+        self.assertEqual(result, 'result')
+        mock_dump.assert_called_once_with()
+        self.assertEqual(sampler.dump_pending, False)
+
+    @mock.patch('cProfile.Profile')
+    @mock.patch('pstats.Stats')
+    def test_call_sampled(self, mock_Stats, mock_Profile):
+        func = mock.Mock(return_value='result')
+        sampler = aversion.ProfileSampler(2)
+
+        results = [sampler(func, 'a', b='c') for i in range(4)]
+
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(func.call_count, 4)
+        func.assert_called_with('a', b='c')
+        self.assertEqual(mock_Profile.call_count, 2)
+        mock_Stats.assert_called_once_with(mock_Profile.return_value)
+        mock_Stats.return_value.add.assert_called_once_with(
+            mock_Profile.return_value)
+        self.assertEqual(sampler.stats, mock_Stats.return_value)
+        self.assertEqual(sampler.samples, 2)
+
+    @mock.patch('cProfile.Profile', return_value=mock.Mock(**{
+        'enable.side_effect': ValueError,
+    }))
+    @mock.patch('pstats.Stats')
+    def test_call_profiler_busy(self, mock_Stats, mock_Profile):
+        func = mock.Mock(return_value='result')
+        sampler = aversion.ProfileSampler(1)
+
+        result = sampler(func)
 
-        mock_warn.assert_called_once_with(
-            "type.ctype: Invalid value 'bar' for parameter 'foo'")
-        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
-                                              params={})
+        self.assertEqual(result, 'result')
+        func.assert_called_once_with()
+        self.assertFalse(mock_Profile.return_value.disable.called)
+        self.assertFalse(mock_Stats.called)
+        self.assertEqual(sampler.samples, 0)
+
+    def test_call_real(self):
+        sampler = aversion.ProfileSampler(1)
+
+        result = sampler(aversion.quoted_split, 'a,b', ',')
+
+        self.assertEqual(list(result), ['a', 'b'])
+        self.assertEqual(sampler.samples, 1)
+        self.assertNotEqual(sampler.stats, None)
 
     @mock.patch.object(aversion.LOG, 'warn')
-    @mock.patch.object(aversion, 'TypeRule')
-    def test_duplicate_param(self, mock_TypeRule, mock_warn):
-        rule = aversion._parse_type_rule('ctype',
-                                         'param:foo="one" param:foo="two"')
+    def test_dump_nofile(self, mock_warn):
+        sampler = aversion.ProfileSampler(1)
+        sampler.stats = mock.Mock()
+
+        result = sampler.dump()
 
+        self.assertEqual(result, False)
+        self.assertFalse(sampler.stats.dump_stats.called)
         mock_warn.assert_called_once_with(
-            "type.ctype: Duplicate value for parameter 'foo'")
-        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
-                                              params=dict(foo='two'))
+            "No file name available for dumping profile data")
 
+    def test_dump_nostats(self):
+        sampler = aversion.ProfileSampler(1, 'file')
 
-class UriNormalizeTest(unittest2.TestCase):
-    def test_uri_normalize(self):
-        result = aversion._uri_normalize('///foo////bar////baz////')
+        result = sampler.dump()
 
-        self.assertEqual(result, '/foo/bar/baz')
+        self.assertEqual(result, False)
 
+    def test_dump_default(self):
+        sampler = aversion.ProfileSampler(1, 'file')
+        sampler.stats = mock.Mock()
 
-class AVersionTest(unittest2.TestCase):
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    def test_init_empty(self):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        result = sampler.dump()
 
-        av = aversion.AVersion(loader, {})
+        self.assertEqual(result, True)
+        sampler.stats.dump_stats.assert_called_once_with('file')
 
-        self.assertEqual(av.overwrite_headers, True)
-        self.assertEqual(av.version_app, None)
-        self.assertEqual(av.versions, {})
-        self.assertEqual(av.aliases, {})
-        self.assertEqual(av.types, {})
-        self.assertEqual(av.formats, {})
-        self.assertEqual(av.uris, [])
-        self.assertEqual(av.config, {
-            'versions': {},
-            'aliases': {},
-            'types': {},
+    def test_dump_override(self):
+        sampler = aversion.ProfileSampler(1, 'file')
+        sampler.stats = mock.Mock()
+
+        result = sampler.dump('other')
+
+        self.assertEqual(result, True)
+        sampler.stats.dump_stats.assert_called_once_with('other')
+
+    def test_reset(self):
+        sampler = aversion.ProfileSampler(1, 'file')
+        sampler.stats = 'stats'
+        sampler.samples = 5
+
+        sampler.reset()
+
+        self.assertEqual(sampler.stats, None)
+        self.assertEqual(sampler.samples, 0)
+
+
+class CounterSetTest(unittest2.TestCase):
+    def test_init(self):
+        counters = aversion.CounterSet(5)
+
+        self.assertEqual(counters.max_keys, 5)
+        self.assertEqual(counters.snapshot(), {})
+
+    def test_incr(self):
+        counters = aversion.CounterSet(2)
+
+        counters.incr('a')
+        counters.incr('b', 2)
+        counters.incr('a')
+        counters.incr('c')
+        counters.incr('d', 3)
+
+        self.assertEqual(counters.snapshot(), {
+            'a': 2,
+            'b': 2,
+            '<other>': 4,
         })
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_snapshot_copy(self):
+        counters = aversion.CounterSet()
+        counters.incr('a')
+
+        snap = counters.snapshot()
+        counters.incr('a')
+
+        self.assertEqual(snap, {'a': 1})
+
+
+class StaticResponseTest(unittest2.TestCase):
     def test_init(self):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        conf = {
-            'overwrite_headers': 'false',
-            'version': 'vers_app',
-            'version.v1': 'vers_v1',
-            'version.v2': 'vers_v2',
-            'alias.v1.1': 'v2',
-            'uri.///v1.0//': 'v1',
-            'uri.//v2////': 'v2',
-            'uri.//v3///': 'v3',
-            'type.a/a': 'type:"%(_)s" version:"v2"',
-            'type.a/b': 'version:"v1"',
-            'type.a/c': 'type:"a/a"',
-            '.a': 'a/a',
-            '.b': 'a/b',
-            'ignored': 'ignored',
-        }
+        sr = aversion.StaticResponse('200 OK', [('a', 'b')], b'body')
 
-        av = aversion.AVersion(loader, {}, **conf)
+        self.assertEqual(sr.status, '200 OK')
+        self.assertEqual(sr.headers, [('a', 'b'), ('Content-Length', '4')])
+        self.assertEqual(sr.body, b'body')
 
-        self.assertEqual(av.overwrite_headers, False)
-        self.assertEqual(av.version_app, 'vers_app')
-        self.assertEqual(av.versions, {
-            'v1': {
-                'app': 'vers_v1',
-                'name': 'v1',
-                'prefixes': ['/v1.0'],
-                'params': {},
+    def test_init_defaults(self):
+        sr = aversion.StaticResponse('204 No Content')
+
+        self.assertEqual(sr.status, '204 No Content')
+        self.assertEqual(sr.headers, [('Content-Length', '0')])
+        self.assertEqual(sr.body, b'')
+
+    def test_init_not_modified(self):
+        sr = aversion.StaticResponse('304 Not Modified', [('a', 'b')])
+
+        self.assertEqual(sr.headers, [('a', 'b')])
+
+    def test_call(self):
+        start_response = mock.Mock()
+        sr = aversion.StaticResponse('200 OK', [('a', 'b')], b'body')
+
+        result = sr({'REQUEST_METHOD': 'GET'}, start_response)
+
+        self.assertEqual(result, [b'body'])
+        start_response.assert_called_once_with(
+            '200 OK', [('a', 'b'), ('Content-Length', '4')])
+        self.assertIsNot(start_response.call_args[0][1], sr.headers)
+
+    def test_call_head(self):
+        start_response = mock.Mock()
+        sr = aversion.StaticResponse('200 OK', [('a', 'b')], b'body')
+
+        result = sr({'REQUEST_METHOD': 'HEAD'}, start_response)
+
+        self.assertEqual(result, [])
+        start_response.assert_called_once_with(
+            '200 OK', [('a', 'b'), ('Content-Length', '4')])
+
+
+class ErrorResponseTest(unittest2.TestCase):
+    def test_error_response(self):
+        result = aversion._error_response('406 Not Acceptable', 'message',
+                                          [('a', 'b')])
+
+        self.assertIsInstance(result, aversion.StaticResponse)
+        self.assertEqual(result.status, '406 Not Acceptable')
+        self.assertEqual(result.body, b'406 Not Acceptable\n\nmessage\n')
+        self.assertEqual(result.headers, [
+            ('Content-Type', 'text/plain; charset=UTF-8'),
+            ('a', 'b'),
+            ('Content-Length', '28'),
+        ])
+
+
+class DiscoveryAppTest(unittest2.TestCase):
+    def make_avers(self):
+        return mock.Mock(
+            versions={
+                'v1': dict(name='v1', app='app1', params={'a': 'b'},
+                           prefixes=['/v1.0', '/v1']),
+                'v2': dict(name='v2', app='app2', params={}),
             },
-            'v2': {
-                'app': 'vers_v2',
-                'name': 'v2',
-                'prefixes': ['/v2'],
-                'params': {},
+            aliases={'v1.1': dict(alias='v1.1', version='v2', params={})},
+            types={
+                'a/a': FakeTypeRule(None, 'v1', {}),
+                'a/b': FakeTypeRule(None, 'v%(v)s', {}),
+                'a/c': FakeTypeRule(None, None, {}),
+                'a/d': FakeTypeRule(None, 'v1.1', {}),
+                'a/e': FakeTypeRule(None, 'v3', {}),
             },
-        })
-        self.assertEqual(av.aliases, {
-            'v1.1': {
-                'alias': 'v1.1',
-                'version': 'v2',
-                'params': {},
+            config={
+                'aliases': 'aliases',
+                'types': 'types',
             },
-        })
-        self.assertEqual(av.types, {
-            'a/a': ('%(_)s', 'v2', {}),
-            'a/b': (None, 'v1', {}),
-            'a/c': ('a/a', None, {}),
-        })
-        self.assertEqual(av.formats, {
-            '.a': 'a/a',
-            '.b': 'a/b',
-        })
-        self.assertEqual(av.uris, [
-            ('/v1.0', 'v1'),
-            ('/v2', 'v2'),
-            ('/v3', 'v3'),
-        ])
-        self.assertEqual(av.config, {
+        )
+
+    def test_build_document(self):
+        avers = self.make_avers()
+
+        result = aversion.DiscoveryApp.build_document(avers)
+
+        self.assertEqual(result, {
             'versions': {
                 'v1': {
-                    'app': 'vers_v1',
                     'name': 'v1',
-                    'prefixes': ['/v1.0'],
-                    'params': {},
+                    'params': {'a': 'b'},
+                    'prefixes': ['/v1', '/v1.0'],
+                    'types': ['a/a'],
                 },
                 'v2': {
-                    'app': 'vers_v2',
                     'name': 'v2',
-                    'prefixes': ['/v2'],
-                    'params': {},
-                },
-            },
-            'aliases': {
-                'v1.1': {
-                    'alias': 'v1.1',
-                    'version': 'v2',
                     'params': {},
+                    'prefixes': [],
+                    'types': ['a/d'],
                 },
             },
-            'types': {
-                'a/a': dict(name='a/a', params={}, suffixes=['.a']),
-                'a/b': dict(name='a/b', params={}, suffixes=['.b']),
-                'a/c': dict(name='a/c', params={}),
-            },
+            'aliases': 'aliases',
+            'types': 'types',
         })
-        loader.assert_has_calls([
-            mock.call.get_app('vers_app'),
-            mock.call.get_app('vers_v1'),
-            mock.call.get_app('vers_v2'),
-        ], any_order=True)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.LOG, 'warn')
-    def test_init_overwrite_headers(self, mock_warn):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        trials = {
-            'true': True,
-            'tRuE': True,
-            't': True,
-            'on': True,
-            'yes': True,
-            'enable': True,
-            'false': False,
-            'fAlSe': False,
-            'off': False,
-            'no': False,
-            'disable': False,
-            '0': False,
-            '1': True,
-            '1000': True,
-            'fals': True,
-        }
+    @mock.patch.object(aversion.DiscoveryApp, 'build_document',
+                       return_value={'b': [1, 2], 'a': 'c'})
+    def test_init(self, mock_build_document):
+        app = aversion.DiscoveryApp('avers')
+
+        self.assertEqual(app.avers, 'avers')
+        mock_build_document.assert_called_once_with('avers')
+        self.assertEqual(app.document, {'b': [1, 2], 'a': 'c'})
+        self.assertEqual(app.response.status, '200 OK')
+        self.assertEqual(app.response.body, b'{"a": "c", "b": [1, 2]}')
+        self.assertEqual(app.response.headers, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', '23'),
+        ])
 
-        for value, expected in trials.items():
-            av = aversion.AVersion(loader, {}, overwrite_headers=value)
-            self.assertEqual(av.overwrite_headers, expected)
+    @mock.patch.object(aversion.DiscoveryApp, 'build_document',
+                       return_value={})
+    def test_call(self, mock_build_document):
+        app = aversion.DiscoveryApp('avers')
+        app.response = mock.Mock(return_value='app_iter')
 
-        mock_warn.assert_called_once_with(
-            "Unrecognized value 'fals' for configuration key "
-            "'overwrite_headers'")
+        result = app('environ', 'start_response')
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.AVersion, '_process',
-                       return_value=mock.Mock(ctype=None, version=None))
-    def test_call_noapp(self, mock_process):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={}, environ={})
-        av = aversion.AVersion(loader, {})
+        self.assertEqual(result, 'app_iter')
+        app.response.assert_called_once_with('environ', 'start_response')
 
-        result = av(request)
 
-        mock_process.assert_called_once_with(request)
-        self.assertFalse(request.get_response.called)
-        self.assertIsInstance(result, webob.exc.HTTPInternalServerError)
-        self.assertEqual(request.headers, {})
-        self.assertEqual(request.environ, {
-            'aversion.config': {
-                'versions': {},
-                'aliases': {},
-                'types': {},
-            },
-            'aversion.version': None,
-        })
+class ShortCircuitTest(unittest2.TestCase):
+    def test_init(self):
+        exc = aversion.ShortCircuit('app')
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.AVersion, '_process',
-                       return_value=mock.Mock(ctype='a/a', version='v1',
-                                              orig_ctype='a/b'))
-    def test_call_app_fallback(self, mock_process):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(**{
-            'headers': {},
-            'environ': {},
-            'get_response.return_value': 'response',
-        })
-        av = aversion.AVersion(loader, {})
-        av.version_app = 'fallback'
-        av.versions = dict(v2=dict(app='version2'))
+        self.assertEqual(exc.app, 'app')
 
-        result = av(request)
 
-        mock_process.assert_called_once_with(request)
-        request.get_response.assert_called_once_with('fallback')
-        self.assertEqual(result, 'response')
-        self.assertEqual(request.headers, {'accept': 'a/a;q=1.0'})
-        self.assertEqual(request.environ, {
-            'aversion.config': {
-                'versions': {},
-                'aliases': {},
-                'types': {},
-            },
-            'aversion.version': None,
-            'aversion.response_type': 'a/a',
-            'aversion.orig_response_type': 'a/b',
-            'aversion.accept': None,
-        })
+class ResponseFilterTest(unittest2.TestCase):
+    def test_init(self):
+        rf = aversion.ResponseFilter('app', ['filter'])
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.AVersion, '_process',
-                       return_value=mock.Mock(ctype='a/a', version='v1',
-                                              orig_ctype='a/b'))
-    def test_call_app_selected(self, mock_process):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(**{
-            'headers': {},
-            'environ': {},
-            'get_response.return_value': 'response',
-        })
-        av = aversion.AVersion(loader, {})
-        av.version_app = 'fallback'
-        av.versions = dict(v1=dict(app='version1'))
+        self.assertEqual(rf.app, 'app')
+        self.assertEqual(rf.filters, ['filter'])
 
-        result = av(request)
+    def test_call(self):
+        def app(environ, start_response):
+            self.assertEqual(environ, {'env': 'ironment'})
+            result = start_response('200 OK', [('a', 'b')])
+            self.assertEqual(result, 'write')
+            return 'app_iter'
 
-        mock_process.assert_called_once_with(request)
-        request.get_response.assert_called_once_with('version1')
-        self.assertEqual(result, 'response')
-        self.assertEqual(request.headers, {'accept': 'a/a;q=1.0'})
-        self.assertEqual(request.environ, {
-            'aversion.config': {
-                'versions': {},
-                'aliases': {},
-                'types': {},
-            },
-            'aversion.version': 'v1',
-            'aversion.response_type': 'a/a',
-            'aversion.orig_response_type': 'a/b',
-            'aversion.accept': None,
-        })
+        filters = [
+            mock.Mock(return_value=('201 Created', [('c', 'd')])),
+            mock.Mock(return_value=('202 Accepted', [('e', 'f')])),
+        ]
+        start_response = mock.Mock(return_value='write')
+        rf = aversion.ResponseFilter(app, filters)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.AVersion, '_process',
-                       return_value=mock.Mock(ctype='a/a', version='v1.1',
-                                              orig_ctype='a/b'))
-    def test_call_app_aliased(self, mock_process):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(**{
-            'headers': {},
-            'environ': {},
-            'get_response.return_value': 'response',
-        })
-        av = aversion.AVersion(loader, {})
-        av.version_app = 'fallback'
-        av.versions = dict(v1=dict(app='version1'))
-        av.aliases = {'v1.1': dict(version='v1')}
+        result = rf({'env': 'ironment'}, start_response)
 
-        result = av(request)
+        self.assertEqual(result, 'app_iter')
+        filters[0].assert_called_once_with('200 OK', [('a', 'b')])
+        filters[1].assert_called_once_with('201 Created', [('c', 'd')])
+        start_response.assert_called_once_with('202 Accepted', [('e', 'f')],
+                                               None)
 
-        mock_process.assert_called_once_with(request)
-        request.get_response.assert_called_once_with('version1')
-        self.assertEqual(result, 'response')
-        self.assertEqual(request.headers, {'accept': 'a/a;q=1.0'})
-        self.assertEqual(request.environ, {
-            'aversion.config': {
-                'versions': {},
-                'aliases': {},
-                'types': {},
-            },
-            'aversion.version': 'v1',
-            'aversion.response_type': 'a/a',
-            'aversion.orig_response_type': 'a/b',
-            'aversion.accept': None,
-        })
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.AVersion, '_process',
-                       return_value=mock.Mock(ctype='a/a', version='v1',
-                                              orig_ctype='a/b'))
-    def test_call_app_selected_nooverwrite(self, mock_process):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(**{
-            'headers': {},
-            'environ': {},
-            'get_response.return_value': 'response',
-        })
-        av = aversion.AVersion(loader, {})
-        av.version_app = 'fallback'
-        av.versions = dict(v1=dict(app='version1'))
-        av.overwrite_headers = False
+class ClosingIterableTest(unittest2.TestCase):
+    def test_iter(self):
+        ci = aversion.ClosingIterable([b'a', b'b'], mock.Mock())
 
-        result = av(request)
+        self.assertEqual(list(ci), [b'a', b'b'])
+        self.assertFalse(ci.callback.called)
 
-        mock_process.assert_called_once_with(request)
-        request.get_response.assert_called_once_with('version1')
-        self.assertEqual(result, 'response')
-        self.assertEqual(request.headers, {})
-        self.assertEqual(request.environ, {
-            'aversion.config': {
-                'versions': {},
-                'aliases': {},
-                'types': {},
-            },
-            'aversion.version': 'v1',
-            'aversion.response_type': 'a/a',
-            'aversion.orig_response_type': 'a/b',
-            'aversion.accept': None,
-        })
+    def test_close(self):
+        iterable = mock.Mock()
+        callback = mock.Mock()
+        ci = aversion.ClosingIterable(iterable, callback)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion, 'Result', return_value='result')
-    @mock.patch.object(aversion.AVersion, '_proc_uri')
-    @mock.patch.object(aversion.AVersion, '_proc_ctype_header')
-    @mock.patch.object(aversion.AVersion, '_proc_accept_header')
-    def test_process_with_result(self, mock_proc_accept_header,
-                                 mock_proc_ctype_header, mock_proc_uri,
-                                 mock_Result):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        av = aversion.AVersion(loader, {})
+        ci.close()
+        ci.close()
 
-        result = av._process('request', '')
+        self.assertEqual(iterable.close.call_count, 2)
+        callback.assert_called_once_with()
 
-        self.assertFalse(mock_Result.called)
-        mock_proc_uri.assert_called_once_with('request', '')
-        mock_proc_ctype_header.assert_called_once_with('request', '')
-        mock_proc_accept_header.assert_called_once_with('request', '')
-        self.assertEqual(result, '')
+    def test_close_no_close(self):
+        callback = mock.Mock()
+        ci = aversion.ClosingIterable([b'a'], callback)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion, 'Result', return_value='result')
-    @mock.patch.object(aversion.AVersion, '_proc_uri')
-    @mock.patch.object(aversion.AVersion, '_proc_ctype_header')
-    @mock.patch.object(aversion.AVersion, '_proc_accept_header')
-    def test_process_without_result(self, mock_proc_accept_header,
-                                    mock_proc_ctype_header, mock_proc_uri,
-                                    mock_Result):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        av = aversion.AVersion(loader, {})
+        ci.close()
 
-        result = av._process('request')
+        callback.assert_called_once_with()
 
-        mock_Result.assert_called_once_with()
-        mock_proc_uri.assert_called_once_with('request', 'result')
-        mock_proc_ctype_header.assert_called_once_with('request', 'result')
-        mock_proc_accept_header.assert_called_once_with('request', 'result')
-        self.assertEqual(result, 'result')
+    def test_close_raises(self):
+        iterable = mock.Mock(**{'close.side_effect': TestException()})
+        callback = mock.Mock()
+        ci = aversion.ClosingIterable(iterable, callback)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    def test_proc_uri_filled_result(self, mock_set_version, mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(path_info='/v1/.a', script_name='')
-        av = aversion.AVersion(loader, {})
-        av.uris = [('/v1', 'v1')]
-        av.formats = {'.a': 'a/a'}
-        result = aversion.Result()
-        result.ctype = 'a/b'
-        result.version = 'v2'
+        self.assertRaises(TestException, ci.close)
+        callback.assert_called_once_with()
 
-        av._proc_uri(request, result)
+    def test_iter_errback(self):
+        errback = mock.Mock()
+        ci = aversion.ClosingIterable([b'a', b'b'], mock.Mock(), errback)
 
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
+        self.assertEqual(list(ci), [b'a', b'b'])
+        self.assertFalse(errback.called)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    def test_proc_uri_basic(self):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(path_info='/v1/.a', script_name='')
-        av = aversion.AVersion(loader, {})
-        av.uris = [('/v1', 'v1')]
-        av.formats = {'.a': 'a/a'}
-        result = aversion.Result()
+    def test_iter_errback_raises(self):
+        def iterable():
+            yield b'a'
+            raise TestException()
 
-        av._proc_uri(request, result)
+        errback = mock.Mock()
+        ci = aversion.ClosingIterable(iterable(), mock.Mock(), errback)
 
-        self.assertEqual(result.ctype, 'a/a')
-        self.assertEqual(result.version, 'v1')
+        self.assertRaises(TestException, list, ci)
+        errback.assert_called_once_with()
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    def test_proc_uri_empties_uri(self):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(path_info='/v1', script_name='')
-        av = aversion.AVersion(loader, {})
-        av.uris = [('/v1', 'v1')]
-        av.formats = {'.a': 'a/a'}
-        result = aversion.Result()
 
-        av._proc_uri(request, result)
+class LimiterTest(unittest2.TestCase):
+    def test_init(self):
+        limiter = aversion.Limiter('v1', 2, 0.5, 3)
+
+        self.assertEqual(limiter.concurrency, 2)
+        self.assertEqual(limiter.timeout, 0.5)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.rejected, 0)
+        self.assertEqual(limiter.response.status, '503 Service Unavailable')
+        self.assertIn(('Retry-After', '3'), limiter.response.headers)
+        self.assertEqual(limiter.response.body,
+                         b'503 Service Unavailable\n\n'
+                         b'Version v1 is at its concurrency limit.\n')
+
+    def test_acquire_release(self):
+        limiter = aversion.Limiter('v1', 2)
+
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(limiter.in_flight, 2)
+        self.assertEqual(limiter.rejected, 1)
+
+        limiter.release()
+
+        self.assertEqual(limiter.in_flight, 1)
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.in_flight, 2)
+        self.assertEqual(limiter.rejected, 1)
+
+    def test_full(self):
+        limiter = aversion.Limiter('v1', 1)
+
+        self.assertFalse(limiter.full())
+        limiter.acquire()
+        self.assertTrue(limiter.full())
+
+    def test_acquire_timeout(self):
+        limiter = aversion.Limiter('v1', 1, 0.01)
+        limiter.acquire()
+
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(limiter.rejected, 1)
+
+    def test_acquire_wait(self):
+        limiter = aversion.Limiter('v1', 1, 10)
+        limiter.acquire()
+        timer = threading.Timer(0.01, limiter.release)
+        timer.start()
+
+        try:
+            self.assertTrue(limiter.acquire())
+        finally:
+            timer.join()
+
+        self.assertEqual(limiter.in_flight, 1)
+        self.assertEqual(limiter.rejected, 0)
+
+
+class LimitedAppTest(unittest2.TestCase):
+    def test_call(self):
+        app = mock.Mock(return_value=[b'body'])
+        limiter = aversion.Limiter('v1', 1)
+        la = aversion.LimitedApp(app, limiter)
+
+        result = la('environ', 'start_response')
+
+        app.assert_called_once_with('environ', 'start_response')
+        self.assertIsInstance(result, aversion.ClosingIterable)
+        self.assertEqual(list(result), [b'body'])
+        self.assertEqual(limiter.in_flight, 1)
+        result.close()
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_call_rejected(self):
+        app = mock.Mock()
+        limiter = aversion.Limiter('v1', 1)
+        limiter.acquire()
+        la = aversion.LimitedApp(app, limiter)
+        start_response = mock.Mock()
+
+        result = la({}, start_response)
+
+        self.assertFalse(app.called)
+        self.assertEqual(result, [limiter.response.body])
+        start_response.assert_called_once_with(
+            '503 Service Unavailable', limiter.response.headers)
+        self.assertEqual(limiter.rejected, 1)
+
+    def test_call_rejected_callback(self):
+        app = mock.Mock()
+        limiter = aversion.Limiter('v1', 1)
+        limiter.acquire()
+        on_reject = mock.Mock()
+        la = aversion.LimitedApp(app, limiter, on_reject)
+
+        la({}, mock.Mock())
+
+        on_reject.assert_called_once_with()
+
+    def test_call_raises(self):
+        app = mock.Mock(side_effect=TestException())
+        limiter = aversion.Limiter('v1', 1)
+        la = aversion.LimitedApp(app, limiter)
+
+        self.assertRaises(TestException, la, 'environ', 'start_response')
+        self.assertEqual(limiter.in_flight, 0)
 
-        self.assertEqual(result.ctype, None)
-        self.assertEqual(result.version, 'v1')
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    def test_proc_uri_nomatch(self):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(path_info='/v2/.b', script_name='')
-        av = aversion.AVersion(loader, {})
-        av.uris = [('/v1', 'v1')]
-        av.formats = {'.a': 'a/a'}
-        result = aversion.Result()
+class CircuitBreakerTest(unittest2.TestCase):
+    def test_init(self):
+        cb = aversion.CircuitBreaker('v1')
 
-        av._proc_uri(request, result)
+        self.assertEqual(cb.failures, 5)
+        self.assertEqual(cb.error_rate, None)
+        self.assertEqual(cb.window, 20)
+        self.assertEqual(cb.latency, None)
+        self.assertEqual(cb.reset, 30)
+        self.assertEqual(cb.fallback, None)
+        self.assertEqual(cb.state, 'closed')
+        self.assertEqual(cb.outcomes.maxlen, 20)
+        self.assertEqual(cb.response.status, '503 Service Unavailable')
+        self.assertIn(('Retry-After', '30'), cb.response.headers)
+        self.assertEqual(cb.response.body,
+                         b'503 Service Unavailable\n\n'
+                         b'Version v1 is temporarily unavailable.\n')
 
-        self.assertEqual(result.ctype, None)
-        self.assertEqual(result.version, None)
+    def test_init_retry_after(self):
+        cb = aversion.CircuitBreaker('v1', reset=2.5)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    @mock.patch.object(aversion, 'parse_ctype',
-                       return_value=('a/a', 'v1'))
-    def test_proc_ctype_header_filled_result(self, mock_parse_ctype,
-                                             mock_set_version, mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'content-type': 'a/b'}, environ={})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
-        result = aversion.Result()
-        result.ctype = 'a/d'
-        result.version = 'v3'
+        self.assertIn(('Retry-After', '3'), cb.response.headers)
 
-        av._proc_ctype_header(request, result)
+    def test_consecutive_failures(self):
+        cb = aversion.CircuitBreaker('v1', failures=2)
 
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
-        self.assertFalse(mock_parse_ctype.called)
-        self.assertFalse(av.types['a/a'].called)
-        self.assertEqual(request.environ, {})
+        cb.record(False)
+        cb.record(True)
+        cb.record(False)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    @mock.patch.object(aversion, 'parse_ctype',
-                       return_value=('a/a', 'v1'))
-    def test_proc_ctype_header_no_ctype(self, mock_parse_ctype,
-                                        mock_set_version, mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
-        result = aversion.Result()
+        self.assertEqual(cb.state, 'closed')
+        self.assertEqual(cb.consecutive, 1)
 
-        av._proc_ctype_header(request, result)
+        cb.record(False)
 
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
-        self.assertFalse(mock_parse_ctype.called)
-        self.assertFalse(av.types['a/a'].called)
+        self.assertEqual(cb.state, 'open')
+        self.assertEqual(cb.opened, 1)
+        self.assertEqual(cb.consecutive, 0)
+        self.assertEqual(len(cb.outcomes), 0)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    @mock.patch.object(aversion, 'parse_ctype',
-                       return_value=('a/a', 'v1'))
-    def test_proc_ctype_header_missing_ctype(self, mock_parse_ctype,
-                                             mock_set_version, mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'content-type': 'a/b'})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/b': mock.Mock(return_value=('a/c', 'v2'))}
-        result = aversion.Result()
+    def test_error_rate(self):
+        cb = aversion.CircuitBreaker('v1', failures=0, error_rate=0.5,
+                                     window=4)
 
-        av._proc_ctype_header(request, result)
+        for success in (False, True, False):
+            cb.record(success)
 
-        mock_parse_ctype.assert_called_once_with('a/b')
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
-        self.assertFalse(av.types['a/b'].called)
+        # The window is not yet full
+        self.assertEqual(cb.state, 'closed')
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion, 'parse_ctype',
-                       return_value=('a/a', 'v1'))
-    def test_proc_ctype_header_basic(self, mock_parse_ctype, mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'content-type': 'a/b'}, environ={})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
-        result = aversion.Result()
+        cb.record(True)
 
-        av._proc_ctype_header(request, result)
+        self.assertEqual(cb.state, 'closed')
 
-        mock_parse_ctype.assert_called_once_with('a/b')
-        av.types['a/a'].assert_called_once_with('v1')
-        self.assertEqual(request.headers, {'content-type': 'a/c'})
-        self.assertEqual(request.environ, {
-            'aversion.request_type': 'a/c',
-            'aversion.orig_request_type': 'a/a',
-            'aversion.content_type': 'a/b',
-        })
-        self.assertFalse(mock_set_ctype.called)
-        self.assertEqual(result.version, 'v2')
+        cb.record(False)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion, 'parse_ctype',
-                       return_value=('a/a', 'v1'))
-    def test_proc_ctype_header_basic_nooverwrite(self, mock_parse_ctype,
-                                                 mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'content-type': 'a/b'}, environ={})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
-        av.overwrite_headers = False
-        result = aversion.Result()
+        self.assertEqual(cb.state, 'open')
 
-        av._proc_ctype_header(request, result)
+    @mock.patch.object(aversion.time, 'time', return_value=100.0)
+    def test_open(self, mock_time):
+        cb = aversion.CircuitBreaker('v1', failures=1, reset=10)
+        cb.record(False)
 
-        mock_parse_ctype.assert_called_once_with('a/b')
-        av.types['a/a'].assert_called_once_with('v1')
-        self.assertEqual(request.headers, {'content-type': 'a/b'})
-        self.assertEqual(request.environ, {
-            'aversion.request_type': 'a/c',
-            'aversion.orig_request_type': 'a/a',
-            'aversion.content_type': 'a/b',
-        })
-        self.assertFalse(mock_set_ctype.called)
-        self.assertEqual(result.version, 'v2')
+        self.assertFalse(cb.available())
+        self.assertEqual(cb.allow(), None)
+        self.assertEqual(cb.rejected, 1)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    @mock.patch.object(aversion, 'parse_ctype',
-                       return_value=('a/a', 'v1'))
-    def test_proc_ctype_header_nomap(self, mock_parse_ctype,
-                                     mock_set_version, mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'content-type': 'a/b'})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('', ''))}
-        result = aversion.Result()
+        # Outcomes of requests admitted earlier are ignored
+        cb.record(True, True)
 
-        av._proc_ctype_header(request, result)
+        self.assertEqual(cb.state, 'open')
 
-        mock_parse_ctype.assert_called_once_with('a/b')
-        av.types['a/a'].assert_called_once_with('v1')
-        self.assertEqual(request.headers, {'content-type': 'a/b'})
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
+    @mock.patch.object(aversion.time, 'time', return_value=100.0)
+    def test_half_open_success(self, mock_time):
+        cb = aversion.CircuitBreaker('v1', failures=1, reset=10)
+        cb.record(False)
+        mock_time.return_value = 110.0
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    @mock.patch.object(aversion, 'best_match',
-                       return_value=('a/a', 'v1'))
-    def test_proc_accept_header_filled_result(self, mock_best_match,
-                                              mock_set_version,
-                                              mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'accept': 'a/b'})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
-        result = aversion.Result()
-        result.ctype = 'a/d'
-        result.version = 'v3'
+        self.assertTrue(cb.available())
+        token = cb.allow()
+        self.assertTrue(token)
+        self.assertEqual(cb.state, 'half-open')
 
-        av._proc_accept_header(request, result)
+        # Only one probe at a time
+        self.assertFalse(cb.available())
+        self.assertFalse(cb.allow())
+        self.assertEqual(cb.rejected, 1)
 
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
-        self.assertFalse(mock_best_match.called)
-        self.assertFalse(av.types['a/a'].called)
+        cb.record(True, token)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    @mock.patch.object(aversion, 'best_match',
-                       return_value=('a/a', 'v1'))
-    def test_proc_accept_header_no_accept(self, mock_best_match,
-                                          mock_set_version, mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
-        result = aversion.Result()
+        self.assertEqual(cb.state, 'closed')
+        self.assertTrue(cb.allow())
 
-        av._proc_accept_header(request, result)
+    @mock.patch.object(aversion.time, 'time', return_value=100.0)
+    def test_half_open_failure(self, mock_time):
+        cb = aversion.CircuitBreaker('v1', failures=1, reset=10)
+        cb.record(False)
+        mock_time.return_value = 110.0
+        token = cb.allow()
 
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
-        self.assertFalse(mock_best_match.called)
-        self.assertFalse(av.types['a/a'].called)
+        cb.record(False, token)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    @mock.patch.object(aversion, 'best_match',
-                       return_value=('a/a', 'v1'))
-    def test_proc_accept_header_missing_ctype(self, mock_best_match,
-                                              mock_set_version,
-                                              mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'accept': 'a/b'})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/b': mock.Mock(return_value=('a/c', 'v2'))}
-        result = aversion.Result()
+        self.assertEqual(cb.state, 'open')
+        self.assertEqual(cb.opened, 2)
+        self.assertFalse(cb.allow())
 
-        av._proc_accept_header(request, result)
+    @mock.patch.object(aversion.time, 'time', return_value=100.0)
+    def test_half_open_other_request(self, mock_time):
+        cb = aversion.CircuitBreaker('v1', failures=1, reset=10)
+        cb.record(False, True)
+        mock_time.return_value = 110.0
+        token = cb.allow()
 
-        mock_best_match.assert_called_once_with('a/b', ['a/b'])
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
-        self.assertFalse(av.types['a/b'].called)
+        # A slow request admitted before the breaker opened
+        cb.record(True, True)
+        cb.record(False, True)
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion, 'best_match',
-                       return_value=('a/a', 'v1'))
-    def test_proc_accept_header_basic(self, mock_best_match):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'accept': 'a/b'})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
-        result = aversion.Result()
+        self.assertEqual(cb.state, 'half-open')
+        self.assertEqual(cb.opened, 1)
+        self.assertFalse(cb.allow())
 
-        av._proc_accept_header(request, result)
+        cb.record(True, token)
 
-        mock_best_match.assert_called_once_with('a/b', ['a/a'])
-        av.types['a/a'].assert_called_once_with('v1')
-        self.assertEqual(result.ctype, 'a/c')
-        self.assertEqual(result.version, 'v2')
+        self.assertEqual(cb.state, 'closed')
 
-    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
-    @mock.patch.object(aversion.Result, 'set_ctype')
-    @mock.patch.object(aversion.Result, 'set_version')
-    @mock.patch.object(aversion, 'best_match',
-                       return_value=('a/a', 'v1'))
-    def test_proc_accept_header_nomap(self, mock_best_match,
-                                      mock_set_version, mock_set_ctype):
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
-        request = mock.Mock(headers={'accept': 'a/b'})
-        av = aversion.AVersion(loader, {})
-        av.types = {'a/a': mock.Mock(return_value=('', ''))}
-        result = aversion.Result()
+    @mock.patch.object(aversion.time, 'time', return_value=100.0)
+    def test_half_open_abandoned_probe(self, mock_time):
+        cb = aversion.CircuitBreaker('v1', failures=1, reset=10)
+        cb.record(False)
+        mock_time.return_value = 110.0
+        stale = cb.allow()
+        mock_time.return_value = 120.0
+        token = cb.allow()
 
-        av._proc_accept_header(request, result)
+        # The abandoned probe no longer decides
+        cb.record(False, stale)
 
-        mock_best_match.assert_called_once_with('a/b', ['a/a'])
-        av.types['a/a'].assert_called_once_with('v1')
-        self.assertFalse(mock_set_version.called)
-        self.assertFalse(mock_set_ctype.called)
+        self.assertEqual(cb.state, 'half-open')
 
+        cb.record(True, token)
 
-class FakeApplication(object):
-    def __init__(self, name):
-        self.name = name
+        self.assertEqual(cb.state, 'closed')
 
-    def __call__(self, environ, start_response):
-        start_response('200 OK', [])
-        yield self.name
+    @mock.patch.object(aversion.time, 'time', return_value=100.0)
+    def test_half_open_cancel(self, mock_time):
+        cb = aversion.CircuitBreaker('v1', failures=1, reset=10)
+        cb.record(False)
+        mock_time.return_value = 110.0
+        token = cb.allow()
 
+        # Only the probe may be withdrawn
+        cb.cancel(True)
 
-# Used for comparing the environment and headers dictionaries
-ANY = object()
-NOTPRESENT = object()
+        self.assertFalse(cb.allow())
 
+        cb.cancel(token)
 
-class FunctionalTest(unittest2.TestCase):
-    def construct_stack(self, conf, **versions):
-        # Construct all the version applications
-        apps = {}
-        for version, params in versions.items():
-            app_key = '%s_app' % version
-            conf_key = ('version' if version == 'version' else
-                        'version.%s' % version)
-            apps[app_key] = FakeApplication(version)
-            conf[conf_key] = app_key
+        self.assertEqual(cb.state, 'half-open')
+        self.assertTrue(cb.allow())
 
-            # Add parameters
-            if params:
-                conf[conf_key] += ' ' + ' '.join('%s="%s"' % (k, v)
-                                                 for k, v in params.items())
+    @mock.patch.object(aversion.time, 'time', return_value=100.0)
+    def test_half_open_abandoned(self, mock_time):
+        cb = aversion.CircuitBreaker('v1', failures=1, reset=10)
+        cb.record(False)
+        mock_time.return_value = 110.0
+        cb.allow()
+        mock_time.return_value = 120.0
 
-        # Set up a loader
-        loader = mock.Mock(**{'get_app.side_effect': lambda x: apps[x]})
+        self.assertTrue(cb.allow())
 
-        # Set up the stack and return it
-        return aversion.AVersion(loader, {}, **conf)
+    def test_snapshot(self):
+        cb = aversion.CircuitBreaker('v1')
+        cb.record(False)
 
-    def make_request(self, path, base_url=None,
-                     content_type=None, accept=None):
-        # Build the headers for the request
-        headers = {}
-        if content_type:
-            headers['content-type'] = content_type
-        if accept:
-            headers['accept'] = accept
+        self.assertEqual(cb.snapshot(), dict(
+            state='closed',
+            consecutive_failures=1,
+            opened=0,
+            rejected=0,
+        ))
 
-        # Build and return the request object
-        return webob.Request.blank(path, base_url=base_url, headers=headers)
 
-    def assertPartialDict(self, actual, expected):
-        for key, value in expected.items():
-            if value == NOTPRESENT:
-                self.assertNotIn(key, actual,
-                                 msg="Value for key %r present" % key)
-                continue
+class BreakerAppTest(unittest2.TestCase):
+    def _call(self, status, breaker, elapsed=0):
+        def app(environ, start_response):
+            start_response(status, [])
+            return [b'body']
 
-            self.assertIn(key, actual, msg="No value for key %r" % key)
+        ba = aversion.BreakerApp(app, breaker, 'token')
+        start_response = mock.Mock()
+        with mock.patch.object(aversion.time, 'time',
+                               side_effect=[100.0, 100.0 + elapsed]):
+            result = ba('environ', start_response)
+            self.assertIsInstance(result, aversion.ClosingIterable)
+            self.assertFalse(breaker.record.called)
+            self.assertEqual(list(result), [b'body'])
+            result.close()
 
-            if value == ANY:
-                continue
+        start_response.assert_called_once_with(status, [], None)
 
-            if isinstance(value, dict):
-                self.assertPartialDict(actual[key], value)
-            else:
-                self.assertEqual(actual[key], value,
-                                 msg="Value mismatch for key %r" % key)
+    def test_success(self):
+        breaker = mock.Mock(latency=None)
 
-    def test_assert_partial_dict(self):
-        # Check that NOTPRESENT requires the key to not be present
-        self.assertRaises(AssertionError, self.assertPartialDict,
-                          dict(a=1), dict(a=NOTPRESENT))
+        self._call('200 OK', breaker)
 
-        # Check that other than NOTPRESENT requires the key to be
-        # present
-        self.assertRaises(AssertionError, self.assertPartialDict,
-                          {}, dict(a=1))
+        breaker.record.assert_called_once_with(True, 'token')
 
-        # Check that value mismatch is caught
-        self.assertRaises(AssertionError, self.assertPartialDict,
-                          dict(a=1), dict(a=2))
+    def test_server_error(self):
+        breaker = mock.Mock(latency=None)
 
-        # Check that ANY allows any value in that location
-        self.assertPartialDict(dict(a=1), dict(a=ANY))
-        self.assertPartialDict(dict(a=2), dict(a=ANY))
+        self._call('502 Bad Gateway', breaker)
 
-        # Check that recursion works properly
-        self.assertRaises(AssertionError, self.assertPartialDict,
-                          dict(a=dict(b=dict(c=1))),
-                          dict(a=dict(b=dict(c=2))))
-        self.assertPartialDict(dict(a=dict(b=dict(c=1))),
-                               dict(a=dict(b=dict(c=1))))
+        breaker.record.assert_called_once_with(False, 'token')
 
-    def test_no_matching_app(self):
-        conf = {
-            'uri./v1': 'version1',
-            'uri./v2': 'version2',
-        }
-        stack = self.construct_stack(conf, version1=dict(v='v1'),
-                                     version2=dict(v='v2'))
-        req = self.make_request('/')
+    def test_latency(self):
+        breaker = mock.Mock(latency=1.0)
 
-        resp = req.get_response(stack)
+        self._call('200 OK', breaker, 1.0)
 
-        self.assertEqual(resp.status_int, 500)
-        self.assertIn("Cannot determine application to serve request",
-                      resp.body)
-        self.assertEqual(req.script_name, '')
-        self.assertEqual(req.path_info, '/')
-        self.assertPartialDict(req.environ, {
-            'aversion.config': {
-                'versions': {
-                    'version1': {
-                        'name': 'version1',
-                        'app': ANY,
-                        'params': dict(v='v1'),
-                        'prefixes': ['/v1'],
-                    },
-                    'version2': {
-                        'name': 'version2',
-                        'app': ANY,
-                        'params': dict(v='v2'),
-                        'prefixes': ['/v2'],
-                    },
-                },
-                'aliases': {},
-                'types': {},
-            },
-            'aversion.response_type': NOTPRESENT,
-            'aversion.orig_response_type': NOTPRESENT,
-            'aversion.accept': NOTPRESENT,
-            'aversion.request_type': NOTPRESENT,
-            'aversion.orig_request_type': NOTPRESENT,
-            'aversion.content_type': NOTPRESENT,
-            'aversion.version': None,
-        })
-        self.assertPartialDict(req.headers, {
-            'content-type': NOTPRESENT,
-            'accept': NOTPRESENT,
-        })
+        breaker.record.assert_called_once_with(True, 'token')
 
-    def test_default_app(self):
-        conf = {
-            'uri./v1': 'version1',
-            'uri./v2': 'version2',
+    def test_latency_exceeded(self):
+        breaker = mock.Mock(latency=1.0)
+
+        self._call('200 OK', breaker, 1.5)
+
+        breaker.record.assert_called_once_with(False, 'token')
+
+    def test_no_status(self):
+        breaker = mock.Mock(latency=None)
+        ba = aversion.BreakerApp(mock.Mock(return_value=[]), breaker)
+
+        ba('environ', 'start_response').close()
+
+        breaker.record.assert_called_once_with(False, True)
+
+    def test_raises(self):
+        breaker = mock.Mock(latency=None)
+        ba = aversion.BreakerApp(mock.Mock(side_effect=TestException()),
+                                 breaker, 'token')
+
+        self.assertRaises(TestException, ba, 'environ', 'start_response')
+        breaker.record.assert_called_once_with(False, 'token')
+
+    def test_body_raises(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            yield b'body'
+            raise TestException()
+
+        breaker = mock.Mock(latency=None)
+        ba = aversion.BreakerApp(app, breaker, 'token')
+
+        result = ba('environ', mock.Mock())
+        self.assertRaises(TestException, list, result)
+        result.close()
+
+        breaker.record.assert_called_once_with(False, 'token')
+
+
+class LatencyStatsTest(unittest2.TestCase):
+    def test_init(self):
+        stats = aversion.LatencyStats()
+
+        self.assertEqual(stats.snapshot(), dict(
+            requests=0,
+            errors=0,
+            mean_latency=0.0,
+            max_latency=0.0,
+        ))
+
+    def test_record(self):
+        stats = aversion.LatencyStats()
+
+        stats.record(True, 1.0)
+        stats.record(False, 3.0)
+        stats.record(True, 2.0)
+
+        self.assertEqual(stats.snapshot(), dict(
+            requests=3,
+            errors=1,
+            mean_latency=2.0,
+            max_latency=3.0,
+        ))
+
+
+class ShadowTest(unittest2.TestCase):
+    def test_init(self):
+        shadow = aversion.Shadow('v1', 'v2')
+
+        self.assertEqual(shadow.version, 'v1')
+        self.assertEqual(shadow.target, 'v2')
+        self.assertEqual(shadow.app, None)
+        self.assertEqual(shadow.rate, 0.01)
+        self.assertEqual(shadow.workers, 1)
+        self.assertEqual(shadow.queue_size, 100)
+        self.assertEqual(shadow.methods, frozenset(['GET', 'HEAD']))
+        self.assertEqual(shadow.max_body, 65536)
+        self.assertEqual(shadow.dropped, 0)
+        self.assertEqual(shadow._queue, None)
+
+    @mock.patch.object(aversion.random, 'random', return_value=0.5)
+    def test_sample(self, mock_random):
+        shadow = aversion.Shadow('v1', 'v2', rate=0.6, max_body=10,
+                                 methods=['GET', 'PUT'])
+
+        self.assertTrue(shadow.sample({}))
+        self.assertTrue(shadow.sample({'REQUEST_METHOD': 'PUT',
+                                       'CONTENT_LENGTH': '10'}))
+        self.assertFalse(shadow.sample({'REQUEST_METHOD': 'POST'}))
+        self.assertFalse(shadow.sample({'REQUEST_METHOD': 'PUT',
+                                        'CONTENT_LENGTH': '11'}))
+        self.assertFalse(shadow.sample({'REQUEST_METHOD': 'PUT',
+                                        'CONTENT_LENGTH': 'x'}))
+        self.assertFalse(shadow.sample({'REQUEST_METHOD': 'PUT',
+                                        'HTTP_TRANSFER_ENCODING': 'chunked'}))
+
+        shadow.rate = 0.5
+
+        self.assertFalse(shadow.sample({}))
+
+    def test_copy_environ(self):
+        shadow = aversion.Shadow('v1', 'v2')
+        environ = {'PATH_INFO': '/a'}
+
+        result = shadow.copy_environ(environ)
+
+        self.assertEqual(result['PATH_INFO'], '/a')
+        self.assertEqual(result['aversion.shadow'], 'v1')
+        self.assertEqual(result['wsgi.input'].read(), b'')
+        self.assertEqual(environ, {'PATH_INFO': '/a'})
+
+    def test_copy_environ_aversion(self):
+        shadow = aversion.Shadow('v1', 'v2')
+        decision = aversion.Decision({'versions': {}}, 'v1',
+                                     aversion.Result(), None)
+        environ = {
+            'aversion.config': {'versions': {'v1': {'params': {}}}},
+            'aversion.decision': decision,
+            'aversion.version': 'v1',
         }
-        stack = self.construct_stack(conf, version={},
-                                     version1=dict(v='v1'),
-                                     version2=dict(v='v2'))
-        req = self.make_request('/')
 
-        resp = req.get_response(stack)
+        result = shadow.copy_environ(environ)
+
+        self.assertEqual(result['aversion.config'],
+                         environ['aversion.config'])
+        self.assertIsNot(result['aversion.config'],
+                         environ['aversion.config'])
+        self.assertIsNot(result['aversion.decision'], decision)
+        self.assertEqual(result['aversion.decision'].version, 'v1')
+        self.assertEqual(result['aversion.version'], 'v1')
+
+        # The primary's view is unaffected by the shadow's changes
+        result['aversion.config']['versions']['v1']['params']['a'] = 'b'
+        self.assertEqual(environ['aversion.config'],
+                         {'versions': {'v1': {'params': {}}}})
+
+    def test_copy_environ_body(self):
+        shadow = aversion.Shadow('v1', 'v2')
+        environ = {
+            'CONTENT_LENGTH': '4',
+            'wsgi.input': io.BytesIO(b'bodyextra'),
+        }
 
-        self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version", resp.body)
-        self.assertEqual(req.script_name, '')
-        self.assertEqual(req.path_info, '/')
+        result = shadow.copy_environ(environ)
+
+        self.assertEqual(result['wsgi.input'].read(), b'body')
+        self.assertEqual(environ['wsgi.input'].read(), b'body')
+
+    @mock.patch.object(aversion.Shadow, '_start')
+    @mock.patch.object(aversion.Shadow, 'copy_environ',
+                       side_effect=lambda x: 'copy of %s' % x)
+    def test_submit(self, mock_copy_environ, mock_start):
+        shadow = aversion.Shadow('v1', 'v2', queue_size=1)
+
+        def fake_start():
+            shadow._pid = aversion.os.getpid()
+            shadow._queue = aversion.queue.Queue()
+            shadow._slots = aversion.threading.BoundedSemaphore(1)
+        mock_start.side_effect = fake_start
+
+        self.assertTrue(shadow.submit('env1'))
+        self.assertFalse(shadow.submit('env2'))
+
+        mock_start.assert_called_once_with()
+        self.assertEqual(shadow._queue.get_nowait(), 'copy of env1')
+        self.assertEqual(shadow.dropped, 1)
+
+        # The dropped request was not copied
+        mock_copy_environ.assert_called_once_with('env1')
+
+    @mock.patch.object(aversion.Shadow, 'copy_environ',
+                       side_effect=TestException())
+    def test_submit_copy_fails(self, mock_copy_environ):
+        shadow = aversion.Shadow('v1', 'v2', queue_size=1)
+        shadow._pid = aversion.os.getpid()
+        shadow._queue = aversion.queue.Queue()
+        shadow._slots = aversion.threading.BoundedSemaphore(1)
+
+        self.assertRaises(TestException, shadow.submit, 'env1')
+
+        # The place in the queue is released
+        self.assertTrue(shadow._slots.acquire(False))
+        self.assertTrue(shadow._queue.empty())
+
+    @mock.patch.object(aversion.Shadow, 'replay',
+                       side_effect=[None, TestException()])
+    def test_worker(self, mock_replay):
+        shadow = aversion.Shadow('v1', 'v2', queue_size=1)
+        work_queue = aversion.queue.Queue()
+        slots = aversion.threading.BoundedSemaphore(2)
+        slots.acquire()
+        slots.acquire()
+        work_queue.put('env1')
+        work_queue.put('env2')
+
+        self.assertRaises(TestException, shadow._worker, work_queue, slots)
+
+        # Both places in the queue were released
+        self.assertTrue(slots.acquire(False))
+        self.assertTrue(slots.acquire(False))
+        self.assertEqual(mock_replay.call_args_list,
+                         [mock.call('env1'), mock.call('env2')])
+
+    @mock.patch.object(aversion.threading, 'Thread')
+    def test_start(self, mock_Thread):
+        shadow = aversion.Shadow('v1', 'v2', workers=2, queue_size=5)
+
+        shadow._start()
+
+        self.assertEqual(shadow._pid, aversion.os.getpid())
+        args = (shadow._queue, shadow._slots)
+        mock_Thread.assert_has_calls([
+            mock.call(target=shadow._worker, args=args,
+                      name='aversion-shadow-v1-0'),
+            mock.call().start(),
+            mock.call(target=shadow._worker, args=args,
+                      name='aversion-shadow-v1-1'),
+            mock.call().start(),
+        ])
+
+        # The queue holds at most 5 requests
+        for i in range(5):
+            self.assertTrue(shadow._slots.acquire(False))
+        self.assertFalse(shadow._slots.acquire(False))
+        self.assertEqual(mock_Thread.return_value.daemon, True)
+
+    @mock.patch.object(aversion.time, 'time', side_effect=[10.0, 12.5])
+    def test_replay(self, mock_time):
+        shadow = aversion.Shadow('v1', 'v2')
+        iterable = mock.MagicMock(**{
+            '__iter__.return_value': iter([b'a', b'b']),
+        })
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return iterable
+        shadow.app = app
+
+        shadow.replay({})
+
+        iterable.close.assert_called_once_with()
+        self.assertEqual(shadow.shadow.snapshot(), dict(
+            requests=1,
+            errors=0,
+            mean_latency=2.5,
+            max_latency=2.5,
+        ))
+
+    @mock.patch.object(aversion.LOG, 'debug')
+    def test_replay_raises(self, mock_debug):
+        shadow = aversion.Shadow('v1', 'v2')
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            raise TestException('failed')
+        shadow.app = app
+
+        shadow.replay({})
+
+        self.assertEqual(shadow.shadow.errors, 1)
+        mock_debug.assert_called_once_with(
+            "Shadow request to version v2 failed: failed")
+
+    def test_record(self):
+        shadow = aversion.Shadow('v1', 'v2')
+
+        shadow.record(shadow.primary, ['200 OK'], 1.0)
+        shadow.record(shadow.primary, ['500 Internal Server Error'], 1.0)
+        shadow.record(shadow.shadow, [], 1.0)
+
+        self.assertEqual(shadow.primary.requests, 2)
+        self.assertEqual(shadow.primary.errors, 1)
+        self.assertEqual(shadow.shadow.requests, 1)
+        self.assertEqual(shadow.shadow.errors, 1)
+
+    def test_snapshot(self):
+        shadow = aversion.Shadow('v1', 'v2')
+        shadow.dropped = 3
+
+        self.assertEqual(shadow.snapshot(), dict(
+            target='v2',
+            dropped=3,
+            primary=shadow.primary.snapshot(),
+            shadow=shadow.shadow.snapshot(),
+        ))
+
+
+class ShadowAppTest(unittest2.TestCase):
+    def _make_shadow(self, submitted=True):
+        return mock.Mock(**{'submit.return_value': submitted})
+
+    @mock.patch.object(aversion.time, 'time', side_effect=[10.0, 11.0])
+    def test_call(self, mock_time):
+        shadow = self._make_shadow()
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'body']
+        sa = aversion.ShadowApp(app, shadow)
+        start_response = mock.Mock()
+
+        result = sa('environ', start_response)
+
+        shadow.submit.assert_called_once_with('environ')
+        self.assertIsInstance(result, aversion.ClosingIterable)
+        self.assertFalse(shadow.record.called)
+        result.close()
+        shadow.record.assert_called_once_with(shadow.primary, ['200 OK'],
+                                              1.0)
+        start_response.assert_called_once_with('200 OK', [], None)
+
+    def test_call_dropped(self):
+        shadow = self._make_shadow(False)
+        app = mock.Mock(return_value=[b'body'])
+        sa = aversion.ShadowApp(app, shadow)
+
+        result = sa('environ', 'start_response')
+
+        self.assertEqual(result, [b'body'])
+        app.assert_called_once_with('environ', 'start_response')
+        self.assertFalse(shadow.record.called)
+
+    def test_call_raises(self):
+        shadow = self._make_shadow()
+        sa = aversion.ShadowApp(mock.Mock(side_effect=TestException()),
+                                shadow)
+
+        self.assertRaises(TestException, sa, 'environ', 'start_response')
+        shadow.record.assert_called_once_with(shadow.primary, [], mock.ANY)
+
+
+class CacheLifetimeTest(unittest2.TestCase):
+    def test_default(self):
+        self.assertEqual(aversion._cache_lifetime([], 10), 10)
+        self.assertEqual(aversion._cache_lifetime(
+            [('Content-Type', 'a/a')]), 0)
+
+    def test_max_age(self):
+        self.assertEqual(aversion._cache_lifetime(
+            [('Cache-Control', 'public, max-age=60')], 10), 60)
+        self.assertEqual(aversion._cache_lifetime(
+            [('Cache-Control', 'max-age="60", s-maxage=30')]), 30)
+        self.assertEqual(aversion._cache_lifetime(
+            [('Cache-Control', 'max-age=bogus')], 10), 0)
+        self.assertEqual(aversion._cache_lifetime(
+            [('Cache-Control', 'max-age=-5')], 10), 0)
+
+    def test_not_storable(self):
+        for headers in ([('Cache-Control', 'max-age=60, no-store')],
+                        [('cache-control', 'No-Cache')],
+                        [('Cache-Control', 'private, max-age=60')],
+                        [('Set-Cookie', 'a=1')],
+                        [('Vary', 'Accept, Cookie')]):
+            self.assertEqual(aversion._cache_lifetime(headers, 10), 0)
+
+    def test_vary_accept(self):
+        self.assertEqual(aversion._cache_lifetime(
+            [('Vary', 'Accept'), ('Cache-Control', 'max-age=5')]), 5)
+
+
+class ResponseCacheTest(unittest2.TestCase):
+    def test_init(self):
+        cache = aversion.ResponseCache('v1', 100, 5, 200)
+
+        self.assertEqual(cache.version, 'v1')
+        self.assertEqual(cache.size, 100)
+        self.assertEqual(cache.ttl, 5)
+        self.assertEqual(cache.max_entry, 100)
+
+    def test_put_get(self):
+        cache = aversion.ResponseCache('v1', 1000)
+
+        result = cache.put('key', '200 OK', [('Age', '3'), ('X-A', 'b')],
+                           b'body', 10, now=100.0)
+
+        self.assertTrue(result)
+        entry = cache.get('key', now=105.0)
+        self.assertEqual(entry['status'], '200 OK')
+        self.assertEqual(entry['headers'], [('X-A', 'b')])
+        self.assertEqual(entry['body'], b'body')
+        self.assertEqual(entry['stored'], 100.0)
+        self.assertEqual(cache.get('other', now=105.0), None)
+        self.assertEqual(cache.snapshot(), dict(
+            entries=1,
+            bytes=12,
+            hits=1,
+            misses=1,
+            stores=1,
+            evictions=0,
+        ))
+
+    def test_expired(self):
+        cache = aversion.ResponseCache('v1', 1000)
+        cache.put('key', '200 OK', [], b'body', 10, now=100.0)
+
+        self.assertEqual(cache.get('key', now=110.0), None)
+        self.assertEqual(cache.snapshot()['entries'], 0)
+        self.assertEqual(cache.used, 0)
+
+    def test_too_large(self):
+        cache = aversion.ResponseCache('v1', 1000, max_entry=10)
+
+        self.assertFalse(cache.put('key', '200 OK', [], b'x' * 11, 10))
+        self.assertEqual(cache.snapshot()['entries'], 0)
+
+    def test_replace(self):
+        cache = aversion.ResponseCache('v1', 1000)
+        cache.put('key', '200 OK', [], b'old', 10, now=100.0)
+        cache.put('key', '200 OK', [], b'newer', 10, now=100.0)
+
+        self.assertEqual(cache.get('key', now=100.0)['body'], b'newer')
+        self.assertEqual(cache.used, 5)
+
+    def test_lru_eviction(self):
+        cache = aversion.ResponseCache('v1', 30)
+        cache.put('a', '200 OK', [], b'x' * 10, 10, now=100.0)
+        cache.put('b', '200 OK', [], b'x' * 10, 10, now=100.0)
+        cache.put('c', '200 OK', [], b'x' * 10, 10, now=100.0)
+
+        # Use "a", so "b" is the least recently used
+        cache.get('a', now=100.0)
+        cache.put('d', '200 OK', [], b'x' * 15, 10, now=100.0)
+
+        self.assertEqual(sorted(cache._nodes), ['a', 'd'])
+        self.assertEqual(cache.used, 25)
+        self.assertEqual(cache.evictions, 2)
+
+
+class BufferingIterableTest(unittest2.TestCase):
+    def test_complete(self):
+        callback = mock.Mock()
+        iterable = mock.MagicMock(**{
+            '__iter__.return_value': iter([b'a', b'b']),
+        })
+        start = [('200 OK', [('X-A', 'b')])]
+        result = aversion.BufferingIterable(iterable, start, 100, callback)
+
+        self.assertEqual(list(result), [b'a', b'b'])
+        self.assertFalse(callback.called)
+        result.close()
+
+        iterable.close.assert_called_once_with()
+        callback.assert_called_once_with('200 OK', [('X-A', 'b')], b'ab')
+
+    def test_incomplete(self):
+        callback = mock.Mock()
+        start = [('200 OK', [])]
+        result = aversion.BufferingIterable([b'a', b'b'], start, 100,
+                                            callback)
+
+        next(iter(result))
+        result.close()
+
+        callback.assert_called_once_with('200 OK', [], None)
+
+    def test_too_large(self):
+        callback = mock.Mock()
+        start = [('200 OK', [])]
+        result = aversion.BufferingIterable([b'ab', b'cd', b'ef'], start, 3,
+                                            callback)
+        app_iter = iter(result)
+
+        self.assertEqual(next(app_iter), b'ab')
+        self.assertFalse(callback.called)
+
+        # The callback is called as soon as the limit is exceeded
+        self.assertEqual(next(app_iter), b'cd')
+        callback.assert_called_once_with('200 OK', [], None)
+
+        self.assertEqual(list(app_iter), [b'ef'])
+        result.close()
+        self.assertEqual(callback.call_count, 1)
+
+    def test_not_started(self):
+        callback = mock.Mock()
+        result = aversion.BufferingIterable([], [], 100, callback)
+
+        list(result)
+        result.close()
+
+        callback.assert_called_once_with(None, [], None)
+
+
+class CachedAppTest(unittest2.TestCase):
+    def test_init(self):
+        result = aversion.CachedApp('app', 'cache', 'key', 'on_hit')
+
+        self.assertEqual(result.app, 'app')
+        self.assertEqual(result.cache, 'cache')
+        self.assertEqual(result.key, 'key')
+        self.assertEqual(result.on_hit, 'on_hit')
+
+    @mock.patch('time.time', return_value=110.5)
+    def test_hit(self, mock_time):
+        cache = mock.Mock(**{'get.return_value': dict(
+            status='200 OK', headers=[('X-A', 'b')], body=b'body',
+            stored=100.0)})
+        app = mock.Mock()
+        on_hit = mock.Mock()
+        start_response = mock.Mock()
+        cached = aversion.CachedApp(app, cache, 'key', on_hit)
+
+        result = cached({'REQUEST_METHOD': 'GET'}, start_response)
+
+        self.assertEqual(result, [b'body'])
+        start_response.assert_called_once_with(
+            '200 OK', [('X-A', 'b'), ('Age', '10')])
+        cache.get.assert_called_once_with('key')
+        on_hit.assert_called_once_with()
+        self.assertFalse(app.called)
+
+    def test_hit_head(self):
+        cache = mock.Mock(**{'get.return_value': dict(
+            status='200 OK', headers=[], body=b'body', stored=0.0)})
+        cached = aversion.CachedApp('app', cache, 'key')
+
+        result = cached({'REQUEST_METHOD': 'HEAD'}, mock.Mock())
+
+        self.assertEqual(result, [])
+
+    def test_miss(self):
+        cache = mock.Mock(**{'get.return_value': None})
+
+        def app(environ, start_response):
+            start_response('200 OK', [('X-A', 'b')])
+            return [b'body']
+        start_response = mock.Mock()
+        cached = aversion.CachedApp(app, cache, 'key')
+
+        result = cached({'REQUEST_METHOD': 'GET'}, start_response)
+
+        self.assertIsInstance(result, aversion.BufferingIterable)
+        self.assertEqual(result.start, [('200 OK', [('X-A', 'b')])])
+        self.assertEqual(result.callback, cached.store)
+        start_response.assert_called_once_with('200 OK', [('X-A', 'b')],
+                                               None)
+
+    def test_store(self):
+        cache = mock.Mock(ttl=0)
+        cached = aversion.CachedApp('app', cache, 'key')
+
+        cached.store('200 OK', [('Cache-Control', 'max-age=60')], b'ab')
+
+        cache.put.assert_called_once_with(
+            'key', '200 OK', [('Cache-Control', 'max-age=60'),
+                              ('Content-Length', '2')], b'ab', 60)
+
+    def test_store_length(self):
+        cache = mock.Mock(ttl=0)
+        cached = aversion.CachedApp('app', cache, 'key')
+        headers = [('Cache-Control', 'max-age=60'), ('content-length', '2')]
+
+        cached.store('200 OK', headers, b'ab')
+
+        cache.put.assert_called_once_with('key', '200 OK', headers, b'ab', 60)
+
+    def test_store_not_cacheable(self):
+        for status, headers, body in (
+                ('200 OK', [('Cache-Control', 'max-age=60')], None),
+                ('404 Not Found', [('Cache-Control', 'max-age=60')], b'ab'),
+                ('200 OK', [('Cache-Control', 'no-store')], b'ab'),
+                ('200 OK', [], b'ab')):
+            cache = mock.Mock(ttl=0)
+            cached = aversion.CachedApp('app', cache, 'key')
+
+            cached.store(status, headers, body)
+
+            self.assertFalse(cache.put.called)
+
+    def test_miss_head(self):
+        cache = mock.Mock(**{'get.return_value': None})
+        app = mock.Mock(return_value='iterable')
+        cached = aversion.CachedApp(app, cache, 'key')
+
+        result = cached({'REQUEST_METHOD': 'HEAD'}, 'start_response')
+
+        self.assertEqual(result, 'iterable')
+        app.assert_called_once_with({'REQUEST_METHOD': 'HEAD'},
+                                    'start_response')
+
+    def test_bypass(self):
+        environ = {'REQUEST_METHOD': 'GET', 'HTTP_PRAGMA': 'no-cache'}
+        cache = mock.Mock()
+        app = mock.Mock(return_value='iterable')
+        cached = aversion.CachedApp(app, cache, 'key')
+
+        result = cached(environ, 'start_response')
+
+        self.assertEqual(result, 'iterable')
+        self.assertFalse(cache.get.called)
+
+
+class SharingTest(unittest2.TestCase):
+    def test_shareable(self):
+        self.assertTrue(aversion._shareable([]))
+        self.assertTrue(aversion._shareable([('Vary', 'accept')]))
+        self.assertTrue(aversion._shareable(
+            [('Cache-Control', 'public, max-age=0')]))
+
+    def test_not_shareable(self):
+        for headers in ([('Cache-Control', 'max-age=60, no-store')],
+                        [('cache-control', 'No-Cache')],
+                        [('Cache-Control', 'private')],
+                        [('Set-Cookie', 'a=1')],
+                        [('Vary', 'Accept, Cookie')]):
+            self.assertFalse(aversion._shareable(headers))
+
+    def test_private_request(self):
+        self.assertFalse(aversion._private_request({}))
+        self.assertFalse(aversion._private_request(
+            {'HTTP_CACHE_CONTROL': 'max-age=0'}))
+        for environ in ({'HTTP_AUTHORIZATION': 'Basic xxx'},
+                        {'HTTP_CACHE_CONTROL': 'max-age=0, no-cache'},
+                        {'HTTP_PRAGMA': 'no-cache'}):
+            self.assertTrue(aversion._private_request(environ))
+
+
+class CoalescerTest(unittest2.TestCase):
+    def test_init(self):
+        coalescer = aversion.Coalescer('v1', 100, 2.5)
+
+        self.assertEqual(coalescer.version, 'v1')
+        self.assertEqual(coalescer.max_size, 100)
+        self.assertEqual(coalescer.timeout, 2.5)
+
+    def test_join(self):
+        coalescer = aversion.Coalescer('v1')
+
+        flight1, leader1 = coalescer.join('key', now=100.0)
+        flight2, leader2 = coalescer.join('key', now=101.0)
+        flight3, leader3 = coalescer.join('other', now=101.0)
+
+        self.assertTrue(leader1)
+        self.assertIs(flight2, flight1)
+        self.assertFalse(leader2)
+        self.assertIsNot(flight3, flight1)
+        self.assertTrue(leader3)
+        self.assertEqual(flight1.started, 100.0)
+        self.assertEqual(coalescer.snapshot()['in_flight'], 2)
+
+    def test_join_abandoned(self):
+        coalescer = aversion.Coalescer('v1', timeout=5)
+        flight1, leader1 = coalescer.join('key', now=100.0)
+
+        flight2, leader2 = coalescer.join('key', now=105.0)
+
+        self.assertIsNot(flight2, flight1)
+        self.assertTrue(leader2)
+
+    def test_finish_wait(self):
+        coalescer = aversion.Coalescer('v1')
+        flight, leader = coalescer.join('key')
+
+        coalescer.finish('key', flight, ('200 OK', [], b'body'))
+
+        self.assertEqual(coalescer.wait(flight), ('200 OK', [], b'body'))
+        self.assertEqual(coalescer.snapshot(), dict(
+            in_flight=0,
+            waiting=0,
+            leaders=1,
+            shared=1,
+            unshared=0,
+            timeouts=0,
+        ))
+
+        # Finishing does not remove a newer flight
+        flight2, leader2 = coalescer.join('key')
+        coalescer.finish('key', flight)
+        self.assertEqual(coalescer.snapshot()['in_flight'], 1)
+
+    def test_wait_unshared(self):
+        coalescer = aversion.Coalescer('v1')
+        flight, leader = coalescer.join('key')
+        coalescer.finish('key', flight)
+
+        self.assertEqual(coalescer.wait(flight), None)
+        self.assertEqual(coalescer.unshared, 1)
+
+    def test_wait_timeout(self):
+        coalescer = aversion.Coalescer('v1', timeout=0.01)
+        flight, leader = coalescer.join('key')
+
+        self.assertEqual(coalescer.wait(flight), None)
+        self.assertEqual(coalescer.timeouts, 1)
+
+    def test_wait_threaded(self):
+        coalescer = aversion.Coalescer('v1')
+        flight, leader = coalescer.join('key')
+        results = []
+
+        def waiter(follower):
+            results.append(coalescer.wait(follower))
+        threads = [threading.Thread(target=waiter,
+                                    args=(coalescer.join('key')[0],))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        coalescer.finish('key', flight, ('200 OK', [], b'body'))
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [('200 OK', [], b'body')] * 3)
+
+
+class CoalescedAppTest(unittest2.TestCase):
+    def test_init(self):
+        result = aversion.CoalescedApp('app', 'coalescer', 'key',
+                                       'on_shared')
+
+        self.assertEqual(result.app, 'app')
+        self.assertEqual(result.coalescer, 'coalescer')
+        self.assertEqual(result.key, 'key')
+        self.assertEqual(result.on_shared, 'on_shared')
+
+    def test_bypass(self):
+        for environ in ({'REQUEST_METHOD': 'HEAD'},
+                        {'REQUEST_METHOD': 'GET', 'HTTP_PRAGMA': 'no-cache'}):
+            coalescer = mock.Mock()
+            app = mock.Mock(return_value='iterable')
+            coalesced = aversion.CoalescedApp(app, coalescer, 'key')
+
+            result = coalesced(environ, 'start_response')
+
+            self.assertEqual(result, 'iterable')
+            self.assertFalse(coalescer.join.called)
+
+    def test_leader(self):
+        coalescer = aversion.Coalescer('v1', max_size=100)
+
+        def app(environ, start_response):
+            start_response('200 OK', [('X-A', 'b')])
+            return [b'bo', b'dy']
+        start_response = mock.Mock()
+        coalesced = aversion.CoalescedApp(app, coalescer, 'key')
+
+        result = coalesced({'REQUEST_METHOD': 'GET'}, start_response)
+        flight = coalescer._flights['key']
+
+        self.assertIsInstance(result, aversion.BufferingIterable)
+        self.assertEqual(list(result), [b'bo', b'dy'])
+        self.assertFalse(flight.event.is_set())
+        result.close()
+        self.assertEqual(flight.response, ('200 OK', [('X-A', 'b')],
+                                           b'body'))
+        self.assertEqual(coalescer._flights, {})
+        start_response.assert_called_once_with('200 OK', [('X-A', 'b')],
+                                               None)
+
+    def test_leader_not_shareable(self):
+        coalescer = aversion.Coalescer('v1', max_size=100)
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Set-Cookie', 'a=1')])
+            return [b'body']
+        coalesced = aversion.CoalescedApp(app, coalescer, 'key')
+
+        result = coalesced({'REQUEST_METHOD': 'GET'}, mock.Mock())
+        flight = coalescer._flights['key']
+        list(result)
+        result.close()
+
+        self.assertTrue(flight.event.is_set())
+        self.assertEqual(flight.response, None)
+
+    def test_leader_error_status(self):
+        for status in ('500 Internal Server Error', '503 Service Unavailable',
+                       '206 Partial Content', '400 Bad Request'):
+            coalescer = aversion.Coalescer('v1', max_size=100)
+
+            def app(environ, start_response):
+                start_response(status, [])
+                return [b'error']
+            coalesced = aversion.CoalescedApp(app, coalescer, 'key')
+
+            result = coalesced({'REQUEST_METHOD': 'GET'}, mock.Mock())
+            flight = coalescer._flights['key']
+            list(result)
+            result.close()
+
+            self.assertTrue(flight.event.is_set())
+            self.assertEqual(flight.response, None)
+
+    def test_leader_cacheable_status(self):
+        coalescer = aversion.Coalescer('v1', max_size=100)
+
+        def app(environ, start_response):
+            start_response('404 Not Found', [])
+            return [b'missing']
+        coalesced = aversion.CoalescedApp(app, coalescer, 'key')
+
+        result = coalesced({'REQUEST_METHOD': 'GET'}, mock.Mock())
+        flight = coalescer._flights['key']
+        list(result)
+        result.close()
+
+        self.assertEqual(flight.response, ('404 Not Found', [], b'missing'))
+
+    def test_leader_iteration_error(self):
+        coalescer = aversion.Coalescer('v1', max_size=100)
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            yield b'part'
+            raise TestException('failed')
+        coalesced = aversion.CoalescedApp(app, coalescer, 'key')
+
+        result = coalesced({'REQUEST_METHOD': 'GET'}, mock.Mock())
+        flight = coalescer._flights['key']
+        self.assertRaises(TestException, list, result)
+        result.close()
+
+        self.assertTrue(flight.event.is_set())
+        self.assertEqual(flight.response, None)
+
+    def test_leader_error(self):
+        coalescer = aversion.Coalescer('v1')
+        app = mock.Mock(side_effect=TestException('failed'))
+        coalesced = aversion.CoalescedApp(app, coalescer, 'key')
+
+        self.assertRaises(TestException, coalesced,
+                          {'REQUEST_METHOD': 'GET'}, mock.Mock())
+        self.assertEqual(coalescer._flights, {})
+
+    def test_follower(self):
+        coalescer = aversion.Coalescer('v1')
+        flight, leader = coalescer.join('key')
+        coalescer.finish('key', flight, ('200 OK', [('X-A', 'b')], b'body'))
+        coalescer._flights['key'] = flight
+        app = mock.Mock()
+        on_shared = mock.Mock()
+        start_response = mock.Mock()
+        coalesced = aversion.CoalescedApp(app, coalescer, 'key', on_shared)
+
+        result = coalesced({'REQUEST_METHOD': 'GET'}, start_response)
+
+        self.assertEqual(result, [b'body'])
+        start_response.assert_called_once_with('200 OK', [('X-A', 'b')])
+        on_shared.assert_called_once_with()
+        self.assertFalse(app.called)
+
+    def test_follower_unshared(self):
+        coalescer = aversion.Coalescer('v1')
+        flight, leader = coalescer.join('key')
+        coalescer.finish('key', flight)
+        coalescer._flights['key'] = flight
+        app = mock.Mock(return_value='iterable')
+        coalesced = aversion.CoalescedApp(app, coalescer, 'key')
+
+        result = coalesced({'REQUEST_METHOD': 'GET'}, 'start_response')
+
+        self.assertEqual(result, 'iterable')
+        app.assert_called_once_with({'REQUEST_METHOD': 'GET'},
+                                    'start_response')
+
+
+class CompressedAppTest(unittest2.TestCase):
+    def call(self, capp, method='GET'):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started.append((status, headers))
+            return mock.Mock()
+
+        iterable = capp({'REQUEST_METHOD': method}, start_response)
+        body = b''.join(iterable)
+        iterable.close()
+        return started, body
+
+    def make_app(self, status='200 OK', headers=None, body=None):
+        app = mock.Mock()
+        body = [b'a' * 100] * 3 if body is None else body
+        iterable = mock.MagicMock()
+        iterable.__iter__.return_value = iter(body)
+
+        def call(environ, start_response):
+            start_response(status, [('Content-Type', 'text/plain')] +
+                           (headers or []))
+            return iterable
+        app.side_effect = call
+        return app, iterable
+
+    def test_init(self):
+        capp = aversion.CompressedApp('app', 'gzip')
+
+        self.assertEqual(capp.app, 'app')
+        self.assertEqual(capp.coding, 'gzip')
+        self.assertEqual(capp.min_size, 1024)
+        self.assertEqual(capp.level, 6)
+        self.assertEqual(capp.skip_types, aversion.COMPRESS_SKIP_TYPES)
+
+    def test_compressible(self):
+        capp = aversion.CompressedApp('app', 'gzip', min_size=10,
+                                      skip_types=['image/*'])
+
+        self.assertTrue(capp._compressible('200 OK', [
+            ('Content-Type', 'text/plain'), ('Content-Length', '10')]))
+        self.assertTrue(capp._compressible('200 OK', [
+            ('Content-Length', 'spam')]))
+        self.assertFalse(capp._compressible('304 Not Modified', []))
+        self.assertFalse(capp._compressible('204 No Content', []))
+        self.assertFalse(capp._compressible('200 OK', [
+            ('content-type', 'Image/PNG; x=y')]))
+        self.assertFalse(capp._compressible('200 OK', [
+            ('Content-Encoding', 'br')]))
+        self.assertFalse(capp._compressible('200 OK', [
+            ('Content-Length', '9')]))
+
+    def test_compressed_headers(self):
+        capp = aversion.CompressedApp('app', 'deflate')
+
+        result = capp._compressed_headers([
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', '300'),
+            ('ETag', '"abc"'),
+        ])
+
+        self.assertEqual(result, [
+            ('Content-Type', 'text/plain'),
+            ('ETag', 'W/"abc"'),
+            ('Content-Encoding', 'deflate'),
+        ])
+
+    def test_call_gzip(self):
+        app, iterable = self.make_app(headers=[('Content-Length', '300')])
+        capp = aversion.CompressedApp(app, 'gzip', min_size=150)
+
+        started, body = self.call(capp)
+
+        self.assertEqual(started, [('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Vary', 'Accept-Encoding'),
+            ('Content-Encoding', 'gzip'),
+        ])])
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                         b'a' * 300)
+        iterable.close.assert_called_once_with()
+
+    def test_call_deflate(self):
+        app, iterable = self.make_app()
+        capp = aversion.CompressedApp(app, 'deflate', min_size=100)
+
+        started, body = self.call(capp)
+
+        self.assertEqual(started[0][1][-1], ('Content-Encoding', 'deflate'))
+        self.assertEqual(zlib.decompress(body), b'a' * 300)
+
+    def test_call_small(self):
+        app, iterable = self.make_app()
+        capp = aversion.CompressedApp(app, 'gzip')
+
+        started, body = self.call(capp)
+
+        self.assertEqual(started, [('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Vary', 'Accept-Encoding'),
+        ])])
+        self.assertEqual(body, b'a' * 300)
+        iterable.close.assert_called_once_with()
+
+    def test_call_no_coding(self):
+        app, iterable = self.make_app()
+        capp = aversion.CompressedApp(app, None, min_size=100)
+
+        started, body = self.call(capp)
+
+        self.assertEqual(started, [('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Vary', 'Accept-Encoding'),
+        ])])
+        self.assertEqual(body, b'a' * 300)
+
+    def test_call_head(self):
+        app, iterable = self.make_app(body=[])
+        capp = aversion.CompressedApp(app, 'gzip', min_size=0)
+
+        started, body = self.call(capp, 'HEAD')
+
+        self.assertEqual(started, [('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Vary', 'Accept-Encoding'),
+        ])])
+        self.assertEqual(body, b'')
+
+    def test_call_head_length(self):
+        app, iterable = self.make_app(headers=[('Content-Length', '300'),
+                                               ('ETag', '"tag"')], body=[])
+        capp = aversion.CompressedApp(app, 'gzip', min_size=100)
+
+        started, body = self.call(capp, 'HEAD')
+
+        self.assertEqual(started, [('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('ETag', 'W/"tag"'),
+            ('Vary', 'Accept-Encoding'),
+            ('Content-Encoding', 'gzip'),
+        ])])
+        self.assertEqual(body, b'')
+
+    def test_call_head_small(self):
+        app, iterable = self.make_app(headers=[('Content-Length', '30')],
+                                      body=[])
+        capp = aversion.CompressedApp(app, 'gzip', min_size=100)
+
+        started, body = self.call(capp, 'HEAD')
+
+        self.assertEqual(started, [('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', '30'),
+        ])])
+        self.assertEqual(body, b'')
+
+    def test_call_head_body(self):
+        app, iterable = self.make_app()
+        capp = aversion.CompressedApp(app, 'gzip', min_size=100)
+
+        started, body = self.call(capp, 'HEAD')
+
+        # Decided on the body produced, as for GET
+        self.assertEqual(started, [('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Vary', 'Accept-Encoding'),
+            ('Content-Encoding', 'gzip'),
+        ])])
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                         b'a' * 300)
+
+    def test_call_incompressible(self):
+        app, iterable = self.make_app(headers=[('Content-Encoding', 'br')])
+        capp = aversion.CompressedApp(app, 'gzip', min_size=100)
+
+        started, body = self.call(capp)
+
+        self.assertEqual(started, [('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Encoding', 'br'),
+        ])])
+        self.assertEqual(body, b'a' * 300)
+
+    def test_call_write(self):
+        writes = []
+
+        def app(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'text/plain')])
+            write(b'written')
+            write(b'twice')
+            return [b'a' * 300]
+        capp = aversion.CompressedApp(app, 'gzip', min_size=100)
+
+        def start_response(status, headers, exc_info=None):
+            writes.append((status, headers))
+            return writes.append
+
+        body = b''.join(capp({}, start_response))
+
+        self.assertEqual(writes, [
+            ('200 OK', [
+                ('Content-Type', 'text/plain'),
+                ('Vary', 'Accept-Encoding'),
+            ]),
+            b'written',
+            b'twice',
+        ])
+        self.assertEqual(body, b'a' * 300)
+
+
+class ConnectionPoolTest(unittest2.TestCase):
+    def test_init(self):
+        pool = aversion.ConnectionPool('http', 'example.com')
+
+        self.assertEqual(pool.connection_class,
+                         aversion.httplib.HTTPConnection)
+        self.assertEqual(pool.host, 'example.com')
+        self.assertEqual(pool.port, None)
+        self.assertEqual(pool.max_size, 10)
+        self.assertEqual(pool.timeout, None)
+        self.assertEqual(pool._idle, [])
+
+    def test_init_https(self):
+        pool = aversion.ConnectionPool('https', 'example.com', 8443, 5, 2.0)
+
+        self.assertEqual(pool.connection_class,
+                         aversion.httplib.HTTPSConnection)
+        self.assertEqual(pool.port, 8443)
+        self.assertEqual(pool.max_size, 5)
+        self.assertEqual(pool.timeout, 2.0)
+
+    def test_connect(self):
+        pool = aversion.ConnectionPool('http', 'example.com', 8080)
+        pool.connection_class = mock.Mock()
+
+        result = pool.connect()
+
+        self.assertEqual(result, pool.connection_class.return_value)
+        pool.connection_class.assert_called_once_with('example.com', 8080)
+
+    def test_connect_timeout(self):
+        pool = aversion.ConnectionPool('http', 'example.com', 8080,
+                                       timeout=2.0)
+        pool.connection_class = mock.Mock()
+
+        pool.connect()
+
+        pool.connection_class.assert_called_once_with('example.com', 8080,
+                                                      timeout=2.0)
+
+    @mock.patch.object(aversion.ConnectionPool, 'connect',
+                       return_value='new')
+    def test_get(self, mock_connect):
+        pool = aversion.ConnectionPool('http', 'example.com')
+        pool._idle = ['idle1', 'idle2']
+
+        self.assertEqual(pool.get(), ('idle2', True))
+        self.assertEqual(pool.get(), ('idle1', True))
+        self.assertEqual(pool.get(), ('new', False))
+        mock_connect.assert_called_once_with()
+
+    def test_put(self):
+        pool = aversion.ConnectionPool('http', 'example.com', max_size=1)
+        conns = [mock.Mock(), mock.Mock()]
+
+        pool.put(conns[0])
+        pool.put(conns[1])
+
+        self.assertEqual(pool._idle, [conns[0]])
+        self.assertFalse(conns[0].close.called)
+        conns[1].close.assert_called_once_with()
+
+    def test_close(self):
+        pool = aversion.ConnectionPool('http', 'example.com')
+        conns = [mock.Mock(), mock.Mock()]
+        pool._idle = conns[:]
+
+        pool.close()
+
+        self.assertEqual(pool._idle, [])
+        for conn in conns:
+            conn.close.assert_called_once_with()
+
+
+class ProxyResponseTest(unittest2.TestCase):
+    def test_iter(self):
+        response = mock.Mock(**{'read.side_effect': [b'ab', b'c', b'']})
+        pr = aversion.ProxyResponse('pool', 'conn', response, 2)
+
+        self.assertEqual(list(pr), [b'ab', b'c'])
+        self.assertTrue(pr.complete)
+        response.read.assert_has_calls([mock.call(2)] * 3)
+
+    def test_close_complete(self):
+        pool = mock.Mock()
+        conn = mock.Mock()
+        response = mock.Mock(length=None, will_close=False)
+        pr = aversion.ProxyResponse(pool, conn, response)
+        pr.complete = True
+
+        pr.close()
+        pr.close()
+
+        response.close.assert_called_once_with()
+        pool.put.assert_called_once_with(conn)
+        self.assertFalse(conn.close.called)
+
+    def test_close_empty(self):
+        pool = mock.Mock()
+        conn = mock.Mock()
+        response = mock.Mock(length=0, will_close=False)
+        pr = aversion.ProxyResponse(pool, conn, response)
+
+        pr.close()
+
+        pool.put.assert_called_once_with(conn)
+
+    def test_close_incomplete(self):
+        pool = mock.Mock()
+        conn = mock.Mock()
+        response = mock.Mock(length=10, will_close=False)
+        pr = aversion.ProxyResponse(pool, conn, response)
+
+        pr.close()
+
+        self.assertFalse(pool.put.called)
+        conn.close.assert_called_once_with()
+
+    def test_close_will_close(self):
+        pool = mock.Mock()
+        conn = mock.Mock()
+        response = mock.Mock(length=None, will_close=True)
+        pr = aversion.ProxyResponse(pool, conn, response)
+        pr.complete = True
+
+        pr.close()
+
+        self.assertFalse(pool.put.called)
+        conn.close.assert_called_once_with()
+
+
+class ProxyAppTest(unittest2.TestCase):
+    def test_init(self):
+        app = aversion.ProxyApp('https://example.com:8443/api/', 5, 2.0)
+
+        self.assertEqual(app.url, 'https://example.com:8443/api/')
+        self.assertEqual(app.prefix, '/api')
+        self.assertEqual(app.block_size, 65536)
+        self.assertEqual(app.pool.connection_class,
+                         aversion.httplib.HTTPSConnection)
+        self.assertEqual(app.pool.host, 'example.com')
+        self.assertEqual(app.pool.port, 8443)
+        self.assertEqual(app.pool.max_size, 5)
+        self.assertEqual(app.pool.timeout, 2.0)
+        self.assertEqual(app.bad_gateway.status, '502 Bad Gateway')
+        self.assertEqual(app.gateway_timeout.status, '504 Gateway Timeout')
+        self.assertEqual(app.length_required.status, '411 Length Required')
+
+    def test_init_invalid(self):
+        self.assertRaises(ValueError, aversion.ProxyApp, 'ftp://example.com')
+        self.assertRaises(ValueError, aversion.ProxyApp, 'http:///path')
+
+    def test_deepcopy(self):
+        app = aversion.ProxyApp('http://example.com')
+
+        result = copy.deepcopy(dict(app=app))
+
+        self.assertIs(result['app'], app)
+
+    def test_configure(self):
+        app = aversion.ProxyApp('http://example.com')
+
+        app.configure(timeout=3.0)
+
+        self.assertEqual(app.pool.max_size, 10)
+        self.assertEqual(app.pool.timeout, 3.0)
+
+        app.configure(pool_size=2)
+
+        self.assertEqual(app.pool.max_size, 2)
+        self.assertEqual(app.pool.timeout, 3.0)
+
+    def test_request_headers(self):
+        app = aversion.ProxyApp('http://example.com')
+        environ = {
+            'HTTP_HOST': 'front.example.com',
+            'HTTP_ACCEPT': 'a/a',
+            'HTTP_CONNECTION': 'keep-alive, X-Private',
+            'HTTP_X_PRIVATE': 'secret',
+            'HTTP_KEEP_ALIVE': '300',
+            'HTTP_EXPECT': '100-continue',
+            'HTTP_X_FORWARDED_FOR': '10.0.0.1',
+            'CONTENT_TYPE': 'a/b',
+            'CONTENT_LENGTH': '10',
+            'REMOTE_ADDR': '10.0.0.2',
+            'wsgi.url_scheme': 'https',
+        }
+
+        result = app._request_headers(environ, 10, False)
+
+        self.assertEqual(sorted(result), [
+            ('Accept', 'a/a'),
+            ('Content-Length', '10'),
+            ('Content-Type', 'a/b'),
+            ('X-Forwarded-For', '10.0.0.1, 10.0.0.2'),
+            ('X-Forwarded-Host', 'front.example.com'),
+            ('X-Forwarded-Proto', 'https'),
+        ])
+
+    def test_request_headers_chunked(self):
+        app = aversion.ProxyApp('http://example.com')
+        environ = {
+            'HTTP_TRANSFER_ENCODING': 'chunked',
+        }
+
+        result = app._request_headers(environ, 0, True)
+
+        self.assertEqual(result, [
+            ('Transfer-Encoding', 'chunked'),
+            ('X-Forwarded-Proto', 'http'),
+        ])
+
+    def test_response_headers_items(self):
+        msg = mock.Mock(spec=['items'], **{'items.return_value': [
+            ('Content-Type', 'a/a'),
+            ('Set-Cookie', 'a=1'),
+            ('Set-Cookie', 'b=2'),
+            ('Transfer-Encoding', 'chunked'),
+            ('Connection', 'X-Private'),
+            ('X-Private', 'secret'),
+        ]})
+        response = mock.Mock(msg=msg, **{
+            'getheader.return_value': 'X-Private',
+        })
+
+        result = aversion.ProxyApp._response_headers(response)
+
+        self.assertEqual(result, [
+            ('Content-Type', 'a/a'),
+            ('Set-Cookie', 'a=1'),
+            ('Set-Cookie', 'b=2'),
+        ])
+        response.getheader.assert_called_once_with('connection')
+
+    def test_response_headers_raw(self):
+        msg = mock.Mock(headers=[
+            'Content-Type: a/a\r\n',
+            'Set-Cookie: a=1\r\n',
+            'Set-Cookie: b=2;\r\n',
+            '\tpath=/\r\n',
+            'Keep-Alive: timeout=5\r\n',
+        ])
+        response = mock.Mock(msg=msg, **{'getheader.return_value': None})
+
+        result = aversion.ProxyApp._response_headers(response)
+
+        self.assertEqual(result, [
+            ('Content-Type', 'a/a'),
+            ('Set-Cookie', 'a=1'),
+            ('Set-Cookie', 'b=2; path=/'),
+        ])
+
+    def test_forward(self):
+        app = aversion.ProxyApp('http://example.com', block_size=4)
+        conn = mock.Mock()
+        environ = {
+            'REQUEST_METHOD': 'PUT',
+            'wsgi.input': mock.Mock(**{
+                'read.side_effect': [b'abcd', b'ef', b''],
+            }),
+        }
+
+        result = app._forward(conn, environ, '/path', [('A', 'b')], 6, False)
+
+        self.assertEqual(result, conn.getresponse.return_value)
+        conn.assert_has_calls([
+            mock.call.putrequest('PUT', '/path', skip_accept_encoding=True),
+            mock.call.putheader('A', 'b'),
+            mock.call.endheaders(),
+            mock.call.send(b'abcd'),
+            mock.call.send(b'ef'),
+            mock.call.getresponse(),
+        ])
+        environ['wsgi.input'].read.assert_has_calls([
+            mock.call(4), mock.call(2)])
+
+    def test_forward_chunked(self):
+        app = aversion.ProxyApp('http://example.com', block_size=4)
+        conn = mock.Mock()
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'wsgi.input': mock.Mock(**{
+                'read.side_effect': [b'abcd', b'ef', b''],
+            }),
+        }
+
+        app._forward(conn, environ, '/path', [], 0, True)
+
+        conn.assert_has_calls([
+            mock.call.endheaders(),
+            mock.call.send(b'4\r\nabcd\r\n'),
+            mock.call.send(b'2\r\nef\r\n'),
+            mock.call.send(b'0\r\n\r\n'),
+            mock.call.getresponse(),
+        ])
+
+    def _make_app(self, *conns):
+        app = aversion.ProxyApp('http://example.com/base')
+        app.pool = mock.Mock(**{'get.side_effect': list(conns)})
+        return app
+
+    @mock.patch.object(aversion.ProxyApp, '_forward')
+    @mock.patch.object(aversion.ProxyApp, '_request_headers',
+                       return_value=[('A', 'b')])
+    @mock.patch.object(aversion.ProxyApp, '_response_headers',
+                       return_value=[('C', 'd')])
+    def test_call(self, mock_response_headers, mock_request_headers,
+                  mock_forward):
+        conn = mock.Mock()
+        app = self._make_app((conn, False))
+        mock_forward.return_value = mock.Mock(status=200, reason='OK')
+        start_response = mock.Mock()
+        environ = {
+            'PATH_INFO': '/a b/c',
+            'QUERY_STRING': 'x=1',
+            'CONTENT_LENGTH': '5',
+        }
+
+        result = app(environ, start_response)
+
+        self.assertIsInstance(result, aversion.ProxyResponse)
+        self.assertEqual(result.conn, conn)
+        self.assertEqual(result.response, mock_forward.return_value)
+        mock_request_headers.assert_called_once_with(environ, 5, False)
+        mock_forward.assert_called_once_with(
+            conn, environ, '/base/a%20b/c?x=1', [('A', 'b')], 5, False)
+        start_response.assert_called_once_with('200 OK', [('C', 'd')])
+
+    @mock.patch.object(aversion.ProxyApp, '_forward')
+    def test_call_length_required(self, mock_forward):
+        app = self._make_app()
+        start_response = mock.Mock()
+        environ = {'HTTP_TRANSFER_ENCODING': 'chunked'}
+
+        result = app(environ, start_response)
+
+        self.assertEqual(result, [app.length_required.body])
+        self.assertFalse(mock_forward.called)
+
+    @mock.patch.object(aversion.ProxyApp, '_forward')
+    @mock.patch.object(aversion.ProxyApp, '_response_headers',
+                       return_value=[])
+    def test_call_chunked(self, mock_response_headers, mock_forward):
+        conn = mock.Mock()
+        app = self._make_app((conn, False))
+        mock_forward.return_value = mock.Mock(status=200, reason='OK')
+        environ = {
+            'HTTP_TRANSFER_ENCODING': 'chunked',
+            'CONTENT_LENGTH': '5',
+            'wsgi.input_terminated': True,
+        }
+
+        app(environ, mock.Mock())
+
+        mock_forward.assert_called_once_with(conn, environ, '/base',
+                                             mock.ANY, 0, True)
+
+    @mock.patch.object(aversion.ProxyApp, '_forward')
+    @mock.patch.object(aversion.ProxyApp, '_response_headers',
+                       return_value=[])
+    def test_call_retry(self, mock_response_headers, mock_forward):
+        conns = [mock.Mock(), mock.Mock(), mock.Mock()]
+        app = self._make_app((conns[0], True), (conns[1], True),
+                             (conns[2], False))
+        response = mock.Mock(status=200, reason='OK')
+        mock_forward.side_effect = [
+            socket.error(errno.ECONNRESET, 'Connection reset by peer'),
+            aversion.httplib.BadStatusLine(''), response,
+        ]
+
+        result = app({'REQUEST_METHOD': 'DELETE'}, mock.Mock())
+
+        self.assertEqual(result.conn, conns[2])
+        conns[0].close.assert_called_once_with()
+        conns[1].close.assert_called_once_with()
+        self.assertFalse(conns[2].close.called)
+
+    @mock.patch.object(aversion.ProxyApp, '_forward',
+                       side_effect=aversion.httplib.BadStatusLine(''))
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_call_no_retry_post(self, mock_warn, mock_forward):
+        conn = mock.Mock()
+        app = self._make_app((conn, True))
+
+        result = app({'REQUEST_METHOD': 'POST'}, mock.Mock())
+
+        self.assertEqual(result, [app.bad_gateway.body])
+        self.assertEqual(mock_forward.call_count, 1)
+
+    @mock.patch.object(aversion.ProxyApp, '_forward',
+                       side_effect=socket.timeout())
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_call_no_retry_timeout(self, mock_warn, mock_forward):
+        conn = mock.Mock()
+        app = self._make_app((conn, True))
+
+        result = app({'REQUEST_METHOD': 'GET'}, mock.Mock())
+
+        self.assertEqual(result, [app.gateway_timeout.body])
+        self.assertEqual(mock_forward.call_count, 1)
+
+    @mock.patch.object(aversion.ProxyApp, '_forward',
+                       side_effect=socket.error(errno.ECONNREFUSED,
+                                                'Connection refused'))
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_call_no_retry_other_error(self, mock_warn, mock_forward):
+        conn = mock.Mock()
+        app = self._make_app((conn, True))
+
+        result = app({}, mock.Mock())
+
+        self.assertEqual(result, [app.bad_gateway.body])
+        self.assertEqual(mock_forward.call_count, 1)
+
+    @mock.patch.object(aversion.ProxyApp, '_forward',
+                       side_effect=socket.error())
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_call_bad_gateway(self, mock_warn, mock_forward):
+        conn = mock.Mock()
+        app = self._make_app((conn, False))
+        start_response = mock.Mock()
+
+        result = app({}, start_response)
+
+        self.assertEqual(result, [app.bad_gateway.body])
+        conn.close.assert_called_once_with()
+        self.assertEqual(mock_warn.call_count, 1)
+
+    @mock.patch.object(aversion.ProxyApp, '_forward',
+                       side_effect=socket.timeout())
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_call_gateway_timeout(self, mock_warn, mock_forward):
+        conn = mock.Mock()
+        app = self._make_app((conn, False))
+        start_response = mock.Mock()
+
+        result = app({}, start_response)
+
+        self.assertEqual(result, [app.gateway_timeout.body])
+
+    @mock.patch.object(aversion.ProxyApp, '_forward',
+                       side_effect=socket.error())
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_call_no_retry_with_body(self, mock_warn, mock_forward):
+        conn = mock.Mock()
+        app = self._make_app((conn, True))
+
+        result = app({'CONTENT_LENGTH': '5'}, mock.Mock())
+
+        self.assertEqual(result, [app.bad_gateway.body])
+        self.assertEqual(mock_forward.call_count, 1)
+
+
+class StaleConnectionTest(unittest2.TestCase):
+    def test_bad_status_line(self):
+        self.assertTrue(aversion._stale_connection(
+            aversion.httplib.BadStatusLine('')))
+
+    def test_reset(self):
+        self.assertTrue(aversion._stale_connection(
+            socket.error(errno.ECONNRESET, 'Connection reset by peer')))
+        self.assertTrue(aversion._stale_connection(
+            socket.error(errno.EPIPE, 'Broken pipe')))
+
+    def test_timeout(self):
+        self.assertFalse(aversion._stale_connection(socket.timeout()))
+
+    def test_other(self):
+        self.assertFalse(aversion._stale_connection(socket.error()))
+        self.assertFalse(aversion._stale_connection(
+            aversion.httplib.IncompleteRead(b'')))
+
+
+class FrameTest(unittest2.TestCase):
+    def test_round_trip(self):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+
+        aversion._send_frame(left, aversion.FRAME_DATA, b'x' * 100000)
+        aversion._send_frame(left, aversion.FRAME_END)
+        left.close()
+
+        self.assertEqual(aversion._recv_frame(right),
+                         (aversion.FRAME_DATA, b'x' * 100000))
+        self.assertEqual(aversion._recv_frame(right),
+                         (aversion.FRAME_END, b''))
+        self.assertRaises(EOFError, aversion._recv_frame, right)
+
+
+class WorkerMainTest(unittest2.TestCase):
+    def run_worker(self, app, environ, body=b''):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+
+        aversion._send_frame(left, aversion.FRAME_ENVIRON,
+                             aversion.pickle.dumps(environ))
+        if body:
+            aversion._send_frame(left, aversion.FRAME_BODY, body)
+        aversion._send_frame(left, aversion.FRAME_BODY_END)
+        left.shutdown(socket.SHUT_WR)
+
+        aversion._worker_main(app, right)
+        right.close()
+
+        frames = []
+        while True:
+            try:
+                frames.append(aversion._recv_frame(left))
+            except EOFError:
+                return frames
+
+    def test_request(self):
+        def app(environ, start_response):
+            self.assertTrue(environ['wsgi.input_terminated'])
+            start_response('200 OK', [('X-Multiprocess',
+                                       str(environ['wsgi.multiprocess']))])
+            return [environ['PATH_INFO'].encode('utf-8'), b'',
+                    environ['wsgi.input'].read()]
+
+        frames = self.run_worker(app, {'PATH_INFO': '/foo'}, b'body')
+
+        self.assertEqual(frames[0][0], aversion.FRAME_START)
+        self.assertEqual(aversion.pickle.loads(frames[0][1]),
+                         ('200 OK', [('X-Multiprocess', 'True')]))
+        self.assertEqual(frames[1:], [
+            (aversion.FRAME_DATA, b'/foo'),
+            (aversion.FRAME_DATA, b'body'),
+            (aversion.FRAME_END, b''),
+        ])
+
+    def test_empty_response(self):
+        def app(environ, start_response):
+            start_response('204 No Content', [])
+            return []
+
+        frames = self.run_worker(app, {})
+
+        self.assertEqual([kind for kind, payload in frames],
+                         [aversion.FRAME_START, aversion.FRAME_END])
+
+    def test_error(self):
+        def app(environ, start_response):
+            raise TestException('failed')
+
+        frames = self.run_worker(app, {})
+
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0][0], aversion.FRAME_ERROR)
+        self.assertIn(b'Traceback', frames[0][1])
+        self.assertIn(b'TestException: failed', frames[0][1])
+
+    def test_no_start_response(self):
+        def app(environ, start_response):
+            return []
+
+        frames = self.run_worker(app, {})
+
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0][0], aversion.FRAME_ERROR)
+        self.assertIn(b'Application did not call start_response',
+                      frames[0][1])
+
+
+class CloseFdsTest(unittest2.TestCase):
+    @mock.patch.object(aversion.os, 'sysconf', return_value=64)
+    @mock.patch.object(aversion.os, 'closerange')
+    def test_close_fds(self, mock_closerange, mock_sysconf):
+        aversion._close_fds(10)
+
+        mock_sysconf.assert_called_once_with('SC_OPEN_MAX')
+        self.assertEqual(mock_closerange.call_args_list, [
+            mock.call(3, 10),
+            mock.call(11, 64),
+        ])
+
+    @mock.patch.object(aversion.os, 'sysconf', side_effect=ValueError())
+    @mock.patch.object(aversion.os, 'closerange')
+    def test_close_fds_no_limit(self, mock_closerange, mock_sysconf):
+        aversion._close_fds(10)
+
+        self.assertEqual(mock_closerange.call_args_list, [
+            mock.call(3, 10),
+            mock.call(11, 256),
+        ])
+
+
+class WorkerPoolTest(unittest2.TestCase):
+    def make_pool(self, *frames):
+        pool = aversion.WorkerPool('v1', 'app', timeout=0.01)
+        pool._pid = os.getpid()
+        pool._idle = aversion.queue.Queue()
+
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        for kind, payload in frames:
+            aversion._send_frame(right, kind, payload)
+        worker = mock.Mock(sock=left, pid=1234)
+        pool._workers.append(worker)
+        pool._idle.put(worker)
+
+        return pool, worker, right
+
+    def test_init(self):
+        pool = aversion.WorkerPool('v1', 'app', processes=3, timeout=2.0)
+
+        self.assertEqual(pool.version, 'v1')
+        self.assertEqual(pool.app, 'app')
+        self.assertEqual(pool.processes, 3)
+        self.assertEqual(pool.timeout, 2.0)
+        self.assertIs(copy.deepcopy(pool), pool)
+
+    def test_call(self):
+        pool, worker, peer = self.make_pool(
+            (aversion.FRAME_START,
+             aversion.pickle.dumps(('200 OK', [('X-Foo', 'bar')]))),
+            (aversion.FRAME_DATA, b'resp'),
+            (aversion.FRAME_END, b''),
+        )
+        environ = {
+            'PATH_INFO': '/foo',
+            'CONTENT_LENGTH': '4',
+            'wsgi.input': io.BytesIO(b'body'),
+            'webob.adhoc_attrs': {},
+            'aversion.config': {'versions': {}},
+        }
+        start_response = mock.Mock()
+
+        result = pool(environ, start_response)
+
+        start_response.assert_called_once_with('200 OK', [('X-Foo', 'bar')])
+        self.assertEqual(list(result), [b'resp'])
+        self.assertTrue(pool._idle.empty())
+        result.close()
+        self.assertIs(pool._idle.get_nowait(), worker)
+
+        # Check what the worker received
+        kind, payload = aversion._recv_frame(peer)
+        self.assertEqual(kind, aversion.FRAME_ENVIRON)
+        self.assertEqual(aversion.pickle.loads(payload),
+                         {'PATH_INFO': '/foo', 'CONTENT_LENGTH': '4'})
+        self.assertEqual(aversion._recv_frame(peer),
+                         (aversion.FRAME_BODY, b'body'))
+        self.assertEqual(aversion._recv_frame(peer),
+                         (aversion.FRAME_BODY_END, b''))
+
+    def test_call_chunked(self):
+        pool, worker, peer = self.make_pool(
+            (aversion.FRAME_START, aversion.pickle.dumps(('200 OK', []))),
+            (aversion.FRAME_END, b''),
+        )
+        pool.block_size = 4
+        environ = {
+            'HTTP_TRANSFER_ENCODING': 'chunked',
+            'wsgi.input': io.BytesIO(b'chunked body'),
+            'wsgi.input_terminated': True,
+        }
+
+        result = pool(environ, mock.Mock())
+        self.assertEqual(list(result), [])
+        result.close()
+
+        # The whole body was sent to the worker
+        kind, payload = aversion._recv_frame(peer)
+        self.assertEqual(kind, aversion.FRAME_ENVIRON)
+        body = []
+        while True:
+            kind, payload = aversion._recv_frame(peer)
+            if kind != aversion.FRAME_BODY:
+                break
+            body.append(payload)
+        self.assertEqual(kind, aversion.FRAME_BODY_END)
+        self.assertEqual(body, [b'chun', b'ked ', b'body'])
+
+    def test_call_length_required(self):
+        pool, worker, peer = self.make_pool()
+        start_response = mock.Mock()
+        environ = {
+            'HTTP_TRANSFER_ENCODING': 'chunked',
+            'wsgi.input': io.BytesIO(b'chunked body'),
+        }
+
+        result = pool(environ, start_response)
+
+        self.assertEqual(result, [pool.length_required.body])
+        self.assertEqual(start_response.call_args[0][0],
+                         '411 Length Required')
+        self.assertIs(pool._idle.get_nowait(), worker)
+
+    def test_call_close_early(self):
+        pool, worker, peer = self.make_pool(
+            (aversion.FRAME_START, aversion.pickle.dumps(('200 OK', []))),
+            (aversion.FRAME_DATA, b'resp'),
+            (aversion.FRAME_DATA, b'more'),
+            (aversion.FRAME_END, b''),
+        )
+
+        result = pool({}, mock.Mock())
+        result.close()
+
+        self.assertIs(pool._idle.get_nowait(), worker)
+        self.assertTrue(result.complete)
+
+    def test_call_unavailable(self):
+        pool = aversion.WorkerPool('v1', 'app', timeout=0.01)
+        pool._pid = os.getpid()
+        pool._idle = aversion.queue.Queue()
+        start_response = mock.Mock()
+
+        result = pool({}, start_response)
+
+        self.assertEqual(start_response.call_args[0][0],
+                         '503 Service Unavailable')
+        self.assertIn(('Retry-After', '1'), start_response.call_args[0][1])
+
+    @mock.patch.object(aversion.WorkerPool, 'discard')
+    def test_call_worker_died(self, mock_discard):
+        pool, worker, peer = self.make_pool()
+        peer.close()
+        start_response = mock.Mock()
+
+        result = pool({}, start_response)
+
+        self.assertEqual(start_response.call_args[0][0], '502 Bad Gateway')
+        mock_discard.assert_called_once_with(worker)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_call_app_failed(self, mock_warn):
+        pool, worker, peer = self.make_pool(
+            (aversion.FRAME_ERROR, b'failed'),
+        )
+        start_response = mock.Mock()
+
+        result = pool({}, start_response)
+
+        self.assertEqual(start_response.call_args[0][0],
+                         '500 Internal Server Error')
+        self.assertIs(pool._idle.get_nowait(), worker)
+        mock_warn.assert_called_once_with(
+            "Worker for version v1 failed: failed")
+
+    def test_iter_app_failed(self):
+        pool, worker, peer = self.make_pool(
+            (aversion.FRAME_START, aversion.pickle.dumps(('200 OK', []))),
+            (aversion.FRAME_DATA, b'resp'),
+            (aversion.FRAME_ERROR, b'failed'),
+        )
+
+        result = pool({}, mock.Mock())
+        app_iter = iter(result)
+
+        self.assertEqual(next(app_iter), b'resp')
+        self.assertRaises(RuntimeError, next, app_iter)
+        result.close()
+        self.assertIs(pool._idle.get_nowait(), worker)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'WorkerProcess')
+    def test_discard(self, mock_WorkerProcess, mock_warn):
+        pool, worker, peer = self.make_pool()
+        pool._idle.get_nowait()
+
+        pool.discard(worker)
+
+        worker.stop.assert_called_once_with()
+        mock_WorkerProcess.assert_called_once_with('app')
+        self.assertEqual(pool._workers, [mock_WorkerProcess.return_value])
+        self.assertIs(pool._idle.get_nowait(),
+                      mock_WorkerProcess.return_value)
+        mock_warn.assert_called_once_with(
+            "Restarting worker 1234 for version v1")
+
+    @mock.patch.object(aversion, 'WorkerProcess')
+    def test_start(self, mock_WorkerProcess):
+        pool = aversion.WorkerPool('v1', 'app', processes=2)
+        inherited = mock.Mock()
+        pool._workers = [inherited]
+        pool._pid = -1
+
+        pool.start()
+        pool.start()
+
+        inherited.sock.close.assert_called_once_with()
+        self.assertEqual(mock_WorkerProcess.call_count, 2)
+        self.assertEqual(pool._idle.qsize(), 2)
+        self.assertEqual(pool._pid, os.getpid())
+
+
+class ContentTypeFilterTest(unittest2.TestCase):
+    def test_init(self):
+        ctf = aversion.ContentTypeFilter('A/JSON', 'a/vnd.spam')
+
+        self.assertEqual(ctf.ctype, 'a/json')
+        self.assertEqual(ctf.orig_ctype, 'a/vnd.spam')
+
+    def test_call(self):
+        ctf = aversion.ContentTypeFilter('a/json', 'a/vnd.spam')
+        headers = [
+            ('X-Other', 'a/json'),
+            ('Content-Type', 'A/Json; charset=utf-8'),
+        ]
+
+        result = ctf('200 OK', headers)
+
+        self.assertEqual(result, ('200 OK', [
+            ('X-Other', 'a/json'),
+            ('Content-Type', 'a/vnd.spam; charset=utf-8'),
+        ]))
+
+    def test_call_mismatch(self):
+        ctf = aversion.ContentTypeFilter('a/json', 'a/vnd.spam')
+        headers = [('content-type', 'text/html')]
+
+        result = ctf('500 Internal Server Error', headers)
+
+        self.assertEqual(result, ('500 Internal Server Error',
+                                  [('content-type', 'text/html')]))
+
+
+class VaryFilterTest(unittest2.TestCase):
+    def test_init(self):
+        vf = aversion.VaryFilter(['Accept'])
+
+        self.assertEqual(vf.fields, ['Accept'])
+
+    def test_call_novary(self):
+        vf = aversion.VaryFilter(['Accept', 'Content-Type'])
+
+        result = vf('200 OK', [('Content-Type', 'a/a')])
+
+        self.assertEqual(result, ('200 OK', [
+            ('Content-Type', 'a/a'),
+            ('Vary', 'Accept, Content-Type'),
+        ]))
+
+    def test_call_merge(self):
+        vf = aversion.VaryFilter(['Accept', 'Content-Type'])
+
+        result = vf('200 OK', [
+            ('vary', 'accept-encoding, ACCEPT'),
+            ('Content-Type', 'a/a'),
+            ('Vary', 'Cookie'),
+        ])
+
+        self.assertEqual(result, ('200 OK', [
+            ('Content-Type', 'a/a'),
+            ('Vary', 'accept-encoding, ACCEPT, Cookie, Content-Type'),
+        ]))
+
+    def test_call_star(self):
+        vf = aversion.VaryFilter(['Accept'])
+        headers = [('Vary', '*'), ('Content-Type', 'a/a')]
+
+        result = vf('200 OK', headers)
+
+        self.assertEqual(result, ('200 OK', headers))
+
+
+class CacheFilterTest(unittest2.TestCase):
+    def test_init(self):
+        cf = aversion.CacheFilter('"etag"', 'max-age=60')
+
+        self.assertEqual(cf.etag, '"etag"')
+        self.assertEqual(cf.cache_control, 'max-age=60')
+
+    def test_call(self):
+        cf = aversion.CacheFilter('"etag"', 'max-age=60')
+
+        result = cf('200 OK', [
+            ('ETag', '"other"'),
+            ('Cache-Control', 'no-cache'),
+            ('Content-Type', 'a/a'),
+        ])
+
+        self.assertEqual(result, ('200 OK', [
+            ('Content-Type', 'a/a'),
+            ('ETag', '"etag"'),
+            ('Cache-Control', 'max-age=60'),
+        ]))
+
+    def test_call_no_cache_control(self):
+        cf = aversion.CacheFilter('"etag"')
+
+        result = cf('200 OK', [
+            ('etag', '"other"'),
+            ('Cache-Control', 'no-cache'),
+        ])
+
+        self.assertEqual(result, ('200 OK', [
+            ('Cache-Control', 'no-cache'),
+            ('ETag', '"etag"'),
+        ]))
+
+    def test_call_error(self):
+        cf = aversion.CacheFilter('"etag"', 'max-age=60')
+        headers = [('Content-Type', 'a/a')]
+
+        result = cf('500 Internal Server Error', headers)
+
+        self.assertEqual(result, ('500 Internal Server Error', headers))
+
+
+class EtagMatchTest(unittest2.TestCase):
+    def test_no_header(self):
+        self.assertFalse(aversion._etag_match('"a"', None))
+        self.assertFalse(aversion._etag_match('"a"', ''))
+
+    def test_match(self):
+        self.assertTrue(aversion._etag_match('"a"', '"a"'))
+        self.assertTrue(aversion._etag_match('"a"', '"b", W/"a"'))
+        self.assertTrue(aversion._etag_match('"a"', '*'))
+
+    def test_mismatch(self):
+        self.assertFalse(aversion._etag_match('"a"', '"b", W/"c"'))
+        self.assertFalse(aversion._etag_match('"a"', 'a'))
+
+
+class QueryParamTest(unittest2.TestCase):
+    def test_first(self):
+        self.assertEqual(aversion._query_param('api-version=2&a=b',
+                                               'api-version'), '2')
+
+    def test_later(self):
+        self.assertEqual(aversion._query_param('a=b&api-version=2',
+                                               'api-version'), '2')
+
+    def test_suffix(self):
+        self.assertEqual(aversion._query_param('xapi-version=1&api-version=2',
+                                               'api-version'), '2')
+
+    def test_missing(self):
+        self.assertEqual(aversion._query_param('xapi-version=1&a=b',
+                                               'api-version'), None)
+        self.assertEqual(aversion._query_param('', 'api-version'), None)
+
+    def test_first_occurrence(self):
+        self.assertEqual(aversion._query_param('v=1&v=2', 'v'), '1')
+
+    def test_decoded(self):
+        self.assertEqual(aversion._query_param('v=beta+1%2E0', 'v'),
+                         'beta 1.0')
+
+
+class SetKeyTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_duplicate(self, mock_warn):
+        result = dict(foo='one')
+        aversion._set_key("pfx", result, 'foo', '"two"', 'bar')
+
+        self.assertEqual(result, dict(foo='two'))
+        mock_warn.assert_called_once_with(
+            "pfx: Duplicate value for bar 'foo'")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_unquoted(self, mock_warn):
+        result = {}
+        aversion._set_key("pfx", result, 'foo', 'one', 'bar')
+
+        self.assertEqual(result, {})
+        mock_warn.assert_called_once_with(
+            "pfx: Invalid value 'one' for bar 'foo'")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_noerror(self, mock_warn):
+        result = {}
+        aversion._set_key("pfx", result, 'foo', '"one"', 'bar')
+
+        self.assertEqual(result, dict(foo='one'))
+        self.assertFalse(mock_warn.called)
+
+
+class ParseVersionRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_invalid_rule(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        self.assertRaises(ImportError, aversion._parse_version_rule, loader,
+                          'v1', '')
+        self.assertFalse(loader.get_app.called)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_no_params(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        result = aversion._parse_version_rule(loader, 'v1', 'api_v1')
+
+        self.assertEqual(result, dict(app='api_v1', name='v1', params={}))
+        loader.get_app.assert_called_once_with('api_v1')
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_bad_parameter(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        result = aversion._parse_version_rule(loader, 'v1',
+                                              'api_v1 foo=one')
+
+        self.assertEqual(result, dict(app='api_v1', name='v1', params={}))
+        loader.get_app.assert_called_once_with('api_v1')
+        mock_warn.assert_called_once_with(
+            "version.v1: Invalid value 'one' for parameter 'foo'")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        result = aversion._parse_version_rule(loader, 'v1',
+                                              'api_v1 foo="one"  bar="two"')
+
+        self.assertEqual(result, dict(
+            app='api_v1',
+            name='v1',
+            params=dict(foo='one', bar='two'),
+        ))
+        loader.get_app.assert_called_once_with('api_v1')
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_duplicate_parameter(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        result = aversion._parse_version_rule(loader, 'v1',
+                                              'api_v1 foo="one" foo="two"')
+
+        self.assertEqual(result, dict(
+            app='api_v1',
+            name='v1',
+            params=dict(foo='two'),
+        ))
+        loader.get_app.assert_called_once_with('api_v1')
+        mock_warn.assert_called_once_with(
+            "version.v1: Duplicate value for parameter 'foo'")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_upstream_url(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        result = aversion._parse_version_rule(
+            loader, 'v1', 'http://localhost:8081/api foo="one"')
+
+        self.assertIsInstance(result['app'], aversion.ProxyApp)
+        self.assertEqual(result['app'].url, 'http://localhost:8081/api')
+        self.assertEqual(result['params'], dict(foo='one'))
+        self.assertFalse(loader.get_app.called)
+        self.assertFalse(mock_warn.called)
+
+
+class ParseAliasRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_invalid_rule(self, mock_warn):
+        self.assertRaises(KeyError, aversion._parse_alias_rule, 'v1.1', '')
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_no_params(self, mock_warn):
+        result = aversion._parse_alias_rule('v1.1', 'v2')
+
+        self.assertEqual(result, dict(alias='v1.1', version='v2', params={}))
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_bad_parameter(self, mock_warn):
+        result = aversion._parse_alias_rule('v1.1', 'v2 foo=one')
+
+        self.assertEqual(result, dict(alias='v1.1', version='v2', params={}))
+        mock_warn.assert_called_once_with(
+            "alias.v1.1: Invalid value 'one' for parameter 'foo'")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        result = aversion._parse_alias_rule('v1.1', 'v2 foo="one"  bar="two"')
+
+        self.assertEqual(result, dict(
+            alias='v1.1',
+            version='v2',
+            params=dict(foo='one', bar='two'),
+        ))
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_duplicate_parameter(self, mock_warn):
+        result = aversion._parse_alias_rule('v1.1', 'v2 foo="one" foo="two"')
+
+        self.assertEqual(result, dict(
+            alias='v1.1',
+            version='v2',
+            params=dict(foo='two'),
+        ))
+        mock_warn.assert_called_once_with(
+            "alias.v1.1: Duplicate value for parameter 'foo'")
+
+
+class ParseTypeRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'TypeRule')
+    def test_invalid_rule(self, mock_TypeRule, mock_warn):
+        rule = aversion._parse_type_rule('ctype', 'value')
+
+        mock_warn.assert_called_once_with(
+            "ctype: Invalid type token 'value'")
+        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
+                                              params={},
+                                              version_range=None)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'TypeRule')
+    def test_unknown_token_type(self, mock_TypeRule, mock_warn):
+        rule = aversion._parse_type_rule('ctype', 'value:bar')
+
+        mock_warn.assert_called_once_with(
+            "ctype: Unrecognized token type 'value'")
+        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
+                                              params={},
+                                              version_range=None)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'TypeRule')
+    def test_bad_token_value(self, mock_TypeRule, mock_warn):
+        rule = aversion._parse_type_rule('ctype', 'type:bar')
+
+        mock_warn.assert_called_once_with(
+            "type.ctype: Invalid value 'bar' for token type 'type'")
+        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
+                                              params={},
+                                              version_range=None)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'TypeRule')
+    def test_token_parsing(self, mock_TypeRule, mock_warn):
+        rule = aversion._parse_type_rule('ctype', 'type:"bar"  version:"baz" '
+                                         'param:foo="one" param:bar="two"')
+
+        self.assertFalse(mock_warn.called)
+        mock_TypeRule.assert_called_once_with(ctype='bar', version='baz',
+                                              params=dict(foo='one',
+                                                          bar='two'),
+                                              version_range=None)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'TypeRule')
+    def test_token_parsing_duplicate(self, mock_TypeRule, mock_warn):
+        rule = aversion._parse_type_rule('ctype', 'type:"bar" type:"baz"')
+
+        mock_warn.assert_called_once_with(
+            "type.ctype: Duplicate value for token type 'type'")
+        mock_TypeRule.assert_called_once_with(ctype='baz', version=None,
+                                              params={},
+                                              version_range=None)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'TypeRule')
+    def test_bad_param_value(self, mock_TypeRule, mock_warn):
+        rule = aversion._parse_type_rule('ctype', 'param:foo=bar')
+
+        mock_warn.assert_called_once_with(
+            "type.ctype: Invalid value 'bar' for parameter 'foo'")
+        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
+                                              params={},
+                                              version_range=None)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'TypeRule')
+    def test_range(self, mock_TypeRule, mock_warn):
+        rule = aversion._parse_type_rule(
+            'ctype', 'version:"v1" range:">=%(min)s"')
+
+        self.assertFalse(mock_warn.called)
+        mock_TypeRule.assert_called_once_with(ctype=None, version='v1',
+                                              params={},
+                                              version_range='>=%(min)s')
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion, 'TypeRule')
+    def test_duplicate_param(self, mock_TypeRule, mock_warn):
+        rule = aversion._parse_type_rule('ctype',
+                                         'param:foo="one" param:foo="two"')
+
+        mock_warn.assert_called_once_with(
+            "type.ctype: Duplicate value for parameter 'foo'")
+        mock_TypeRule.assert_called_once_with(ctype=None, version=None,
+                                              params=dict(foo='two'),
+                                              version_range=None)
+
+
+class ParseOptionsTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_parse(self, mock_warn):
+        result = aversion._parse_options(
+            'limit.v1', ' a="1"  b=\'2\' c="3" a="4" d=5', ('a', 'b', 'd'))
+
+        self.assertEqual(result, dict(a='4', b='2'))
+        mock_warn.assert_has_calls([
+            mock.call("limit.v1: Unrecognized parameter 'c'"),
+            mock.call("limit.v1: Duplicate value for parameter 'a'"),
+            mock.call("limit.v1: Invalid value '5' for parameter 'd'"),
+        ])
+
+
+class ParseLimitRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        result = aversion._parse_limit_rule(
+            'v1', 'concurrency="10"  timeout="0.5" retry_after="2"')
+
+        self.assertIsInstance(result, aversion.Limiter)
+        self.assertEqual(result.concurrency, 10)
+        self.assertEqual(result.timeout, 0.5)
+        self.assertIn(('Retry-After', '2'), result.response.headers)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_defaults(self, mock_warn):
+        result = aversion._parse_limit_rule('v1', 'concurrency="10"')
+
+        self.assertEqual(result.concurrency, 10)
+        self.assertEqual(result.timeout, 0)
+        self.assertIn(('Retry-After', '1'), result.response.headers)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_unrecognized(self, mock_warn):
+        result = aversion._parse_limit_rule('v1', 'concurrency="10" foo="1"')
+
+        self.assertEqual(result.concurrency, 10)
+        mock_warn.assert_called_once_with(
+            "limit.v1: Unrecognized parameter 'foo'")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_missing_concurrency(self, mock_warn):
+        result = aversion._parse_limit_rule('v1', 'timeout="1"')
+
+        self.assertEqual(result, None)
+        mock_warn.assert_called_once_with(
+            "limit.v1: Invalid concurrency limit 'timeout=\"1\"'")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_bad_concurrency(self, mock_warn):
+        for spec in ('concurrency="ten"', 'concurrency="0"'):
+            result = aversion._parse_limit_rule('v1', spec)
+
+            self.assertEqual(result, None)
+        self.assertEqual(mock_warn.call_count, 2)
+
+
+class ParseBreakerRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        result = aversion._parse_breaker_rule(
+            'v1', 'failures="3" error_rate="0.5" window="10" latency="2.5" '
+            'reset="60" fallback="v0"')
+
+        self.assertIsInstance(result, aversion.CircuitBreaker)
+        self.assertEqual(result.failures, 3)
+        self.assertEqual(result.error_rate, 0.5)
+        self.assertEqual(result.window, 10)
+        self.assertEqual(result.latency, 2.5)
+        self.assertEqual(result.reset, 60.0)
+        self.assertEqual(result.fallback, 'v0')
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_defaults(self, mock_warn):
+        result = aversion._parse_breaker_rule('v1', '')
+
+        self.assertEqual(result.failures, 5)
+        self.assertEqual(result.fallback, None)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_invalid(self, mock_warn):
+        result = aversion._parse_breaker_rule(
+            'v1', 'failures="x" window="0" latency="-1" reset="10"')
+
+        self.assertEqual(result.failures, 5)
+        self.assertEqual(result.window, 20)
+        self.assertEqual(result.latency, None)
+        self.assertEqual(result.reset, 10.0)
+        self.assertEqual(mock_warn.call_count, 3)
+        mock_warn.assert_any_call(
+            "breaker.v1: Invalid value 'x' for parameter 'failures'")
+
+
+class ParseShadowRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        result = aversion._parse_shadow_rule(
+            'v1', 'target="v2" rate="0.5" workers="2" queue="10" '
+            'methods="get Put" max_body="0"')
+
+        self.assertIsInstance(result, aversion.Shadow)
+        self.assertEqual(result.version, 'v1')
+        self.assertEqual(result.target, 'v2')
+        self.assertEqual(result.rate, 0.5)
+        self.assertEqual(result.workers, 2)
+        self.assertEqual(result.queue_size, 10)
+        self.assertEqual(result.methods, frozenset(['GET', 'PUT']))
+        self.assertEqual(result.max_body, 0)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_no_target(self, mock_warn):
+        result = aversion._parse_shadow_rule('v1', 'rate="0.5"')
+
+        self.assertEqual(result, None)
+        mock_warn.assert_called_once_with(
+            "shadow.v1: No target version specified")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_invalid(self, mock_warn):
+        result = aversion._parse_shadow_rule(
+            'v1', 'target="v2" rate="x" workers="0" queue="-1"')
+
+        self.assertEqual(result.rate, 0.01)
+        self.assertEqual(result.workers, 1)
+        self.assertEqual(result.queue_size, 100)
+        self.assertEqual(mock_warn.call_count, 3)
+
+
+class ParseCacheRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        result = aversion._parse_cache_rule(
+            'v1', 'size="1000" ttl="2.5" max_entry="100"')
+
+        self.assertIsInstance(result, aversion.ResponseCache)
+        self.assertEqual(result.version, 'v1')
+        self.assertEqual(result.size, 1000)
+        self.assertEqual(result.ttl, 2.5)
+        self.assertEqual(result.max_entry, 100)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_defaults(self, mock_warn):
+        result = aversion._parse_cache_rule('v1', '')
+
+        self.assertEqual(result.size, 1048576)
+        self.assertEqual(result.ttl, 0)
+        self.assertEqual(result.max_entry, 1048576)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_invalid(self, mock_warn):
+        for spec in ('size="big"', 'size="0"', 'ttl="-1"',
+                     'max_entry="0"'):
+            mock_warn.reset_mock()
+
+            result = aversion._parse_cache_rule('v1', spec)
+
+            self.assertEqual(result, None)
+            mock_warn.assert_called_once_with(
+                "cache.v1: Invalid response cache %r" % spec)
+
+
+class ParseCoalesceRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        result = aversion._parse_coalesce_rule(
+            'v1', 'max_size="1000" timeout="2.5"')
+
+        self.assertIsInstance(result, aversion.Coalescer)
+        self.assertEqual(result.version, 'v1')
+        self.assertEqual(result.max_size, 1000)
+        self.assertEqual(result.timeout, 2.5)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_defaults(self, mock_warn):
+        result = aversion._parse_coalesce_rule('v1', '')
+
+        self.assertEqual(result.max_size, 65536)
+        self.assertEqual(result.timeout, 5.0)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_invalid(self, mock_warn):
+        for spec in ('max_size="big"', 'max_size="0"', 'timeout="0"'):
+            mock_warn.reset_mock()
+
+            result = aversion._parse_coalesce_rule('v1', spec)
+
+            self.assertEqual(result, None)
+            mock_warn.assert_called_once_with(
+                "coalesce.v1: Invalid request coalescing %r" % spec)
+
+
+class ParseProxyRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        result = aversion._parse_proxy_rule('v1',
+                                            'pool_size="5" timeout="2.5"')
+
+        self.assertEqual(result, dict(pool_size=5, timeout=2.5))
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_invalid(self, mock_warn):
+        result = aversion._parse_proxy_rule('v1',
+                                            'pool_size="five" timeout="2"')
+
+        self.assertEqual(result, dict(timeout=2.0))
+        mock_warn.assert_called_once_with(
+            "proxy.v1: Invalid value 'five' for parameter 'pool_size'")
+
+
+class ParseWorkersRuleTest(unittest2.TestCase):
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_full_parse(self, mock_warn):
+        result = aversion._parse_workers_rule('v1',
+                                              'processes="4" timeout="2.5"')
+
+        self.assertEqual(result, dict(processes=4, timeout=2.5))
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_invalid(self, mock_warn):
+        result = aversion._parse_workers_rule('v1',
+                                              'processes="0" timeout="x"')
+
+        self.assertEqual(result, {})
+        self.assertEqual(mock_warn.call_count, 2)
+        mock_warn.assert_any_call(
+            "workers.v1: Invalid value '0' for parameter 'processes'")
+        mock_warn.assert_any_call(
+            "workers.v1: Invalid value 'x' for parameter 'timeout'")
+
+
+class UriNormalizeTest(unittest2.TestCase):
+    def test_uri_normalize(self):
+        result = aversion._uri_normalize('///foo////bar////baz////')
+
+        self.assertEqual(result, '/foo/bar/baz')
+
+
+class AVersionTest(unittest2.TestCase):
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_init_empty(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {})
+
+        self.assertEqual(av.overwrite_headers, True)
+        self.assertEqual(av.compact_environ, False)
+        self.assertEqual(av.correct_response_type, False)
+        self.assertEqual(av.add_vary, True)
+        self.assertEqual(av.strict_accept, False)
+        self.assertEqual(av.acceptable, [])
+        self.assertEqual(av.strict_content_type, False)
+        self.assertEqual(av.rejected_types.snapshot(), {})
+        self.assertEqual(av.max_header_length, None)
+        self.assertEqual(av.max_media_ranges, None)
+        self.assertEqual(av.max_type_params, None)
+        self.assertEqual(av.header_limit_action, 'ignore')
+        self.assertEqual(av.limited_headers.snapshot(), {})
+        self.assertEqual(av.version_app, None)
+        self.assertEqual(av.version_cacheable, False)
+        self.assertEqual(av.version_cache_control, None)
+        self.assertEqual(av.version_etag, None)
+        self.assertEqual(av.not_modified, None)
+        self.assertEqual(av.health_paths, set())
+        self.assertEqual(av.health_response.body, b'OK\n')
+        self.assertEqual(av.metrics_path, None)
+        self.assertEqual(av.limiters, {})
+        self.assertEqual(av.degraded, set())
+        self.assertEqual(av.fallbacks.snapshot(), {})
+        self.assertEqual(av.breakers, {})
+        self.assertEqual(av.shadows, {})
+        self.assertEqual(av.profiler, None)
+        self.assertEqual(av.versions, {})
+        self.assertEqual(av.aliases, {})
+        self.assertEqual(av.types, {})
+        self.assertEqual(av.formats, {})
+        self.assertEqual(av.uris, [])
+        self.assertEqual(av.config, {
+            'versions': {},
+            'aliases': {},
+            'types': {},
+        })
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_init(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        conf = {
+            'overwrite_headers': 'false',
+            'compact_environ': 'on',
+            'correct_response_type': 'yes',
+            'add_vary': 'no',
+            'strict_accept': 'on',
+            'strict_content_type': 'on',
+            'max_header_length': '0',
+            'max_media_ranges': '10',
+            'max_type_params': '5',
+            'header_limit_action': 'Reject',
+            'health_paths': ' /healthz  /livez ',
+            'health_versions': 'true',
+            'metrics_path': '/metrics',
+            'limit.v1': 'concurrency="5"',
+            'limit.v3': 'concurrency="5"',
+            'degraded': 'v1  v3',
+            'version': 'vers_app',
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'alias.v1.1': 'v2',
+            'uri.///v1.0//': 'v1',
+            'uri.//v2////': 'v2',
+            'uri.//v3///': 'v3',
+            'type.a/a': 'type:"%(_)s" version:"v2"',
+            'type.a/b': 'version:"v1"',
+            'type.a/c': 'type:"a/a"',
+            '.a': 'a/a',
+            '.b': 'a/b',
+            'ignored': 'ignored',
+        }
+
+        av = aversion.AVersion(loader, {}, **conf)
+
+        self.assertEqual(av.overwrite_headers, False)
+        self.assertEqual(av.compact_environ, True)
+        self.assertEqual(av.correct_response_type, True)
+        self.assertEqual(av.add_vary, False)
+        self.assertEqual(av.strict_accept, True)
+        self.assertEqual(av.acceptable, ['a/a', 'a/b', 'a/c'])
+        self.assertEqual(av.not_acceptable.status, '406 Not Acceptable')
+        self.assertEqual(av.strict_content_type, True)
+        self.assertEqual(av.max_header_length, None)
+        self.assertEqual(av.max_media_ranges, 10)
+        self.assertEqual(av.max_type_params, 5)
+        self.assertEqual(av.header_limit_action, 'reject')
+        self.assertEqual(av.header_too_large.status,
+                         '431 Request Header Fields Too Large')
+        self.assertEqual(av.unsupported_type.status,
+                         '415 Unsupported Media Type')
+        self.assertEqual(av.unsupported_type.body,
+                         b'415 Unsupported Media Type\n\n'
+                         b'Supported content types: a/a, a/b, a/c\n')
+        self.assertEqual(av.not_acceptable.body,
+                         b'406 Not Acceptable\n\n'
+                         b'Acceptable content types: a/a, a/b, a/c\n')
+        self.assertEqual(av.health_paths, set(['/healthz', '/livez']))
+        self.assertEqual(av.metrics_path, '/metrics')
+        self.assertEqual(list(av.limiters.keys()), ['v1'])
+        self.assertEqual(av.limiters['v1'].concurrency, 5)
+        self.assertEqual(av.degraded, set(['v1', 'v3']))
+        self.assertEqual(av.health_response.headers, [
+            ('Content-Type', 'application/json'),
+            ('Cache-Control', 'no-cache'),
+            ('Content-Length', '42'),
+        ])
+        self.assertEqual(json.loads(av.health_response.body.decode('utf-8')),
+                         {'status': 'ok', 'versions': ['v1', 'v2']})
+        self.assertEqual(av.version_app, 'vers_app')
+        self.assertEqual(av.versions, {
+            'v1': {
+                'app': 'vers_v1',
+                'name': 'v1',
+                'prefixes': ['/v1.0'],
+                'params': {},
+            },
+            'v2': {
+                'app': 'vers_v2',
+                'name': 'v2',
+                'prefixes': ['/v2'],
+                'params': {},
+            },
+        })
+        self.assertEqual(av.aliases, {
+            'v1.1': {
+                'alias': 'v1.1',
+                'version': 'v2',
+                'params': {},
+            },
+        })
+        self.assertEqual(av.types, {
+            'a/a': ('%(_)s', 'v2', {}, None),
+            'a/b': (None, 'v1', {}, None),
+            'a/c': ('a/a', None, {}, None),
+        })
+        self.assertEqual(av.formats, {
+            '.a': 'a/a',
+            '.b': 'a/b',
+        })
+        self.assertEqual(av.uris, [
+            ('/v1.0', 'v1'),
+            ('/v2', 'v2'),
+            ('/v3', 'v3'),
+        ])
+        self.assertEqual(av.config, {
+            'versions': {
+                'v1': {
+                    'app': 'vers_v1',
+                    'name': 'v1',
+                    'prefixes': ['/v1.0'],
+                    'params': {},
+                },
+                'v2': {
+                    'app': 'vers_v2',
+                    'name': 'v2',
+                    'prefixes': ['/v2'],
+                    'params': {},
+                },
+            },
+            'aliases': {
+                'v1.1': {
+                    'alias': 'v1.1',
+                    'version': 'v2',
+                    'params': {},
+                },
+            },
+            'types': {
+                'a/a': dict(name='a/a', params={}, suffixes=['.a']),
+                'a/b': dict(name='a/b', params={}, suffixes=['.b']),
+                'a/c': dict(name='a/c', params={}),
+            },
+        })
+        loader.assert_has_calls([
+            mock.call.get_app('vers_app'),
+            mock.call.get_app('vers_v1'),
+            mock.call.get_app('vers_v2'),
+        ], any_order=True)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_overwrite_headers(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        trials = {
+            'true': True,
+            'tRuE': True,
+            't': True,
+            'on': True,
+            'yes': True,
+            'enable': True,
+            'false': False,
+            'fAlSe': False,
+            'off': False,
+            'no': False,
+            'disable': False,
+            '0': False,
+            '1': True,
+            '1000': True,
+            'fals': True,
+        }
+
+        for value, expected in trials.items():
+            av = aversion.AVersion(loader, {}, overwrite_headers=value)
+            self.assertEqual(av.overwrite_headers, expected)
+
+        mock_warn.assert_called_once_with(
+            "Unrecognized value 'fals' for configuration key "
+            "'overwrite_headers'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_init_discovery(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, **{
+            'version': 'aversion:discovery',
+            'version.v1': 'vers_v1',
+        })
+
+        self.assertIsInstance(av.version_app, aversion.DiscoveryApp)
+        self.assertIs(av.version_app.avers, av)
+        self.assertEqual(av.version_cacheable, True)
+        self.assertNotEqual(av.version_etag, None)
+        loader.get_app.assert_called_once_with('vers_v1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.DiscoveryApp, 'build_document',
+                       return_value={'a': 'b'})
+    def test_config_changed_cacheable(self, mock_build_document):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, version_cacheable='on',
+                               version_cache_control='max-age=60')
+        mock_build_document.reset_mock()
+        av.version_app = mock.Mock()
+
+        av.config_changed()
+
+        mock_build_document.assert_called_once_with(av)
+        self.assertFalse(av.version_app.render.called)
+        etag = '"%s"' % hashlib.sha1(b'{"a": "b"}').hexdigest()
+        self.assertEqual(av.version_etag, etag)
+        self.assertEqual(av.not_modified.status, '304 Not Modified')
+        self.assertEqual(av.not_modified.headers, [
+            ('ETag', etag),
+            ('Cache-Control', 'max-age=60'),
+        ])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.DiscoveryApp, 'render')
+    def test_config_changed_discovery(self, mock_render):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, version='aversion:discovery')
+        mock_render.reset_mock()
+        etag = av.version_etag
+        av.versions['v1'] = dict(name='v1', app='app', params={})
+
+        av.config_changed()
+
+        mock_render.assert_called_once_with()
+        self.assertNotEqual(av.version_etag, etag)
+        self.assertEqual(av.not_modified.headers, [
+            ('ETag', av.version_etag),
+        ])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_config_changed_uncacheable(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, version_cacheable='on')
+        av.version_cacheable = False
+
+        av.config_changed()
+
+        self.assertEqual(av.version_etag, None)
+        self.assertEqual(av.not_modified, None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_header_limits_bad(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, max_media_ranges='many',
+                               header_limit_action='explode')
+
+        self.assertEqual(av.max_media_ranges, None)
+        self.assertEqual(av.header_limit_action, 'ignore')
+        mock_warn.assert_has_calls([
+            mock.call("Unrecognized value 'many' for configuration key "
+                      "'max_media_ranges'"),
+            mock.call("Unrecognized value 'explode' for configuration key "
+                      "'header_limit_action'"),
+        ], any_order=True)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion.AVersion, '_install_profile_signal')
+    def test_init_profile(self, mock_install_profile_signal, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, profile_rate='100',
+                               profile_file='file', profile_signal='usr1')
+
+        self.assertIsInstance(av.profiler, aversion.ProfileSampler)
+        self.assertEqual(av.profiler.rate, 100)
+        self.assertEqual(av.profiler.filename, 'file')
+        mock_install_profile_signal.assert_called_once_with('USR1')
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch.object(aversion.AVersion, '_install_profile_signal')
+    def test_init_profile_disabled(self, mock_install_profile_signal,
+                                   mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, profile_rate='0',
+                               profile_signal='usr1')
+
+        self.assertEqual(av.profiler, None)
+        self.assertFalse(mock_install_profile_signal.called)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_profile_badrate(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, profile_rate='often')
+
+        self.assertEqual(av.profiler, None)
+        mock_warn.assert_called_once_with(
+            "Unrecognized value 'often' for configuration key "
+            "'profile_rate'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch('signal.signal')
+    def test_install_profile_signal(self, mock_signal):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {})
+        av.profiler = mock.Mock()
+
+        av._install_profile_signal('USR1')
+
+        mock_signal.assert_called_once_with(aversion.signal.SIGUSR1,
+                                            mock.ANY)
+        handler = mock_signal.call_args[0][1]
+        handler(aversion.signal.SIGUSR1, None)
+        av.profiler.request_dump.assert_called_once_with()
+        self.assertFalse(av.profiler.dump.called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    @mock.patch('signal.signal')
+    def test_install_profile_signal_bad(self, mock_signal, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {})
+
+        av._install_profile_signal('SIGNOSUCH')
+
+        self.assertFalse(mock_signal.called)
+        mock_warn.assert_called_once_with(
+            "Unable to install handler for signal 'SIGNOSUCH'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version=None))
+    def test_call_profiled(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.profiler = mock.Mock(side_effect=lambda func, *args: func(*args))
+
+        result = av(request)
+
+        av.profiler.assert_called_once_with(mock_process, request)
+        mock_process.assert_called_once_with(request)
+        self.assertIsInstance(result, webob.exc.HTTPInternalServerError)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       side_effect=aversion.ShortCircuit('static'))
+    def test_call_short_circuit(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.version_app = 'fallback'
+
+        result = av(request)
+
+        mock_process.assert_called_once_with(request)
+        self.assertEqual(result, 'static')
+        self.assertEqual(request.environ, {})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_metrics(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'limit.v1': 'concurrency="2"',
+            'cache.v1': 'size="100"',
+            'charsets': 'utf-8',
+        })
+        av.limiters['v1'].acquire()
+        av.rejected_types.incr('a/a')
+        av.limited_headers.incr('Accept', 2)
+
+        self.assertEqual(av.metrics(), {
+            'versions': {
+                'v1': {'in_flight': 1, 'rejected': 0},
+            },
+            'breakers': {},
+            'fallbacks': {},
+            'shadows': {},
+            'caches': {
+                'v1': {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0,
+                       'stores': 0, 'evictions': 0},
+            },
+            'coalescing': {},
+            'negotiation': {
+                'accept-charset': {'entries': 0, 'hits': 0, 'misses': 0},
+            },
+            'header_cache': {'entries': 0, 'hits': 0, 'misses': 0},
+            'rejected_types': {'a/a': 1},
+            'limited_headers': {'Accept': 2},
+        })
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process')
+    @mock.patch.object(aversion.AVersion, 'metrics',
+                       return_value={'a': 'b'})
+    def test_call_metrics(self, mock_metrics, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={}, path_info='/metrics')
+        av = aversion.AVersion(loader, {}, version='vers_app',
+                               metrics_path='/metrics')
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.StaticResponse)
+        self.assertEqual(result.body, b'{"a": "b"}')
+        self.assertFalse(mock_process.called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version='v1'))
+    def test_call_limited(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'limit.v1': 'concurrency="2"',
+        })
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.LimitedApp)
+        self.assertEqual(result.app, 'vers_v1')
+        self.assertIs(result.limiter, av.limiters['v1'])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_proxy(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'http://localhost:8081/',
+            'proxy.v1': 'pool_size="5"',
+            'proxy.v2': 'pool_size="5" timeout="2"',
+        })
+
+        self.assertIsInstance(av.versions['v2']['app'], aversion.ProxyApp)
+        self.assertEqual(av.versions['v2']['app'].pool.max_size, 5)
+        self.assertEqual(av.versions['v2']['app'].pool.timeout, 2.0)
+        mock_warn.assert_called_once_with(
+            "proxy.v1: Version 'v1' is not an upstream server")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.WorkerPool, 'start')
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_workers(self, mock_warn, mock_start):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'http://localhost:8081/',
+            'workers.v1': 'processes="3"',
+            'workers.v2': '',
+            'workers.v3': '',
+        })
+
+        self.assertIsInstance(av.versions['v1']['app'], aversion.WorkerPool)
+        self.assertEqual(av.versions['v1']['app'].app, 'vers_v1')
+        self.assertEqual(av.versions['v1']['app'].processes, 3)
+        mock_start.assert_called_once_with()
+        self.assertIsInstance(av.versions['v2']['app'], aversion.ProxyApp)
+        self.assertEqual(mock_warn.call_count, 2)
+        mock_warn.assert_any_call(
+            "workers.v2: Version 'v2' is not a local application")
+        mock_warn.assert_any_call(
+            "workers.v3: Version 'v3' is not a local application")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_caches(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'cache.v1': 'size="100"',
+            'cache.v2': 'size="100"',
+        })
+
+        self.assertEqual(list(av.caches.keys()), ['v1'])
+        self.assertEqual(av.caches['v1'].size, 100)
+        mock_warn.assert_called_once_with("cache.v2: Unknown version 'v2'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1'))
+    def test_call_cached(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={'HTTP_ACCEPT': 'a/a'},
+                            method='GET', host='example.com',
+                            script_name='/v1', path_info='/foo',
+                            query_string='a=1')
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'cache.v1': '',
+            'breaker.v1': '',
+        })
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.CachedApp)
+        self.assertIsInstance(result.app, aversion.BreakerApp)
+        self.assertIs(result.cache, av.caches['v1'])
+        self.assertEqual(result.key, ('v1', 'example.com', '/v1', '/foo',
+                                      'a=1', 'a/a', None, None, 'a/a'))
+        self.assertEqual(result.on_hit.func, av.breakers['v1'].cancel)
+        self.assertEqual(result.on_hit.args, (True,))
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_coalescers(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'coalesce.v1': 'timeout="1"',
+            'coalesce.v2': '',
+        })
+
+        self.assertEqual(list(av.coalescers.keys()), ['v1'])
+        self.assertEqual(av.coalescers['v1'].timeout, 1.0)
+        mock_warn.assert_called_once_with(
+            "coalesce.v2: Unknown version 'v2'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1'))
+    def test_call_coalesced(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={}, method='GET',
+                            host='example.com', script_name='/v1',
+                            path_info='/foo', query_string='')
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'coalesce.v1': '',
+            'cache.v1': '',
+        })
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.CachedApp)
+        self.assertIsInstance(result.app, aversion.CoalescedApp)
+        self.assertEqual(result.app.app, 'vers_v1')
+        self.assertIs(result.app.coalescer, av.coalescers['v1'])
+        self.assertEqual(result.app.key, ('v1', 'example.com', '/v1',
+                                          '/foo', '', 'a/a', None, None,
+                                          None))
+        self.assertEqual(result.app.on_shared, None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_compress(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, compress='Deflate br gzip',
+                               compress_min_size='100', compress_level='9',
+                               compress_skip_types='image/* a/B')
+
+        self.assertEqual(av.compress, ['deflate', 'gzip'])
+        self.assertEqual(av.compress_min_size, 100)
+        self.assertEqual(av.compress_level, 9)
+        self.assertEqual(av.compress_skip_types, ['image/*', 'a/b'])
+        mock_warn.assert_called_once_with(
+            "Unknown content coding 'br' for key 'compress'")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_version_index(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'version_order': 'v2 v1 v3',
+            'type.a/a': 'version:"v1" range:"%(v)s"',
+            'type.a/b': 'version:"v2"',
+        })
+
+        self.assertEqual(av.version_index.versions, ['v2', 'v1'])
+        self.assertIs(av.types['a/a'].index, av.version_index)
+        self.assertEqual(av.types['a/b'].index, None)
+        mock_warn.assert_called_once_with(
+            "version_order: Unknown version 'v3'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_init_header_cache(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, header_cache_size='10',
+                               max_media_ranges='5', max_type_params='2')
+
+        self.assertEqual(av.header_cache.size, 10)
+        self.assertEqual(av.header_cache.max_ranges, 5)
+        self.assertEqual(av.header_cache.max_params, 2)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_init_negotiators(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, languages='en-US fr',
+                               max_media_ranges='5', max_type_params='2')
+
+        self.assertEqual(len(av.negotiators), 1)
+        header, attr, negotiator = av.negotiators[0]
+        self.assertEqual(header, 'accept-language')
+        self.assertEqual(attr, 'language')
+        self.assertEqual(negotiator.allowed, ['en-US', 'fr'])
+        self.assertEqual(negotiator.rule, aversion.match_language_range)
+        self.assertEqual(negotiator.max_ranges, 5)
+        self.assertEqual(negotiator.max_params, 2)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                encoding='gzip'))
+    def test_call_compressed(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={}, method='GET')
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'compress': 'gzip',
+            'compress_min_size': '10',
+        })
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.CompressedApp)
+        self.assertEqual(result.app, 'vers_v1')
+        self.assertEqual(result.coding, 'gzip')
+        self.assertEqual(result.min_size, 10)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1'))
+    def test_call_cached_post(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={}, method='POST')
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'cache.v1': '',
+        })
+
+        result = av(request)
+
+        self.assertEqual(result, 'vers_v1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_breakers(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'alias.v1.1': 'v1',
+            'breaker.v1': 'fallback="v3"',
+            'breaker.v2': 'fallback="v1.1"',
+            'breaker.v3': '',
+        })
+
+        self.assertEqual(sorted(av.breakers.keys()), ['v1', 'v2'])
+        self.assertEqual(av.breakers['v1'].fallback, None)
+        self.assertEqual(av.breakers['v2'].fallback, 'v1.1')
+        self.assertEqual(mock_warn.call_count, 2)
+        mock_warn.assert_any_call("breaker.v3: Unknown version 'v3'")
+        mock_warn.assert_any_call(
+            "breaker.v1: Unknown fallback version 'v3'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_shadows(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'alias.v2.1': 'v2',
+            'shadow.v1': 'target="v2.1"',
+            'shadow.v2': 'target="v3"',
+        })
+
+        self.assertEqual(list(av.shadows.keys()), ['v1'])
+        self.assertEqual(av.shadows['v1'].app, 'vers_v2')
+        mock_warn.assert_called_once_with(
+            "shadow.v2: Unknown version 'v2' or 'v3'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_canonical_version(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, **{'alias.v1.1': 'v2'})
+
+        self.assertEqual(av._canonical_version('v1.1'), 'v2')
+        self.assertEqual(av._canonical_version('v1'), 'v1')
+        self.assertEqual(av._canonical_version(None), None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_unavailable(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'version.v3': 'vers_v3',
+            'limit.v2': 'concurrency="1"',
+            'degraded': 'v3',
+        })
+
+        self.assertFalse(av._unavailable('v1'))
+        self.assertFalse(av._unavailable('v2'))
+        self.assertTrue(av._unavailable('v3'))
+        av.limiters['v2'].acquire()
+        self.assertTrue(av._unavailable('v2'))
+        av.breakers['v1'] = mock.Mock(**{'available.return_value': False})
+        self.assertTrue(av._unavailable('v1'))
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_fall_back(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'version.v3': 'vers_v3',
+            'alias.v1.1': 'v1',
+            'degraded': 'v2 v3',
+        })
+        av.types = {
+            'a/a': mock.Mock(return_value=('a/x', 'v3')),
+            'a/b': mock.Mock(return_value=('a/y', 'v2')),
+            'a/c': mock.Mock(return_value=('a/z', 'v4')),
+            'a/d': mock.Mock(return_value=(None, 'v1.1')),
+            'a/e': mock.Mock(return_value=('a/w', 'v1')),
+        }
+        result = fake_result(version='v2', ctype='a/y', orig_ctype='a/b',
+                             candidates=[
+                                 ('a/e', {'q': '0'}),
+                                 ('a/e', {'q': 'spam'}),
+                                 ('a/a', {}),
+                                 ('a/b', {}),
+                                 ('a/c', {}),
+                                 ('a/d', {'q': '0.5'}),
+                                 ('a/e', {}),
+                             ])
+
+        version = av._fall_back(result, 'v2')
+
+        self.assertEqual(version, 'v1')
+        self.assertEqual(result.version, 'v1.1')
+        self.assertEqual(result.ctype, None)
+        self.assertEqual(result.orig_ctype, None)
+        self.assertFalse(av.types['a/e'].called)
+        self.assertEqual(av.fallbacks.snapshot(), {'v2': 1})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_fall_back_none_available(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'degraded': 'v1 v2',
+        })
+        av.types = {'a/a': mock.Mock(return_value=('a/x', 'v1'))}
+        result = fake_result(version='v2', ctype='a/y', orig_ctype='a/b',
+                             candidates=[('a/a', {})])
+
+        version = av._fall_back(result, 'v2')
+
+        self.assertEqual(version, 'v2')
+        self.assertEqual(result.version, 'v2')
+        self.assertEqual(result.ctype, 'a/y')
+        self.assertEqual(result.orig_ctype, 'a/b')
+        self.assertEqual(av.fallbacks.snapshot(), {})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_fall_back', return_value='v1')
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v2',
+                                                candidates=[('a/b', {})]))
+    def test_call_fall_back(self, mock_process, mock_fall_back):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, add_vary='off', degraded='v2',
+                               **{
+                                   'version.v1': 'vers_v1',
+                                   'version.v2': 'vers_v2',
+                               })
+
+        result = av(request)
+
+        mock_fall_back.assert_called_once_with(mock_process.return_value,
+                                               'v2')
+        self.assertEqual(result, 'vers_v1')
+        self.assertEqual(request.environ['aversion.version'], 'v1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_fall_back')
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v2',
+                                                candidates=[('a/b', {})]))
+    def test_call_no_fall_back(self, mock_process, mock_fall_back):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, add_vary='off', **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+        })
+
+        result = av(request)
+
+        self.assertFalse(mock_fall_back.called)
+        self.assertEqual(result, 'vers_v2')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version='v1'))
+    def test_call_breaker(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'breaker.v1': '',
+            'limit.v1': 'concurrency="2"',
+        })
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.LimitedApp)
+        self.assertEqual(result.on_reject.func, av.breakers['v1'].cancel)
+        self.assertEqual(result.on_reject.args, (True,))
+        self.assertIsInstance(result.app, aversion.BreakerApp)
+        self.assertEqual(result.app.app, 'vers_v1')
+        self.assertIs(result.app.breaker, av.breakers['v1'])
+        self.assertEqual(result.app.token, True)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version='v1'))
+    def test_call_breaker_open(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'breaker.v1': 'failures="1"',
+        })
+        av.breakers['v1'].record(False)
+
+        result = av(request)
+
+        self.assertIs(result, av.breakers['v1'].response)
+        self.assertEqual(request.environ, {})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_renegotiate')
+    def test_call_breaker_fallback(self, mock_renegotiate):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'alias.v1.1': 'v1',
+            'breaker.v1': '',
+            'breaker.v2': 'failures="1" fallback="v1.1"',
+        })
+        av.breakers['v2'].record(False)
+
+        with mock.patch.object(aversion.AVersion, '_process',
+                               return_value=fake_result(ctype=None,
+                                                        version='v2')):
+            result = av(request)
+
+        self.assertIsInstance(result, aversion.BreakerApp)
+        self.assertEqual(result.app, 'vers_v1')
+        self.assertIs(result.breaker, av.breakers['v1'])
+        self.assertEqual(request.environ['aversion.version'], 'v1')
+        self.assertEqual(av.fallbacks.snapshot(), {'v2': 1})
+        mock_renegotiate.assert_called_once_with(request, mock.ANY, 'v1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_call_breaker_fallback_open(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'breaker.v1': 'failures="1"',
+            'breaker.v2': 'failures="1" fallback="v1"',
+        })
+        av.breakers['v1'].record(False)
+        av.breakers['v2'].record(False)
+
+        with mock.patch.object(aversion.AVersion, '_process',
+                               return_value=fake_result(ctype=None,
+                                                        version='v2')):
+            result = av(request)
+
+        self.assertIs(result, av.breakers['v2'].response)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version='v1'))
+    def test_call_shadow(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'shadow.v1': 'target="v2" rate="1"',
+        })
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.ShadowApp)
+        self.assertEqual(result.app, 'vers_v1')
+        self.assertIs(result.shadow, av.shadows['v1'])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version='v1'))
+    def test_call_shadow_unsampled(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'shadow.v1': 'target="v2" rate="0"',
+        })
+
+        result = av(request)
+
+        self.assertEqual(result, 'vers_v1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process')
+    def test_call_health(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={}, path_info='/healthz')
+        av = aversion.AVersion(loader, {}, version='vers_app',
+                               health_paths='/healthz')
+
+        result = av(request)
+
+        self.assertIs(result, av.health_response)
+        self.assertFalse(mock_process.called)
+        self.assertEqual(request.environ, {})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version=None))
+    def test_call_cacheable(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={}, method='GET')
+        av = aversion.AVersion(loader, {}, version='vers_app',
+                               version_cacheable='on',
+                               version_cache_control='max-age=60')
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.ResponseFilter)
+        self.assertEqual(result.app, 'vers_app')
+        self.assertEqual(len(result.filters), 1)
+        self.assertIsInstance(result.filters[0], aversion.CacheFilter)
+        self.assertEqual(result.filters[0].etag, av.version_etag)
+        self.assertEqual(result.filters[0].cache_control, 'max-age=60')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version=None))
+    def test_call_cacheable_not_modified(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, version='vers_app',
+                               version_cacheable='on')
+        request = mock.Mock(headers={}, method='HEAD', environ={
+            'HTTP_IF_NONE_MATCH': av.version_etag,
+        })
+
+        result = av(request)
+
+        self.assertIs(result, av.not_modified)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version=None))
+    def test_call_cacheable_post(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, version='vers_app',
+                               version_cacheable='on')
+        request = mock.Mock(headers={}, method='POST', environ={
+            'HTTP_IF_NONE_MATCH': av.version_etag,
+        })
+
+        result = av(request)
+
+        self.assertEqual(result, 'vers_app')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype=None, version=None))
+    def test_call_noapp(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {})
+
+        result = av(request)
+
+        mock_process.assert_called_once_with(request)
+        self.assertFalse(request.get_response.called)
+        self.assertIsInstance(result, webob.exc.HTTPInternalServerError)
+        self.assertEqual(request.headers, {})
+        self.assertEqual(request.environ, {
+            'aversion.config': {
+                'versions': {},
+                'aliases': {},
+                'types': {},
+            },
+            'aversion.version': None,
+        })
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                orig_ctype='a/b'))
+    def test_call_app_fallback(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(**{
+            'headers': {},
+            'environ': {},
+            'get_response.return_value': 'response',
+        })
+        av = aversion.AVersion(loader, {})
+        av.version_app = 'fallback'
+        av.versions = dict(v2=dict(app='version2'))
+
+        result = av(request)
+
+        mock_process.assert_called_once_with(request)
+        self.assertFalse(request.get_response.called)
+        self.assertEqual(result, 'fallback')
+        self.assertEqual(request.headers, {'accept': 'a/a;q=1.0'})
+        self.assertEqual(request.environ, {
+            'aversion.config': {
+                'versions': {},
+                'aliases': {},
+                'types': {},
+            },
+            'aversion.version': None,
+            'aversion.response_type': 'a/a',
+            'aversion.orig_response_type': 'a/b',
+            'aversion.accept': None,
+        })
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                orig_ctype='a/b'))
+    def test_call_app_selected(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(**{
+            'headers': {},
+            'environ': {},
+            'get_response.return_value': 'response',
+        })
+        av = aversion.AVersion(loader, {})
+        av.version_app = 'fallback'
+        av.versions = dict(v1=dict(app='version1'))
+
+        result = av(request)
+
+        mock_process.assert_called_once_with(request)
+        self.assertFalse(request.get_response.called)
+        self.assertEqual(result, 'version1')
+        self.assertEqual(request.headers, {'accept': 'a/a;q=1.0'})
+        self.assertEqual(request.environ, {
+            'aversion.config': {
+                'versions': {},
+                'aliases': {},
+                'types': {},
+            },
+            'aversion.version': 'v1',
+            'aversion.response_type': 'a/a',
+            'aversion.orig_response_type': 'a/b',
+            'aversion.accept': None,
+        })
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1.1',
+                                                orig_ctype='a/b'))
+    def test_call_app_aliased(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(**{
+            'headers': {},
+            'environ': {},
+            'get_response.return_value': 'response',
+        })
+        av = aversion.AVersion(loader, {})
+        av.version_app = 'fallback'
+        av.versions = dict(v1=dict(app='version1'))
+        av.aliases = {'v1.1': dict(version='v1')}
+
+        result = av(request)
+
+        mock_process.assert_called_once_with(request)
+        self.assertFalse(request.get_response.called)
+        self.assertEqual(result, 'version1')
+        self.assertEqual(request.headers, {'accept': 'a/a;q=1.0'})
+        self.assertEqual(request.environ, {
+            'aversion.config': {
+                'versions': {},
+                'aliases': {},
+                'types': {},
+            },
+            'aversion.version': 'v1',
+            'aversion.response_type': 'a/a',
+            'aversion.orig_response_type': 'a/b',
+            'aversion.accept': None,
+        })
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                orig_ctype='a/b'))
+    def test_call_app_selected_nooverwrite(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(**{
+            'headers': {},
+            'environ': {},
+            'get_response.return_value': 'response',
+        })
+        av = aversion.AVersion(loader, {})
+        av.version_app = 'fallback'
+        av.versions = dict(v1=dict(app='version1'))
+        av.overwrite_headers = False
+
+        result = av(request)
+
+        mock_process.assert_called_once_with(request)
+        self.assertFalse(request.get_response.called)
+        self.assertEqual(result, 'version1')
+        self.assertEqual(request.headers, {})
+        self.assertEqual(request.environ, {
+            'aversion.config': {
+                'versions': {},
+                'aliases': {},
+                'types': {},
+            },
+            'aversion.version': 'v1',
+            'aversion.response_type': 'a/a',
+            'aversion.orig_response_type': 'a/b',
+            'aversion.accept': None,
+        })
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                orig_ctype='a/b'))
+    def test_call_app_selected_correct_ctype(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.versions = dict(v1=dict(app='version1'))
+        av.correct_response_type = True
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.ResponseFilter)
+        self.assertEqual(result.app, 'version1')
+        self.assertEqual(len(result.filters), 1)
+        self.assertIsInstance(result.filters[0], aversion.ContentTypeFilter)
+        self.assertEqual(result.filters[0].ctype, 'a/a')
+        self.assertEqual(result.filters[0].orig_ctype, 'a/b')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                vary=['Accept']))
+    def test_call_app_selected_vary(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.versions = dict(v1=dict(app='version1'))
+
+        result = av(request)
+
+        self.assertIsInstance(result, aversion.ResponseFilter)
+        self.assertEqual(result.app, 'version1')
+        self.assertEqual(len(result.filters), 1)
+        self.assertIsInstance(result.filters[0], aversion.VaryFilter)
+        self.assertEqual(result.filters[0].fields, ['Accept'])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                vary=['Accept']))
+    def test_call_app_selected_novary(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.versions = dict(v1=dict(app='version1'))
+        av.add_vary = False
+
+        result = av(request)
+
+        self.assertEqual(result, 'version1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                orig_ctype='a/a'))
+    def test_call_app_selected_correct_ctype_same(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.versions = dict(v1=dict(app='version1'))
+        av.correct_response_type = True
+
+        result = av(request)
+
+        self.assertEqual(result, 'version1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_process',
+                       return_value=fake_result(ctype='a/a', version='v1',
+                                                orig_ctype='a/b'))
+    def test_call_app_selected_compact(self, mock_process):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(**{
+            'headers': {},
+            'environ': {'HTTP_ACCEPT': 'a/b'},
+            'get_response.return_value': 'response',
+        })
+        av = aversion.AVersion(loader, {})
+        av.version_app = 'fallback'
+        av.versions = dict(v1=dict(app='version1'))
+        av.compact_environ = True
+
+        result = av(request)
+
+        mock_process.assert_called_once_with(request)
+        self.assertFalse(request.get_response.called)
+        self.assertEqual(result, 'version1')
+        self.assertEqual(request.headers, {'accept': 'a/a;q=1.0'})
+        self.assertEqual(sorted(request.environ.keys()),
+                         ['HTTP_ACCEPT', 'aversion.decision'])
+        decision = request.environ['aversion.decision']
+        self.assertIsInstance(decision, aversion.Decision)
+        self.assertEqual(decision.version, 'v1')
+        self.assertEqual(decision.response_type, 'a/a')
+        self.assertEqual(decision.orig_response_type, 'a/b')
+        self.assertEqual(decision.accept, 'a/b')
+        self.assertEqual(decision.config, {
+            'versions': {},
+            'aliases': {},
+            'types': {},
+        })
+
+    def _renegotiate_av(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, **{
+            'version.v1': 'vers_v1',
+            'version.v2': 'vers_v2',
+            'alias.v1.1': 'v1',
+        })
+        av.types = {
+            'a/a': mock.Mock(return_value=('a/v2', 'v2')),
+            'a/b': mock.Mock(return_value=('a/v1', 'v1.1')),
+        }
+        return av
+
+    def test_renegotiate_request_ctype(self):
+        av = self._renegotiate_av()
+        request = mock.Mock(headers={'content-type': 'a/v2'})
+        result = fake_result(request_ctype='a/v2', orig_request_ctype='a/a',
+                             request_header='a/a;v=2')
+
+        av._renegotiate(request, result, 'v1')
+
+        self.assertEqual(request.headers['content-type'], 'a/a;v=2')
+        self.assertEqual(result.request_ctype, None)
+        self.assertEqual(result.orig_request_ctype, None)
+        self.assertEqual(result.request_header, None)
+
+    def test_renegotiate_request_ctype_no_overwrite(self):
+        av = self._renegotiate_av()
+        av.overwrite_headers = False
+        request = mock.Mock(headers={'content-type': 'a/a;v=2'})
+        result = fake_result(request_ctype='a/v2', orig_request_ctype='a/a',
+                             request_header='a/a;v=2')
+
+        av._renegotiate(request, result, 'v1')
+
+        self.assertEqual(request.headers['content-type'], 'a/a;v=2')
+        self.assertEqual(result.request_ctype, None)
+
+    def test_renegotiate_suffix(self):
+        av = self._renegotiate_av()
+        request = mock.Mock(headers={})
+        result = fake_result(ctype='a/c',
+                             parsed_accept=(('a/b', {'_': 'a/b'}),))
+
+        av._renegotiate(request, result, 'v1')
+
+        self.assertEqual(result.ctype, 'a/c')
+        self.assertEqual(result.orig_ctype, None)
+        self.assertFalse(av.types['a/b'].called)
+
+    def test_renegotiate_candidate(self):
+        av = self._renegotiate_av()
+        request = mock.Mock(headers={})
+        result = fake_result(ctype='a/v2', orig_ctype='a/a', parsed_accept=(
+            ('a/a', {'_': 'a/a', 'q': '0.8'}),
+            ('a/*', {'_': 'a/*', 'q': '0.5'}),
+        ))
+
+        av._renegotiate(request, result, 'v1')
+
+        self.assertEqual(result.ctype, 'a/v1')
+        self.assertEqual(result.orig_ctype, 'a/b')
+        av.types['a/b'].assert_called_once_with({'_': 'a/*', 'q': '0.5'})
+
+    def test_renegotiate_no_candidate(self):
+        av = self._renegotiate_av()
+        request = mock.Mock(headers={})
+        result = fake_result(ctype='a/v2', orig_ctype='a/a', parsed_accept=(
+            ('a/a', {'_': 'a/a'}),
+            ('a/b', {'_': 'a/b', 'q': '0'}),
+        ))
+
+        av._renegotiate(request, result, 'v1')
+
+        self.assertEqual(result.ctype, None)
+        self.assertEqual(result.orig_ctype, None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion, 'Result', return_value='result')
+    @mock.patch.object(aversion.AVersion, '_proc_uri')
+    @mock.patch.object(aversion.AVersion, '_proc_ctype_header')
+    @mock.patch.object(aversion.AVersion, '_proc_accept_header')
+    @mock.patch.object(aversion.AVersion, '_proc_accept_encoding_header')
+    @mock.patch.object(aversion.AVersion, '_proc_negotiate')
+    def test_process_with_result(self, mock_proc_negotiate,
+                                 mock_proc_accept_encoding_header,
+                                 mock_proc_accept_header,
+                                 mock_proc_ctype_header, mock_proc_uri,
+                                 mock_Result):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {})
+
+        result = av._process('request', '')
+
+        self.assertFalse(mock_Result.called)
+        mock_proc_uri.assert_called_once_with('request', '')
+        mock_proc_ctype_header.assert_called_once_with('request', '')
+        mock_proc_accept_header.assert_called_once_with('request', '')
+        mock_proc_accept_encoding_header.assert_called_once_with(
+            'request', '')
+        mock_proc_negotiate.assert_called_once_with('request', '')
+        self.assertEqual(result, '')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion, 'Result', return_value='result')
+    @mock.patch.object(aversion.AVersion, '_proc_uri')
+    @mock.patch.object(aversion.AVersion, '_proc_ctype_header')
+    @mock.patch.object(aversion.AVersion, '_proc_accept_header')
+    @mock.patch.object(aversion.AVersion, '_proc_accept_encoding_header')
+    @mock.patch.object(aversion.AVersion, '_proc_negotiate')
+    def test_process_without_result(self, mock_proc_negotiate,
+                                    mock_proc_accept_encoding_header,
+                                    mock_proc_accept_header,
+                                    mock_proc_ctype_header, mock_proc_uri,
+                                    mock_Result):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {})
+
+        result = av._process('request')
+
+        mock_Result.assert_called_once_with()
+        mock_proc_uri.assert_called_once_with('request', 'result')
+        mock_proc_ctype_header.assert_called_once_with('request', 'result')
+        mock_proc_accept_header.assert_called_once_with('request', 'result')
+        mock_proc_accept_encoding_header.assert_called_once_with(
+            'request', 'result')
+        mock_proc_negotiate.assert_called_once_with('request', 'result')
+        self.assertEqual(result, 'result')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    def test_proc_uri_filled_result(self, mock_set_version, mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(path_info='/v1/.a', script_name='')
+        av = aversion.AVersion(loader, {})
+        av.uris = [('/v1', 'v1')]
+        av.formats = {'.a': 'a/a'}
+        result = aversion.Result()
+        result.ctype = 'a/b'
+        result.version = 'v2'
+
+        av._proc_uri(request, result)
+
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_uri_basic(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(path_info='/v1/.a', script_name='')
+        av = aversion.AVersion(loader, {})
+        av.uris = [('/v1', 'v1')]
+        av.formats = {'.a': 'a/a'}
+        result = aversion.Result()
+
+        av._proc_uri(request, result)
+
+        self.assertEqual(result.ctype, 'a/a')
+        self.assertEqual(result.version, 'v1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_uri_empties_uri(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(path_info='/v1', script_name='')
+        av = aversion.AVersion(loader, {})
+        av.uris = [('/v1', 'v1')]
+        av.formats = {'.a': 'a/a'}
+        result = aversion.Result()
+
+        av._proc_uri(request, result)
+
+        self.assertEqual(result.ctype, None)
+        self.assertEqual(result.version, 'v1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_uri_nomatch(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(path_info='/v2/.b', script_name='')
+        av = aversion.AVersion(loader, {})
+        av.uris = [('/v1', 'v1')]
+        av.formats = {'.a': 'a/a'}
+        result = aversion.Result()
+
+        av._proc_uri(request, result)
+
+        self.assertEqual(result.ctype, None)
+        self.assertEqual(result.version, None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    @mock.patch.object(aversion, 'parse_ctype',
+                       return_value=('a/a', {'v': '1'}))
+    def test_proc_ctype_header_filled_result(self, mock_parse_ctype,
+                                             mock_set_version, mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'content-type': 'a/b'}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+        result.ctype = 'a/d'
+        result.version = 'v3'
+
+        av._proc_ctype_header(request, result)
+
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+        self.assertFalse(mock_parse_ctype.called)
+        self.assertFalse(av.types['a/a'].called)
+        self.assertEqual(request.environ, {})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    @mock.patch.object(aversion, 'parse_ctype',
+                       return_value=('a/a', {'v': '1'}))
+    def test_proc_ctype_header_no_ctype(self, mock_parse_ctype,
+                                        mock_set_version, mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_ctype_header(request, result)
+
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+        self.assertFalse(mock_parse_ctype.called)
+        self.assertFalse(av.types['a/a'].called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    @mock.patch.object(aversion, 'parse_ctype',
+                       return_value=('a/a', {'v': '1'}))
+    def test_proc_ctype_header_missing_ctype(self, mock_parse_ctype,
+                                             mock_set_version, mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'content-type': 'a/b'})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/b': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_ctype_header(request, result)
+
+        mock_parse_ctype.assert_called_once_with('a/b', None)
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+        self.assertFalse(av.types['a/b'].called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion, 'parse_ctype',
+                       return_value=('a/a', {'v': '1'}))
+    def test_proc_ctype_header_basic(self, mock_parse_ctype, mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'content-type': 'a/b'}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_ctype_header(request, result)
+
+        mock_parse_ctype.assert_called_once_with('a/b', None)
+        av.types['a/a'].assert_called_once_with({'v': '1'})
+        self.assertEqual(request.headers, {'content-type': 'a/c'})
+        self.assertEqual(request.environ, {})
+        self.assertEqual(result.parsed_ctype, ('a/a', {'v': '1'}))
+        self.assertIsInstance(result.parsed_ctype[1], aversion.FrozenParams)
+        self.assertEqual(result.request_ctype, 'a/c')
+        self.assertEqual(result.orig_request_ctype, 'a/a')
+        self.assertEqual(result.request_header, 'a/b')
+        self.assertFalse(mock_set_ctype.called)
+        self.assertEqual(result.version, 'v2')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion, 'parse_ctype',
+                       return_value=('a/a', {'v': '1'}))
+    def test_proc_ctype_header_basic_nooverwrite(self, mock_parse_ctype,
+                                                 mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'content-type': 'a/b'}, environ={})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        av.overwrite_headers = False
+        result = aversion.Result()
+
+        av._proc_ctype_header(request, result)
+
+        mock_parse_ctype.assert_called_once_with('a/b', None)
+        av.types['a/a'].assert_called_once_with({'v': '1'})
+        self.assertEqual(request.headers, {'content-type': 'a/b'})
+        self.assertEqual(request.environ, {})
+        self.assertEqual(result.request_ctype, 'a/c')
+        self.assertEqual(result.orig_request_ctype, 'a/a')
+        self.assertEqual(result.request_header, 'a/b')
+        self.assertFalse(mock_set_ctype.called)
+        self.assertEqual(result.version, 'v2')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    @mock.patch.object(aversion, 'parse_ctype',
+                       return_value=('a/a', {'v': '1'}))
+    def test_proc_ctype_header_nomap(self, mock_parse_ctype,
+                                     mock_set_version, mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'content-type': 'a/b'})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('', ''))}
+        result = aversion.Result()
+
+        av._proc_ctype_header(request, result)
+
+        mock_parse_ctype.assert_called_once_with('a/b', None)
+        av.types['a/a'].assert_called_once_with({'v': '1'})
+        self.assertEqual(request.headers, {'content-type': 'a/b'})
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_check_request_ctype')
+    def test_process_strict_content_type(self, mock_check_request_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {}, process_order='uri accept')
+        result = aversion.Result()
+        result.ctype = 'a/d'
+        result.version = 'v3'
+
+        av._process(request, result)
+        self.assertFalse(mock_check_request_ctype.called)
+
+        # Checked even though the Content-Type rules are not processed
+        av.strict_content_type = True
+        av._process(request, result)
+        mock_check_request_ctype.assert_called_once_with(request)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.AVersion, '_check_accept')
+    def test_process_strict_accept(self, mock_check_accept):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {}, process_order='uri ctype')
+        result = aversion.Result()
+        result.ctype = 'a/d'
+        result.version = 'v3'
+
+        av._process(request, result)
+        self.assertFalse(mock_check_accept.called)
+
+        # Checked even though the Accept rules are not processed
+        av.strict_accept = True
+        av._process(request, result)
+        mock_check_accept.assert_called_once_with(request, result)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_header_limit_ignore(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {})
+
+        self.assertRaises(aversion.HeaderLimitExceeded, av._header_limit,
+                          'accept')
+        self.assertEqual(av.limited_headers.snapshot(), {'accept': 1})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_header_limit_reject(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, header_limit_action='reject')
+
+        with self.assertRaises(aversion.ShortCircuit) as cm:
+            av._header_limit('accept')
+
+        self.assertIs(cm.exception.app, av.header_too_large)
+        self.assertEqual(av.limited_headers.snapshot(), {'accept': 1})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_parse_ctype_header(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, max_header_length='10',
+                               max_type_params='1')
+
+        self.assertEqual(av._parse_ctype_header('a/b;c=d'),
+                         ('a/b', {'_': 'a/b', 'c': 'd'}))
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          av._parse_ctype_header, 'a/b;c=d;e')
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          av._parse_ctype_header, 'a/b;c=ddddd')
+        self.assertEqual(av.limited_headers.snapshot(), {'content-type': 2})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_parse_accept_header(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, max_header_length='10',
+                               max_media_ranges='2')
+
+        self.assertEqual(av._parse_accept_header('a/b,a/c'),
+                         (('a/b', {'_': 'a/b'}), ('a/c', {'_': 'a/c'})))
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          av._parse_accept_header, 'a/b,a/c,*')
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          av._parse_accept_header, 'a/b,a/ccccc')
+        self.assertEqual(av.limited_headers.snapshot(), {'accept': 2})
+
+        # Parsed headers are cached
+        self.assertIs(av._parse_accept_header('a/b,a/c'),
+                      av._parse_accept_header('a/b,a/c'))
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_ctype_header_limited(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'content-type': 'a/a;b;c'})
+        av = aversion.AVersion(loader, {}, max_type_params='1')
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_ctype_header(request, result)
+
+        self.assertFalse(av.types['a/a'].called)
+        self.assertEqual(result.version, None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_best_encoding(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, compress='gzip',
+                               max_header_length='10', max_media_ranges='2')
+
+        self.assertEqual(av._best_encoding('br, gzip'), 'gzip')
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          av._best_encoding, 'br, gzip, *')
+        self.assertRaises(aversion.HeaderLimitExceeded,
+                          av._best_encoding, 'gzip;q=0.5000')
+        self.assertEqual(av.limited_headers.snapshot(),
+                         {'accept-encoding': 2})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_accept_encoding_header(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept-encoding': 'deflate, gzip'})
+        av = aversion.AVersion(loader, {}, compress='deflate gzip')
+        result = aversion.Result()
+
+        av._proc_accept_encoding_header(request, result)
+
+        self.assertEqual(result.encoding, 'deflate')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_accept_encoding_header_disabled(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept-encoding': 'gzip'})
+        av = aversion.AVersion(loader, {})
+        result = aversion.Result()
+
+        av._proc_accept_encoding_header(request, result)
+
+        self.assertEqual(result.encoding, None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_accept_encoding_header_limited(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept-encoding': 'br, gzip'})
+        av = aversion.AVersion(loader, {}, compress='gzip',
+                               max_media_ranges='1')
+        result = aversion.Result()
+
+        av._proc_accept_encoding_header(request, result)
+
+        self.assertEqual(result.encoding, None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_version_selection(self, mock_warn):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+
+        av = aversion.AVersion(loader, {}, version_header=' Accept-Version',
+                               version_param='api-version',
+                               process_order='Header accept spam uri')
+
+        self.assertEqual(av.version_header, 'Accept-Version')
+        self.assertEqual(av.version_header_key, 'HTTP_ACCEPT_VERSION')
+        self.assertEqual(av.version_param, 'api-version')
+        self.assertEqual(av.process_order, ['_proc_version_header',
+                                            '_proc_accept_header',
+                                            '_proc_uri'])
+        mock_warn.assert_called_once_with(
+            "Unknown processing stage 'spam' for key 'process_order'")
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_process_order(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, process_order='query accept')
+        calls = []
+        for stage in ('_proc_uri', '_proc_version_header',
+                      '_proc_version_param', '_proc_ctype_header',
+                      '_proc_accept_header', '_proc_accept_encoding_header',
+                      '_proc_negotiate'):
+            setattr(av, stage, functools.partial(
+                lambda stage, request, result: calls.append(stage), stage))
+
+        av._process('request', 'result')
+
+        self.assertEqual(calls, ['_proc_version_param', '_proc_accept_header',
+                                 '_proc_accept_encoding_header',
+                                 '_proc_negotiate'])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_version_header(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, version_header='Accept-Version')
+        av.versions = {'v2': {}}
+        av.aliases = {'2': {'version': 'v2'}}
+
+        for value, expected in (('2', '2'), (' v2 ', 'v2'), ('3', None),
+                                ('', None)):
+            request = mock.Mock(environ={'HTTP_ACCEPT_VERSION': value})
+            result = aversion.Result()
+
+            av._proc_version_header(request, result)
+
+            self.assertEqual(result.version, expected)
+            self.assertEqual(result.vary, ['Accept-Version'])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_version_header_determined(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(environ={'HTTP_ACCEPT_VERSION': 'v2'})
+        av = aversion.AVersion(loader, {}, version_header='Accept-Version')
+        av.versions = {'v1': {}, 'v2': {}}
+        result = aversion.Result()
+        result.version = 'v1'
+
+        av._proc_version_header(request, result)
+
+        self.assertEqual(result.version, 'v1')
+        self.assertEqual(result.vary, [])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_version_header_unconfigured(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(environ={'HTTP_ACCEPT_VERSION': 'v2'})
+        av = aversion.AVersion(loader, {})
+        av.versions = {'v2': {}}
+        result = aversion.Result()
+
+        av._proc_version_header(request, result)
+
+        self.assertEqual(result.version, None)
+        self.assertEqual(result.vary, [])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_version_param(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, version_param='api-version')
+        av.versions = {'v2': {}}
+        av.aliases = {'2': {'version': 'v2'}}
+
+        for query, expected in (('a=b&api-version=2', '2'),
+                                ('api-version=v2', 'v2'),
+                                ('api-version=3', None), ('', None)):
+            request = mock.Mock(environ={'QUERY_STRING': query})
+            result = aversion.Result()
+
+            av._proc_version_param(request, result)
+
+            self.assertEqual(result.version, expected)
+            self.assertEqual(result.vary, [])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_version_param_determined(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(environ={'QUERY_STRING': 'api-version=v2'})
+        av = aversion.AVersion(loader, {}, version_param='api-version')
+        av.versions = {'v1': {}, 'v2': {}}
+        result = aversion.Result()
+        result.version = 'v1'
+
+        av._proc_version_param(request, result)
+
+        self.assertEqual(result.version, 'v1')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_negotiate(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept-language': 'fr, en;q=0.5'})
+        av = aversion.AVersion(loader, {}, languages='en fr',
+                               charsets='utf-8 iso-8859-1')
+        result = aversion.Result()
+
+        av._proc_negotiate(request, result)
+
+        self.assertEqual(result.language, 'fr')
+        self.assertEqual(result.charset, 'utf-8')
+        self.assertEqual(result.vary, ['Accept-Language', 'Accept-Charset'])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_negotiate_unacceptable(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept-charset': 'ascii'})
+        av = aversion.AVersion(loader, {}, charsets='utf-8')
+        result = aversion.Result()
+
+        av._proc_negotiate(request, result)
+
+        self.assertEqual(result.charset, None)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_negotiate_limited(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept-language': 'fr, de, en'})
+        av = aversion.AVersion(loader, {}, languages='en fr',
+                               max_header_length='5')
+        result = aversion.Result()
+
+        av._proc_negotiate(request, result)
+
+        self.assertEqual(result.language, 'en')
+        self.assertEqual(av.limited_headers.snapshot(),
+                         {'accept-language': 1})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_negotiate_limited_reject(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept-language': 'fr, de, en'})
+        av = aversion.AVersion(loader, {}, languages='en fr',
+                               max_media_ranges='2',
+                               header_limit_action='reject')
+        result = aversion.Result()
+
+        with self.assertRaises(aversion.ShortCircuit) as cm:
+            av._proc_negotiate(request, result)
+
+        self.assertIs(cm.exception.app, av.header_too_large)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_accept_header_limited(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept': 'a/b,a/a'})
+        av = aversion.AVersion(loader, {}, max_media_ranges='1')
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_accept_header(request, result)
+
+        self.assertFalse(av.types['a/a'].called)
+        self.assertEqual(result.version, None)
+        self.assertEqual(result.ctype, None)
+
+    def _check_ctype(self, **environ):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(environ=environ)
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': 'rule'}
+        av._check_request_ctype(request)
+        return av
+
+    def test_check_request_ctype_nobody(self):
+        av = self._check_ctype(CONTENT_TYPE='b/b')
+
+        self.assertEqual(av.rejected_types.snapshot(), {})
+
+    def test_check_request_ctype_empty_body(self):
+        av = self._check_ctype(CONTENT_TYPE='b/b', CONTENT_LENGTH='0')
+
+        self.assertEqual(av.rejected_types.snapshot(), {})
+
+    def test_check_request_ctype_bad_length(self):
+        av = self._check_ctype(CONTENT_TYPE='b/b', CONTENT_LENGTH='bad')
+
+        self.assertEqual(av.rejected_types.snapshot(), {})
+
+    def test_check_request_ctype_recognized(self):
+        av = self._check_ctype(CONTENT_TYPE='a/a; charset=utf-8',
+                               CONTENT_LENGTH='10')
+
+        self.assertEqual(av.rejected_types.snapshot(), {})
+
+    def test_check_request_ctype_unrecognized(self):
+        with self.assertRaises(aversion.ShortCircuit) as cm:
+            self._check_ctype(CONTENT_TYPE='b/b; charset=utf-8',
+                              CONTENT_LENGTH='10')
+
+        self.assertEqual(cm.exception.app.status,
+                         '415 Unsupported Media Type')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_check_request_ctype_limited(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(environ=dict(CONTENT_TYPE='a/a;b;c',
+                                         CONTENT_LENGTH='10'))
+        av = aversion.AVersion(loader, {}, max_type_params='1')
+        av.types = {'a/a': 'rule'}
+
+        self.assertRaises(aversion.ShortCircuit,
+                          av._check_request_ctype, request)
+
+        self.assertEqual(av.rejected_types.snapshot(), {'<other>': 1})
+
+    def test_check_request_ctype_chunked_missing(self):
+        with self.assertRaises(aversion.ShortCircuit) as cm:
+            self._check_ctype(HTTP_TRANSFER_ENCODING='Chunked')
+
+        self.assertEqual(cm.exception.app.status,
+                         '415 Unsupported Media Type')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_check_request_ctype_counted(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(environ=dict(CONTENT_TYPE='b/b',
+                                         CONTENT_LENGTH='10'))
+        av = aversion.AVersion(loader, {})
+
+        for i in range(3):
+            self.assertRaises(aversion.ShortCircuit,
+                              av._check_request_ctype, request)
+
+        self.assertEqual(av.rejected_types.snapshot(), {'b/b': 3})
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    @mock.patch.object(aversion, '_rank_matches',
+                       return_value=[('a/a', 'v1')])
+    def test_proc_accept_header_filled_result(self, mock_rank_matches,
+                                              mock_set_version,
+                                              mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept': 'a/b'})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+        result.ctype = 'a/d'
+        result.version = 'v3'
+
+        av._proc_accept_header(request, result)
+
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+        self.assertFalse(mock_rank_matches.called)
+        self.assertFalse(av.types['a/a'].called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    @mock.patch.object(aversion, '_rank_matches',
+                       return_value=[('a/a', 'v1')])
+    def test_proc_accept_header_no_accept(self, mock_rank_matches,
+                                          mock_set_version, mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_accept_header(request, result)
+
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+        self.assertFalse(mock_rank_matches.called)
+        self.assertFalse(av.types['a/a'].called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    @mock.patch.object(aversion, '_rank_matches', return_value=[])
+    def test_proc_accept_header_missing_ctype(self, mock_rank_matches,
+                                              mock_set_version,
+                                              mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept': 'a/b'})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/b': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_accept_header(request, result)
+
+        mock_rank_matches.assert_called_once_with(
+            (('a/b', {'_': 'a/b'}),), mock.ANY, aversion.match_media_range)
+        self.assertEqual(list(mock_rank_matches.call_args[0][1]), ['a/b'])
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+        self.assertFalse(av.types['a/b'].called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion, '_rank_matches',
+                       return_value=[('a/a', 'v1')])
+    def test_proc_accept_header_basic(self, mock_rank_matches):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept': 'a/b'})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_accept_header(request, result)
+
+        mock_rank_matches.assert_called_once_with(
+            (('a/b', {'_': 'a/b'}),), mock.ANY, aversion.match_media_range)
+        self.assertEqual(list(mock_rank_matches.call_args[0][1]), ['a/a'])
+        av.types['a/a'].assert_called_once_with('v1')
+        self.assertEqual(result.parsed_accept, (('a/b', {'_': 'a/b'}),))
+        self.assertEqual(result.ctype, 'a/c')
+        self.assertEqual(result.version, 'v2')
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion.Result, 'set_ctype')
+    @mock.patch.object(aversion.Result, 'set_version')
+    @mock.patch.object(aversion, '_rank_matches',
+                       return_value=[('a/a', 'v1')])
+    def test_proc_accept_header_nomap(self, mock_rank_matches,
+                                      mock_set_version, mock_set_ctype):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept': 'a/b'})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('', ''))}
+        result = aversion.Result()
+
+        av._proc_accept_header(request, result)
+
+        mock_rank_matches.assert_called_once_with(
+            (('a/b', {'_': 'a/b'}),), mock.ANY, aversion.match_media_range)
+        self.assertEqual(list(mock_rank_matches.call_args[0][1]), ['a/a'])
+        av.types['a/a'].assert_called_once_with('v1')
+        self.assertFalse(mock_set_version.called)
+        self.assertFalse(mock_set_ctype.called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion, '_rank_matches',
+                       return_value=[('a/a', 'v1'), ('a/b', 'v2')])
+    def test_proc_accept_header_candidates(self, mock_rank_matches):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept': 'a/b'})
+        av = aversion.AVersion(loader, {})
+        av.types = {
+            'a/a': mock.Mock(return_value=('a/c', 'v2')),
+            'a/b': mock.Mock(return_value=('a/d', 'v1')),
+        }
+        result = aversion.Result()
+
+        av._proc_accept_header(request, result)
+
+        self.assertEqual(result.version, 'v2')
+        self.assertEqual(result.candidates, [('a/b', 'v2')])
+        self.assertFalse(av.types['a/b'].called)
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    @mock.patch.object(aversion, '_rank_matches',
+                       return_value=[('a/a', 'v1'), ('a/b', 'v2')])
+    def test_proc_accept_header_candidates_partial(self, mock_rank_matches):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept': 'a/b'})
+        av = aversion.AVersion(loader, {})
+        av.types = {
+            'a/a': mock.Mock(return_value=('a/c', 'v2')),
+            'a/b': mock.Mock(return_value=('a/d', 'v1')),
+        }
+        result = aversion.Result()
+        result.ctype = 'a/e'
+
+        av._proc_accept_header(request, result)
+
+        self.assertEqual(result.version, 'v2')
+        self.assertEqual(result.candidates, [])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_ctype_header_vary(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+
+        av._proc_ctype_header(request, result)
+
+        self.assertEqual(result.vary, ['Content-Type'])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_ctype_header_vary_version_set(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+        result.version = 'v1'
+
+        av._proc_ctype_header(request, result)
+
+        self.assertEqual(result.vary, [])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_ctype_header_vary_notypes(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {})
+        result = aversion.Result()
+
+        av._proc_ctype_header(request, result)
+
+        self.assertEqual(result.vary, [])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_accept_header_vary(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+        result.version = 'v1'
+
+        av._proc_accept_header(request, result)
+
+        self.assertEqual(result.vary, ['Accept'])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_accept_header_vary_filled_result(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={'accept': 'a/a'})
+        av = aversion.AVersion(loader, {})
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        result = aversion.Result()
+        result.version = 'v1'
+        result.ctype = 'a/b'
+
+        av._proc_accept_header(request, result)
+
+        self.assertEqual(result.vary, [])
+
+    @mock.patch.object(aversion, 'TypeRule', FakeTypeRule)
+    def test_proc_accept_header_vary_notypes(self):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        request = mock.Mock(headers={})
+        av = aversion.AVersion(loader, {})
+        result = aversion.Result()
+
+        av._proc_accept_header(request, result)
+
+        self.assertEqual(result.vary, [])
+
+    def _strict_av(self, **kwargs):
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: x})
+        av = aversion.AVersion(loader, {}, strict_accept='on', **kwargs)
+        av.types = {'a/a': mock.Mock(return_value=('a/c', 'v2'))}
+        av.acceptable = ['a/a', 'a/b']
+        return av
+
+    def _strict_process(self, av, request, result):
+        av._proc_accept_header(request, result)
+        av._check_accept(request, result)
+
+    def test_check_accept_match(self):
+        request = mock.Mock(headers={'accept': 'a/*'})
+        av = self._strict_av()
+        result = aversion.Result()
+
+        self._strict_process(av, request, result)
+
+        self.assertEqual(result.ctype, 'a/c')
+
+    def test_check_accept_suffix_type(self):
+        request = mock.Mock(headers={'accept': 'a/b'})
+        av = self._strict_av()
+        result = aversion.Result()
+
+        self._strict_process(av, request, result)
+
+        self.assertEqual(result.ctype, None)
+
+    def test_check_accept_suffix_selected(self):
+        request = mock.Mock(headers={'accept': 'b/b'})
+        av = self._strict_av()
+        result = aversion.Result()
+        result.ctype = 'a/b'
+
+        self._strict_process(av, request, result)
+
+        self.assertEqual(result.ctype, 'a/b')
+
+    def test_check_accept_empty(self):
+        request = mock.Mock(headers={'accept': ' '})
+        av = self._strict_av()
+        result = aversion.Result()
+
+        self._strict_process(av, request, result)
+
+        self.assertEqual(result.ctype, None)
+
+    def test_check_accept_mismatch(self):
+        request = mock.Mock(headers={'accept': 'b/b'})
+        av = self._strict_av()
+        result = aversion.Result()
+
+        with self.assertRaises(aversion.ShortCircuit) as cm:
+            self._strict_process(av, request, result)
+
+        self.assertIs(cm.exception.app, av.not_acceptable)
+
+    def test_check_accept_nothing_configured(self):
+        request = mock.Mock(headers={'accept': 'b/b'})
+        av = self._strict_av()
+        av.types = {}
+        av.acceptable = []
+        result = aversion.Result()
+
+        self._strict_process(av, request, result)
+
+        self.assertEqual(result.ctype, None)
+
+    def test_check_accept_stage_omitted(self):
+        request = mock.Mock(headers={'accept': 'b/b'})
+        av = self._strict_av(process_order='uri')
+        result = aversion.Result()
+
+        with self.assertRaises(aversion.ShortCircuit) as cm:
+            av._check_accept(request, result)
+
+        self.assertIs(cm.exception.app, av.not_acceptable)
+
+    def test_check_accept_stage_omitted_match(self):
+        request = mock.Mock(headers={'accept': 'a/b'})
+        av = self._strict_av(process_order='uri')
+        result = aversion.Result()
+
+        av._check_accept(request, result)
+
+    @mock.patch.object(aversion.AVersion, '_parse_accept_header')
+    def test_check_accept_limited(self, mock_parse_accept_header):
+        request = mock.Mock(headers={'accept': 'b/b'})
+        av = self._strict_av()
+        result = aversion.Result()
+
+        # The Accept header rules ignored the header
+        av._check_accept(request, result)
+
+        self.assertFalse(mock_parse_accept_header.called)
+
+
+class FakeApplication(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, environ, start_response):
+        start_response('200 OK', [])
+        yield self.name.encode('ascii')
+
+
+class FakeUpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_request(self):
+        length = int(self.headers.get('content-length') or 0)
+        body = json.dumps(dict(
+            method=self.command,
+            path=self.path,
+            accept=self.headers.get('accept'),
+            forwarded_for=self.headers.get('x-forwarded-for'),
+            body=self.rfile.read(length).decode('utf-8'),
+        )).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'a=1')
+        self.send_header('Set-Cookie', 'b=2')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_request
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeUpstream(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeUpstreamHandler)
+        self.connections = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# Used for comparing the environment and headers dictionaries
+ANY = object()
+NOTPRESENT = object()
+
+
+class FunctionalTest(unittest2.TestCase):
+    def construct_stack(self, conf, **versions):
+        # Construct all the version applications
+        apps = {}
+        for version, params in versions.items():
+            app_key = '%s_app' % version
+            conf_key = ('version' if version == 'version' else
+                        'version.%s' % version)
+            apps[app_key] = FakeApplication(version)
+            conf[conf_key] = app_key
+
+            # Add parameters
+            if params:
+                conf[conf_key] += ' ' + ' '.join('%s="%s"' % (k, v)
+                                                 for k, v in params.items())
+
+        # Set up a loader
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: apps[x]})
+
+        # Set up the stack and return it
+        return aversion.AVersion(loader, {}, **conf)
+
+    def make_request(self, path, base_url=None,
+                     content_type=None, accept=None):
+        # Build the headers for the request
+        headers = {}
+        if content_type:
+            headers['content-type'] = content_type
+        if accept:
+            headers['accept'] = accept
+
+        # Build and return the request object
+        return webob.Request.blank(path, base_url=base_url, headers=headers)
+
+    def assertPartialDict(self, actual, expected):
+        for key, value in expected.items():
+            if value == NOTPRESENT:
+                self.assertNotIn(key, actual,
+                                 msg="Value for key %r present" % key)
+                continue
+
+            self.assertIn(key, actual, msg="No value for key %r" % key)
+
+            if value == ANY:
+                continue
+
+            if isinstance(value, dict):
+                self.assertPartialDict(actual[key], value)
+            else:
+                self.assertEqual(actual[key], value,
+                                 msg="Value mismatch for key %r" % key)
+
+    def test_assert_partial_dict(self):
+        # Check that NOTPRESENT requires the key to not be present
+        self.assertRaises(AssertionError, self.assertPartialDict,
+                          dict(a=1), dict(a=NOTPRESENT))
+
+        # Check that other than NOTPRESENT requires the key to be
+        # present
+        self.assertRaises(AssertionError, self.assertPartialDict,
+                          {}, dict(a=1))
+
+        # Check that value mismatch is caught
+        self.assertRaises(AssertionError, self.assertPartialDict,
+                          dict(a=1), dict(a=2))
+
+        # Check that ANY allows any value in that location
+        self.assertPartialDict(dict(a=1), dict(a=ANY))
+        self.assertPartialDict(dict(a=2), dict(a=ANY))
+
+        # Check that recursion works properly
+        self.assertRaises(AssertionError, self.assertPartialDict,
+                          dict(a=dict(b=dict(c=1))),
+                          dict(a=dict(b=dict(c=2))))
+        self.assertPartialDict(dict(a=dict(b=dict(c=1))),
+                               dict(a=dict(b=dict(c=1))))
+
+    def test_no_matching_app(self):
+        conf = {
+            'uri./v1': 'version1',
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf, version1=dict(v='v1'),
+                                     version2=dict(v='v2'))
+        req = self.make_request('/')
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 500)
+        self.assertIn(b"Cannot determine application to serve request",
+                      resp.body)
+        self.assertEqual(req.script_name, '')
+        self.assertEqual(req.path_info, '/')
+        self.assertPartialDict(req.environ, {
+            'aversion.config': {
+                'versions': {
+                    'version1': {
+                        'name': 'version1',
+                        'app': ANY,
+                        'params': dict(v='v1'),
+                        'prefixes': ['/v1'],
+                    },
+                    'version2': {
+                        'name': 'version2',
+                        'app': ANY,
+                        'params': dict(v='v2'),
+                        'prefixes': ['/v2'],
+                    },
+                },
+                'aliases': {},
+                'types': {},
+            },
+            'aversion.response_type': NOTPRESENT,
+            'aversion.orig_response_type': NOTPRESENT,
+            'aversion.accept': NOTPRESENT,
+            'aversion.request_type': NOTPRESENT,
+            'aversion.orig_request_type': NOTPRESENT,
+            'aversion.content_type': NOTPRESENT,
+            'aversion.version': None,
+        })
+        self.assertPartialDict(req.headers, {
+            'content-type': NOTPRESENT,
+            'accept': NOTPRESENT,
+        })
+
+    def test_default_app(self):
+        conf = {
+            'uri./v1': 'version1',
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf, version={},
+                                     version1=dict(v='v1'),
+                                     version2=dict(v='v2'))
+        req = self.make_request('/')
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b'version', resp.body)
+        self.assertEqual(req.script_name, '')
+        self.assertEqual(req.path_info, '/')
         self.assertPartialDict(req.environ, {
             'aversion.config': {
                 'versions': {
@@ -1340,7 +6845,7 @@ class FunctionalTest(unittest2.TestCase):
         resp = req.get_response(stack)
 
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version1", resp.body)
+        self.assertEqual(b'version1', resp.body)
         self.assertEqual(req.script_name, '/v1')
         self.assertEqual(req.path_info, '/')
         self.assertPartialDict(req.environ, {
@@ -1388,7 +6893,7 @@ class FunctionalTest(unittest2.TestCase):
         resp = req.get_response(stack)
 
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version2", resp.body)
+        self.assertEqual(b'version2', resp.body)
         self.assertEqual(req.script_name, '/v2')
         self.assertEqual(req.path_info, '/foo')
         self.assertPartialDict(req.environ, {
@@ -1438,7 +6943,7 @@ class FunctionalTest(unittest2.TestCase):
         resp = req.get_response(stack)
 
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version1", resp.body)
+        self.assertEqual(b'version1', resp.body)
         self.assertEqual(req.script_name, '/v1')
         self.assertEqual(req.path_info, '/')
         self.assertPartialDict(req.environ, {
@@ -1499,7 +7004,7 @@ class FunctionalTest(unittest2.TestCase):
         resp = req.get_response(stack)
 
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version2", resp.body)
+        self.assertEqual(b'version2', resp.body)
         self.assertEqual(req.script_name, '/v1.1')
         self.assertEqual(req.path_info, '/')
         self.assertPartialDict(req.environ, {
@@ -1555,7 +7060,7 @@ class FunctionalTest(unittest2.TestCase):
         resp = req.get_response(stack)
 
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version1", resp.body)
+        self.assertEqual(b'version1', resp.body)
         self.assertEqual(req.script_name, '')
         self.assertEqual(req.path_info, '/')
         self.assertPartialDict(req.environ, {
@@ -1617,7 +7122,7 @@ class FunctionalTest(unittest2.TestCase):
         resp = req.get_response(stack)
 
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version2", resp.body)
+        self.assertEqual(b'version2', resp.body)
         self.assertEqual(req.script_name, '')
         self.assertEqual(req.path_info, '/')
         self.assertPartialDict(req.environ, {
@@ -1665,11 +7170,253 @@ class FunctionalTest(unittest2.TestCase):
             'aversion.version': 'version2',
         })
         self.assertPartialDict(req.headers, {
-            'content-type': 'application/xml',
-            'accept': NOTPRESENT,
+            'content-type': 'application/xml',
+            'accept': NOTPRESENT,
+        })
+
+    def test_version2_app_ctypematch_typerewrite(self):
+        conf = {
+            'type.application/vnd.spam': ('version:"version%(v)s" '
+                                          'type:"application/%(x)s" '
+                                          'param:type="spam"'),
+        }
+        stack = self.construct_stack(conf, version={},
+                                     version1=dict(v='v1'),
+                                     version2=dict(v='v2'))
+        ctype = 'application/vnd.spam;v=2;x="xml";y=42'
+        req = self.make_request('/', content_type=ctype)
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b'version2', resp.body)
+        self.assertEqual(req.script_name, '')
+        self.assertEqual(req.path_info, '/')
+        self.assertPartialDict(req.environ, {
+            'aversion.config': {
+                'versions': {
+                    'version1': {
+                        'name': 'version1',
+                        'app': ANY,
+                        'params': dict(v='v1'),
+                        'prefixes': NOTPRESENT,
+                    },
+                    'version2': {
+                        'name': 'version2',
+                        'app': ANY,
+                        'params': dict(v='v2'),
+                        'prefixes': NOTPRESENT,
+                    },
+                },
+                'aliases': {},
+                'types': {
+                    'application/vnd.spam': {
+                        'name': 'application/vnd.spam',
+                        'params': dict(type='spam'),
+                        'suffixes': NOTPRESENT,
+                    },
+                },
+            },
+            'aversion.response_type': NOTPRESENT,
+            'aversion.orig_response_type': NOTPRESENT,
+            'aversion.accept': NOTPRESENT,
+            'aversion.request_type': 'application/xml',
+            'aversion.orig_request_type': 'application/vnd.spam',
+            'aversion.content_type': ctype,
+            'aversion.version': 'version2',
+        })
+        self.assertPartialDict(req.headers, {
+            'content-type': 'application/xml',
+            'accept': NOTPRESENT,
+        })
+
+    def test_version2_app_ctypematch_notyperewrite(self):
+        conf = {
+            'type.application/vnd.spam': ('version:"version%(v)s" '
+                                          'type:"application/%(x)s" '
+                                          'param:type="spam"'),
+            'overwrite_headers': 'off',
+        }
+        stack = self.construct_stack(conf, version={},
+                                     version1=dict(v='v1'),
+                                     version2=dict(v='v2'))
+        ctype = 'application/vnd.spam;v=2;x="xml";y=42'
+        req = self.make_request('/', content_type=ctype)
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b'version2', resp.body)
+        self.assertEqual(req.script_name, '')
+        self.assertEqual(req.path_info, '/')
+        self.assertPartialDict(req.environ, {
+            'aversion.config': {
+                'versions': {
+                    'version1': {
+                        'name': 'version1',
+                        'app': ANY,
+                        'params': dict(v='v1'),
+                        'prefixes': NOTPRESENT,
+                    },
+                    'version2': {
+                        'name': 'version2',
+                        'app': ANY,
+                        'params': dict(v='v2'),
+                        'prefixes': NOTPRESENT,
+                    },
+                },
+                'aliases': {},
+                'types': {
+                    'application/vnd.spam': {
+                        'name': 'application/vnd.spam',
+                        'params': dict(type='spam'),
+                        'suffixes': NOTPRESENT,
+                    },
+                },
+            },
+            'aversion.response_type': NOTPRESENT,
+            'aversion.orig_response_type': NOTPRESENT,
+            'aversion.accept': NOTPRESENT,
+            'aversion.request_type': 'application/xml',
+            'aversion.orig_request_type': 'application/vnd.spam',
+            'aversion.content_type': ctype,
+            'aversion.version': 'version2',
+        })
+        self.assertPartialDict(req.headers, {
+            'content-type': ctype,
+            'accept': NOTPRESENT,
+        })
+
+    def test_version1_app_acceptmatch(self):
+        conf = {
+            'type.application/json': ('version:"version%(v)s" '
+                                      'param:type="json"'),
+            'type.application/xml': ('version:"version%(v)s" '
+                                     'param:type="xml"'),
+        }
+        stack = self.construct_stack(conf, version={},
+                                     version1=dict(v='v1'),
+                                     version2=dict(v='v2'))
+        req = self.make_request('/', accept='application/json;v=1')
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b'version1', resp.body)
+        self.assertEqual(req.script_name, '')
+        self.assertEqual(req.path_info, '/')
+        self.assertPartialDict(req.environ, {
+            'aversion.config': {
+                'versions': {
+                    'version1': {
+                        'name': 'version1',
+                        'app': ANY,
+                        'params': dict(v='v1'),
+                        'prefixes': NOTPRESENT,
+                    },
+                    'version2': {
+                        'name': 'version2',
+                        'app': ANY,
+                        'params': dict(v='v2'),
+                        'prefixes': NOTPRESENT,
+                    },
+                },
+                'aliases': {},
+                'types': {
+                    'application/json': {
+                        'name': 'application/json',
+                        'params': dict(type='json'),
+                        'suffixes': NOTPRESENT,
+                    },
+                    'application/xml': {
+                        'name': 'application/xml',
+                        'params': dict(type='xml'),
+                        'suffixes': NOTPRESENT,
+                    },
+                },
+            },
+            'aversion.response_type': 'application/json',
+            'aversion.orig_response_type': 'application/json',
+            'aversion.accept': 'application/json;v=1',
+            'aversion.request_type': NOTPRESENT,
+            'aversion.orig_request_type': NOTPRESENT,
+            'aversion.content_type': NOTPRESENT,
+            'aversion.version': 'version1',
+        })
+        self.assertPartialDict(req.headers, {
+            'content-type': NOTPRESENT,
+            'accept': 'application/json;q=1.0',
+        })
+
+    def test_version1_1_app_acceptmatch_withalias(self):
+        conf = {
+            'type.application/json': ('version:"version%(v)s" '
+                                      'param:type="json"'),
+            'type.application/xml': ('version:"version%(v)s" '
+                                     'param:type="xml"'),
+            'alias.version1.1': 'version2 map="1.1->2"',
+        }
+        stack = self.construct_stack(conf, version={},
+                                     version1=dict(v='v1'),
+                                     version2=dict(v='v2'))
+        req = self.make_request('/', accept='application/xml;v=1.1')
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b'version2', resp.body)
+        self.assertEqual(req.script_name, '')
+        self.assertEqual(req.path_info, '/')
+        self.assertPartialDict(req.environ, {
+            'aversion.config': {
+                'versions': {
+                    'version1': {
+                        'name': 'version1',
+                        'app': ANY,
+                        'params': dict(v='v1'),
+                        'prefixes': NOTPRESENT,
+                    },
+                    'version2': {
+                        'name': 'version2',
+                        'app': ANY,
+                        'params': dict(v='v2'),
+                        'prefixes': NOTPRESENT,
+                    },
+                },
+                'aliases': {
+                    'version1.1': {
+                        'alias': 'version1.1',
+                        'version': 'version2',
+                        'params': dict(map="1.1->2"),
+                    },
+                },
+                'types': {
+                    'application/json': {
+                        'name': 'application/json',
+                        'params': dict(type='json'),
+                        'suffixes': NOTPRESENT,
+                    },
+                    'application/xml': {
+                        'name': 'application/xml',
+                        'params': dict(type='xml'),
+                        'suffixes': NOTPRESENT,
+                    },
+                },
+            },
+            'aversion.response_type': 'application/xml',
+            'aversion.orig_response_type': 'application/xml',
+            'aversion.accept': 'application/xml;v=1.1',
+            'aversion.request_type': NOTPRESENT,
+            'aversion.orig_request_type': NOTPRESENT,
+            'aversion.content_type': NOTPRESENT,
+            'aversion.version': 'version2',
+        })
+        self.assertPartialDict(req.headers, {
+            'content-type': NOTPRESENT,
+            'accept': 'application/xml;q=1.0',
         })
 
-    def test_version2_app_ctypematch_typerewrite(self):
+    def test_version2_app_acceptmatch_typerewrite(self):
         conf = {
             'type.application/vnd.spam': ('version:"version%(v)s" '
                                           'type:"application/%(x)s" '
@@ -1678,13 +7425,13 @@ class FunctionalTest(unittest2.TestCase):
         stack = self.construct_stack(conf, version={},
                                      version1=dict(v='v1'),
                                      version2=dict(v='v2'))
-        ctype = 'application/vnd.spam;v=2;x="xml";y=42'
-        req = self.make_request('/', content_type=ctype)
+        accept = 'application/vnd.spam;v=2;x="xml";y=42'
+        req = self.make_request('/', accept=accept)
 
         resp = req.get_response(stack)
 
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version2", resp.body)
+        self.assertEqual(b'version2', resp.body)
         self.assertEqual(req.script_name, '')
         self.assertEqual(req.path_info, '/')
         self.assertPartialDict(req.environ, {
@@ -1712,20 +7459,20 @@ class FunctionalTest(unittest2.TestCase):
                     },
                 },
             },
-            'aversion.response_type': NOTPRESENT,
-            'aversion.orig_response_type': NOTPRESENT,
-            'aversion.accept': NOTPRESENT,
-            'aversion.request_type': 'application/xml',
-            'aversion.orig_request_type': 'application/vnd.spam',
-            'aversion.content_type': ctype,
+            'aversion.response_type': 'application/xml',
+            'aversion.orig_response_type': 'application/vnd.spam',
+            'aversion.accept': accept,
+            'aversion.request_type': NOTPRESENT,
+            'aversion.orig_request_type': NOTPRESENT,
+            'aversion.content_type': NOTPRESENT,
             'aversion.version': 'version2',
         })
         self.assertPartialDict(req.headers, {
-            'content-type': 'application/xml',
-            'accept': NOTPRESENT,
+            'content-type': NOTPRESENT,
+            'accept': 'application/xml;q=1.0',
         })
 
-    def test_version2_app_ctypematch_notyperewrite(self):
+    def test_version2_app_acceptmatch_notyperewrite(self):
         conf = {
             'type.application/vnd.spam': ('version:"version%(v)s" '
                                           'type:"application/%(x)s" '
@@ -1735,13 +7482,13 @@ class FunctionalTest(unittest2.TestCase):
         stack = self.construct_stack(conf, version={},
                                      version1=dict(v='v1'),
                                      version2=dict(v='v2'))
-        ctype = 'application/vnd.spam;v=2;x="xml";y=42'
-        req = self.make_request('/', content_type=ctype)
+        accept = 'application/vnd.spam;v=2;x="xml";y=42'
+        req = self.make_request('/', accept=accept)
 
         resp = req.get_response(stack)
 
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version2", resp.body)
+        self.assertEqual(b'version2', resp.body)
         self.assertEqual(req.script_name, '')
         self.assertEqual(req.path_info, '/')
         self.assertPartialDict(req.environ, {
@@ -1769,257 +7516,1013 @@ class FunctionalTest(unittest2.TestCase):
                     },
                 },
             },
+            'aversion.response_type': 'application/xml',
+            'aversion.orig_response_type': 'application/vnd.spam',
+            'aversion.accept': accept,
+            'aversion.request_type': NOTPRESENT,
+            'aversion.orig_request_type': NOTPRESENT,
+            'aversion.content_type': NOTPRESENT,
+            'aversion.version': 'version2',
+        })
+        self.assertPartialDict(req.headers, {
+            'content-type': NOTPRESENT,
+            'accept': accept,
+        })
+
+    def test_version2_app_compact_environ(self):
+        conf = {
+            'compact_environ': 'true',
+            'type.application/vnd.spam': ('version:"version%(v)s" '
+                                          'type:"application/%(x)s"'),
+        }
+        stack = self.construct_stack(conf, version={},
+                                     version1=dict(v='v1'),
+                                     version2=dict(v='v2'))
+        ctype = 'application/vnd.spam;v=2;x="xml";y=42'
+        accept = 'application/vnd.spam;v=1;x="json"'
+        req = self.make_request('/', content_type=ctype, accept=accept)
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b'version2', resp.body)
+        self.assertPartialDict(req.environ, {
+            'aversion.config': NOTPRESENT,
+            'aversion.version': NOTPRESENT,
             'aversion.response_type': NOTPRESENT,
-            'aversion.orig_response_type': NOTPRESENT,
-            'aversion.accept': NOTPRESENT,
+            'aversion.request_type': NOTPRESENT,
+            'aversion.decision': ANY,
+        })
+        env = req.environ
+        self.assertEqual(aversion.environ_get(env, 'aversion.version'),
+                         'version2')
+        self.assertEqual(aversion.environ_get(env, 'aversion.response_type'),
+                         'application/json')
+        self.assertEqual(
+            aversion.environ_get(env, 'aversion.orig_response_type'),
+            'application/vnd.spam')
+        self.assertEqual(aversion.environ_get(env, 'aversion.accept'),
+                         accept)
+        self.assertEqual(aversion.environ_get(env, 'aversion.request_type'),
+                         'application/xml')
+        self.assertEqual(aversion.environ_get(env, 'aversion.content_type'),
+                         ctype)
+        self.assertPartialDict(
+            aversion.environ_get(env, 'aversion.config'), {
+                'versions': {
+                    'version2': {
+                        'name': 'version2',
+                        'params': dict(v='v2'),
+                    },
+                },
+            })
+
+        # Check that the compatibility shim populates the variables
+        env['aversion.decision'].populate(env)
+        self.assertPartialDict(env, {
+            'aversion.version': 'version2',
+            'aversion.response_type': 'application/json',
+            'aversion.orig_response_type': 'application/vnd.spam',
+            'aversion.accept': accept,
             'aversion.request_type': 'application/xml',
             'aversion.orig_request_type': 'application/vnd.spam',
             'aversion.content_type': ctype,
-            'aversion.version': 'version2',
         })
-        self.assertPartialDict(req.headers, {
-            'content-type': ctype,
-            'accept': NOTPRESENT,
+
+    def test_passthrough(self):
+        app_iter = ['passed', 'through']
+
+        def app(environ, start_response):
+            start_response('203 Non-Authoritative Information',
+                           [('X-Test', 'value')])
+            return app_iter
+
+        loader = mock.Mock(**{'get_app.return_value': app})
+        stack = aversion.AVersion(loader, {}, **{
+            'version.v1': 'v1_app',
+            'uri./v1': 'v1',
+        })
+        req = self.make_request('/v1/foo')
+
+        status, headers, result = req.call_application(stack)
+
+        self.assertEqual(status, '203 Non-Authoritative Information')
+        self.assertEqual(headers, [('X-Test', 'value')])
+        self.assertIs(result, app_iter)
+
+    def test_correct_response_type(self):
+        def app(environ, start_response):
+            start_response('200 OK', [
+                ('Content-Type', environ['HTTP_ACCEPT'].split(';')[0] +
+                 '; charset=UTF-8'),
+            ])
+            return [b'body']
+
+        loader = mock.Mock(**{'get_app.return_value': app})
+        stack = aversion.AVersion(loader, {}, **{
+            'correct_response_type': 'on',
+            'version.v2': 'v2_app',
+            'type.application/vnd.spam': ('version:"v%(v)s" '
+                                          'type:"application/%(x)s"'),
+        })
+        req = self.make_request('/', accept='application/vnd.spam;v=2;x=xml')
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers['content-type'],
+                         'application/vnd.spam; charset=UTF-8')
+        self.assertEqual(resp.body, b'body')
+
+    def test_vary_uri_only(self):
+        conf = {
+            'uri./v1': 'version1',
+            'type.application/json': 'version:"version%(v)s"',
+            '.json': 'application/json',
+        }
+        stack = self.construct_stack(conf, version={}, version1={})
+        req = self.make_request('/v1/foo.json', accept='application/xml')
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b'version1', resp.body)
+        self.assertNotIn('vary', resp.headers)
+
+    def test_vary_negotiated(self):
+        conf = {
+            'uri./v1': 'version1',
+            'type.application/json': 'version:"version%(v)s"',
+        }
+        stack = self.construct_stack(conf, version={}, version1={})
+        req = self.make_request('/foo', content_type='application/json;v=1',
+                                accept='application/json')
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(b'version1', resp.body)
+        self.assertEqual(resp.headers['vary'], 'Content-Type, Accept')
+
+    def test_strict_accept(self):
+        conf = {
+            'strict_accept': 'on',
+            'uri./v1': 'version1',
+            'type.application/json': 'version:"version%(v)s"',
+            '.xml': 'application/xml',
+        }
+        stack = self.construct_stack(conf, version={}, version1={})
+
+        req = self.make_request('/v1/foo', accept='text/html')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 406)
+        self.assertEqual(resp.body,
+                         b'406 Not Acceptable\n\nAcceptable content types: '
+                         b'application/json, application/xml\n')
+
+        req = self.make_request('/v1/foo', accept='text/html;q=1, */*;q=0.1')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version1')
+
+        req = self.make_request('/v1/foo', accept='application/xml')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version1')
+
+        req = self.make_request('/v1/foo.xml', accept='text/html')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version1')
+
+    def test_strict_content_type(self):
+        conf = {
+            'strict_content_type': 'on',
+            'uri./v1': 'version1',
+            'type.application/json': 'version:"version%(v)s"',
+        }
+        stack = self.construct_stack(conf, version={}, version1={})
+
+        req = self.make_request('/v1/foo', content_type='text/plain')
+        req.method = 'POST'
+        req.body = b'body'
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 415)
+        self.assertEqual(resp.body,
+                         b'415 Unsupported Media Type\n\nSupported content '
+                         b'types: application/json\n')
+        self.assertEqual(req.body_file.tell(), 0)
+        self.assertEqual(stack.rejected_types.snapshot(), {'text/plain': 1})
+
+        req = self.make_request('/v1/foo', content_type='application/json')
+        req.method = 'POST'
+        req.body = b'{}'
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version1')
+
+        req = self.make_request('/v1/foo', content_type='text/plain')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version1')
+
+    def test_strict_stages_omitted(self):
+        conf = {
+            'strict_accept': 'on',
+            'strict_content_type': 'on',
+            'process_order': 'uri',
+            'uri./v1': 'version1',
+            'type.application/json': 'version:"version%(v)s"',
+        }
+        stack = self.construct_stack(conf, version={}, version1={})
+
+        req = self.make_request('/v1/foo', content_type='text/plain')
+        req.method = 'POST'
+        req.body = b'body'
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 415)
+
+        req = self.make_request('/v1/foo', accept='text/html')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 406)
+
+        req = self.make_request('/v1/foo', accept='application/json')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version1')
+
+    def test_header_limits(self):
+        conf = {
+            'max_media_ranges': '3',
+            'type.application/json': 'version:"version%(v)s"',
+        }
+        stack = self.construct_stack(conf, version={}, version1={})
+        accept = 'text/html,text/plain,text/xml,application/json;v=1'
+
+        # Ignored by default
+        req = self.make_request('/foo', accept=accept)
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version')
+
+        # Rejected if so configured
+        stack.header_limit_action = 'reject'
+        req = self.make_request('/foo', accept=accept)
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 431)
+
+        # Within the limits
+        req = self.make_request('/foo', accept=accept.split(',', 1)[1])
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version1')
+        self.assertEqual(stack.limited_headers.snapshot(), {'accept': 2})
+
+    def test_discovery(self):
+        conf = {
+            'version': 'aversion:discovery',
+            'alias.v1.1': 'version2',
+            'uri./v1': 'version1',
+            'uri./v2': 'version2',
+            'type.application/json': 'version:"version%(v)s"',
+            'type.application/vnd.v1': 'version:"version1"',
+            '.json': 'application/json',
+        }
+        stack = self.construct_stack(conf, version1=dict(v='1'),
+                                     version2={})
+        req = self.make_request('/')
+
+        resp = req.get_response(stack)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(json.loads(resp.body.decode('utf-8')), {
+            'versions': {
+                'version1': {
+                    'name': 'version1',
+                    'params': {'v': '1'},
+                    'prefixes': ['/v1'],
+                    'types': ['application/vnd.v1'],
+                },
+                'version2': {
+                    'name': 'version2',
+                    'params': {},
+                    'prefixes': ['/v2'],
+                    'types': [],
+                },
+            },
+            'aliases': {
+                'v1.1': {
+                    'alias': 'v1.1',
+                    'version': 'version2',
+                    'params': {},
+                },
+            },
+            'types': {
+                'application/json': {
+                    'name': 'application/json',
+                    'params': {},
+                    'suffixes': ['.json'],
+                },
+                'application/vnd.v1': {
+                    'name': 'application/vnd.v1',
+                    'params': {},
+                },
+            },
+        })
+        self.assertIs(stack(self.make_request('/').environ,
+                            mock.Mock())[0],
+                      stack.version_app.response.body)
+
+    def test_discovery_conditional(self):
+        conf = {
+            'version': 'aversion:discovery',
+            'version_cache_control': 'public, max-age=300',
+            'uri./v1': 'version1',
+        }
+        stack = self.construct_stack(conf, version1={})
+
+        resp = self.make_request('/').get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers['etag'], stack.version_etag)
+        self.assertEqual(resp.headers['cache-control'],
+                         'public, max-age=300')
+        body = resp.body
+
+        req = self.make_request('/')
+        req.headers['If-None-Match'] = resp.headers['etag']
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 304)
+        self.assertEqual(resp.headers['etag'], stack.version_etag)
+        self.assertEqual(resp.headers['cache-control'],
+                         'public, max-age=300')
+        self.assertEqual(resp.body, b'')
+
+        # Changing the configuration changes the entity tag
+        stack.aliases['v1.1'] = dict(alias='v1.1', version='version1',
+                                     params={})
+        stack.config_changed()
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertNotEqual(resp.body, body)
+        self.assertNotEqual(resp.headers['etag'],
+                            req.headers['If-None-Match'])
+
+    def test_health_check(self):
+        conf = {
+            'health_paths': '/healthz',
+            'uri./v1': 'version1',
+        }
+        stack = self.construct_stack(conf, version={}, version1={})
+
+        req = self.make_request('/healthz', accept='a/b')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers['content-type'],
+                         'text/plain; charset=UTF-8')
+        self.assertEqual(resp.headers['cache-control'], 'no-cache')
+        self.assertEqual(resp.body, b'OK\n')
+        self.assertNotIn('aversion.version', req.environ)
+        self.assertEqual(req.headers['accept'], 'a/b')
+
+        # Other paths are routed as usual
+        resp = self.make_request('/v1/healthz').get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertNotEqual(resp.body, b'OK\n')
+
+    def test_concurrency_limit(self):
+        conf = {
+            'limit.version1': 'concurrency="1" retry_after="5"',
+            'metrics_path': '/metrics',
+            'uri./v1': 'version1',
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf, version1={}, version2={})
+
+        # Hold a slot by not closing the application iterable
+        app_iter = stack(self.make_request('/v1/foo').environ,
+                         lambda status, headers, exc_info=None: None)
+        self.assertEqual(list(app_iter), [b'version1'])
+
+        resp = self.make_request('/v1/foo').get_response(stack)
+        self.assertEqual(resp.status_int, 503)
+        self.assertEqual(resp.headers['retry-after'], '5')
+
+        # Other versions are unaffected
+        resp = self.make_request('/v2/foo').get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+
+        resp = self.make_request('/metrics').get_response(stack)
+        self.assertEqual(json.loads(resp.body.decode('utf-8'))['versions'], {
+            'version1': {'in_flight': 1, 'rejected': 1},
         })
 
-    def test_version1_app_acceptmatch(self):
+        # Closing the iterable releases the slot
+        app_iter.close()
+        resp = self.make_request('/v1/foo').get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(stack.limiters['version1'].in_flight, 0)
+
+    def test_overload_fall_back(self):
+        conf = {
+            'limit.version2': 'concurrency="1"',
+            'type.a/a': 'version:"%(version)s"',
+            'alias.1': 'version1',
+            'alias.2': 'version2',
+        }
+        stack = self.construct_stack(conf, version1={}, version2={})
+        accept = 'a/a;version=2, a/a;version=1;q=0.5'
+
+        resp = self.make_request('/', accept=accept).get_response(stack)
+        self.assertEqual(resp.body, b'version2')
+
+        # Hold the only slot of version2
+        app_iter = stack(self.make_request('/', accept=accept).environ,
+                         lambda status, headers, exc_info=None: None)
+
+        resp = self.make_request('/', accept=accept).get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'version1')
+
+        # Clients which only accept version2 are rejected
+        resp = self.make_request('/', accept='a/a;version=2').get_response(
+            stack)
+        self.assertEqual(resp.status_int, 503)
+
+        app_iter.close()
+        self.assertEqual(stack.metrics()['fallbacks'], {'version2': 1})
+
+    def test_upstream_proxy(self):
+        upstream = FakeUpstream()
+        self.addCleanup(upstream.stop)
+        conf = {
+            'version.version2': '%s/base' % upstream.url,
+            'proxy.version2': 'pool_size="1"',
+            'uri./v1': 'version1',
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf, version1={})
+
+        for i in range(3):
+            req = self.make_request('/v2/foo%20bar?x=1', accept='a/a')
+            req.environ['REMOTE_ADDR'] = '10.0.0.1'
+            resp = req.get_response(stack)
+
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers.getall('set-cookie'),
+                             ['a=1', 'b=2'])
+            self.assertEqual(json.loads(resp.body.decode('utf-8')), dict(
+                method='GET',
+                path='/base/foo%20bar?x=1',
+                accept='a/a',
+                forwarded_for='10.0.0.1',
+                body='',
+            ))
+
+        # Send a request body
+        req = self.make_request('/v2/foo')
+        req.method = 'PUT'
+        req.body = b'request body'
+        resp = req.get_response(stack)
+        self.assertEqual(json.loads(resp.body.decode('utf-8'))['body'],
+                         'request body')
+
+        # A HEAD response has no body
+        req = self.make_request('/v2/foo')
+        req.method = 'HEAD'
+        resp = req.get_response(stack)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, b'')
+
+        # The requests shared a single connection
+        self.assertEqual(upstream.connections, 1)
+
+        # Other versions are served locally
+        resp = self.make_request('/v1/foo').get_response(stack)
+        self.assertEqual(resp.body, b'version1')
+
+    def test_upstream_proxy_unavailable(self):
+        upstream = FakeUpstream()
+        url = upstream.url
+        upstream.stop()
+        conf = {
+            'version.version2': url,
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf)
+
+        with mock.patch.object(aversion.LOG, 'warn'):
+            resp = self.make_request('/v2/foo').get_response(stack)
+
+        self.assertEqual(resp.status_int, 502)
+
+    def test_worker_processes(self):
+        conf = {
+            'workers.version2': 'processes="2"',
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf, version2={})
+        pool = stack.versions['version2']['app']
+        self.addCleanup(pool.stop)
+
+        # The workers are started when the pool is configured
+        self.assertEqual(len(pool._workers), 2)
+
+        # Restart them with an application reporting on the worker
+        pipe_r, pipe_w = os.pipe()
+        self.addCleanup(os.close, pipe_r)
+        self.addCleanup(os.close, pipe_w)
+
+        def version2(environ, start_response):
+            try:
+                os.fstat(pipe_w)
+                inherited = 'open'
+            except OSError:
+                inherited = 'closed'
+            start_response('200 OK', [('X-Pid', str(os.getpid())),
+                                      ('X-Inherited', inherited)])
+            return [environ['PATH_INFO'].encode('utf-8'), b':',
+                    environ['wsgi.input'].read()]
+        pool.stop()
+        pool.app = version2
+        pool.start()
+
+        pids = set()
+        for i in range(4):
+            req = self.make_request('/v2/foo')
+            req.method = 'POST'
+            req.body = ('request %d' % i).encode('ascii')
+            resp = req.get_response(stack)
+
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.body,
+                             ('/foo:request %d' % i).encode('ascii'))
+            pids.add(resp.headers['x-pid'])
+
+            # Inherited file descriptors are closed in the workers
+            self.assertEqual(resp.headers['x-inherited'], 'closed')
+
+        # The requests were served by the worker processes
+        self.assertNotIn(str(os.getpid()), pids)
+        self.assertLessEqual(len(pids), 2)
+        self.assertEqual(len(pool._workers), 2)
+
+    def test_response_cache(self):
+        conf = {
+            'cache.version2': 'size="1000"',
+            'uri./v2': 'version2',
+            'type.a/a': 'version:version2',
+            'type.b/b': 'version:version2',
+        }
+        stack = self.construct_stack(conf, version2={})
+        calls = []
+
+        def version2(environ, start_response):
+            calls.append(environ['HTTP_ACCEPT'])
+            start_response('200 OK', [
+                ('Content-Type', environ['HTTP_ACCEPT'].split(';')[0]),
+                ('Cache-Control', 'max-age=60'),
+            ])
+            yield ('call %d' % len(calls)).encode('ascii')
+        stack.versions['version2']['app'] = version2
+
+        # The second request is answered from the cache
+        for i in range(2):
+            resp = self.make_request('/v2/foo', accept='a/a').get_response(
+                stack)
+            self.assertEqual(resp.body, b'call 1')
+        self.assertEqual(resp.headers['age'], '0')
+
+        # The negotiated type is part of the key
+        resp = self.make_request('/v2/foo', accept='b/b').get_response(stack)
+        self.assertEqual(resp.body, b'call 2')
+        self.assertEqual(resp.content_type, 'b/b')
+
+        # As is the query string
+        resp = self.make_request('/v2/foo?x=1',
+                                 accept='a/a').get_response(stack)
+        self.assertEqual(resp.body, b'call 3')
+
+        # A client may bypass the cache
+        req = self.make_request('/v2/foo', accept='a/a')
+        req.headers['Cache-Control'] = 'no-cache'
+        resp = req.get_response(stack)
+        self.assertEqual(resp.body, b'call 4')
+
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(stack.metrics()['caches']['version2']['hits'], 1)
+
+    def test_response_cache_vary_accept(self):
         conf = {
-            'type.application/json': ('version:"version%(v)s" '
-                                      'param:type="json"'),
-            'type.application/xml': ('version:"version%(v)s" '
-                                     'param:type="xml"'),
+            'cache.version2': 'ttl="60"',
+            'uri./v2': 'version2',
         }
-        stack = self.construct_stack(conf, version={},
-                                     version1=dict(v='v1'),
-                                     version2=dict(v='v2'))
-        req = self.make_request('/', accept='application/json;v=1')
+        stack = self.construct_stack(conf, version2={})
+        calls = []
+
+        def version2(environ, start_response):
+            calls.append(environ['HTTP_ACCEPT'])
+            ctype = ('application/xml' if 'xml' in environ['HTTP_ACCEPT']
+                     else 'application/json')
+            start_response('200 OK', [('Content-Type', ctype),
+                                      ('Vary', 'Accept')])
+            return [ctype.encode('ascii')]
+        stack.versions['version2']['app'] = version2
+
+        # The Accept header reaches the application unchanged, so
+        # each value is cached separately
+        for accept in ('application/json', 'application/xml',
+                       'application/json', 'application/xml'):
+            resp = self.make_request('/v2/foo',
+                                     accept=accept).get_response(stack)
+            self.assertEqual(resp.body, accept.encode('ascii'))
+
+        self.assertEqual(calls, ['application/json', 'application/xml'])
+        self.assertEqual(stack.metrics()['caches']['version2']['hits'], 2)
+
+    def test_request_coalescing(self):
+        conf = {
+            'coalesce.version2': 'timeout="5"',
+            'uri./v2': 'version2',
+            'metrics_path': '/metrics',
+        }
+        stack = self.construct_stack(conf, version2={})
+        calls = []
+        release = threading.Event()
+
+        def version2(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            release.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            yield ('response %d' % len(calls)).encode('ascii')
+        stack.versions['version2']['app'] = version2
+
+        # Start identical requests concurrently
+        bodies = []
+
+        def client():
+            resp = self.make_request('/v2/foo').get_response(stack)
+            bodies.append(resp.body)
+        threads = [threading.Thread(target=client) for i in range(4)]
+        for thread in threads:
+            thread.start()
+
+        # Wait for the requests to join the flight, then let the
+        # application respond
+        for i in range(500):
+            if stack.metrics()['coalescing']['version2']['waiting'] == 3:
+                break
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, ['/foo'])
+        self.assertEqual(bodies, [b'response 1'] * 4)
+        self.assertEqual(stack.metrics()['coalescing']['version2'], dict(
+            in_flight=0,
+            waiting=0,
+            leaders=1,
+            shared=3,
+            unshared=0,
+            timeouts=0,
+        ))
 
-        resp = req.get_response(stack)
+        # Later requests are processed afresh
+        resp = self.make_request('/v2/foo').get_response(stack)
+        self.assertEqual(resp.body, b'response 2')
 
-        self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version1", resp.body)
-        self.assertEqual(req.script_name, '')
-        self.assertEqual(req.path_info, '/')
-        self.assertPartialDict(req.environ, {
-            'aversion.config': {
-                'versions': {
-                    'version1': {
-                        'name': 'version1',
-                        'app': ANY,
-                        'params': dict(v='v1'),
-                        'prefixes': NOTPRESENT,
-                    },
-                    'version2': {
-                        'name': 'version2',
-                        'app': ANY,
-                        'params': dict(v='v2'),
-                        'prefixes': NOTPRESENT,
-                    },
-                },
-                'aliases': {},
-                'types': {
-                    'application/json': {
-                        'name': 'application/json',
-                        'params': dict(type='json'),
-                        'suffixes': NOTPRESENT,
-                    },
-                    'application/xml': {
-                        'name': 'application/xml',
-                        'params': dict(type='xml'),
-                        'suffixes': NOTPRESENT,
-                    },
-                },
-            },
-            'aversion.response_type': 'application/json',
-            'aversion.orig_response_type': 'application/json',
-            'aversion.accept': 'application/json;v=1',
-            'aversion.request_type': NOTPRESENT,
-            'aversion.orig_request_type': NOTPRESENT,
-            'aversion.content_type': NOTPRESENT,
-            'aversion.version': 'version1',
-        })
-        self.assertPartialDict(req.headers, {
-            'content-type': NOTPRESENT,
-            'accept': 'application/json;q=1.0',
+    def test_request_coalescing_vary_accept(self):
+        conf = {
+            'coalesce.version2': 'timeout="5"',
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf, version2={})
+        calls = []
+        release = threading.Event()
+
+        def version2(environ, start_response):
+            calls.append(environ['HTTP_ACCEPT'])
+            release.wait(5)
+            start_response('200 OK', [('Content-Type', environ['HTTP_ACCEPT']),
+                                      ('Vary', 'Accept')])
+            yield environ['HTTP_ACCEPT'].encode('ascii')
+        stack.versions['version2']['app'] = version2
+
+        # Start requests differing only in the Accept header
+        bodies = []
+
+        def client(accept):
+            resp = self.make_request('/v2/foo',
+                                     accept=accept).get_response(stack)
+            bodies.append((accept, resp.body))
+        threads = [threading.Thread(target=client, args=(accept,))
+                   for accept in ('application/json', 'application/xml') * 2]
+        for thread in threads:
+            thread.start()
+
+        # Wait for one request of each kind to wait on the other
+        for i in range(500):
+            if stack.metrics()['coalescing']['version2']['waiting'] == 2:
+                break
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(calls), ['application/json',
+                                         'application/xml'])
+        for accept, body in bodies:
+            self.assertEqual(body, accept.encode('ascii'))
+        self.assertEqual(
+            stack.metrics()['coalescing']['version2']['leaders'], 2)
+
+    def test_version_selection(self):
+        conf = {
+            'version_header': 'Accept-Version',
+            'version_param': 'api-version',
+            'process_order': 'query header uri accept',
+            'alias.2': 'version2',
+            'uri./v1': 'version1',
+            'type.a/a': 'version:"version1"',
+        }
+        stack = self.construct_stack(conf, version1={}, version2={})
+
+        # Each stage selects the version in turn
+        for path, headers, expected in (
+                ('/foo?api-version=2', {'Accept-Version': 'version1'},
+                 'version2'),
+                ('/v1/foo', {'Accept-Version': '2'}, 'version2'),
+                ('/v1/foo', {'Accept-Version': '3'}, 'version1'),
+                ('/foo?api-version=3', {'Accept': 'a/a'}, 'version1')):
+            req = self.make_request(path)
+            req.headers.update(headers)
+            resp = req.get_response(stack)
+            self.assertEqual(resp.body, expected.encode('ascii'))
+
+            # The header was not consulted if the query selected the
+            # version
+            self.assertEqual('Accept-Version' in resp.headers.get('vary', ''),
+                             'api-version=2' not in path)
+
+    def test_version_ranges(self):
+        conf = {
+            'type.a/a': 'version:"v1.0" range:"%(version)s"',
+            'type.a/b': 'range:">=%(min)s"',
+            '.a': 'a/a',
+        }
+        stack = self.construct_stack(conf, **{
+            'v1.0': {}, 'v1.2': {}, 'v1.10': {}, 'v2.0': {},
         })
 
-    def test_version1_1_app_acceptmatch_withalias(self):
+        for accept, expected in (('a/a;version=1.x', 'v1.10'),
+                                 ('a/a;version="<1.10"', 'v1.2'),
+                                 ('a/a;version=3.x', 'v1.0'),
+                                 ('a/a', 'v1.0'),
+                                 ('a/b;min=1.1', 'v2.0')):
+            resp = self.make_request('/foo', accept=accept).get_response(
+                stack)
+            self.assertEqual(resp.body.decode('ascii').split()[0],
+                             expected, accept)
+
+    def test_parsed_headers(self):
         conf = {
-            'type.application/json': ('version:"version%(v)s" '
-                                      'param:type="json"'),
-            'type.application/xml': ('version:"version%(v)s" '
-                                     'param:type="xml"'),
-            'alias.version1.1': 'version2 map="1.1->2"',
+            'uri./v2': 'version2',
+            'type.a/a': 'version:version2',
         }
-        stack = self.construct_stack(conf, version={},
-                                     version1=dict(v='v1'),
-                                     version2=dict(v='v2'))
-        req = self.make_request('/', accept='application/xml;v=1.1')
+        stack = self.construct_stack(conf, version2={})
+        parsed = []
+
+        def version2(environ, start_response):
+            parsed.append((
+                aversion.environ_get(environ, 'aversion.parsed_accept'),
+                aversion.environ_get(environ,
+                                     'aversion.parsed_content_type'),
+            ))
+            start_response('200 OK', [('Content-Type', 'a/a')])
+            return [b'']
+        stack.versions['version2']['app'] = version2
+
+        for i in range(2):
+            req = self.make_request('/v2/foo', content_type='a/a;v=1',
+                                    accept='b/b;q=0.5, a/a')
+            req.method = 'POST'
+            req.body = b'body'
+            req.get_response(stack)
+
+        self.assertEqual(parsed[0], (
+            (('a/a', {'_': 'a/a'}), ('b/b', {'_': 'b/b', 'q': '0.5'})),
+            ('a/a', {'_': 'a/a', 'v': '1'}),
+        ))
+
+        # The second request reused the parsed headers
+        self.assertIs(parsed[0][0], parsed[1][0])
+        self.assertIs(parsed[0][1], parsed[1][1])
+        self.assertEqual(stack.metrics()['header_cache'],
+                         dict(entries=2, hits=2, misses=2))
+
+    def test_negotiation(self):
+        conf = {
+            'languages': 'en-US de',
+            'charsets': 'utf-8 iso-8859-1',
+            'cache.version2': '',
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf, version2={})
+
+        def version2(environ, start_response):
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain'),
+                ('Cache-Control', 'max-age=60'),
+            ])
+            yield aversion.environ_get(environ, 'aversion.language').encode(
+                'ascii')
+        stack.versions['version2']['app'] = version2
+
+        # Each language is cached separately
+        for lang, expected in (('de-AT, de, en;q=0.5', b'de'),
+                               ('en', b'en-US'), ('de', b'de')):
+            req = self.make_request('/v2/foo')
+            req.headers['Accept-Language'] = lang
+            resp = req.get_response(stack)
+            self.assertEqual(resp.body, expected)
+            self.assertEqual(resp.headers['vary'],
+                             'Accept-Language, Accept-Charset')
+
+        self.assertEqual(stack.metrics()['caches']['version2']['hits'], 1)
+
+    def test_response_compression(self):
+        conf = {
+            'compress': 'gzip deflate',
+            'compress_min_size': '100',
+            'cache.version2': '',
+            'uri./v2': 'version2',
+        }
+        stack = self.construct_stack(conf, version2={})
+        calls = []
+
+        def version2(environ, start_response):
+            calls.append(environ.get('HTTP_ACCEPT_ENCODING'))
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain'),
+                ('Cache-Control', 'max-age=60'),
+                ('ETag', '"v2"'),
+            ])
+            for i in range(10):
+                yield b'0123456789' * 10
+        stack.versions['version2']['app'] = version2
 
+        req = self.make_request('/v2/foo')
+        req.headers['Accept-Encoding'] = 'deflate, gzip;q=0.5'
         resp = req.get_response(stack)
 
-        self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version2", resp.body)
-        self.assertEqual(req.script_name, '')
-        self.assertEqual(req.path_info, '/')
-        self.assertPartialDict(req.environ, {
-            'aversion.config': {
-                'versions': {
-                    'version1': {
-                        'name': 'version1',
-                        'app': ANY,
-                        'params': dict(v='v1'),
-                        'prefixes': NOTPRESENT,
-                    },
+        self.assertEqual(resp.headers['content-encoding'], 'deflate')
+        self.assertEqual(resp.headers['etag'], 'W/"v2"')
+        self.assertIn('Accept-Encoding', resp.headers['vary'])
+        self.assertEqual(zlib.decompress(resp.body), b'0123456789' * 100)
+
+        # The cached body is not compressed
+        req = self.make_request('/v2/foo')
+        req.headers['Accept-Encoding'] = 'gzip'
+        resp = req.get_response(stack)
+        self.assertEqual(resp.headers['content-encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(resp.body, 16 + zlib.MAX_WBITS),
+                         b'0123456789' * 100)
+
+        resp = self.make_request('/v2/foo').get_response(stack)
+        self.assertNotIn('content-encoding', resp.headers)
+        self.assertIn('Accept-Encoding', resp.headers['vary'])
+        self.assertEqual(resp.body, b'0123456789' * 100)
+
+        # A HEAD request gets the headers of the matching GET
+        req = self.make_request('/v2/foo')
+        req.method = 'HEAD'
+        req.headers['Accept-Encoding'] = 'gzip'
+        resp = req.get_response(stack)
+        self.assertEqual(resp.headers['content-encoding'], 'gzip')
+        self.assertEqual(resp.headers['etag'], 'W/"v2"')
+        self.assertIn('Accept-Encoding', resp.headers['vary'])
+        self.assertEqual(resp.body, b'')
+
+        self.assertEqual(calls, ['deflate, gzip;q=0.5'])
+
+    def test_circuit_breaker(self):
+        conf = {
+            'breaker.version2': 'failures="2" reset="10"',
+            'uri./v2': 'version2',
+            'metrics_path': '/metrics',
+        }
+        stack = self.construct_stack(conf, version2={})
+        failing = [True]
+
+        def version2(environ, start_response):
+            if failing[0]:
+                start_response('500 Internal Server Error', [])
+            else:
+                start_response('200 OK', [])
+            yield b'version2'
+        stack.versions['version2']['app'] = version2
+
+        with mock.patch.object(aversion.time, 'time', return_value=100.0):
+            for i in range(2):
+                resp = self.make_request('/v2/foo').get_response(stack)
+                self.assertEqual(resp.status_int, 500)
+
+            # The breaker is now open
+            resp = self.make_request('/v2/foo').get_response(stack)
+            self.assertEqual(resp.status_int, 503)
+            self.assertEqual(resp.headers['retry-after'], '10')
+
+            resp = self.make_request('/metrics').get_response(stack)
+            self.assertEqual(
+                json.loads(resp.body.decode('utf-8'))['breakers'], {
                     'version2': {
-                        'name': 'version2',
-                        'app': ANY,
-                        'params': dict(v='v2'),
-                        'prefixes': NOTPRESENT,
-                    },
-                },
-                'aliases': {
-                    'version1.1': {
-                        'alias': 'version1.1',
-                        'version': 'version2',
-                        'params': dict(map="1.1->2"),
-                    },
-                },
-                'types': {
-                    'application/json': {
-                        'name': 'application/json',
-                        'params': dict(type='json'),
-                        'suffixes': NOTPRESENT,
-                    },
-                    'application/xml': {
-                        'name': 'application/xml',
-                        'params': dict(type='xml'),
-                        'suffixes': NOTPRESENT,
+                        'state': 'open',
+                        'consecutive_failures': 0,
+                        'opened': 1,
+                        'rejected': 1,
                     },
-                },
-            },
-            'aversion.response_type': 'application/xml',
-            'aversion.orig_response_type': 'application/xml',
-            'aversion.accept': 'application/xml;v=1.1',
-            'aversion.request_type': NOTPRESENT,
-            'aversion.orig_request_type': NOTPRESENT,
-            'aversion.content_type': NOTPRESENT,
-            'aversion.version': 'version2',
-        })
-        self.assertPartialDict(req.headers, {
-            'content-type': NOTPRESENT,
-            'accept': 'application/xml;q=1.0',
-        })
+                })
 
-    def test_version2_app_acceptmatch_typerewrite(self):
+        # After the reset interval, a successful probe closes it
+        failing[0] = False
+        with mock.patch.object(aversion.time, 'time', return_value=110.0):
+            resp = self.make_request('/v2/foo').get_response(stack)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(stack.breakers['version2'].state, 'closed')
+
+    def test_circuit_breaker_fallback_types(self):
         conf = {
-            'type.application/vnd.spam': ('version:"version%(v)s" '
-                                          'type:"application/%(x)s" '
-                                          'param:type="spam"'),
+            'breaker.version2': 'failures="1" fallback="version1"',
+            'type.a/a': 'type:"a/v%(v)s" version:"version%(v)s"',
         }
-        stack = self.construct_stack(conf, version={},
-                                     version1=dict(v='v1'),
-                                     version2=dict(v='v2'))
-        accept = 'application/vnd.spam;v=2;x="xml";y=42'
-        req = self.make_request('/', accept=accept)
+        stack = self.construct_stack(conf, version1={}, version2={})
+        stack.breakers['version2'].record(False)
+        seen = []
+
+        def version1(environ, start_response):
+            seen.append((environ.get('CONTENT_TYPE'),
+                         environ.get('HTTP_ACCEPT')))
+            start_response('200 OK', [])
+            return [b'version1']
+        stack.versions['version1']['app'] = version1
+
+        # The fallback version gets the type the client accepts for it
+        req = self.make_request('/foo', content_type='a/a;v=2',
+                                accept='a/a;v=2, a/a;v=1;q=0.5')
+        resp = req.get_response(stack)
+        self.assertEqual(resp.body, b'version1')
 
+        # Without such a type, the headers are passed on as sent
+        req = self.make_request('/foo', content_type='a/a;v=2',
+                                accept='a/a;v=2')
         resp = req.get_response(stack)
+        self.assertEqual(resp.body, b'version1')
 
-        self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version2", resp.body)
-        self.assertEqual(req.script_name, '')
-        self.assertEqual(req.path_info, '/')
-        self.assertPartialDict(req.environ, {
-            'aversion.config': {
-                'versions': {
-                    'version1': {
-                        'name': 'version1',
-                        'app': ANY,
-                        'params': dict(v='v1'),
-                        'prefixes': NOTPRESENT,
-                    },
-                    'version2': {
-                        'name': 'version2',
-                        'app': ANY,
-                        'params': dict(v='v2'),
-                        'prefixes': NOTPRESENT,
-                    },
-                },
-                'aliases': {},
-                'types': {
-                    'application/vnd.spam': {
-                        'name': 'application/vnd.spam',
-                        'params': dict(type='spam'),
-                        'suffixes': NOTPRESENT,
-                    },
-                },
-            },
-            'aversion.response_type': 'application/xml',
-            'aversion.orig_response_type': 'application/vnd.spam',
-            'aversion.accept': accept,
-            'aversion.request_type': NOTPRESENT,
-            'aversion.orig_request_type': NOTPRESENT,
-            'aversion.content_type': NOTPRESENT,
-            'aversion.version': 'version2',
-        })
-        self.assertPartialDict(req.headers, {
-            'content-type': NOTPRESENT,
-            'accept': 'application/xml;q=1.0',
-        })
+        self.assertEqual(seen, [
+            ('a/a;v=2', 'a/v1;q=1.0'),
+            ('a/a;v=2', 'a/a;v=2'),
+        ])
 
-    def test_version2_app_acceptmatch_notyperewrite(self):
+    def test_shadow_traffic(self):
         conf = {
-            'type.application/vnd.spam': ('version:"version%(v)s" '
-                                          'type:"application/%(x)s" '
-                                          'param:type="spam"'),
-            'overwrite_headers': 'off',
+            'shadow.version1': 'target="version2" rate="1" '
+                               'methods="GET POST"',
+            'uri./v1': 'version1',
         }
-        stack = self.construct_stack(conf, version={},
-                                     version1=dict(v='v1'),
-                                     version2=dict(v='v2'))
-        accept = 'application/vnd.spam;v=2;x="xml";y=42'
-        req = self.make_request('/', accept=accept)
-
+        stack = self.construct_stack(conf, version1={}, version2={})
+        replayed = []
+        done = threading.Event()
+
+        def version2(environ, start_response):
+            replayed.append((environ['PATH_INFO'], environ['aversion.shadow'],
+                             environ['wsgi.input'].read()))
+            start_response('503 Service Unavailable', [])
+            done.set()
+            return [b'discarded']
+        stack.shadows['version1'].app = version2
+
+        req = self.make_request('/v1/foo')
+        req.method = 'POST'
+        req.body = b'request body'
         resp = req.get_response(stack)
 
+        # The client sees only the primary response
         self.assertEqual(resp.status_int, 200)
-        self.assertEqual("version2", resp.body)
-        self.assertEqual(req.script_name, '')
-        self.assertEqual(req.path_info, '/')
-        self.assertPartialDict(req.environ, {
-            'aversion.config': {
-                'versions': {
-                    'version1': {
-                        'name': 'version1',
-                        'app': ANY,
-                        'params': dict(v='v1'),
-                        'prefixes': NOTPRESENT,
-                    },
-                    'version2': {
-                        'name': 'version2',
-                        'app': ANY,
-                        'params': dict(v='v2'),
-                        'prefixes': NOTPRESENT,
-                    },
-                },
-                'aliases': {},
-                'types': {
-                    'application/vnd.spam': {
-                        'name': 'application/vnd.spam',
-                        'params': dict(type='spam'),
-                        'suffixes': NOTPRESENT,
-                    },
-                },
-            },
-            'aversion.response_type': 'application/xml',
-            'aversion.orig_response_type': 'application/vnd.spam',
-            'aversion.accept': accept,
-            'aversion.request_type': NOTPRESENT,
-            'aversion.orig_request_type': NOTPRESENT,
-            'aversion.content_type': NOTPRESENT,
-            'aversion.version': 'version2',
-        })
-        self.assertPartialDict(req.headers, {
-            'content-type': NOTPRESENT,
-            'accept': accept,
-        })
+        self.assertEqual(resp.body, b'version1')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(replayed, [('/foo', 'version1', b'request body')])
+
+        # Wait for the outcome to be recorded
+        shadow = stack.shadows['version1']
+        for i in range(500):
+            if shadow.shadow.requests:
+                break
+            time.sleep(0.01)
+        snapshot = stack.metrics()['shadows']['version1']
+        self.assertEqual(snapshot['target'], 'version2')
+        self.assertEqual(snapshot['dropped'], 0)
+        self.assertEqual(snapshot['primary']['requests'], 1)
+        self.assertEqual(snapshot['primary']['errors'], 0)
+        self.assertEqual(snapshot['shadow']['requests'], 1)
+        self.assertEqual(snapshot['shadow']['errors'], 1)
@@ -0,0 +1,517 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import threading
+
+import mock
+import unittest2
+
+import aversion
+
+# The ASGI entry point requires Python 3
+try:
+    import asyncio
+
+    import aversion_asgi
+except (ImportError, SyntaxError):
+    aversion_asgi = None
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def done(result=None):
+    future = asyncio.Future()
+    future.set_result(result)
+    return future
+
+
+class FakeConnection(object):
+    def __init__(self, *messages):
+        self.messages = list(messages)
+        self.sent = []
+
+    def receive(self):
+        if self.messages:
+            return done(self.messages.pop(0))
+        return done({'type': 'http.disconnect'})
+
+    def send(self, message):
+        self.sent.append(message)
+        return done()
+
+    @property
+    def status(self):
+        return self.sent[0]['status']
+
+    @property
+    def headers(self):
+        return dict(self.sent[0]['headers'])
+
+    @property
+    def body(self):
+        return b''.join(message.get('body', b'')
+                        for message in self.sent[1:])
+
+
+class LoopThreadMixin(object):
+    def start_loop(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.addCleanup(stop)
+
+        return loop
+
+
+@unittest2.skipIf(aversion_asgi is None, "ASGI requires Python 3")
+class VersionPoolTest(unittest2.TestCase):
+    def test_init(self):
+        pool = aversion_asgi.VersionPool('v1', 3, 5)
+        self.addCleanup(pool.shutdown)
+
+        self.assertEqual(pool.version, 'v1')
+        self.assertEqual(pool.threads, 3)
+        self.assertEqual(pool.queue_size, 5)
+        self.assertEqual(pool.response.status, '503 Service Unavailable')
+        self.assertIn(('Retry-After', '1'), pool.response.headers)
+
+    def test_full(self):
+        pool = aversion_asgi.VersionPool('v1', 1, 1)
+        self.addCleanup(pool.shutdown)
+
+        self.assertFalse(pool.full())
+        pool.queued = 1
+        self.assertTrue(pool.full())
+        self.assertEqual(pool.rejected, 1)
+
+    def test_full_unlimited(self):
+        pool = aversion_asgi.VersionPool('v1', 1)
+        self.addCleanup(pool.shutdown)
+        pool.queued = 100
+
+        self.assertFalse(pool.full())
+        self.assertEqual(pool.rejected, 0)
+
+    def test_run(self):
+        pool = aversion_asgi.VersionPool('v1', 2)
+        self.addCleanup(pool.shutdown)
+        names = []
+
+        def func():
+            names.append(threading.current_thread().name)
+            self.assertEqual(pool.active, 1)
+            self.assertEqual(pool.queued, 0)
+            return 'result'
+
+        result = run(pool.run(func))
+
+        self.assertEqual(result, 'result')
+        self.assertTrue(names[0].startswith('aversion-v1'))
+        self.assertEqual(pool.snapshot(), dict(
+            threads=2,
+            active=0,
+            queued=0,
+            max_queued=1,
+            completed=1,
+            rejected=0,
+        ))
+
+    def test_run_error(self):
+        pool = aversion_asgi.VersionPool('v1', 2)
+        self.addCleanup(pool.shutdown)
+
+        def func():
+            raise ValueError('failed')
+
+        self.assertRaises(ValueError, run, pool.run(func))
+        self.assertEqual(pool.active, 0)
+        self.assertEqual(pool.completed, 1)
+
+
+@unittest2.skipIf(aversion_asgi is None, "ASGI requires Python 3")
+class RequestBodyTest(unittest2.TestCase, LoopThreadMixin):
+    def make_body(self, *chunks):
+        conn = FakeConnection(*[
+            {'type': 'http.request', 'body': chunk,
+             'more_body': i < len(chunks) - 1}
+            for i, chunk in enumerate(chunks)
+        ])
+        body = aversion_asgi.RequestBody(conn.receive, self.start_loop())
+        return body, conn
+
+    def test_read(self):
+        body, conn = self.make_body(b'abc', b'def', b'ghi')
+
+        self.assertEqual(body.read(4), b'abcd')
+        self.assertEqual(len(conn.messages), 1)
+        self.assertEqual(body.read(), b'efghi')
+        self.assertEqual(body.read(), b'')
+        self.assertEqual(body.read(1), b'')
+
+    def test_readline(self):
+        body, conn = self.make_body(b'ab', b'c\nde', b'f\ng')
+
+        self.assertEqual(body.readline(), b'abc\n')
+        self.assertEqual(body.readline(2), b'de')
+        self.assertEqual(body.readlines(), [b'f\n', b'g'])
+
+    def test_disconnect(self):
+        conn = FakeConnection({'type': 'http.request', 'body': b'abc',
+                               'more_body': True})
+        body = aversion_asgi.RequestBody(conn.receive, self.start_loop())
+
+        self.assertEqual(body.read(), b'abc')
+
+
+@unittest2.skipIf(aversion_asgi is None, "ASGI requires Python 3")
+class WSGIRunnerTest(unittest2.TestCase, LoopThreadMixin):
+    def test_call(self):
+        def app(environ, start_response):
+            start_response('201 Created', [('X-Foo', 'bar')])
+            return [b'abc', b'', b'def']
+        conn = FakeConnection()
+        runner = aversion_asgi.WSGIRunner(app, {}, conn.send,
+                                          self.start_loop())
+
+        runner()
+
+        self.assertTrue(runner.started)
+        self.assertEqual(conn.sent, [
+            {'type': 'http.response.start', 'status': 201,
+             'headers': [(b'x-foo', b'bar')]},
+            {'type': 'http.response.body', 'body': b'abc',
+             'more_body': True},
+            {'type': 'http.response.body', 'body': b'def',
+             'more_body': True},
+            {'type': 'http.response.body', 'body': b''},
+        ])
+
+    def test_call_empty(self):
+        closed = []
+
+        class Iterable(list):
+            def close(self):
+                closed.append(True)
+
+        def app(environ, start_response):
+            start_response('204 No Content', [])
+            return Iterable()
+        conn = FakeConnection()
+        runner = aversion_asgi.WSGIRunner(app, {}, conn.send,
+                                          self.start_loop())
+
+        runner()
+
+        self.assertEqual(conn.status, 204)
+        self.assertEqual(conn.body, b'')
+        self.assertEqual(closed, [True])
+
+    def test_call_write(self):
+        def app(environ, start_response):
+            write = start_response('200 OK', [])
+            write(b'written')
+            return []
+        conn = FakeConnection()
+        runner = aversion_asgi.WSGIRunner(app, {}, conn.send,
+                                          self.start_loop())
+
+        runner()
+
+        self.assertEqual(conn.body, b'written')
+
+    def test_call_error(self):
+        def app(environ, start_response):
+            raise ValueError('failed')
+        conn = FakeConnection()
+        runner = aversion_asgi.WSGIRunner(app, {}, conn.send,
+                                          self.start_loop())
+
+        self.assertRaises(ValueError, runner)
+        self.assertFalse(runner.started)
+        self.assertEqual(conn.sent, [])
+
+
+@unittest2.skipIf(aversion_asgi is None, "ASGI requires Python 3")
+class BuildEnvironTest(unittest2.TestCase):
+    def test_basic(self):
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': 'POST',
+            'scheme': 'https',
+            'path': '/api/v1/caf\xe9',
+            'root_path': '/api',
+            'query_string': b'a=1',
+            'server': ('example.com', 443),
+            'client': ('10.0.0.1', 12345),
+            'headers': [
+                (b'host', b'example.com'),
+                (b'content-type', b'text/plain'),
+                (b'content-length', b'4'),
+                (b'accept', b'a/a'),
+                (b'Accept', b'b/b'),
+                (b'cookie', b'a=1'),
+                (b'cookie', b'b=2'),
+            ],
+        }
+
+        result = aversion_asgi.build_environ(scope, 'body')
+
+        self.assertEqual(result['REQUEST_METHOD'], 'POST')
+        self.assertEqual(result['SCRIPT_NAME'], '/api')
+        self.assertEqual(result['PATH_INFO'], '/v1/caf\xc3\xa9')
+        self.assertEqual(result['QUERY_STRING'], 'a=1')
+        self.assertEqual(result['SERVER_NAME'], 'example.com')
+        self.assertEqual(result['SERVER_PORT'], '443')
+        self.assertEqual(result['SERVER_PROTOCOL'], 'HTTP/1.1')
+        self.assertEqual(result['REMOTE_ADDR'], '10.0.0.1')
+        self.assertEqual(result['wsgi.url_scheme'], 'https')
+        self.assertEqual(result['wsgi.input'], 'body')
+        self.assertTrue(result['wsgi.input_terminated'])
+        self.assertEqual(result['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(result['CONTENT_LENGTH'], '4')
+        self.assertEqual(result['HTTP_HOST'], 'example.com')
+        self.assertEqual(result['HTTP_ACCEPT'], 'a/a,b/b')
+        self.assertEqual(result['HTTP_COOKIE'], 'a=1; b=2')
+
+    def test_defaults(self):
+        result = aversion_asgi.build_environ({'path': '/'}, None)
+
+        self.assertEqual(result['REQUEST_METHOD'], 'GET')
+        self.assertEqual(result['SCRIPT_NAME'], '')
+        self.assertEqual(result['PATH_INFO'], '/')
+        self.assertEqual(result['SERVER_NAME'], 'localhost')
+        self.assertEqual(result['SERVER_PORT'], '80')
+        self.assertNotIn('REMOTE_ADDR', result)
+
+
+@unittest2.skipIf(aversion_asgi is None, "ASGI requires Python 3")
+class BuildScopeTest(unittest2.TestCase):
+    def test_build(self):
+        scope = {
+            'type': 'http',
+            'path': '/v1/foo.json',
+            'raw_path': b'/v1/foo.json',
+            'root_path': '',
+            'headers': [(b'host', b'example.com'), (b'accept', b'*/*')],
+        }
+        environ = {
+            'SCRIPT_NAME': '/v1',
+            'PATH_INFO': '/foo',
+            'HTTP_ACCEPT': 'a/a;q=1.0',
+            'aversion.version': 'v1',
+            'REQUEST_METHOD': 'GET',
+        }
+
+        result = aversion_asgi.build_scope(scope, environ)
+
+        self.assertEqual(result, {
+            'type': 'http',
+            'path': '/v1/foo',
+            'root_path': '/v1',
+            'headers': [(b'host', b'example.com'),
+                        (b'accept', b'a/a;q=1.0')],
+            'aversion': {'aversion.version': 'v1'},
+        })
+        self.assertEqual(scope['path'], '/v1/foo.json')
+
+
+@unittest2.skipIf(aversion_asgi is None, "ASGI requires Python 3")
+class AVersionASGITest(unittest2.TestCase):
+    def construct(self, conf, **kwargs):
+        def version1(environ, start_response):
+            start_response('200 OK', [('X-Thread',
+                                       threading.current_thread().name)])
+            return [b'version1:', environ['wsgi.input'].read()]
+
+        apps = dict(version1_app=version1)
+        conf['version.v1'] = 'version1_app'
+        conf['uri./v1'] = 'v1'
+        conf['uri./v2'] = 'v2'
+        loader = mock.Mock(**{'get_app.side_effect': lambda x: apps[x]})
+        avers = aversion.AVersion(loader, {}, **conf)
+
+        self.native_scopes = []
+
+        def native(scope, receive, send):
+            self.native_scopes.append(scope)
+            send({'type': 'http.response.start', 'status': 200,
+                  'headers': []})
+            send({'type': 'http.response.body', 'body': b'native'})
+            return done()
+
+        bridge = aversion_asgi.AVersionASGI(avers, dict(v2=native),
+                                            **kwargs)
+        self.addCleanup(bridge.shutdown)
+        return bridge
+
+    def request(self, bridge, path, method='GET', body=b'', **kwargs):
+        scope = dict(type='http', method=method, path=path,
+                     headers=[(b'host', b'example.com')])
+        scope.update(kwargs)
+        conn = FakeConnection({'type': 'http.request', 'body': body})
+        run(bridge(scope, conn.receive, conn.send))
+        return conn
+
+    def test_init(self):
+        bridge = self.construct({}, threads=dict(v1=3),
+                                queue_sizes=dict(v1=7), default_threads=4)
+
+        self.assertEqual(list(bridge.pools.keys()), ['v1'])
+        self.assertEqual(bridge.pools['v1'].threads, 3)
+        self.assertEqual(bridge.pools['v1'].queue_size, 7)
+        self.assertEqual(bridge.default_pool.threads, 4)
+        self.assertEqual(bridge.default_pool.queue_size, None)
+        self.assertIsInstance(bridge.aversion.versions['v2']['app'],
+                              aversion_asgi.NativeApp)
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_native_limits(self, mock_warn):
+        bridge = self.construct({
+            'version.v2': 'version1_app',
+            'limit.v2': 'concurrency="1"',
+        })
+
+        self.assertNotIn('v2', bridge.pools)
+        mock_warn.assert_called_once_with(
+            "limit.v2: Not applied to native ASGI application")
+
+    @mock.patch.object(aversion.LOG, 'warn')
+    def test_init_native_cache(self, mock_warn):
+        self.construct({
+            'version.v2': 'version1_app',
+            'cache.v2': 'size="10"',
+            'coalesce.v2': '',
+            'compress': 'gzip',
+        })
+
+        mock_warn.assert_has_calls([
+            mock.call("cache.v2: Not applied to native ASGI application"),
+            mock.call("coalesce.v2: Not applied to native ASGI application"),
+            mock.call("compress: Not applied to native ASGI applications"),
+        ])
+        self.assertEqual(mock_warn.call_count, 3)
+
+    def test_wsgi(self):
+        bridge = self.construct({})
+
+        conn = self.request(bridge, '/v1/foo', 'POST', b'body')
+
+        self.assertEqual(conn.status, 200)
+        self.assertEqual(conn.body, b'version1:body')
+        self.assertTrue(conn.headers[b'x-thread'].startswith(b'aversion-v1'))
+        self.assertEqual(bridge.pools['v1'].completed, 1)
+        self.assertEqual(bridge.default_pool.completed, 0)
+
+    def test_native(self):
+        bridge = self.construct({})
+
+        conn = self.request(bridge, '/v2/foo')
+
+        self.assertEqual(conn.body, b'native')
+        self.assertEqual(len(self.native_scopes), 1)
+        scope = self.native_scopes[0]
+        self.assertEqual(scope['root_path'], '/v2')
+        self.assertEqual(scope['path'], '/v2/foo')
+        self.assertEqual(
+            aversion.environ_get(scope['aversion'], 'aversion.version'),
+            'v2')
+
+    def test_native_vary(self):
+        bridge = self.construct({'type.application/json': 'version:"v2"'})
+
+        conn = self.request(bridge, '/foo', headers=[
+            (b'host', b'example.com'),
+            (b'accept', b'application/json'),
+        ])
+
+        self.assertEqual(conn.body, b'native')
+        self.assertEqual(conn.headers[b'vary'], b'Content-Type, Accept')
+
+    def test_default_pool(self):
+        bridge = self.construct({})
+
+        conn = self.request(bridge, '/')
+
+        self.assertEqual(conn.status, 500)
+        self.assertEqual(bridge.default_pool.completed, 1)
+
+    def test_queue_full(self):
+        bridge = self.construct({}, queue_sizes=dict(v1=0))
+
+        conn = self.request(bridge, '/v1/foo')
+
+        self.assertEqual(conn.status, 503)
+        self.assertEqual(bridge.pools['v1'].rejected, 1)
+        self.assertEqual(bridge.pools['v1'].completed, 0)
+
+    @mock.patch.object(aversion.LOG, 'exception')
+    def test_error(self, mock_exception):
+        bridge = self.construct({})
+
+        def version1(environ, start_response):
+            raise ValueError('failed')
+        bridge.aversion.versions['v1']['app'] = version1
+
+        conn = self.request(bridge, '/v1/foo')
+
+        self.assertEqual(conn.status, 500)
+        mock_exception.assert_called_once_with(
+            "Error running WSGI application for version v1")
+
+    def test_metrics(self):
+        bridge = self.construct({'metrics_path': '/metrics'})
+        self.request(bridge, '/v1/foo')
+
+        conn = self.request(bridge, '/metrics')
+
+        metrics = json.loads(conn.body.decode('utf-8'))
+        self.assertEqual(metrics['pools']['v1']['completed'], 1)
+        self.assertEqual(metrics['default_pool']['completed'], 0)
+        self.assertIn('fallbacks', metrics)
+
+    def test_websocket(self):
+        bridge = self.construct({})
+
+        conn = self.request(bridge, '/v1/foo', type='websocket')
+
+        self.assertEqual(conn.sent, [{'type': 'websocket.close'}])
+
+    def test_lifespan(self):
+        bridge = self.construct({})
+        conn = FakeConnection({'type': 'lifespan.startup'},
+                              {'type': 'lifespan.shutdown'})
+
+        with mock.patch.object(bridge, 'shutdown') as mock_shutdown:
+            run(bridge({'type': 'lifespan'}, conn.receive, conn.send))
+
+        self.assertEqual(conn.sent, [
+            {'type': 'lifespan.startup.complete'},
+            {'type': 'lifespan.shutdown.complete'},
+        ])
+        mock_shutdown.assert_called_once_with()